@@ -1,19 +1,19 @@
-import boto3
 import json
+import time
 
 from os import environ
 
+import spoptimize.aws_clients as aws_clients
+import spoptimize.sfn_helper as sfn_helper
 import spoptimize.spot_warning as spot_warning
 import spoptimize.stepfns as stepfns
 import spoptimize.stepfn_strings as strs
 import spoptimize.util as util
-from spoptimize.logging_helper import logging
+from spoptimize.logging_helper import LazyJson, StructuredMessage, logging, set_log_context, setup_json_handlers
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-sfn = boto3.client('stepfunctions')
-
 
 class InstancePending(Exception):
     pass
@@ -23,120 +23,467 @@ class GroupLocked(Exception):
     pass
 
 
-def handler(event, context):
-    logger.debug('EVENT: {}'.format(json.dumps(event, indent=2, default=util.json_dumps_converter)))
-    action = environ.get('SPOPTIMIZE_ACTION').lower()
-    if not action:
-        raise Exception('SPOPTIMIZE_ACTION env var is not set')
-    if environ.get('SPOPTIMIZE_DEBUG', 'false').lower() not in ['0', 'no', 'false']:
-        logger.setLevel(logging.DEBUG)
+def sns_messages(records):
+    '''
+    Yields the decoded message of each SNS record; undecodable records are logged and skipped
+    '''
+    for record in records:
+        if 'Sns' in record and 'Message' in record['Sns']:
+            try:
+                yield json.loads(record['Sns']['Message'])
+            except ValueError:
+                logger.error('Unable to decode SNS message: {}'.format(record['Sns']['Message']))
+
+
+def timings_table():
+    '''
+    Returns the DynamoDB table observed timings are recorded in; None if adaptive waits are disabled
+    '''
+    if environ.get('SPOPTIMIZE_ADAPTIVE_WAITS', 'false').lower() not in ['0', 'no', 'false']:
+        return environ['SPOPTIMIZE_LOCK_TABLE']
+    return None
+
+
+def spot_fulfillment_events():
+    '''
+    Returns True if the spot fulfillment function is deployed to resume executions from EC2 events
+    '''
+    return environ.get('SPOPTIMIZE_SPOT_FULFILLMENT_EVENTS', 'false').lower() not in ['0', 'no', 'false']
+
+
+def lock_name(event):
+    '''
+    Returns the name of the lock (swap slot) held by the execution processing event
+    '''
+    # executions started before swap slots were introduced hold the group's lock, recorded as True
+    if event.get('asg_lock') and event['asg_lock'] is not True:
+        return event['asg_lock']
+    return event['autoscaling_group']['AutoScalingGroupName']
+
+
+def execution_arn(event):
+    '''
+    Returns the ARN of the execution processing event, generated from the state machine ARN
+    '''
+    my_arn = environ['SPOPTIMIZE_SFN_ARN'].split(':')
+    my_arn[5] = 'execution'
+    my_arn.append(event['ondemand_instance_id'])
+    return ':'.join(my_arn)
+
+
+# action name -> function of the execution's state
+actions = {}
+# action name -> AWS API calls it may make per invocation (see aws_clients.over_budget)
+api_budgets = {}
+
+
+def action(name, api_budget=None):
+    '''
+    Registers the decorated function as the handler of action name, allowed the API calls of api_budget
+    '''
+    def register(func):
+        actions[name] = func
+        if api_budget is not None:
+            api_budgets[name] = api_budget
+        return func
+    return register
+
+
+# functions of an action's input that API budgets scale with
+def batch_size(event):
+    return len(event.get('ondemand_instance_ids') or [None])
+
+
+def spot_request_count(event):
+    return len(event.get('spot_request', {}).get('SpotInstanceRequestIds') or [None])
+
+
+def swap_slots(event):
+    return event.get('max_concurrent_swaps', 1)
+
+
+def record_count(event):
+    return len(event.get('Records', []))
+
+
+def log_api_usage(name, event):
+    '''
+    Logs the AWS API calls made by the invocation of name, with a warning if they exceed its budget
+    Returns a dict mapping each operation called more often than allowed to a tuple of its calls & allowance
+    '''
+    usage = aws_clients.get_usage()
+    logger.info(StructuredMessage('AWS API usage of {}'.format(name), api_usage={
+        'calls': sum([x['calls'] for x in usage.values()]),
+        'retries': sum([x['retries'] for x in usage.values()]),
+        'ms': round(sum([x['ms'] for x in usage.values()]), 1),
+        'operations': dict([(k, dict(v, ms=round(v['ms'], 1))) for (k, v) in usage.items()])
+    }))
+    if name not in api_budgets:
+        return {}
+    exceeded = aws_clients.over_budget(dict([(k, v['calls']) for (k, v) in usage.items()]), api_budgets[name], event)
+    if exceeded:
+        logger.warning('{0} exceeded its AWS API budget: {1}'.format(name, ', '.join(
+            ['{0} {1}/{2}'.format(k, v[0], v[1]) for (k, v) in sorted(exceeded.items())])))
+    return exceeded
+
+
+# Process an autoscaling launch event via SNS; Start execution of step fns
+@action('start-state-machine', api_budget={
+    'autoscaling.describe_auto_scaling_groups': record_count,
+    'dynamodb.get_item': record_count,
+    # joining or opening a replacement batch is attempted twice; joining updates the batch & its members
+    'dynamodb.put_item': lambda event: 2 * record_count(event),
+    'dynamodb.update_item': lambda event: 3 * record_count(event),
+    'stepfunctions.start_execution': record_count
+})
+def start_state_machine(event):
+    init_states = stepfns.init_machine_states(sns_messages(event.get('Records', [])), timings_table())
+    if not spot_fulfillment_events():
+        # nothing would resume executions awaiting fulfillment events, so they poll instead
+        for init_state in init_states:
+            init_state['spot_fulfillment_events'] = False
+    # instances that joined a replacement batch are replaced by the batch leader's execution
+    init_states = [x for x in init_states if stepfns.join_replacement_batch(environ['SPOPTIMIZE_LOCK_TABLE'], x)]
+    retval = sfn_helper.start_executions(environ['SPOPTIMIZE_SFN_ARN'], init_states,
+                                         int(environ.get('SPOPTIMIZE_START_CONCURRENCY', 0)))
+    failures = sfn_helper.failed_executions(retval)
+    if failures:
+        # Executions are named after the instance id, so a retry only restarts the failed ones
+        raise Exception('Unable to start {0} of {1} execution(s): {2}'.format(
+            len(failures), len(retval), ', '.join([x['ondemand_instance_id'] for x in failures])))
+    return retval
+
+
+# Increment Count (the state machine now increments in-state; kept for executions started by older definitions,
+# which invoke the legacy increment-count function)
+@action('increment-count', api_budget={})
+def increment_count(event):
+    return int(event['iteration_count']) + 1
+
+
+# Load Replacement Batch
+@action('load-batch', api_budget={'dynamodb.get_item': 1})
+def load_batch(event):
+    return stepfns.load_replacement_batch(environ['SPOPTIMIZE_LOCK_TABLE'], event['ondemand_instance_id'])
+
+
+# Test New ASG Instance
+@action('ondemand-instance-healthy', api_budget={
+    # the group is described again after protecting each instance
+    'autoscaling.describe_auto_scaling_groups': lambda event: batch_size(event) + 2,
+    'autoscaling.set_instance_protection': batch_size,
+    # the group's lock is taken (over) & released around protecting instances, each failed write reading the lock's
+    # holder; one timing is recorded
+    'dynamodb.get_item': 3,
+    'dynamodb.put_item': 4,
+    'dynamodb.update_item': 1,
+    'dynamodb.delete_item': 1,
+    'stepfunctions.describe_execution': 1,
+    'stepfunctions.send_task_success': 1
+})
+def ondemand_instance_healthy(event):
+    instance_ids = event.get('ondemand_instance_ids') or [event['ondemand_instance_id']]
+    prot_inst_res = stepfns.protected_instances(
+        event['autoscaling_group']['AutoScalingGroupName'], instance_ids,
+        event['min_protected_instances'], environ['SPOPTIMIZE_LOCK_TABLE'], execution_arn(event)
+    )
+    if prot_inst_res == strs.unable_to_acquire_lock:
+        raise GroupLocked('Unable to acquire lock')
+    retval = stepfns.asg_instances_state(event['autoscaling_group'], instance_ids)
+    if retval == 'Pending':
+        raise InstancePending('{} is not online and/or healthy'.format(', '.join(instance_ids)))
+    if retval == strs.asg_instance_healthy and timings_table() and event.get('launched_at') \
+            and not event['iteration_count']:
+        stepfns.record_timing(timings_table(), event['autoscaling_group'], 'ondemand_healthy',
+                              int(time.time()) - event['launched_at'])
+    return retval
+
+
+# Request Spot Instance
+@action('request-spot', api_budget={
+    'autoscaling.describe_auto_scaling_groups': 2,
+    'autoscaling.describe_launch_configurations': 1,
+    'iam.get_instance_profile': 1,
+    'ec2.describe_security_groups': 1,
+    'ec2.request_spot_instances': 1,
+    # the persisted launch specification
+    'dynamodb.get_item': 1,
+    'dynamodb.put_item': 1,
+    'dynamodb.delete_item': 1
+})
+def request_spot(event):
+    client_token = '{0}-{1}'.format(event['ondemand_instance_id'], event['iteration_count'])
+    spec_table = None
+    if environ.get('SPOPTIMIZE_PERSIST_LAUNCH_SPECS', 'false').lower() not in ['0', 'no', 'false']:
+        spec_table = environ['SPOPTIMIZE_LOCK_TABLE']
+    if event.get('ondemand_instance_ids'):
+        return stepfns.request_spot_instances(event['autoscaling_group'], event['launch_az'],
+                                              event.get('launch_subnet_id'), event['ondemand_instance_ids'],
+                                              client_token, spec_table)
+    return stepfns.request_spot_instance(event['autoscaling_group'], event['launch_az'],
+                                         event.get('launch_subnet_id'), client_token, spec_table)
+
+
+# Check Spot Request
+@action('check-spot', api_budget={
+    'ec2.describe_spot_instance_requests': 1,
+    'ec2.describe_instances': 1,
+    'dynamodb.get_item': 1,
+    'dynamodb.put_item': 1
+})
+def check_spot(event):
+    retval = stepfns.spot_request_result(event['spot_request'])
+    if retval not in [strs.spot_request_pending, strs.spot_request_failure, strs.asg_instance_terminated] \
+            and timings_table() and event.get('spot_requested_at'):
+        stepfns.record_timing(timings_table(), event['autoscaling_group'], 'spot_fulfillment',
+                              int(time.time()) - util.epoch_seconds(event['spot_requested_at']['timestamp']))
+    return retval
+
+
+# Wait For Spot Fulfillment (invoked with a task token; the execution resumes via send_task_success)
+@action('await-spot', api_budget={
+    'dynamodb.put_item': spot_request_count,
+    'dynamodb.delete_item': spot_request_count,
+    'ec2.describe_spot_instance_requests': 1,
+    'ec2.describe_instances': 1,
+    'stepfunctions.send_task_success': 1
+})
+def await_spot(event):
+    return stepfns.await_spot_request(environ['SPOPTIMIZE_LOCK_TABLE'], event['spot_request'], event['task_token'])
+
+
+# AutoScaling Group Disappeared
+@action('term-spot-instance', api_budget={'ec2.terminate_instances': 1, 'dynamodb.batch_write_item': 1})
+def term_spot_instance(event):
+    retval = stepfns.terminate_ec2_instance(event.get('spot_request_result'))
+    # the spot instances may have been attached (& registered) before their group disappeared
+    instance_ids = event.get('spot_request_result')
+    if instance_ids:
+        stepfns.deregister_spot_instances(environ['SPOPTIMIZE_LOCK_TABLE'],
+                                          instance_ids if isinstance(instance_ids, list) else [instance_ids])
+    return retval
+
+
+# Acquire AutoScaling Group Lock
+@action('acquire-lock', api_budget={
+    'autoscaling.describe_auto_scaling_groups': 1,
+    # each swap slot is tried, and a lock written before leases were introduced is taken over by a second put;
+    # each failed put reads the slot's holder
+    'dynamodb.get_item': lambda event: 2 * swap_slots(event),
+    'dynamodb.put_item': lambda event: 2 * swap_slots(event),
+    'stepfunctions.describe_execution': swap_slots
+})
+def acquire_lock(event):
+    # the lease must outlast the wait for the attached instances; health checks renew it from then on
+    retval = stepfns.acquire_swap_slot(environ['SPOPTIMIZE_LOCK_TABLE'],
+                                       event['autoscaling_group']['AutoScalingGroupName'],
+                                       execution_arn(event), event.get('max_concurrent_swaps', 1),
+                                       event.get('spot_attach_sleep_interval', 0) + stepfns.lock_lease_seconds)
+    if retval:
+        return retval
+    raise GroupLocked('Unable to acquire lock')
+
+
+# Release AutoScaling Group Lock
+@action('release-lock', api_budget={
+    # the lock is handed over to the first waiter still waiting; one waiter that no longer waits is tolerated. A swap
+    # slot is only handed over within the group's spare capacity
+    'autoscaling.describe_auto_scaling_groups': 1,
+    # the queue's first waiter is read before each hand-over, which reads the lock's holder if it fails
+    'dynamodb.get_item': 3,
+    'dynamodb.update_item': 2,
+    'dynamodb.put_item': 2,
+    'dynamodb.delete_item': 1,
+    'stepfunctions.send_task_success': 2
+})
+def release_lock(event):
+    return stepfns.release_lock(environ['SPOPTIMIZE_LOCK_TABLE'], event['autoscaling_group']['AutoScalingGroupName'],
+                                execution_arn(event), lock_name(event))
+
+
+# Wait For AutoScaling Group Lock (invoked with a task token; the execution resumes via send_task_success)
+@action('await-lock', api_budget={
+    # a lock acquired while being handed another is released, handing it over to the next waiter
+    'autoscaling.describe_auto_scaling_groups': 2,
+    'dynamodb.get_item': lambda event: 2 * swap_slots(event) + 3,
+    'dynamodb.update_item': 3,
+    'dynamodb.put_item': lambda event: 2 * swap_slots(event) + 1,
+    'dynamodb.delete_item': 1,
+    'stepfunctions.describe_execution': swap_slots,
+    'stepfunctions.send_task_success': 1
+})
+def await_lock(event):
+    return stepfns.await_lock(environ['SPOPTIMIZE_LOCK_TABLE'], event['autoscaling_group']['AutoScalingGroupName'],
+                              execution_arn(event), event['task_token'], event.get('max_concurrent_swaps', 1),
+                              event.get('spot_attach_sleep_interval', 0) + stepfns.lock_lease_seconds)
+
+
+# Attach Spot Instance
+@action('attach-spot', api_budget={
+    'autoscaling.describe_auto_scaling_groups': 1,
+    'ec2.create_tags': batch_size,
+    # a batch that fails as a whole is attached one instance at a time
+    'autoscaling.attach_instances': lambda event: batch_size(event) + 1,
+    'autoscaling.terminate_instance_in_auto_scaling_group': batch_size,
+    'ec2.terminate_instances': 1,
+    'dynamodb.batch_write_item': 2
+})
+def attach_spot(event):
+    if isinstance(event['spot_request_result'], list):
+        retval = stepfns.attach_spot_instances(event['autoscaling_group'], event['spot_request_result'],
+                                               event['spot_request']['OnDemandInstanceIds'])
+        attached_ids = retval if isinstance(retval, list) else []
     else:
-        logger.setLevel(logging.INFO)
-    retval = None
-
-    # Process an autoscaling launch event via SNS; Start execution of step fns
-    if action == 'start-state-machine':
-        state_machine_arn = environ['SPOPTIMIZE_SFN_ARN']
-        step_fn_resps = []
-        for record in event['Records']:
-            if 'Sns' in record and 'Message' in record['Sns']:
-                (init_state, msg) = stepfns.init_machine_state(json.loads(record['Sns']['Message']))
-                if init_state.get('autoscaling_group'):
-                    logger.debug('Starting execution of {0} with name {1}'.format(state_machine_arn, init_state['ondemand_instance_id']))
-                    logger.debug('Input: {}'.format(json.dumps(init_state, indent=2, default=util.json_dumps_converter)))
-                    # NOTE: execution ARN is used for locks. if name changes, update lock acquisition & release
-                    step_fn_resps.append(sfn.start_execution(
-                        stateMachineArn=state_machine_arn,
-                        name=init_state['ondemand_instance_id'],
-                        input=json.dumps(init_state, indent=2, default=util.json_dumps_converter)
-                    ))
-                else:
-                    logger.error('Aborting executing: {}'.format(msg))
-        retval = step_fn_resps
-
-    # Increment Count
-    elif action == 'increment-count':
-        retval = int(event['iteration_count']) + 1
-
-    # Test New ASG Instance
-    elif action == 'ondemand-instance-healthy':
-        # Generate execution ARN from state machine ARN
-        my_arn = environ['SPOPTIMIZE_SFN_ARN'].split(':')
-        my_arn[5] = 'execution'
-        my_arn.append(event['ondemand_instance_id'])
-        prot_inst_res = stepfns.protected_instance(
-            event['autoscaling_group']['AutoScalingGroupName'], event['ondemand_instance_id'],
-            event['min_protected_instances'], environ['SPOPTIMIZE_LOCK_TABLE'], ':'.join(my_arn)
-        )
-        if prot_inst_res == strs.unable_to_acquire_lock:
-            raise GroupLocked('Unable to acquire lock')
-        retval = stepfns.asg_instance_state(event['autoscaling_group'], event['ondemand_instance_id'])
-        if retval == 'Pending':
-            raise InstancePending('{} is not online and/or healthy'.format(event['ondemand_instance_id']))
-
-    # Request Spot Instance
-    elif action == 'request-spot':
-        client_token = '{0}-{1}'.format(event['ondemand_instance_id'], event['iteration_count'])
-        retval = stepfns.request_spot_instance(event['autoscaling_group'], event['launch_az'],
-                                               event.get('launch_subnet_id'), client_token)
-
-    # Check Spot Request
-    elif action == 'check-spot':
-        if event['spot_request'].get('SpoptimizeError'):
-            logger.info('Spot request error'.format(event['spot_request']['SpoptimizeError']))
-            retval = 'Failure'
-        else:
-            retval = stepfns.get_spot_request_status(event['spot_request']['SpotInstanceRequestId'])
-
-    # AutoScaling Group Disappeared
-    elif action == 'term-spot-instance':
-        retval = stepfns.terminate_ec2_instance(event.get('spot_request_result'))
-
-    # Acquire AutoScaling Group Lock
-    elif action == 'acquire-lock':
-        # Generate execution ARN from state machine ARN
-        my_arn = environ['SPOPTIMIZE_SFN_ARN'].split(':')
-        my_arn[5] = 'execution'
-        my_arn.append(event['ondemand_instance_id'])
-        if stepfns.acquire_lock(environ['SPOPTIMIZE_LOCK_TABLE'],
-                                event['autoscaling_group']['AutoScalingGroupName'],
-                                ':'.join(my_arn)):
-            retval = True
-        else:
-            raise GroupLocked('Unable to acquire lock')
-
-    # Release AutoScaling Group Lock
-    elif action == 'release-lock':
-        # Generate execution ARN from state machine ARN
-        my_arn = environ['SPOPTIMIZE_SFN_ARN'].split(':')
-        my_arn[5] = 'execution'
-        my_arn.append(event['ondemand_instance_id'])
-        retval = stepfns.release_lock(environ['SPOPTIMIZE_LOCK_TABLE'],
-                                      event['autoscaling_group']['AutoScalingGroupName'],
-                                      ':'.join(my_arn))
-
-    # Attach Spot Instance
-    elif action == 'attach-spot':
-        retval = stepfns.attach_spot_instance(event['autoscaling_group'], event['spot_request_result'], event['ondemand_instance_id'])
-
-    # Test Attached Instance
-    elif action == 'spot-instance-healthy':
-        retval = stepfns.asg_instance_state(event['autoscaling_group'], event['spot_request_result'])
-        if retval == 'Pending':
-            raise InstancePending('{} is not online and/or healthy'.format(event['spot_request_result']))
+        retval = stepfns.attach_spot_instance(event['autoscaling_group'], event['spot_request_result'],
+                                              event['ondemand_instance_id'])
+        attached_ids = [event['spot_request_result']] if retval == strs.success else []
+    if attached_ids:
+        stepfns.register_spot_instances(environ['SPOPTIMIZE_LOCK_TABLE'],
+                                        event['autoscaling_group']['AutoScalingGroupName'], attached_ids)
+    return retval
 
+
+# Test Attached Instance
+@action('spot-instance-healthy', api_budget={
+    'autoscaling.describe_auto_scaling_groups': 1,
+    # the lock's holder is read if renewing fails; one timing is recorded
+    'dynamodb.get_item': 2,
+    'dynamodb.put_item': 2
+})
+def spot_instance_healthy(event):
+    stepfns.renew_lock(environ['SPOPTIMIZE_LOCK_TABLE'], lock_name(event), execution_arn(event))
+    if isinstance(event.get('spot_attach_result'), list):
+        # a replacement batch succeeds only once every attached instance is healthy
+        retval = stepfns.asg_instances_state(event['autoscaling_group'], event['spot_attach_result'], require_all=True)
     else:
-        raise Exception('SPOPTIMIZE_ACTION env var specifies unknown action: {}'.format(action))
-    # Replace any instance of datetime.datetime in retval with a string to avoid
-    # 'An error occurred during JSON serialization of response' Exception
-    util.walk_dict_for_datetime(retval)
+        retval = stepfns.asg_instance_state(event['autoscaling_group'], event['spot_request_result'])
+    if retval == 'Pending':
+        raise InstancePending('{} is not online and/or healthy'.format(event['spot_request_result']))
+    if retval == strs.asg_instance_healthy and timings_table() and event.get('spot_attached_at'):
+        stepfns.record_timing(timings_table(), event['autoscaling_group'], 'spot_healthy',
+                              int(time.time()) - util.epoch_seconds(event['spot_attached_at']['timestamp']))
     return retval
 
 
-def spot_warning_handler(event, context):
-    logger.debug('EVENT: {}'.format(json.dumps(event, indent=2, default=util.json_dumps_converter)))
+# the spot fulfillment handler's event names a single spot request, whose waiter may be recorded under up to
+# stepfns.max_batch_size spot request ids
+api_budgets['spot-fulfillment'] = {
+    'dynamodb.get_item': 1,
+    'dynamodb.delete_item': stepfns.max_batch_size,
+    'ec2.describe_instances': 2,
+    'ec2.describe_spot_instance_requests': 1,
+    'stepfunctions.send_task_success': 1
+}
+
+
+def configure_logging():
+    '''
+    Sets the log level, and formats log records as JSON if enabled, per the function's environment
+    '''
     if environ.get('SPOPTIMIZE_DEBUG', 'false').lower() not in ['0', 'no', 'false']:
         logger.setLevel(logging.DEBUG)
     else:
         logger.setLevel(logging.INFO)
-    spot_warning.process_warning_event(event)
+    if environ.get('SPOPTIMIZE_JSON_LOGS', 'false').lower() not in ['0', 'no', 'false']:
+        setup_json_handlers()
+
+
+def state_log_context(state):
+    '''
+    Returns the log context of an action invoked with the execution's state: its group, execution & instance ids
+    '''
+    if not isinstance(state, dict):
+        return {}
+    spot_ids = state.get('spot_attach_result') or state.get('spot_request_result')
+    return {
+        'group': state.get('autoscaling_group', {}).get('AutoScalingGroupName'),
+        # executions are named after the ondemand instance they replace
+        'execution': state.get('ondemand_instance_id'),
+        'instance_ids': state.get('ondemand_instance_ids') or
+        ([state['ondemand_instance_id']] if state.get('ondemand_instance_id') else None),
+        'spot_instance_ids': [x for x in (spot_ids if isinstance(spot_ids, list) else [spot_ids])
+                              if str(x).startswith('i-')] or None
+    }
+
+
+def event_instance_ids(event):
+    '''
+    Returns the instance id of an EC2 event as a list; None if it has none
+    '''
+    instance_id = event.get('detail', {}).get('instance-id') if isinstance(event, dict) else None
+    return [instance_id] if instance_id else None
+
+
+def action_input(event):
+    '''
+    Returns a tuple of the action to invoke and its input, the execution's state
+    '''
+    # The state machine invokes a single function with the action & the execution's state as its input;
+    # functions deployed per action specify it via the SPOPTIMIZE_ACTION env var
+    action = environ.get('SPOPTIMIZE_ACTION', '')
+    if isinstance(event, dict) and 'spoptimize_action' in event:
+        action = event['spoptimize_action']
+        # any other input (e.g. the task token of a callback) is added to the execution's state
+        event = dict(event.get('state', {}), **{k: v for k, v in event.items() if k not in ['spoptimize_action', 'state']})
+    return (action.lower(), event)
+
+
+def handler(event, context):
+    configure_logging()
+    (action, state) = action_input(event)
+    set_log_context(action=action or None, **state_log_context(state))
+    logger.debug('EVENT: %s', LazyJson(event, indent=2))
+    event = state
+    if not action:
+        raise Exception('Neither spoptimize_action nor SPOPTIMIZE_ACTION env var is set')
+    if action not in actions:
+        raise Exception('Unknown action: {}'.format(action))
+    aws_clients.reset_usage()
+    try:
+        retval = actions[action](event)
+    finally:
+        log_api_usage(action, event)
+    # Replace any instance of datetime.datetime in retval with a string to avoid
+    # 'An error occurred during JSON serialization of response' Exception
+    return util.json_safe(retval)
+
+
+def spot_warning_handler(event, context):
+    configure_logging()
+    set_log_context(action='spot-warning', instance_ids=event_instance_ids(event))
+    logger.debug('EVENT: %s', LazyJson(event, indent=2))
+    aws_clients.reset_usage()
+    try:
+        spot_warning.process_warning_event(event, environ.get('SPOPTIMIZE_LOCK_TABLE'))
+    finally:
+        log_api_usage('spot-warning', event)
+
+
+def spot_warning_batch_handler(event, context):
+    configure_logging()
+    set_log_context(action='spot-warning-batch')
+    logger.debug('EVENT: %s', LazyJson(event, indent=2))
+    # warnings are buffered in SQS; each message body is a CloudWatch event
+    events = []
+    for record in event.get('Records', []):
+        try:
+            events.append(json.loads(record['body']))
+        except ValueError:
+            logger.error('Unable to decode SQS message: {}'.format(record['body']))
+    aws_clients.reset_usage()
+    try:
+        spot_warning.process_warning_events(events, environ.get('SPOPTIMIZE_LOCK_TABLE'))
+    finally:
+        log_api_usage('spot-warning-batch', event)
+
+
+def spot_fulfillment_handler(event, context):
+    configure_logging()
+    set_log_context(action='spot-fulfillment', instance_ids=event_instance_ids(event),
+                    spot_request_id=event.get('detail', {}).get('spot-instance-request-id'))
+    logger.debug('EVENT: %s', LazyJson(event, indent=2))
+    aws_clients.reset_usage()
+    try:
+        stepfns.process_spot_event(environ['SPOPTIMIZE_LOCK_TABLE'], event)
+    finally:
+        log_api_usage('spot-fulfillment', event)
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+'''
+Benchmarks each action of handler.handler, and the spot fulfillment handler: wall time, memory allocated and AWS API
+calls per invocation. Actions are measured as they're invoked by seeded simulations (see simulation.py) that,
+between them, exercise every action; AWS is replaced by the stand-ins of fake_aws.py.
+
+Results are compared to the baselines stored in benchmark-baselines.json, and the API calls of every invocation to
+the action's budget (see handler.api_budgets); --check exits non-zero on a regression or an invocation over budget.
+API calls & invocations are deterministic; wall times depend on the machine, so re-save baselines when it changes.
+
+    $ python scripts/benchmark-actions.py [-n RUNS] [--operations] [--save] [--check] [--json]
+'''
+
+import argparse
+import collections
+import json
+import logging
+import os
+import platform
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    # python 2.7
+    tracemalloc = None
+
+here = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, here)
+
+import simulation  # noqa: E402
+
+baselines_file = os.path.join(here, 'benchmark-baselines.json')
+timer = getattr(time, 'perf_counter', time.time)
+horizon = 72 * 3600
+
+# seeded simulations that, between them, invoke every action; env is the Lambda environment they run with
+scenarios = collections.OrderedDict([
+    ('steady', {'groups': 2, 'launches': 40, 'duration': 3600}),
+    ('contended', {'groups': 1, 'launches': 30, 'burst': 10, 'duration': 0, 'headroom': 3,
+                   'tags': {'max_concurrent_swaps': '3'}}),
+    ('batched', {'groups': 2, 'launches': 40, 'burst': 5, 'duration': 1800, 'spot_failure_rate': 0.1,
+                 'tags': {'replacement_batch_window': '60', 'spot_fulfillment_events': 'true'},
+                 'env': {'SPOPTIMIZE_SPOT_FULFILLMENT_EVENTS': 'true'}}),
+    ('scale-in', {'groups': 1, 'launches': 20, 'burst': 2, 'duration': 1800, 'scale_in_after': 600}),
+    # the group scales in while spot requests are pending, so their ondemand instances are gone by attach time
+    ('scale-in-pending-spot', {'groups': 1, 'launches': 10, 'burst': 10, 'duration': 0, 'scale_in_after': 900,
+                               'spot_fulfillment_seconds': 600}),
+])
+# actions the state machine no longer invokes, and the input they're benchmarked with
+direct_invocations = {
+    'increment-count': {'spoptimize_action': 'increment-count', 'state': {'iteration_count': 1}}
+}
+# a metric regresses when it exceeds its baseline by more than this fraction
+default_tolerances = {'invocations': 0.0, 'api_calls': 0.001, 'ms_p50': 0.5, 'peak_kib': 0.2}
+
+
+class BenchmarkSimulation(simulation.Simulation):
+    '''
+    Records the wall time (or, with trace_memory, the memory allocated) and the API calls of every invocation,
+    and the operations it called more often than its action's budget allows
+    '''
+
+    def __init__(self, handler, samples, trace_memory=False, **kwargs):
+        super(BenchmarkSimulation, self).__init__(handler, **kwargs)
+        self.samples = samples
+        self.trace_memory = trace_memory
+
+    def run_function(self, name, func, event):
+        calls = dict(self.aws.calls)
+        sample = {}
+        if self.trace_memory:
+            tracemalloc.start()
+        t0 = timer()
+        try:
+            return super(BenchmarkSimulation, self).run_function(name, func, event)
+        finally:
+            sample['seconds'] = timer() - t0
+            if self.trace_memory:
+                (sample['retained'], sample['peak']) = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+            sample['calls'] = dict([('{0}.{1}'.format(*k), v - calls.get(k, 0)) for (k, v) in self.aws.calls.items()
+                                    if v != calls.get(k, 0)])
+            if name in self.handler.api_budgets:
+                state = self.handler.action_input(event)[1] if func == self.handler.handler else event
+                sample['over_budget'] = self.handler.aws_clients.over_budget(
+                    sample['calls'], self.handler.api_budgets[name], state)
+            self.samples[name].append(sample)
+
+
+def run_scenarios(handler, runs):
+    '''
+    Returns the samples of each action: runs timed passes over every scenario, plus a pass tracing memory
+    '''
+    timed = collections.defaultdict(list)
+    traced = collections.defaultdict(list)
+    passes = [(timed, False)] * runs
+    if tracemalloc:
+        passes.append((traced, True))
+    for (samples, trace_memory) in passes:
+        for (name, kwargs) in scenarios.items():
+            kwargs = dict(kwargs)
+            saved_env = dict(os.environ)
+            os.environ.update(kwargs.pop('env', {}))
+            try:
+                sim = BenchmarkSimulation(handler, samples, trace_memory, **kwargs)
+                sim.run(horizon)
+            finally:
+                os.environ.clear()
+                os.environ.update(saved_env)
+        for (action, event) in direct_invocations.items():
+            sim = BenchmarkSimulation(handler, samples, trace_memory)
+            uninstall = simulation.fake_aws.install(sim.aws)
+            try:
+                sim.run_function(action, handler.handler, event)
+            finally:
+                uninstall()
+    return (timed, traced)
+
+
+def summarize(timed, traced, runs):
+    results = {}
+    for (action, samples) in timed.items():
+        invocations = len(samples) // runs
+        # API calls are the same every run
+        first_run = samples[:invocations]
+        operations = collections.Counter()
+        for sample in first_run:
+            operations.update(sample['calls'])
+        millis = sorted([x['seconds'] * 1000 for x in samples])
+        memory = traced.get(action, [])
+        results[action] = {
+            'invocations': invocations,
+            'ms_p50': round(millis[len(millis) // 2], 4),
+            'ms_p90': round(millis[int(0.9 * (len(millis) - 1))], 4),
+            'peak_kib': round(sum([x['peak'] for x in memory]) / 1024.0 / len(memory), 2) if memory else None,
+            'retained_kib': round(sum([x['retained'] for x in memory]) / 1024.0 / len(memory), 2) if memory else None,
+            'api_calls': round(sum(operations.values()) / float(invocations), 4),
+            'api_calls_by_operation': dict([(k, round(v / float(invocations), 4)) for (k, v) in operations.items()])
+        }
+    return results
+
+
+def compare(results, baselines, tolerances):
+    '''
+    Returns a list of regressions: (action, metric, baseline, result)
+    '''
+    regressions = []
+    for (action, res) in sorted(results.items()):
+        base = baselines.get(action)
+        if not base:
+            continue
+        for (metric, tolerance) in tolerances.items():
+            if res.get(metric) is None or base.get(metric) is None:
+                continue
+            if res[metric] > base[metric] * (1 + tolerance) + 1e-9:
+                regressions.append((action, metric, base[metric], res[metric]))
+    return regressions
+
+
+def over_budget(timed):
+    '''
+    Returns a list of the operations invocations called more often than their action's budget allows:
+    (action, operation, most calls by an invocation, calls allowed to it)
+    '''
+    exceeded = {}
+    for (action, samples) in timed.items():
+        for sample in samples:
+            for (operation, (calls, allowed)) in sample.get('over_budget', {}).items():
+                if calls > exceeded.get((action, operation), (0, 0))[0]:
+                    exceeded[(action, operation)] = (calls, allowed)
+    return [(k[0], k[1], v[0], v[1]) for (k, v) in sorted(exceeded.items())]
+
+
+def delta(res, base, metric):
+    if not base or base.get(metric) is None or res.get(metric) is None:
+        return ''
+    if not base[metric]:
+        return '(new)' if res[metric] else ''
+    return '({:+.0%})'.format(res[metric] / float(base[metric]) - 1)
+
+
+def print_results(results, baselines, operations=False):
+    print('{0:<28}{1:>8}{2:>18}{3:>10}{4:>18}{5:>16}'.format(
+        'action', 'calls', 'p50 ms', 'p90 ms', 'peak KiB', 'API calls/call'))
+    for (action, res) in sorted(results.items()):
+        base = baselines.get(action)
+        print('{0:<28}{1:>8}{2:>10.3f}{3:>8}{4:>10.3f}{5:>10}{6:>8}{7:>8.2f}{8:>8}'.format(
+            action, res['invocations'], res['ms_p50'], delta(res, base, 'ms_p50'), res['ms_p90'],
+            '{:.1f}'.format(res['peak_kib']) if res['peak_kib'] is not None else '-', delta(res, base, 'peak_kib'),
+            res['api_calls'], delta(res, base, 'api_calls')))
+        if operations:
+            for (operation, count) in sorted(res['api_calls_by_operation'].items()):
+                print('    {0:<64}{1:>8.2f}'.format(operation, count))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Lambda actions of Spoptimize, offline')
+    parser.add_argument('-n', '--runs', type=int, default=3, help='Timed passes over the scenarios (default: 3)')
+    parser.add_argument('--operations', action='store_true', help='Print API calls per operation of each action')
+    parser.add_argument('--save', action='store_true', help='Store the results as the new baselines')
+    parser.add_argument('--check', action='store_true', help='Exit non-zero if any metric regressed')
+    parser.add_argument('--time-tolerance', type=float, default=default_tolerances['ms_p50'],
+                        help='Allowed slow-down of p50 wall time (default: {})'.format(default_tolerances['ms_p50']))
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    handler = simulation.import_handler()
+    logging.disable(logging.CRITICAL)
+    (timed, traced) = run_scenarios(handler, args.runs)
+    results = summarize(timed, traced, args.runs)
+
+    baselines = {}
+    if os.path.exists(baselines_file):
+        with open(baselines_file, 'r') as f:
+            baselines = json.load(f)['actions']
+    tolerances = dict(default_tolerances, ms_p50=args.time_tolerance)
+    regressions = compare(results, baselines, tolerances)
+    missing = sorted(set(handler.actions) - set(results))
+    exceeded = over_budget(timed)
+
+    if args.json:
+        print(json.dumps({'actions': results, 'regressions': regressions, 'missing': missing,
+                          'over_budget': exceeded}, indent=2, sort_keys=True))
+    else:
+        print_results(results, baselines, args.operations)
+        for (action, metric, base, res) in regressions:
+            print('REGRESSION {0} {1}: {2:.3f} -> {3:.3f}'.format(action, metric, base, res))
+        for (action, operation, calls, allowed) in exceeded:
+            print('OVER BUDGET {0} {1}: {2} calls, {3} allowed'.format(action, operation, calls, allowed))
+        if missing:
+            print('Not benchmarked: {}'.format(', '.join(missing)))
+    if args.save:
+        with open(baselines_file, 'w') as f:
+            json.dump({'python': platform.python_version(), 'runs': args.runs, 'actions': results}, f, indent=2,
+                      sort_keys=True)
+            f.write('\n')
+    if args.check and (regressions or missing or exceeded):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
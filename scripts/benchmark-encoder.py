@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+'''
+Measures the cost of making action results & Step Functions inputs JSON-safe: util.json_safe and util.to_json
+against the in-place walk they replace, on a large autoscaling group description and launch configuration.
+
+    $ python scripts/benchmark-encoder.py [-n ITERATIONS] [--instances N] [--tags N]
+'''
+
+import argparse
+import copy
+import datetime
+import json
+import os
+import sys
+import time
+
+here = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'spoptimize'))
+
+import util  # noqa: E402
+
+timer = getattr(time, 'perf_counter', time.time)
+created_time = datetime.datetime(2018, 3, 6, 9, 36, 2, 521173)
+
+
+def legacy_walk_dict_for_datetime(node):
+    '''
+    util.walk_dict_for_datetime before json_safe
+    '''
+    if type(node) is dict:
+        for key, item in node.items():
+            if type(item) in [dict, list]:
+                legacy_walk_dict_for_datetime(item)
+            elif type(item) is datetime.datetime:
+                node[key] = item.isoformat()
+    if type(node) is list:
+        for idx, item in enumerate(node):
+            if type(item) in [dict, list]:
+                legacy_walk_dict_for_datetime(item)
+            elif type(item) is datetime.datetime:
+                node[idx] = item.isoformat()
+
+
+def legacy_json_dumps_converter(o):
+    if isinstance(o, datetime.datetime):
+        return o.isoformat()
+    raise TypeError("Unknown type")
+
+
+def asg_description(instances, tags):
+    '''
+    Returns a describe_auto_scaling_groups() response of a group with instances and tags
+    '''
+    name = 'spoptimize-benchmark'
+    return {'AutoScalingGroups': [{
+        'AutoScalingGroupName': name,
+        'AutoScalingGroupARN': 'arn:aws:autoscaling:us-east-1:123456789012:autoScalingGroup:uuid:autoScalingGroupName/' + name,
+        'LaunchConfigurationName': name + '-lc',
+        'MinSize': 0,
+        'MaxSize': instances + 1,
+        'DesiredCapacity': instances,
+        'DefaultCooldown': 300,
+        'AvailabilityZones': ['us-east-1a', 'us-east-1b', 'us-east-1c'],
+        'LoadBalancerNames': [],
+        'TargetGroupARNs': ['arn:aws:elasticloadbalancing:us-east-1:123456789012:targetgroup/{0}/{1:016x}'.format(name, x)
+                            for x in range(3)],
+        'HealthCheckType': 'ELB',
+        'HealthCheckGracePeriod': 120,
+        'Instances': [{
+            'InstanceId': 'i-{:017x}'.format(x),
+            'AvailabilityZone': 'us-east-1{}'.format('abc'[x % 3]),
+            'LifecycleState': 'InService',
+            'HealthStatus': 'Healthy',
+            'LaunchConfigurationName': name + '-lc',
+            'ProtectedFromScaleIn': x == 0
+        } for x in range(instances)],
+        'CreatedTime': created_time,
+        'SuspendedProcesses': [],
+        'VPCZoneIdentifier': 'subnet-0000000a,subnet-0000000b,subnet-0000000c',
+        'EnabledMetrics': [{'Metric': 'GroupInServiceInstances', 'Granularity': '1Minute'}],
+        'Tags': [{
+            'ResourceId': name,
+            'ResourceType': 'auto-scaling-group',
+            'Key': 'tag-{}'.format(x),
+            'Value': 'value-{}'.format(x),
+            'PropagateAtLaunch': bool(x % 2)
+        } for x in range(tags)],
+        'TerminationPolicies': ['Default'],
+        'NewInstancesProtectedFromScaleIn': False
+    }], 'ResponseMetadata': {'RequestId': 'request-id', 'HTTPStatusCode': 200, 'RetryAttempts': 0}}
+
+
+def launch_config(devices):
+    '''
+    Returns a describe_launch_configurations() response of a launch configuration with devices block devices
+    '''
+    return {'LaunchConfigurations': [{
+        'LaunchConfigurationName': 'spoptimize-benchmark-lc',
+        'LaunchConfigurationARN': 'arn:aws:autoscaling:us-east-1:123456789012:launchConfiguration:uuid:'
+                                  'launchConfigurationName/spoptimize-benchmark-lc',
+        'ImageId': 'ami-0123456789abcdef0',
+        'KeyName': 'spoptimize',
+        'SecurityGroups': ['sg-0123456789abcdef{}'.format(x) for x in range(5)],
+        'ClassicLinkVPCSecurityGroups': [],
+        'UserData': 'IyEvYmluL2Jhc2gK' * 1024,
+        'InstanceType': 'm5.large',
+        'KernelId': '',
+        'RamdiskId': '',
+        'BlockDeviceMappings': [{
+            'DeviceName': '/dev/sd{}'.format(chr(ord('b') + x % 24)),
+            'Ebs': {'VolumeSize': 100, 'VolumeType': 'gp2', 'DeleteOnTermination': True}
+        } for x in range(devices)],
+        'InstanceMonitoring': {'Enabled': True},
+        'IamInstanceProfile': 'spoptimize-benchmark',
+        'CreatedTime': created_time,
+        'EbsOptimized': True
+    }], 'ResponseMetadata': {'RequestId': 'request-id', 'HTTPStatusCode': 200, 'RetryAttempts': 0}}
+
+
+def measure(func, payloads):
+    '''
+    Returns the mean microseconds func takes per payload
+    '''
+    t0 = timer()
+    for payload in payloads:
+        func(payload)
+    return (timer() - t0) * 1e6 / len(payloads)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the JSON-safe encoding of boto3 responses')
+    parser.add_argument('-n', '--iterations', type=int, default=200, help='Encodings per measurement (default: 200)')
+    parser.add_argument('--instances', type=int, default=500, help='Instances of the group (default: 500)')
+    parser.add_argument('--tags', type=int, default=50, help='Tags of the group (default: 50)')
+    parser.add_argument('--devices', type=int, default=24, help='Block devices of the launch config (default: 24)')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    payloads = [('asg', asg_description(args.instances, args.tags)), ('launch-config', launch_config(args.devices))]
+    results = {}
+    for (name, payload) in payloads:
+        assert json.loads(util.to_json(payload)) == util.json_safe(payload)
+        # the in-place walk converts a payload once, so it's given a fresh copy every time
+        copies = [copy.deepcopy(payload) for _ in range(args.iterations)]
+        walked = copy.deepcopy(payload)
+        legacy_walk_dict_for_datetime(walked)
+        results[name] = {
+            'legacy_walk_us': measure(legacy_walk_dict_for_datetime, copies),
+            'json_safe_us': measure(util.json_safe, [payload] * args.iterations),
+            'legacy_dumps_us': measure(lambda x: json.dumps(x, default=legacy_json_dumps_converter),
+                                       [payload] * args.iterations),
+            'to_json_us': measure(util.to_json, [payload] * args.iterations),
+            'dumps_walked_us': measure(json.dumps, [walked] * args.iterations)
+        }
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+    print('{0:<16}{1:>14}{2:>14}{3:>14}{4:>14}'.format('payload', 'walk us', 'json_safe us', 'dumps us', 'to_json us'))
+    for (name, res) in sorted(results.items()):
+        print('{0:<16}{1:>14.1f}{2:>14.1f}{3:>14.1f}{4:>14.1f}'.format(
+            name, res['legacy_walk_us'], res['json_safe_us'], res['legacy_dumps_us'], res['to_json_us']))
+
+
+if __name__ == '__main__':
+    main()
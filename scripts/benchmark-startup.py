@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+'''
+Measures the cold-start cost of each Lambda action: the time to import the handler and to create the boto3
+clients the action uses. Each action is measured in a fresh interpreter, as a cold Lambda container would be.
+
+    $ python scripts/benchmark-startup.py [-n RUNS]
+'''
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+here = os.path.dirname(os.path.realpath(__file__))
+repo_dir = os.path.join(here, '..')
+
+# clients used by each action of handler.handler; 'all' is what every Lambda paid for before clients were lazy
+action_clients = {
+    'start-state-machine': ['autoscaling', 'dynamodb', 'stepfunctions'],
+    'increment-count': [],
+    'load-batch': ['dynamodb'],
+    'ondemand-instance-healthy': ['autoscaling', 'dynamodb', 'stepfunctions'],
+    'request-spot': ['autoscaling', 'ec2', 'iam'],
+    'check-spot': ['ec2'],
+    'await-spot': ['dynamodb', 'ec2', 'stepfunctions'],
+    'term-spot-instance': ['ec2'],
+    'acquire-lock': ['dynamodb', 'stepfunctions'],
+    'release-lock': ['dynamodb'],
+    'attach-spot': ['autoscaling', 'ec2'],
+    'spot-instance-healthy': ['autoscaling'],
+    'all': ['autoscaling', 'dynamodb', 'ec2', 'iam', 'stepfunctions'],
+}
+
+probe = '''
+import json, sys, time
+sys.path.append('spoptimize')
+t0 = time.time()
+import handler
+t1 = time.time()
+for service in sys.argv[1:]:
+    handler.sfn_helper.aws_clients.get_client(service)
+t2 = time.time()
+print(json.dumps({'import': (t1 - t0) * 1000, 'clients': (t2 - t1) * 1000}))
+'''
+
+
+def measure(action, runs):
+    '''
+    Returns the median import & client-creation times (in ms) of action over runs fresh interpreters
+    '''
+    env = dict(os.environ)
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    env['SPOPTIMIZE_ACTION'] = action
+    samples = []
+    for _ in range(runs):
+        out = subprocess.check_output([sys.executable, '-c', probe] + action_clients[action], cwd=repo_dir, env=env)
+        samples.append(json.loads(out.decode('utf-8').strip().splitlines()[-1]))
+    res = {}
+    for key in ['import', 'clients']:
+        values = sorted([x[key] for x in samples])
+        res[key] = values[len(values) // 2]
+    return res
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Lambda cold-start cost per action')
+    parser.add_argument('-n', '--runs', type=int, default=5, help='Fresh interpreters per action (default: 5)')
+    args = parser.parse_args()
+    print('{0:<28}{1:>12}{2:>12}{3:>12}'.format('action', 'import ms', 'clients ms', 'total ms'))
+    for action in sorted(action_clients):
+        res = measure(action, args.runs)
+        print('{0:<28}{1:>12.1f}{2:>12.1f}{3:>12.1f}'.format(
+            action, res['import'], res['clients'], res['import'] + res['clients']))
+
+
+if __name__ == '__main__':
+    main()
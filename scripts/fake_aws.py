@@ -0,0 +1,1171 @@
+'''
+Stateful, in-process stand-ins for the autoscaling, EC2, IAM, DynamoDB and Step Functions APIs used by spoptimize,
+driven by a virtual clock, so that the real handler actions can be run offline (see simulate-throughput.py)
+
+Instances boot, spot requests are fulfilled and autoscaling groups launch & terminate instances as virtual time
+passes; every API call made by spoptimize is counted in FakeAws.calls
+'''
+
+import collections
+import copy
+import datetime
+import heapq
+import itertools
+import json
+import random
+import re
+import sys
+import threading
+from decimal import Decimal
+
+from botocore.exceptions import ClientError
+
+# 2018-03-01T00:00:00Z
+default_start = 1519862400
+
+default_settings = {
+    # seconds until a launched instance is running (+/- 20%)
+    'boot_seconds': 60,
+    # seconds until a spot request is fulfilled (+/- 20%)
+    'spot_fulfillment_seconds': 30,
+    # fraction of spot requests that are closed instead of fulfilled
+    'spot_failure_rate': 0.0,
+    # maximum number of open & active spot requests; None for no limit
+    'max_spot_instances': None,
+    # seconds an attached instance is Pending before it's InService
+    'attach_seconds': 10,
+    # seconds an instance is Terminating before autoscaling removes it (and launches a replacement, if needed)
+    'terminate_seconds': 30,
+    # seconds a terminated instance is shutting-down
+    'shutdown_seconds': 30,
+    # seconds from an instance running until its launch notification is published
+    'notification_seconds': 5,
+}
+
+
+def client_error(operation, code, message, **extra):
+    '''
+    Returns a ClientError as raised by boto3 for operation (a method name, such as put_item)
+    '''
+    response = {'Error': {'Code': code, 'Message': message}}
+    response.update(extra)
+    return ClientError(response, ''.join([x.capitalize() for x in operation.split('_')]))
+
+
+class VirtualClock(object):
+    '''
+    Virtual time, advanced by running the callbacks scheduled on it in order
+    '''
+
+    def __init__(self, start=default_start):
+        self.now = float(start)
+        self._queue = []
+        self._seq = itertools.count()
+
+    def time(self):
+        return self.now
+
+    def datetime(self, when=None):
+        return datetime.datetime.utcfromtimestamp(self.now if when is None else when)
+
+    def isoformat(self, when=None):
+        return self.datetime(when).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+    def datetime_class(self):
+        '''
+        Returns a subclass of datetime.datetime whose now() is the virtual time (in UTC, as on Lambda)
+        '''
+        clock = self
+
+        class VirtualDatetime(datetime.datetime):
+
+            @classmethod
+            def now(cls, tz=None):
+                return clock.datetime()
+
+            @classmethod
+            def utcnow(cls):
+                return clock.datetime()
+
+        return VirtualDatetime
+
+    def call_at(self, when, func):
+        heapq.heappush(self._queue, (max(when, self.now), next(self._seq), func))
+
+    def call_later(self, delay, func):
+        self.call_at(self.now + delay, func)
+
+    def pending(self):
+        return len(self._queue)
+
+    def run(self, until=None):
+        '''
+        Runs scheduled callbacks in order until none are left, or the next one is due after until
+        '''
+        while self._queue:
+            if until is not None and self._queue[0][0] > until:
+                self.now = float(until)
+                return
+            (when, _, func) = heapq.heappop(self._queue)
+            self.now = when
+            func()
+
+
+class FakeAws(object):
+    '''
+    The state of a simulated AWS account; setup methods (create_*, scale_out) aren't counted as API calls
+    '''
+
+    def __init__(self, clock, seed=0, region='us-east-1', account_id='123456789012', **settings):
+        self.clock = clock
+        self.region = region
+        self.account_id = account_id
+        self.settings = dict(default_settings, **settings)
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        # (service, operation) -> number of calls
+        self.calls = collections.Counter()
+        # functions of (service, operation, kwargs) called before each API call
+        self.call_listeners = []
+        # topic -> functions of a message; see publish()
+        self.subscribers = collections.defaultdict(list)
+        self.groups = {}
+        self.launch_configs = {}
+        self.instances = {}
+        self.spot_requests = {}
+        self.spot_client_tokens = {}
+        self.instance_profiles = {}
+        self.security_groups = {}
+        self.tables = {}
+        self.state_machines = {}
+        self._dirty_groups = set()
+        self._ids = itertools.count(1)
+        self.services = {
+            'autoscaling': FakeAutoScaling(self),
+            'dynamodb': FakeDynamoDb(self),
+            'ec2': FakeEc2(self),
+            'iam': FakeIam(self),
+            'stepfunctions': FakeStepFunctions(self)
+        }
+
+    def client(self, service):
+        return RecordingClient(self, service)
+
+    def new_id(self, prefix, digits=17):
+        return '{0}-{1:0{2}x}'.format(prefix, next(self._ids), digits)
+
+    def jitter(self, seconds):
+        return seconds * self.random.uniform(0.8, 1.2)
+
+    def subscribe(self, topic, func):
+        self.subscribers[topic].append(func)
+
+    def publish(self, topic, message, delay=0):
+        '''
+        Delivers message to the subscribers of topic after delay seconds: 'autoscaling' for launch notifications,
+        'ec2' for EC2 events
+        '''
+        for func in self.subscribers[topic]:
+            self.clock.call_later(delay, lambda f=func: f(message))
+
+    def event(self, detail_type, detail, resources):
+        return {
+            'version': '0',
+            'id': self.new_id('event', 8),
+            'detail-type': detail_type,
+            'source': 'aws.ec2',
+            'account': self.account_id,
+            'time': self.clock.isoformat()[:19] + 'Z',
+            'region': self.region,
+            'resources': resources,
+            'detail': detail
+        }
+
+    # setup
+
+    def create_table(self, table_name, hash_key='group_name'):
+        self.tables[table_name] = {'hash_key': hash_key, 'items': {}}
+
+    def create_instance_profile(self, name):
+        self.instance_profiles[name] = 'arn:aws:iam::{0}:instance-profile/{1}'.format(self.account_id, name)
+
+    def create_security_group(self, name):
+        self.security_groups[name] = self.new_id('sg', 8)
+        return self.security_groups[name]
+
+    def create_launch_config(self, name, **kwargs):
+        launch_config = {
+            'LaunchConfigurationName': name,
+            'LaunchConfigurationARN': 'arn:aws:autoscaling:{0}:{1}:launchConfiguration:{2}:launchConfigurationName/{3}'.format(
+                self.region, self.account_id, self.new_id('lc', 8), name),
+            'ImageId': 'ami-428aa838',
+            'InstanceType': 't2.micro',
+            'SecurityGroups': [],
+            'BlockDeviceMappings': [],
+            'InstanceMonitoring': {'Enabled': False},
+            'EbsOptimized': False,
+            'KernelId': '',
+            'RamdiskId': '',
+            'UserData': '',
+            'CreatedTime': self.clock.datetime()
+        }
+        launch_config.update(kwargs)
+        self.launch_configs[name] = launch_config
+
+    def create_group(self, name, lc_name, subnets, min_size, max_size, desired=0, grace_period=300, tags=None):
+        '''
+        subnets: list of (subnet id, availability zone) tuples instances are launched into in turn
+        tags: list of (key, value, propagate at launch) tuples
+        '''
+        self.groups[name] = {
+            'name': name,
+            'arn': 'arn:aws:autoscaling:{0}:{1}:autoScalingGroup:{2}:autoScalingGroupName/{3}'.format(
+                self.region, self.account_id, self.new_id('asg', 8), name),
+            'lc_name': lc_name,
+            'subnets': list(subnets),
+            'next_subnet': 0,
+            'min_size': min_size,
+            'max_size': max_size,
+            'desired': desired,
+            'grace_period': grace_period,
+            'tags': list(tags or []),
+            'members': collections.OrderedDict(),
+            'created': self.clock.datetime()
+        }
+        self.mark_dirty(name)
+
+    def scale_out(self, group_name, count):
+        '''
+        Raises the desired capacity of group_name by count, as a scaling policy would
+        '''
+        with self.lock:
+            group = self.groups[group_name]
+            group['desired'] += count
+            group['max_size'] = max(group['max_size'], group['desired'])
+            self.mark_dirty(group_name)
+
+    def scale_in(self, group_name, count):
+        '''
+        Lowers the desired capacity of group_name by count (but not below its Min Size), as a scaling policy would
+        '''
+        with self.lock:
+            group = self.groups[group_name]
+            group['desired'] = max(group['min_size'], group['desired'] - count)
+            self.mark_dirty(group_name)
+
+    # autoscaling activities
+
+    def mark_dirty(self, group_name):
+        '''
+        Has autoscaling reconcile the instances of group_name with its desired capacity
+        '''
+        if not self._dirty_groups:
+            self.clock.call_later(0, self.reconcile)
+        self._dirty_groups.add(group_name)
+
+    def reconcile(self):
+        with self.lock:
+            for group_name in sorted(self._dirty_groups):
+                group = self.groups.get(group_name)
+                if not group:
+                    continue
+                active = [x for x in group['members'].values() if x['terminating_at'] is None]
+                for _ in range(group['desired'] - len(active)):
+                    self.launch_instance(group)
+                # scale in, sparing protected instances
+                extras = [x for x in reversed(active) if not x['ProtectedFromScaleIn']]
+                for member in extras[:max(len(active) - group['desired'], 0)]:
+                    self.terminate_member(group, member['InstanceId'])
+            self._dirty_groups.clear()
+
+    def launch_instance(self, group):
+        (subnet_id, az) = group['subnets'][group['next_subnet'] % len(group['subnets'])]
+        group['next_subnet'] += 1
+        launch_config = self.launch_configs[group['lc_name']]
+        tags = [(x[0], x[1]) for x in group['tags'] if x[2]] + [('aws:autoscaling:groupName', group['name'])]
+        instance = self.create_instance(launch_config['ImageId'], launch_config['InstanceType'], az, subnet_id, tags)
+        self.add_member(group, instance, instance['running_at'])
+        message = {
+            'Event': 'autoscaling:EC2_INSTANCE_LAUNCH',
+            'AccountId': self.account_id,
+            'AutoScalingGroupName': group['name'],
+            'AutoScalingGroupARN': group['arn'],
+            'EC2InstanceId': instance['InstanceId'],
+            'Description': 'Launching a new EC2 instance: {}'.format(instance['InstanceId']),
+            'Cause': 'An instance was started in response to a difference between desired and actual capacity',
+            'StartTime': self.clock.isoformat(),
+            'Details': {'Subnet ID': subnet_id, 'Availability Zone': az},
+            'StatusCode': 'InProgress'
+        }
+        self.publish('autoscaling', message, instance['running_at'] - self.clock.now + self.settings['notification_seconds'])
+
+    def add_member(self, group, instance, in_service_at):
+        group['members'][instance['InstanceId']] = {
+            'InstanceId': instance['InstanceId'],
+            'AvailabilityZone': instance['AvailabilityZone'],
+            'LaunchConfigurationName': group['lc_name'],
+            'ProtectedFromScaleIn': False,
+            'in_service_at': in_service_at,
+            'terminating_at': None
+        }
+        instance['group'] = group['name']
+
+    def terminate_member(self, group, instance_id):
+        member = group['members'][instance_id]
+        if member['terminating_at'] is not None:
+            return
+        member['terminating_at'] = self.clock.now
+        self.terminate_instance(self.instances[instance_id])
+        self.clock.call_later(self.settings['terminate_seconds'],
+                              lambda: self.remove_member(group['name'], instance_id))
+
+    def remove_member(self, group_name, instance_id):
+        with self.lock:
+            group = self.groups.get(group_name)
+            if group and group['members'].pop(instance_id, None):
+                self.instances[instance_id]['group'] = None
+                self.mark_dirty(group_name)
+
+    def member_lifecycle(self, member):
+        if member['terminating_at'] is not None:
+            return 'Terminating'
+        if self.clock.now < member['in_service_at']:
+            return 'Pending'
+        return 'InService'
+
+    # ec2 activities
+
+    def create_instance(self, image_id, instance_type, az, subnet_id, tags=None, spot_request_id=None):
+        instance = {
+            'InstanceId': self.new_id('i'),
+            'ImageId': image_id,
+            'InstanceType': instance_type,
+            'AvailabilityZone': az,
+            'SubnetId': subnet_id,
+            'SpotInstanceRequestId': spot_request_id,
+            'Tags': collections.OrderedDict(tags or []),
+            'launched_at': self.clock.now,
+            'running_at': self.clock.now + self.jitter(self.settings['boot_seconds']),
+            'terminated_at': None,
+            'group': None
+        }
+        self.instances[instance['InstanceId']] = instance
+        return instance
+
+    def terminate_instance(self, instance):
+        if instance['terminated_at'] is not None:
+            return
+        instance['terminated_at'] = self.clock.now
+        group = self.groups.get(instance['group'])
+        if group and group['members'][instance['InstanceId']]['terminating_at'] is None:
+            # terminated outside of autoscaling; replaced like an unhealthy instance
+            self.terminate_member(group, instance['InstanceId'])
+
+    def instance_state(self, instance):
+        if instance['terminated_at'] is not None:
+            if self.clock.now < instance['terminated_at'] + self.settings['shutdown_seconds']:
+                return 'shutting-down'
+            return 'terminated'
+        if self.clock.now < instance['running_at']:
+            return 'pending'
+        return 'running'
+
+    def fulfill_spot_request(self, spot_request_id, failed):
+        with self.lock:
+            spot_request = self.spot_requests[spot_request_id]
+            if spot_request['State'] != 'open':
+                return
+            if failed:
+                spot_request['State'] = 'closed'
+                spot_request['Status'] = {'Code': 'capacity-not-available'}
+                return
+            spec = spot_request['LaunchSpecification']
+            instance = self.create_instance(spec.get('ImageId'), spec.get('InstanceType'),
+                                            spec.get('Placement', {}).get('AvailabilityZone'), spec.get('SubnetId'),
+                                            spot_request_id=spot_request_id)
+            spot_request['State'] = 'active'
+            spot_request['Status'] = {'Code': 'fulfilled'}
+            spot_request['InstanceId'] = instance['InstanceId']
+            self.publish('ec2', self.event('EC2 Spot Instance Request Fulfillment', {
+                'spot-instance-request-id': spot_request_id,
+                'instance-id': instance['InstanceId']
+            }, ['arn:aws:ec2:{0}:{1}:spot-instance-request/{2}'.format(self.region, self.account_id, spot_request_id)]))
+            self.publish('ec2', self.event('EC2 Instance State-change Notification', {
+                'instance-id': instance['InstanceId'],
+                'state': 'running'
+            }, ['arn:aws:ec2:{0}:{1}:instance/{2}'.format(self.region, self.account_id, instance['InstanceId'])]),
+                instance['running_at'] - self.clock.now)
+
+
+class RecordingClient(object):
+    '''
+    Stands in for a boto3 client: counts each call and serializes calls made by concurrent threads
+    '''
+
+    def __init__(self, aws, service):
+        self.aws = aws
+        self.service = service
+
+    def __getattr__(self, operation):
+        func = getattr(self.aws.services[self.service], operation, None)
+        if operation.startswith('_') or func is None:
+            raise AttributeError('{0} client has no attribute {1}'.format(self.service, operation))
+
+        def call(**kwargs):
+            with self.aws.lock:
+                self.aws.calls[(self.service, operation)] += 1
+                for listener in self.aws.call_listeners:
+                    listener(self.service, operation, kwargs)
+                return func(**kwargs)
+        return call
+
+    def __repr__(self):
+        return 'RecordingClient({})'.format(self.service)
+
+
+class FakeService(object):
+
+    def __init__(self, aws):
+        self.aws = aws
+
+    @property
+    def now(self):
+        return self.aws.clock.now
+
+
+class FakeAutoScaling(FakeService):
+
+    def group_description(self, group):
+        aws = self.aws
+        return {
+            'AutoScalingGroupName': group['name'],
+            'AutoScalingGroupARN': group['arn'],
+            'LaunchConfigurationName': group['lc_name'],
+            'MinSize': group['min_size'],
+            'MaxSize': group['max_size'],
+            'DesiredCapacity': group['desired'],
+            'DefaultCooldown': 300,
+            'AvailabilityZones': sorted(set([x[1] for x in group['subnets']])),
+            'LoadBalancerNames': [],
+            'TargetGroupARNs': [],
+            'HealthCheckType': 'EC2',
+            'HealthCheckGracePeriod': group['grace_period'],
+            'Instances': [{
+                'InstanceId': x['InstanceId'],
+                'AvailabilityZone': x['AvailabilityZone'],
+                'LifecycleState': aws.member_lifecycle(x),
+                'HealthStatus': 'Healthy',
+                'LaunchConfigurationName': x['LaunchConfigurationName'],
+                'ProtectedFromScaleIn': x['ProtectedFromScaleIn']
+            } for x in group['members'].values()],
+            'CreatedTime': group['created'],
+            'SuspendedProcesses': [],
+            'VPCZoneIdentifier': ','.join([x[0] for x in group['subnets']]),
+            'EnabledMetrics': [],
+            'Tags': [{
+                'ResourceId': group['name'],
+                'ResourceType': 'auto-scaling-group',
+                'Key': x[0],
+                'Value': x[1],
+                'PropagateAtLaunch': x[2]
+            } for x in group['tags']],
+            'TerminationPolicies': ['Default'],
+            'NewInstancesProtectedFromScaleIn': False
+        }
+
+    def describe_auto_scaling_groups(self, AutoScalingGroupNames=None, **kwargs):
+        names = AutoScalingGroupNames or sorted(self.aws.groups)
+        return {'AutoScalingGroups': [self.group_description(self.aws.groups[x])
+                                      for x in names if x in self.aws.groups]}
+
+    def describe_auto_scaling_instances(self, InstanceIds=None, **kwargs):
+        if len(InstanceIds or []) > 50:
+            raise client_error('describe_auto_scaling_instances', 'ValidationError',
+                               'The number of instance ids that may be passed in is limited to 50')
+        retval = []
+        for instance_id in InstanceIds or []:
+            instance = self.aws.instances.get(instance_id)
+            group = self.aws.groups.get(instance['group']) if instance else None
+            if not group:
+                continue
+            member = group['members'][instance_id]
+            retval.append({
+                'InstanceId': instance_id,
+                'AutoScalingGroupName': group['name'],
+                'AvailabilityZone': member['AvailabilityZone'],
+                'LifecycleState': self.aws.member_lifecycle(member),
+                'HealthStatus': 'HEALTHY',
+                'LaunchConfigurationName': member['LaunchConfigurationName'],
+                'ProtectedFromScaleIn': member['ProtectedFromScaleIn']
+            })
+        return {'AutoScalingInstances': retval}
+
+    def describe_launch_configurations(self, LaunchConfigurationNames=None, **kwargs):
+        names = LaunchConfigurationNames or sorted(self.aws.launch_configs)
+        return {'LaunchConfigurations': [copy.deepcopy(self.aws.launch_configs[x])
+                                         for x in names if x in self.aws.launch_configs]}
+
+    def group(self, operation, group_name):
+        if group_name not in self.aws.groups:
+            raise client_error(operation, 'ValidationError', 'AutoScalingGroup name not found - {}'.format(group_name))
+        return self.aws.groups[group_name]
+
+    def attach_instances(self, InstanceIds, AutoScalingGroupName):
+        group = self.group('attach_instances', AutoScalingGroupName)
+        for instance_id in InstanceIds:
+            instance = self.aws.instances.get(instance_id)
+            if not instance:
+                raise client_error('attach_instances', 'ValidationError', 'Invalid Instance ID(s) specified')
+            if self.aws.instance_state(instance) != 'running' or instance['group']:
+                raise client_error('attach_instances', 'ValidationError',
+                                   'Instance {} is not in correct state'.format(instance_id))
+        if group['desired'] + len(InstanceIds) > group['max_size']:
+            raise client_error('attach_instances', 'ValidationError', (
+                'Cannot attach {0} instance(s) to AutoScalingGroup {1}: Desired capacity:{2} + instances:{0} exceeds '
+                'max size:{3}. New desired capacity will exceed the max size; please update the AutoScalingGroup '
+                'sizes appropriately.').format(len(InstanceIds), group['name'], group['desired'], group['max_size']))
+        group['desired'] += len(InstanceIds)
+        for instance_id in InstanceIds:
+            instance = self.aws.instances[instance_id]
+            self.aws.add_member(group, instance, self.now + self.aws.settings['attach_seconds'])
+            self.aws.publish('autoscaling', {
+                'Event': 'autoscaling:EC2_INSTANCE_LAUNCH',
+                'AccountId': self.aws.account_id,
+                'AutoScalingGroupName': group['name'],
+                'AutoScalingGroupARN': group['arn'],
+                'EC2InstanceId': instance_id,
+                'Description': 'Attaching an existing EC2 instance: {}'.format(instance_id),
+                'Cause': 'An instance was added in response to user request',
+                'StartTime': self.aws.clock.isoformat(),
+                'Details': {'Subnet ID': instance['SubnetId'], 'Availability Zone': instance['AvailabilityZone']},
+                'StatusCode': 'InProgress'
+            }, self.aws.settings['notification_seconds'])
+        return {}
+
+    def set_desired_capacity(self, AutoScalingGroupName, DesiredCapacity, HonorCooldown=False):
+        group = self.group('set_desired_capacity', AutoScalingGroupName)
+        if not group['min_size'] <= DesiredCapacity <= group['max_size']:
+            raise client_error('set_desired_capacity', 'ValidationError',
+                               'New SetDesiredCapacity value {0} is outside of the range [{1}, {2}]'.format(
+                                   DesiredCapacity, group['min_size'], group['max_size']))
+        group['desired'] = DesiredCapacity
+        self.aws.mark_dirty(group['name'])
+        return {}
+
+    def set_instance_protection(self, InstanceIds, AutoScalingGroupName, ProtectedFromScaleIn):
+        group = self.group('set_instance_protection', AutoScalingGroupName)
+        for instance_id in InstanceIds:
+            if instance_id not in group['members']:
+                raise client_error('set_instance_protection', 'ValidationError',
+                                   'The instance {0} is not part of Auto Scaling group {1}'.format(
+                                       instance_id, AutoScalingGroupName))
+            group['members'][instance_id]['ProtectedFromScaleIn'] = ProtectedFromScaleIn
+        return {}
+
+    def terminate_instance_in_auto_scaling_group(self, InstanceId, ShouldDecrementDesiredCapacity):
+        instance = self.aws.instances.get(InstanceId)
+        group = self.aws.groups.get(instance['group']) if instance else None
+        if not group or group['members'][InstanceId]['terminating_at'] is not None:
+            raise client_error('terminate_instance_in_auto_scaling_group', 'ValidationError',
+                               'Instance Id not found - No managed instance found for instance ID {}'.format(InstanceId))
+        if ShouldDecrementDesiredCapacity:
+            if group['desired'] <= group['min_size']:
+                raise client_error('terminate_instance_in_auto_scaling_group', 'ValidationError', (
+                    'Currently, desiredSize equals minSize ({}). Terminating instance without replacement will '
+                    'violate group\'s min size constraint.').format(group['min_size']))
+            group['desired'] -= 1
+        self.aws.terminate_member(group, InstanceId)
+        self.aws.mark_dirty(group['name'])
+        return {'Activity': {
+            'ActivityId': self.aws.new_id('activity', 8),
+            'AutoScalingGroupName': group['name'],
+            'Description': 'Terminating EC2 instance: {}'.format(InstanceId),
+            'StartTime': self.aws.clock.datetime(),
+            'StatusCode': 'InProgress'
+        }}
+
+
+class FakeEc2(FakeService):
+
+    def unknown_ids(self, operation, instance_ids):
+        unknown = [x for x in instance_ids if x not in self.aws.instances]
+        if unknown:
+            raise client_error(operation, 'InvalidInstanceID.NotFound',
+                               "The instance IDs '{}' do not exist".format(', '.join(unknown)))
+
+    def instance_description(self, instance):
+        state = self.aws.instance_state(instance)
+        retval = {
+            'InstanceId': instance['InstanceId'],
+            'ImageId': instance['ImageId'],
+            'InstanceType': instance['InstanceType'],
+            'LaunchTime': self.aws.clock.datetime(instance['launched_at']),
+            'Placement': {'AvailabilityZone': instance['AvailabilityZone'], 'Tenancy': 'default'},
+            'SubnetId': instance['SubnetId'],
+            'State': {'Code': {'pending': 0, 'running': 16, 'shutting-down': 32, 'terminated': 48}[state], 'Name': state},
+            'Tags': [{'Key': k, 'Value': v} for (k, v) in instance['Tags'].items()]
+        }
+        if instance['SpotInstanceRequestId']:
+            retval['InstanceLifecycle'] = 'spot'
+            retval['SpotInstanceRequestId'] = instance['SpotInstanceRequestId']
+        return retval
+
+    def describe_instances(self, InstanceIds=None, Filters=None, **kwargs):
+        if InstanceIds:
+            self.unknown_ids('describe_instances', InstanceIds)
+            instances = [self.aws.instances[x] for x in InstanceIds]
+        else:
+            instances = list(self.aws.instances.values())
+        for filt in Filters or []:
+            if filt['Name'] == 'instance-id':
+                instances = [x for x in instances if x['InstanceId'] in filt['Values']]
+        if not instances:
+            return {'Reservations': []}
+        return {'Reservations': [{
+            'ReservationId': 'r-{}'.format(x['InstanceId'][2:]),
+            'OwnerId': self.aws.account_id,
+            'Instances': [self.instance_description(x)]
+        } for x in instances]}
+
+    def describe_tags(self, Filters=None, NextToken=None, MaxResults=1000):
+        tags = []
+        resource_ids = None
+        for filt in Filters or []:
+            if filt['Name'] == 'resource-id':
+                resource_ids = set(filt['Values'])
+        for (instance_id, instance) in sorted(self.aws.instances.items()):
+            if resource_ids is None or instance_id in resource_ids:
+                tags.extend([{'ResourceId': instance_id, 'ResourceType': 'instance', 'Key': k, 'Value': v}
+                             for (k, v) in instance['Tags'].items()])
+        start = int(NextToken or 0)
+        retval = {'Tags': tags[start:start + MaxResults]}
+        if start + MaxResults < len(tags):
+            retval['NextToken'] = str(start + MaxResults)
+        return retval
+
+    def create_tags(self, Resources, Tags):
+        self.unknown_ids('create_tags', Resources)
+        for instance_id in Resources:
+            self.aws.instances[instance_id]['Tags'].update([(x['Key'], x['Value']) for x in Tags])
+        return {}
+
+    def terminate_instances(self, InstanceIds):
+        self.unknown_ids('terminate_instances', InstanceIds)
+        retval = []
+        for instance_id in InstanceIds:
+            instance = self.aws.instances[instance_id]
+            previous_state = self.aws.instance_state(instance)
+            self.aws.terminate_instance(instance)
+            retval.append({'InstanceId': instance_id, 'PreviousState': {'Name': previous_state},
+                           'CurrentState': {'Name': self.aws.instance_state(instance)}})
+        return {'TerminatingInstances': retval}
+
+    def describe_security_groups(self, GroupNames=None, GroupIds=None, **kwargs):
+        unknown = [x for x in GroupNames or [] if x not in self.aws.security_groups]
+        if unknown:
+            raise client_error('describe_security_groups', 'InvalidGroup.NotFound',
+                               "The security group '{}' does not exist".format(unknown[0]))
+        return {'SecurityGroups': [{'GroupName': x, 'GroupId': self.aws.security_groups[x]} for x in GroupNames or []]}
+
+    def spot_request_description(self, spot_request):
+        retval = copy.deepcopy(spot_request)
+        retval['CreateTime'] = self.aws.clock.datetime(spot_request['CreateTime'])
+        if not retval.get('InstanceId'):
+            retval.pop('InstanceId', None)
+        return retval
+
+    def request_spot_instances(self, InstanceCount=1, LaunchSpecification=None, Type='one-time', ClientToken=None,
+                               **kwargs):
+        aws = self.aws
+        if ClientToken and ClientToken in aws.spot_client_tokens:
+            spot_request_ids = aws.spot_client_tokens[ClientToken]
+        else:
+            limit = aws.settings['max_spot_instances']
+            in_use = len([x for x in aws.spot_requests.values() if x['State'] == 'open' or (
+                x['State'] == 'active' and aws.instances[x['InstanceId']]['terminated_at'] is None)])
+            if limit is not None and in_use + InstanceCount > limit:
+                raise client_error('request_spot_instances', 'MaxSpotInstanceCountExceeded',
+                                   'Max spot instance count exceeded')
+            spot_request_ids = []
+            for _ in range(InstanceCount):
+                spot_request_id = aws.new_id('sir', 8)
+                aws.spot_requests[spot_request_id] = {
+                    'SpotInstanceRequestId': spot_request_id,
+                    'State': 'open',
+                    'Status': {'Code': 'pending-evaluation'},
+                    'Type': Type,
+                    'LaunchSpecification': copy.deepcopy(LaunchSpecification or {}),
+                    'CreateTime': self.now,
+                    'InstanceId': None
+                }
+                failed = aws.random.random() < aws.settings['spot_failure_rate']
+                aws.clock.call_later(aws.jitter(aws.settings['spot_fulfillment_seconds']),
+                                     lambda x=spot_request_id, f=failed: aws.fulfill_spot_request(x, f))
+                spot_request_ids.append(spot_request_id)
+            if ClientToken:
+                aws.spot_client_tokens[ClientToken] = spot_request_ids
+        return {'SpotInstanceRequests': [self.spot_request_description(aws.spot_requests[x]) for x in spot_request_ids]}
+
+    def describe_spot_instance_requests(self, SpotInstanceRequestIds=None, **kwargs):
+        unknown = [x for x in SpotInstanceRequestIds or [] if x not in self.aws.spot_requests]
+        if unknown:
+            raise client_error('describe_spot_instance_requests', 'InvalidSpotInstanceRequestID.NotFound',
+                               "The spot instance request ID '{}' does not exist".format(unknown[0]))
+        return {'SpotInstanceRequests': [self.spot_request_description(self.aws.spot_requests[x])
+                                         for x in SpotInstanceRequestIds or sorted(self.aws.spot_requests)]}
+
+
+class FakeIam(FakeService):
+
+    def get_instance_profile(self, InstanceProfileName):
+        if InstanceProfileName not in self.aws.instance_profiles:
+            raise client_error('get_instance_profile', 'NoSuchEntity',
+                               'Instance Profile {} cannot be found.'.format(InstanceProfileName))
+        return {'InstanceProfile': {
+            'InstanceProfileName': InstanceProfileName,
+            'Arn': self.aws.instance_profiles[InstanceProfileName],
+            'Roles': []
+        }}
+
+
+class Expression(object):
+    '''
+    Parses & evaluates the subset of DynamoDB condition and update expressions: comparisons, AND/OR/NOT,
+    attribute_exists, attribute_not_exists, begins_with, size, if_not_exists, list_append and
+    SET/REMOVE/ADD/DELETE clauses on document paths such as waiters[0].execution_arn
+    '''
+
+    token_re = re.compile(r'<>|<=|>=|[=<>()\[\],.+-]|[#:]?\w+')
+    comparators = {
+        '=': lambda a, b: a == b,
+        '<>': lambda a, b: a != b,
+        '<': lambda a, b: a < b,
+        '<=': lambda a, b: a <= b,
+        '>': lambda a, b: a > b,
+        '>=': lambda a, b: a >= b
+    }
+
+    def __init__(self, expression, names=None, values=None):
+        self.tokens = self.token_re.findall(expression)
+        if ''.join(self.tokens) != re.sub(r'\s', '', expression):
+            raise ValueError('Invalid expression: {}'.format(expression))
+        self.pos = 0
+        self.names = names or {}
+        self.values = values or {}
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def expect(self, token):
+        if self.next() != token:
+            raise ValueError('Expected {0} at token {1} of {2}'.format(token, self.pos, self.tokens))
+
+    def keyword(self, word):
+        if (self.peek() or '').upper() == word:
+            self.pos += 1
+            return True
+        return False
+
+    # condition expressions
+
+    def condition(self):
+        '''
+        Returns a function of an item that evaluates the condition
+        '''
+        terms = [self.conjunction()]
+        while self.keyword('OR'):
+            terms.append(self.conjunction())
+        return lambda item: any([x(item) for x in terms])
+
+    def conjunction(self):
+        terms = [self.negation()]
+        while self.keyword('AND'):
+            terms.append(self.negation())
+        return lambda item: all([x(item) for x in terms])
+
+    def negation(self):
+        if self.keyword('NOT'):
+            term = self.negation()
+            return lambda item: not term(item)
+        return self.comparison()
+
+    def comparison(self):
+        token = self.peek()
+        if token == '(':
+            self.next()
+            term = self.condition()
+            self.expect(')')
+            return term
+        if token in ['attribute_exists', 'attribute_not_exists']:
+            self.next()
+            self.expect('(')
+            path = self.path()
+            self.expect(')')
+            exists = token == 'attribute_exists'
+            return lambda item: (resolve(item, path) is not None) == exists
+        if token == 'begins_with':
+            self.next()
+            self.expect('(')
+            left = self.operand()
+            self.expect(',')
+            right = self.operand()
+            self.expect(')')
+            return lambda item: plain(left(item)) is not None and \
+                str(plain(left(item))).startswith(str(plain(right(item))))
+        left = self.operand()
+        comparator = self.comparators[self.next()]
+        right = self.operand()
+
+        def compare(item):
+            (a, b) = (plain(left(item)), plain(right(item)))
+            if a is None or b is None:
+                return False
+            return comparator(a, b)
+        return compare
+
+    def operand(self):
+        token = self.peek()
+        if token.startswith(':'):
+            self.next()
+            value = self.values[token]
+            return lambda item: value
+        if token == 'size':
+            self.next()
+            self.expect('(')
+            path = self.path()
+            self.expect(')')
+
+            def size(item):
+                value = resolve(item, path)
+                if value is None:
+                    return None
+                return {'N': str(len(list(value.values())[0]))}
+            return size
+        path = self.path()
+        return lambda item: resolve(item, path)
+
+    def path(self):
+        segments = [self.name(self.next())]
+        while self.peek() in ['.', '[']:
+            if self.next() == '.':
+                segments.append(self.name(self.next()))
+            else:
+                segments.append(int(self.next()))
+                self.expect(']')
+        return segments
+
+    def name(self, token):
+        return self.names[token] if token.startswith('#') else token
+
+    # update expressions
+
+    def update(self):
+        '''
+        Returns a function that applies the update to an item in place
+        '''
+        updates = []
+        while self.peek() is not None:
+            clause = self.next().upper()
+            while True:
+                path = self.path()
+                if clause == 'SET':
+                    self.expect('=')
+                    updates.append((clause, path, self.set_value()))
+                elif clause == 'REMOVE':
+                    updates.append((clause, path, None))
+                elif clause in ['ADD', 'DELETE']:
+                    updates.append((clause, path, self.operand()))
+                else:
+                    raise ValueError('Unknown clause: {}'.format(clause))
+                if self.peek() != ',':
+                    break
+                self.next()
+
+        def apply(item):
+            # values are evaluated against the item before it's updated
+            values = [(clause, path, value(item) if value else None) for (clause, path, value) in updates]
+            # removing list elements in descending order keeps the remaining indexes valid
+            for (clause, path, value) in sorted([x for x in values if x[0] == 'REMOVE'],
+                                                key=lambda x: x[1][-1], reverse=True):
+                remove(item, path)
+            for (clause, path, value) in values:
+                if clause == 'SET':
+                    assign(item, path, value)
+                elif clause == 'ADD':
+                    current = resolve(item, path)
+                    if 'N' in value:
+                        total = Decimal(current['N'] if current else '0') + Decimal(value['N'])
+                        assign(item, path, {'N': str(total)})
+                    else:
+                        kind = list(value.keys())[0]
+                        members = list(current[kind]) if current else []
+                        assign(item, path, {kind: members + [x for x in value[kind] if x not in members]})
+                elif clause == 'DELETE':
+                    current = resolve(item, path)
+                    if current:
+                        kind = list(value.keys())[0]
+                        members = [x for x in current[kind] if x not in value[kind]]
+                        if members:
+                            assign(item, path, {kind: members})
+                        else:
+                            remove(item, path)
+        return apply
+
+    def set_value(self):
+        left = self.set_operand()
+        if self.peek() not in ['+', '-']:
+            return left
+        sign = 1 if self.next() == '+' else -1
+        right = self.set_operand()
+        return lambda item: {'N': str(Decimal(left(item)['N']) + sign * Decimal(right(item)['N']))}
+
+    def set_operand(self):
+        token = self.peek()
+        if token == 'if_not_exists':
+            self.next()
+            self.expect('(')
+            path = self.path()
+            self.expect(',')
+            default = self.set_operand()
+            self.expect(')')
+            return lambda item: resolve(item, path) or default(item)
+        if token == 'list_append':
+            self.next()
+            self.expect('(')
+            left = self.set_operand()
+            self.expect(',')
+            right = self.set_operand()
+            self.expect(')')
+            return lambda item: {'L': left(item)['L'] + right(item)['L']}
+        return self.operand()
+
+
+def resolve(item, path):
+    '''
+    Returns the attribute value at path in item; None if there's none
+    '''
+    node = {'M': item}
+    for segment in path:
+        if isinstance(segment, int):
+            children = node.get('L')
+            node = children[segment] if children is not None and segment < len(children) else None
+        else:
+            children = node.get('M')
+            node = children.get(segment) if children is not None else None
+        if node is None:
+            return None
+    return node
+
+
+def assign(item, path, value):
+    parent = resolve(item, path[:-1])
+    if isinstance(path[-1], int):
+        if path[-1] < len(parent['L']):
+            parent['L'][path[-1]] = value
+        else:
+            parent['L'].append(value)
+    else:
+        parent['M'][path[-1]] = value
+
+
+def remove(item, path):
+    parent = resolve(item, path[:-1])
+    if parent is None:
+        return
+    if isinstance(path[-1], int):
+        if path[-1] < len(parent.get('L', [])):
+            del parent['L'][path[-1]]
+    else:
+        parent.get('M', {}).pop(path[-1], None)
+
+
+def plain(value):
+    '''
+    Returns the python value of a scalar attribute value
+    '''
+    if value is None:
+        return None
+    if 'N' in value:
+        return Decimal(value['N'])
+    if 'S' in value:
+        return value['S']
+    if 'BOOL' in value:
+        return value['BOOL']
+    return json.dumps(value, sort_keys=True)
+
+
+def copy_item(item):
+    '''
+    Returns a copy of a DynamoDB item; much cheaper than copy.deepcopy as attribute values have a known shape
+    '''
+    if item is None:
+        return None
+    return dict([(k, copy_value(v)) for (k, v) in item.items()])
+
+
+def copy_value(value):
+    if 'M' in value:
+        return {'M': copy_item(value['M'])}
+    if 'L' in value:
+        return {'L': [copy_value(x) for x in value['L']]}
+    return dict([(k, list(v) if isinstance(v, list) else v) for (k, v) in value.items()])
+
+
+class FakeDynamoDb(FakeService):
+
+    def table(self, operation, table_name):
+        if table_name not in self.aws.tables:
+            raise client_error(operation, 'ResourceNotFoundException', 'Requested resource not found')
+        return self.aws.tables[table_name]
+
+    def key(self, table, key):
+        return key[table['hash_key']]['S']
+
+    def check(self, operation, item, condition, names, values):
+        if condition and not Expression(condition, names, values).condition()(item or {}):
+            raise client_error(operation, 'ConditionalCheckFailedException', 'The conditional request failed')
+
+    def get_item(self, TableName, Key, ConsistentRead=False, **kwargs):
+        table = self.table('get_item', TableName)
+        item = table['items'].get(self.key(table, Key))
+        return {'Item': copy_item(item)} if item else {}
+
+    def put_item(self, TableName, Item, ConditionExpression=None, ExpressionAttributeNames=None,
+                 ExpressionAttributeValues=None, ReturnValues=None):
+        table = self.table('put_item', TableName)
+        key = self.key(table, Item)
+        old = table['items'].get(key)
+        self.check('put_item', old, ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues)
+        table['items'][key] = copy_item(Item)
+        # stored items are never handed out, so old needn't be copied
+        return {'Attributes': old} if ReturnValues == 'ALL_OLD' and old else {}
+
+    def update_item(self, TableName, Key, UpdateExpression, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ReturnValues=None):
+        table = self.table('update_item', TableName)
+        key = self.key(table, Key)
+        old = table['items'].get(key)
+        self.check('update_item', old, ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues)
+        update = Expression(UpdateExpression, ExpressionAttributeNames, ExpressionAttributeValues).update()
+        if ReturnValues == 'ALL_OLD':
+            item = copy_item(old) if old else copy_item(Key)
+        else:
+            # the stored item is updated in place
+            item = old if old else copy_item(Key)
+        update(item)
+        table['items'][key] = item
+        if ReturnValues == 'ALL_NEW':
+            return {'Attributes': copy_item(item)}
+        if ReturnValues == 'ALL_OLD' and old:
+            return {'Attributes': old}
+        return {}
+
+    def delete_item(self, TableName, Key, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ReturnValues=None):
+        table = self.table('delete_item', TableName)
+        key = self.key(table, Key)
+        old = table['items'].get(key)
+        self.check('delete_item', old, ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues)
+        table['items'].pop(key, None)
+        return {'Attributes': old} if ReturnValues == 'ALL_OLD' and old else {}
+
+    def batch_write_item(self, RequestItems):
+        if sum([len(x) for x in RequestItems.values()]) > 25:
+            raise client_error('batch_write_item', 'ValidationException',
+                               'Too many items requested for the BatchWriteItem call')
+        for (table_name, requests) in RequestItems.items():
+            table = self.table('batch_write_item', table_name)
+            for request in requests:
+                if 'PutRequest' in request:
+                    item = request['PutRequest']['Item']
+                    table['items'][self.key(table, item)] = copy_item(item)
+                else:
+                    table['items'].pop(self.key(table, request['DeleteRequest']['Key']), None)
+        return {'UnprocessedItems': {}}
+
+    def batch_get_item(self, RequestItems):
+        if sum([len(x['Keys']) for x in RequestItems.values()]) > 100:
+            raise client_error('batch_get_item', 'ValidationException',
+                               'Too many items requested for the BatchGetItem call')
+        responses = {}
+        for (table_name, request) in RequestItems.items():
+            table = self.table('batch_get_item', table_name)
+            items = [table['items'].get(self.key(table, x)) for x in request['Keys']]
+            responses[table_name] = [copy_item(x) for x in items if x]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+
+class FakeStepFunctions(FakeService):
+    '''
+    Forwards to the state machines registered in FakeAws.state_machines (see sfn_interpreter.StateMachine)
+    '''
+
+    def start_execution(self, stateMachineArn, name=None, input='{}'):
+        if stateMachineArn not in self.aws.state_machines:
+            raise client_error('start_execution', 'StateMachineDoesNotExist',
+                               'State Machine Does Not Exist: {}'.format(stateMachineArn))
+        return self.aws.state_machines[stateMachineArn].start_execution(name, input)
+
+    def describe_execution(self, executionArn):
+        for machine in self.aws.state_machines.values():
+            if executionArn in machine.executions:
+                return machine.describe_execution(executionArn)
+        raise client_error('describe_execution', 'ExecutionDoesNotExist',
+                           'Execution Does Not Exist: {}'.format(executionArn))
+
+    def send_task_success(self, taskToken, output):
+        for machine in self.aws.state_machines.values():
+            if taskToken in machine.tasks:
+                return machine.send_task_success(taskToken, output)
+        raise client_error('send_task_success', 'TaskDoesNotExist', 'Task Does Not Exist')
+
+
+def spoptimize_modules(name):
+    '''
+    Returns the loaded copies of spoptimize module name: the handler imports spoptimize.<name>, while modules of
+    the package import <name> (which is the same module on python 2.7)
+    '''
+    return [sys.modules[x] for x in [name, 'spoptimize.{}'.format(name)] if x in sys.modules]
+
+
+def install(aws):
+    '''
+    Routes the boto3 clients of the loaded spoptimize modules to aws, and their clocks to aws.clock;
+    the handler must have been imported
+    Returns a function that undoes the installation
+    '''
+    patches = []
+
+    def patch(obj, attr, value):
+        patches.append((obj, attr, getattr(obj, attr)))
+        setattr(obj, attr, value)
+
+    for module in spoptimize_modules('aws_clients'):
+        patch(module, 'clients', dict([(x, aws.client(x)) for x in aws.services]))
+    # the handler reports the API calls accounted by the copy its helper modules use
+    copies = spoptimize_modules('aws_clients')
+    for module in copies[1:]:
+        patch(module, 'usage', copies[0].usage)
+        patch(module, 'usage_lock', copies[0].usage_lock)
+    for module in spoptimize_modules('asg_helper'):
+        for cache in [module.asg_cache, module.launch_config_cache]:
+            cache.invalidate()
+            patch(cache, 'clock', aws.clock.time)
+    for module in spoptimize_modules('spot_helper'):
+        for cache in [module.instance_profile_cache, module.security_group_cache, module.launch_spec_cache]:
+            cache.invalidate()
+            patch(cache, 'clock', aws.clock.time)
+    for module in spoptimize_modules('stepfns'):
+        patch(module, 'datetime', aws.clock.datetime_class())
+    if 'handler' in sys.modules:
+        patch(sys.modules['handler'], 'time', aws.clock)
+
+    def uninstall():
+        for (obj, attr, value) in reversed(patches):
+            setattr(obj, attr, value)
+    return uninstall
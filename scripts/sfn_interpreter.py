@@ -0,0 +1,488 @@
+'''
+Interprets the Spoptimize state machine defined in sam.yml on a virtual clock (see fake_aws.VirtualClock)
+
+Supports the subset of the Amazon States Language sam.yml uses: Wait, Choice, Pass, Task (Lambda functions and
+lambda:invoke.waitForTaskToken), Succeed and Fail states; Retry, Catch, Parameters, ResultPath & OutputPath; and the
+States.Format, StringToJson, JsonToString, JsonMerge & MathAdd intrinsic functions
+'''
+
+import copy
+import json
+import os
+import re
+
+import yaml
+
+from fake_aws import client_error
+
+here = os.path.dirname(os.path.realpath(__file__))
+default_template = os.path.join(here, '..', 'sam.yml')
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+
+class TemplateLoader(yaml.SafeLoader):
+    '''
+    Loads Cloudformation templates, turning short-form tags such as !Sub into their Fn:: mappings
+    '''
+    pass
+
+
+def construct_intrinsic(loader, suffix, node):
+    name = suffix if suffix == 'Ref' else 'Fn::{}'.format(suffix)
+    if isinstance(node, yaml.ScalarNode):
+        return {name: loader.construct_scalar(node)}
+    if isinstance(node, yaml.SequenceNode):
+        return {name: loader.construct_sequence(node, deep=True)}
+    return {name: loader.construct_mapping(node, deep=True)}
+
+
+TemplateLoader.add_multi_constructor('!', construct_intrinsic)
+
+
+def load_definition(template_file=default_template, resource='SpotRequestor', region='us-east-1',
+                    account_id='123456789012', **parameters):
+    '''
+    Returns the definition of the state machine resource of template_file; ${...} references are substituted with
+    pseudo parameters, parameters and the template's parameter defaults
+    '''
+    with open(template_file, 'r') as f:
+        template = yaml.load(f, Loader=TemplateLoader)
+    values = dict([(k, str(v['Default'])) for (k, v) in template.get('Parameters', {}).items() if 'Default' in v])
+    values.update({'AWS::Region': region, 'AWS::AccountId': account_id, 'AWS::StackName': values.get('StackBasename')})
+    values.update(dict([(k, str(v)) for (k, v) in parameters.items()]))
+    definition = template['Resources'][resource]['Properties']['DefinitionString']
+    if isinstance(definition, dict):
+        definition = definition['Fn::Sub']
+    if isinstance(definition, list):
+        # Fn::Sub: [template, variables]
+        values.update(definition[1])
+        definition = definition[0]
+
+    def substitute(match):
+        if match.group(1).startswith('!'):
+            return '${' + match.group(1)[1:] + '}'
+        return values[match.group(1)]
+    return json.loads(re.sub(r'\$\{([^}]+)\}', substitute, definition))
+
+
+class StatesError(Exception):
+    '''
+    An error raised while running a state; error is its name as matched by Retry & Catch
+    '''
+
+    def __init__(self, error, cause=''):
+        super(StatesError, self).__init__('{0}: {1}'.format(error, cause))
+        self.error = error
+        self.cause = cause
+
+
+def get_path(data, path, context=None):
+    '''
+    Returns the value at JsonPath path ($.a.b) of data, or of context for $$ paths
+    '''
+    (node, path) = (context, path[2:]) if path.startswith('$$') else (data, path[1:])
+    for key in [x for x in path.split('.') if x]:
+        if not isinstance(node, dict) or key not in node:
+            raise StatesError('States.Runtime', 'Invalid path {}'.format(path))
+        node = node[key]
+    return node
+
+
+def set_path(data, path, value):
+    '''
+    Returns a copy of data with value set at JsonPath path
+    '''
+    if path == '$':
+        return value
+    data = copy.deepcopy(data)
+    keys = path[2:].split('.')
+    node = data
+    for key in keys[:-1]:
+        node = node.setdefault(key, {})
+    node[keys[-1]] = value
+    return data
+
+
+class Intrinsic(object):
+    '''
+    Parses & evaluates intrinsic functions, such as States.Format('{}', $.a)
+    '''
+
+    def __init__(self, text, data, context):
+        self.text = text
+        self.pos = 0
+        self.data = data
+        self.context = context
+
+    def skip_space(self):
+        while self.pos < len(self.text) and self.text[self.pos].isspace():
+            self.pos += 1
+
+    def evaluate(self):
+        self.skip_space()
+        text = self.text
+        if text.startswith("'", self.pos):
+            # string literals keep their backslash escapes for States.Format; see unescape()
+            end = self.pos + 1
+            while text[end] != "'":
+                end += 2 if text[end] == '\\' else 1
+            value = Literal(text[self.pos + 1:end])
+            self.pos = end + 1
+            return value
+        match = re.compile(r'[^,()\s]+').match(text, self.pos)
+        token = match.group(0)
+        self.pos = match.end()
+        if token.startswith('$'):
+            return get_path(self.data, token, self.context)
+        if token.startswith('States.'):
+            args = []
+            self.skip_space()
+            self.pos += 1
+            self.skip_space()
+            while text[self.pos] != ')':
+                args.append(self.evaluate())
+                self.skip_space()
+                if text[self.pos] == ',':
+                    self.pos += 1
+            self.pos += 1
+            return self.call(token, args)
+        return json.loads(token)
+
+    def call(self, name, args):
+        if name == 'States.Format':
+            (template, values) = (args[0], list(args[1:]))
+            retval = []
+            i = 0
+            while i < len(template):
+                if template[i] == '\\':
+                    retval.append(template[i + 1])
+                    i += 2
+                elif template.startswith('{}', i):
+                    value = values.pop(0)
+                    retval.append(unescape(value) if isinstance(value, string_types) else json.dumps(value))
+                    i += 2
+                else:
+                    retval.append(template[i])
+                    i += 1
+            return ''.join(retval)
+        args = [unescape(x) for x in args]
+        if name == 'States.StringToJson':
+            return json.loads(args[0])
+        if name == 'States.JsonToString':
+            return json.dumps(args[0], separators=(',', ':'))
+        if name == 'States.JsonMerge':
+            retval = dict(args[0])
+            retval.update(args[1])
+            return retval
+        if name == 'States.MathAdd':
+            return args[0] + args[1]
+        raise StatesError('States.Runtime', 'Unsupported intrinsic function {}'.format(name))
+
+
+class Literal(str):
+    '''
+    A string literal of an intrinsic function, with its backslash escapes
+    '''
+    pass
+
+
+def unescape(value):
+    if isinstance(value, Literal):
+        return re.sub(r'\\(.)', r'\1', value)
+    return value
+
+
+def evaluate_parameters(template, data, context):
+    '''
+    Returns template with its "key.$" entries replaced by the values of their paths or intrinsic functions
+    '''
+    if isinstance(template, list):
+        return [evaluate_parameters(x, data, context) for x in template]
+    if not isinstance(template, dict):
+        return template
+    retval = {}
+    for (key, value) in template.items():
+        if key.endswith('.$'):
+            if value.startswith('States.'):
+                retval[key[:-2]] = unescape(Intrinsic(value, data, context).evaluate())
+            else:
+                retval[key[:-2]] = get_path(data, value, context)
+        else:
+            retval[key] = evaluate_parameters(value, data, context)
+    return retval
+
+
+comparisons = {
+    'StringEquals': lambda a, b: a == b,
+    'StringLessThan': lambda a, b: a < b,
+    'StringGreaterThan': lambda a, b: a > b,
+    'NumericEquals': lambda a, b: a == b,
+    'NumericLessThan': lambda a, b: a < b,
+    'NumericLessThanEquals': lambda a, b: a <= b,
+    'NumericGreaterThan': lambda a, b: a > b,
+    'NumericGreaterThanEquals': lambda a, b: a >= b,
+    'BooleanEquals': lambda a, b: a == b
+}
+
+
+def choice_matches(rule, data):
+    if 'And' in rule:
+        return all([choice_matches(x, data) for x in rule['And']])
+    if 'Or' in rule:
+        return any([choice_matches(x, data) for x in rule['Or']])
+    if 'Not' in rule:
+        return not choice_matches(rule['Not'], data)
+    if 'IsPresent' in rule:
+        try:
+            get_path(data, rule['Variable'])
+            return rule['IsPresent']
+        except StatesError:
+            return not rule['IsPresent']
+    value = get_path(data, rule['Variable'])
+    if 'IsNull' in rule:
+        return (value is None) == rule['IsNull']
+    for (name, comparison) in comparisons.items():
+        if name in rule:
+            if name.startswith('Numeric') and (isinstance(value, bool) or not isinstance(value, (int, float))):
+                return False
+            return comparison(value, rule[name])
+    raise StatesError('States.Runtime', 'Unsupported choice rule {}'.format(rule))
+
+
+def error_matches(error_equals, error):
+    if error in error_equals:
+        return True
+    return 'States.ALL' in error_equals and error != 'States.Runtime'
+
+
+class Execution(object):
+
+    def __init__(self, arn, name, machine_input, start):
+        self.arn = arn
+        self.name = name
+        self.input = machine_input
+        self.status = 'RUNNING'
+        self.start = start
+        self.stop = None
+        self.output = None
+        self.error = None
+        self.cause = None
+        # (virtual time, state name) of every state entered
+        self.history = []
+
+
+class StateMachine(object):
+    '''
+    Runs executions of definition on clock; invoke(function_name, payload) runs a Lambda function, returning its
+    result or raising its exception
+    '''
+
+    def __init__(self, arn, definition, clock, invoke, lambda_seconds=0.1):
+        self.arn = arn
+        self.definition = definition
+        self.clock = clock
+        self.invoke = invoke
+        self.lambda_seconds = lambda_seconds
+        # execution arn -> Execution
+        self.executions = {}
+        # task token -> open task
+        self.tasks = {}
+        self.transitions = 0
+        self._tokens = 0
+
+    def execution_arn(self, name):
+        parts = self.arn.split(':')
+        parts[5] = 'execution'
+        return ':'.join(parts + [name])
+
+    # Step Functions API, see fake_aws.FakeStepFunctions
+
+    def start_execution(self, name, machine_input):
+        arn = self.execution_arn(name)
+        if arn in self.executions:
+            raise client_error('start_execution', 'ExecutionAlreadyExists', 'Execution Already Exists: {}'.format(arn))
+        execution = Execution(arn, name, machine_input, self.clock.now)
+        self.executions[arn] = execution
+        data = json.loads(machine_input)
+        self.clock.call_later(0, lambda: self.enter(execution, self.definition['StartAt'], data))
+        return {'executionArn': arn, 'startDate': self.clock.datetime()}
+
+    def describe_execution(self, arn):
+        execution = self.executions[arn]
+        retval = {
+            'executionArn': arn,
+            'stateMachineArn': self.arn,
+            'name': execution.name,
+            'status': execution.status,
+            'startDate': self.clock.datetime(execution.start),
+            'input': execution.input
+        }
+        if execution.stop is not None:
+            retval['stopDate'] = self.clock.datetime(execution.stop)
+        if execution.output is not None:
+            retval['output'] = execution.output
+        return retval
+
+    def send_task_success(self, token, output):
+        task = self.tasks[token]
+        if not task['open'] or task['execution'].status != 'RUNNING':
+            raise client_error('send_task_success', 'TaskTimedOut', 'Task Timed Out: {}'.format(token))
+        task['open'] = False
+        result = json.loads(output)
+        self.clock.call_later(0, lambda: self.task_succeeded(task, result))
+        return {}
+
+    # interpreter
+
+    def enter(self, execution, name, data):
+        if execution.status != 'RUNNING':
+            return
+        self.transitions += 1
+        execution.history.append((self.clock.now, name))
+        state = self.definition['States'][name]
+        context = {
+            'Execution': {'Id': execution.arn, 'Name': execution.name, 'StartTime': self.clock.isoformat(execution.start)},
+            'State': {'Name': name, 'EnteredTime': self.clock.isoformat()},
+            'StateMachine': {'Id': self.arn}
+        }
+        try:
+            state_input = get_path(data, state.get('InputPath', '$'))
+            getattr(self, 'run_{}'.format(state['Type'].lower()))(execution, name, state, state_input, context)
+        except StatesError as e:
+            self.finish(execution, 'FAILED', error=e.error, cause=e.cause)
+
+    def run_pass(self, execution, name, state, data, context):
+        result = data
+        if 'Result' in state:
+            result = state['Result']
+        elif 'Parameters' in state:
+            result = evaluate_parameters(state['Parameters'], data, context)
+        self.advance(execution, state, data, result)
+
+    def run_wait(self, execution, name, state, data, context):
+        seconds = state['Seconds'] if 'Seconds' in state else get_path(data, state['SecondsPath'])
+        self.clock.call_later(seconds, lambda: self.advance(execution, state, data, data))
+
+    def run_choice(self, execution, name, state, data, context):
+        for rule in state['Choices']:
+            if choice_matches(rule, data):
+                return self.goto(execution, rule['Next'], data)
+        if 'Default' not in state:
+            raise StatesError('States.NoChoiceMatched', 'No choice matched in state {}'.format(name))
+        self.goto(execution, state['Default'], data)
+
+    def run_succeed(self, execution, name, state, data, context):
+        self.finish(execution, 'SUCCEEDED', output=data)
+
+    def run_fail(self, execution, name, state, data, context):
+        self.finish(execution, 'FAILED', error=state.get('Error'), cause=state.get('Cause'))
+
+    def run_task(self, execution, name, state, data, context):
+        task = {'execution': execution, 'name': name, 'state': state, 'data': data, 'context': context,
+                'attempts': {}, 'open': False}
+        self.attempt(task)
+
+    def attempt(self, task):
+        state = task['state']
+        parameters = task['data']
+        if 'Parameters' in state:
+            context = dict(task['context'])
+            if state['Resource'].endswith('.waitForTaskToken'):
+                self._tokens += 1
+                token = 'token-{}'.format(self._tokens)
+                context['Task'] = {'Token': token}
+                task['open'] = True
+                self.tasks[token] = task
+                task['token'] = token
+            parameters = evaluate_parameters(state['Parameters'], task['data'], context)
+        if state['Resource'].endswith('.waitForTaskToken'):
+            (function_name, payload) = (parameters['FunctionName'], parameters.get('Payload', {}))
+            if 'TimeoutSeconds' in state:
+                token = task['token']
+                self.clock.call_later(state['TimeoutSeconds'], lambda: self.task_timed_out(task, token))
+        else:
+            (function_name, payload) = (state['Resource'].split(':')[-1], parameters)
+        self.clock.call_later(self.lambda_seconds, lambda: self.invoke_function(task, function_name, payload))
+
+    def invoke_function(self, task, function_name, payload):
+        if task['execution'].status != 'RUNNING':
+            return
+        waiting = task['state']['Resource'].endswith('.waitForTaskToken')
+        try:
+            # results & payloads are serialized, as by Lambda
+            result = self.invoke(function_name, json.loads(json.dumps(payload)))
+            result = json.loads(json.dumps(result))
+        except Exception as e:
+            if waiting:
+                if not task['open']:
+                    return
+                task['open'] = False
+            return self.task_failed(task, type(e).__name__, str(e))
+        if not waiting:
+            self.task_succeeded(task, result)
+
+    def task_timed_out(self, task, token):
+        if task['open'] and task.get('token') == token:
+            task['open'] = False
+            self.task_failed(task, 'States.Timeout', 'Task timed out')
+
+    def task_succeeded(self, task, result):
+        execution = task['execution']
+        if execution.status != 'RUNNING':
+            return
+        try:
+            self.advance(execution, task['state'], task['data'], result)
+        except StatesError as e:
+            self.finish(execution, 'FAILED', error=e.error, cause=e.cause)
+
+    def task_failed(self, task, error, cause):
+        execution = task['execution']
+        if execution.status != 'RUNNING':
+            return
+        state = task['state']
+        for (i, retrier) in enumerate(state.get('Retry', [])):
+            if error_matches(retrier['ErrorEquals'], error):
+                attempts = task['attempts'].get(i, 0)
+                if attempts < retrier.get('MaxAttempts', 3):
+                    task['attempts'][i] = attempts + 1
+                    delay = retrier.get('IntervalSeconds', 1) * retrier.get('BackoffRate', 2.0) ** attempts
+                    self.clock.call_later(delay, lambda: self.attempt(task))
+                    return
+                break
+        for catcher in state.get('Catch', []):
+            if error_matches(catcher['ErrorEquals'], error):
+                data = task['data']
+                result_path = catcher.get('ResultPath', '$')
+                if result_path is not None:
+                    data = set_path(data, result_path, {'Error': error, 'Cause': cause})
+                return self.goto(execution, catcher['Next'], data)
+        self.finish(execution, 'FAILED', error=error, cause=cause)
+
+    def advance(self, execution, state, data, result):
+        '''
+        Applies result to data per ResultPath & OutputPath and moves on to the next state
+        '''
+        if 'ResultPath' in state and state['ResultPath'] is None:
+            output = data
+        else:
+            output = set_path(data, state.get('ResultPath', '$'), result)
+        output = get_path(output, state.get('OutputPath', '$'))
+        if state.get('End'):
+            return self.finish(execution, 'SUCCEEDED', output=output)
+        self.goto(execution, state['Next'], output)
+
+    def goto(self, execution, name, data):
+        self.clock.call_later(0, lambda: self.enter(execution, name, data))
+
+    def finish(self, execution, status, output=None, error=None, cause=None):
+        if execution.status != 'RUNNING':
+            return
+        execution.status = status
+        execution.stop = self.clock.now
+        execution.output = json.dumps(output) if output is not None else None
+        execution.error = error
+        execution.cause = cause
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+'''
+Runs simulated instance launches through the real handler actions and the state machine of sam.yml, offline: AWS is
+replaced by the stand-ins of fake_aws.py and time is virtual, so hours of launches run in seconds. Reports swaps per
+hour, API calls per swap and the time executions spend waiting for their group's lock. As in the default stack, EC2
+events only reach the spot fulfillment function with --env SPOPTIMIZE_SPOT_FULFILLMENT_EVENTS=true.
+
+    $ python scripts/simulate-throughput.py [--groups N] [--launches N] [--burst N] [--duration SECONDS]
+                                            [--tag max_concurrent_swaps=2] [--env SPOPTIMIZE_ADAPTIVE_WAITS=true]
+'''
+
+import argparse
+import json
+import logging
+import os
+import sys
+
+here = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, here)
+
+import fake_aws  # noqa: E402
+import simulation  # noqa: E402
+
+
+def print_results(results):
+    print('{0:<36}{1:>12}'.format('launches', results['launches']))
+    print('{0:<36}{1:>12}'.format('executions', results['executions']))
+    for (outcome, count) in sorted(results['execution_outcomes'].items()):
+        print('  {0:<50}{1:>8}'.format(outcome, count))
+    print('{0:<36}{1:>12}'.format('swaps', results['swaps']))
+    print('{0:<36}{1:>12.1f}'.format('swaps per hour', results['swaps_per_hour']))
+    print('{0:<36}{1:>12.1f}'.format('API calls per swap', results['api_calls_per_swap']))
+    print('{0:<36}{1:>12.1f}'.format('Lambda invocations per swap', results['lambda_invocations_per_swap']))
+    print('{0:<36}{1:>12.1f}'.format('state transitions per swap', results['state_transitions_per_swap']))
+    print('')
+    print('{0:<36}{1:>8}{2:>8}{3:>8}{4:>8}{5:>8}'.format('seconds', 'count', 'mean', 'p50', 'p90', 'max'))
+    for key in ['swap_seconds', 'lock_wait_seconds']:
+        stats = results[key]
+        if stats['count']:
+            print('{0:<36}{1:>8}{2:>8.0f}{3:>8.0f}{4:>8.0f}{5:>8.0f}'.format(
+                key.replace('_seconds', '').replace('_', ' '), stats['count'], stats['mean'], stats['p50'],
+                stats['p90'], stats['max']))
+    print('')
+    print('{0:<60}{1:>8}'.format('API calls', results['api_calls']))
+    for (operation, count) in sorted(results['api_calls_by_operation'].items(), key=lambda x: (-x[1], x[0])):
+        print('  {0:<58}{1:>8}'.format(operation, count))
+    print('{0:<60}{1:>8}'.format('Lambda invocations', results['lambda_invocations']))
+    for (action, count) in sorted(results['lambda_invocations_by_action'].items(), key=lambda x: (-x[1], x[0])):
+        print('  {0:<58}{1:>8}'.format(action, count))
+    for (error, count) in sorted(results['lambda_errors'].items()):
+        print('  {0:<58}{1:>8}'.format('error ' + error, count))
+    print('')
+    print('Simulated {0:.1f} hours in {1:.1f} seconds'.format(results['virtual_hours'], results['wall_seconds']))
+
+
+def key_value(text):
+    if '=' not in text:
+        raise argparse.ArgumentTypeError('Expected KEY=VALUE: {}'.format(text))
+    return tuple(text.split('=', 1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate Spoptimize replacing instances, offline')
+    parser.add_argument('--groups', type=int, default=4, help='Autoscaling groups (default: 4)')
+    parser.add_argument('--launches', type=int, default=100, help='Instances launched in all (default: 100)')
+    parser.add_argument('--burst', type=int, default=1, help='Instances launched per scale out (default: 1)')
+    parser.add_argument('--duration', type=float, default=3600,
+                        help='Seconds over which scale outs happen; 0 for all at once (default: 3600)')
+    parser.add_argument('--headroom', type=int, default=1,
+                        help="Instances groups' Max Size exceeds their final Desired Capacity by (default: 1)")
+    parser.add_argument('--scale-in-after', type=float,
+                        help='Seconds after each scale out to scale in by as many instances (default: never)')
+    parser.add_argument('--horizon', type=float, default=72 * 3600,
+                        help='Seconds after the last scale out executions may run for (default: 72 hours)')
+    parser.add_argument('--tag', type=key_value, action='append', default=[], metavar='KEY=VALUE',
+                        help='spoptimize:KEY group tag, e.g. max_concurrent_swaps=2')
+    parser.add_argument('--env', type=key_value, action='append', default=[], metavar='KEY=VALUE',
+                        help='Lambda environment variable, e.g. SPOPTIMIZE_ADAPTIVE_WAITS=true')
+    parser.add_argument('--boot-seconds', type=float, default=fake_aws.default_settings['boot_seconds'])
+    parser.add_argument('--spot-fulfillment-seconds', type=float,
+                        default=fake_aws.default_settings['spot_fulfillment_seconds'])
+    parser.add_argument('--spot-failure-rate', type=float, default=fake_aws.default_settings['spot_failure_rate'])
+    parser.add_argument('--max-spot-instances', type=int, default=fake_aws.default_settings['max_spot_instances'])
+    parser.add_argument('--lambda-seconds', type=float, default=0.1, help='Duration of each Lambda invocation')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    parser.add_argument('-v', '--verbose', action='store_true', help="Print the handler's logs")
+    args = parser.parse_args()
+
+    handler = simulation.import_handler(dict(args.env))
+    if args.verbose:
+        from spoptimize.logging_helper import setup_stream_handler
+        setup_stream_handler()
+    else:
+        logging.disable(logging.CRITICAL)
+    sim = simulation.Simulation(
+        handler, groups=args.groups, launches=args.launches, burst=args.burst, duration=args.duration,
+        headroom=args.headroom, scale_in_after=args.scale_in_after, tags=dict(args.tag), seed=args.seed,
+        lambda_seconds=args.lambda_seconds, boot_seconds=args.boot_seconds,
+        spot_fulfillment_seconds=args.spot_fulfillment_seconds, spot_failure_rate=args.spot_failure_rate,
+        max_spot_instances=args.max_spot_instances)
+    results = sim.results(sim.run(args.horizon))
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        print_results(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+'''
+Runs simulated instance launches through the real handler actions and the state machine of sam.yml on a virtual clock,
+against the stand-ins of fake_aws.py; see simulate-throughput.py and benchmark-actions.py
+'''
+
+import collections
+import json
+import os
+import random
+import sys
+import time
+
+import fake_aws
+import sfn_interpreter
+
+here = os.path.dirname(os.path.realpath(__file__))
+repo_dir = os.path.realpath(os.path.join(here, '..'))
+
+region = 'us-east-1'
+account_id = '123456789012'
+state_machine_arn = 'arn:aws:states:{0}:{1}:stateMachine:spoptimize'.format(region, account_id)
+lock_table = 'spoptimize-simulation'
+subnets = [('subnet-0000000a', 'us-east-1a'), ('subnet-0000000b', 'us-east-1b'), ('subnet-0000000c', 'us-east-1c')]
+# retry delays of asynchronous Lambda invocations (SNS notifications & CloudWatch events)
+async_retry_delays = [60, 120]
+
+
+def import_handler(env=None):
+    '''
+    Imports the handler as Lambda would, configured to use the simulated lock table & state machine
+    '''
+    os.environ.setdefault('AWS_DEFAULT_REGION', region)
+    os.environ['SPOPTIMIZE_LOCK_TABLE'] = lock_table
+    os.environ['SPOPTIMIZE_SFN_ARN'] = state_machine_arn
+    # as sam.yml's SpotFulfillmentEvents defaults to false, the spot fulfillment function isn't deployed unless
+    # env enables it
+    os.environ['SPOPTIMIZE_SPOT_FULFILLMENT_EVENTS'] = 'false'
+    os.environ.update(env or {})
+    sys.path.insert(0, repo_dir)
+    # modules of the package import each other by their bare names
+    sys.path.append(os.path.join(repo_dir, 'spoptimize'))
+    import handler
+    return handler
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'mean': sum(values) / float(len(values)),
+        'p50': values[int(round(0.5 * (len(values) - 1)))],
+        'p90': values[int(round(0.9 * (len(values) - 1)))],
+        'max': values[-1]
+    }
+
+
+class Simulation(object):
+    '''
+    Scales out groups at random (virtual) times over duration seconds, for launches instances in all, and replaces
+    them via the state machine; with scale_in_after, each scale out is undone that many seconds later
+    '''
+
+    def __init__(self, handler, groups=4, launches=100, burst=1, duration=3600, headroom=1, scale_in_after=None,
+                 tags=None, seed=0, lambda_seconds=0.1, **settings):
+        self.handler = handler
+        self.clock = fake_aws.VirtualClock()
+        self.start = self.clock.now
+        self.duration = duration
+        self.aws = fake_aws.FakeAws(self.clock, seed=seed, region=region, account_id=account_id, **settings)
+        self.invocations = collections.Counter()
+        self.errors = collections.Counter()
+        random.seed(seed)
+
+        aws = self.aws
+        aws.create_table(lock_table)
+        aws.create_instance_profile('spoptimize-simulation')
+        security_group_id = aws.create_security_group('spoptimize-simulation')
+        aws.create_launch_config('spoptimize-simulation', IamInstanceProfile='spoptimize-simulation',
+                                 SecurityGroups=[security_group_id], KeyName='spoptimize-simulation')
+        group_names = ['spoptimize-simulation-{:02d}'.format(x) for x in range(groups)]
+        bursts = [burst] * (launches // burst) + ([launches % burst] if launches % burst else [])
+        # random.choice() draws differently on python 2 & 3; uniform() and random() don't
+        schedule = sorted([(aws.random.uniform(0, duration), group_names[int(aws.random.random() * groups)], x)
+                           for x in bursts])
+        for group_name in group_names:
+            launched = sum([x[2] for x in schedule if x[1] == group_name])
+            group_tags = [('Name', group_name, True)] + [
+                ('spoptimize:{}'.format(k), v, False) for (k, v) in sorted((tags or {}).items())]
+            aws.create_group(group_name, 'spoptimize-simulation', subnets, min_size=0, max_size=launched + headroom,
+                             grace_period=60, tags=group_tags)
+        for (when, group_name, count) in schedule:
+            self.clock.call_at(self.start + when, lambda g=group_name, n=count: aws.scale_out(g, n))
+            if scale_in_after is not None:
+                self.clock.call_at(self.start + when + scale_in_after,
+                                   lambda g=group_name, n=count: aws.scale_in(g, n))
+
+        self.machine = sfn_interpreter.StateMachine(
+            state_machine_arn, sfn_interpreter.load_definition(region=region, account_id=account_id),
+            self.clock, self.invoke, lambda_seconds)
+        aws.state_machines[state_machine_arn] = self.machine
+        aws.subscribe('autoscaling', self.launch_notification)
+        aws.subscribe('ec2', self.ec2_event)
+
+    def run_function(self, name, func, event):
+        '''
+        Runs Lambda function func for event, counted as an invocation of name; every invocation goes through here
+        '''
+        self.invocations[name] += 1
+        return func(event, None)
+
+    def invoke(self, function_name, payload):
+        '''
+        Runs the function invoked by the state machine
+        '''
+        return self.run_function(payload.get('spoptimize_action', function_name), self.handler.handler, payload)
+
+    def invoke_async(self, name, func, event, attempt=0):
+        '''
+        Runs func(event, None) as an asynchronously invoked Lambda function, retried after errors
+        '''
+        try:
+            self.run_function(name, func, json.loads(json.dumps(event)))
+        except Exception as e:
+            self.errors['{0}: {1}'.format(name, type(e).__name__)] += 1
+            if attempt < len(async_retry_delays):
+                self.clock.call_later(async_retry_delays[attempt],
+                                      lambda: self.invoke_async(name, func, event, attempt + 1))
+
+    def launch_notification(self, message):
+        # each SNS notification is delivered to the start-state-machine function on its own
+        event = {'spoptimize_action': 'start-state-machine', 'state': {'Records': [{
+            'EventSource': 'aws:sns',
+            'Sns': {'Type': 'Notification', 'Subject': message['Description'], 'Message': json.dumps(message)}
+        }]}}
+        self.invoke_async('start-state-machine', self.handler.handler, event)
+
+    def ec2_event(self, event):
+        # EC2 events are only routed to the spot fulfillment function where it's deployed
+        if not self.handler.spot_fulfillment_events():
+            return
+        self.invoke_async('spot-fulfillment', self.handler.spot_fulfillment_handler, event)
+
+    def run(self, horizon):
+        '''
+        Runs until every execution has ended, or horizon seconds of virtual time after the last launch
+        Returns the wall clock seconds the simulation took
+        '''
+        uninstall = fake_aws.install(self.aws)
+        t0 = time.time()
+        try:
+            self.clock.run(until=self.start + self.duration + horizon)
+        finally:
+            uninstall()
+        return time.time() - t0
+
+    def results(self, wall_seconds):
+        executions = list(self.machine.executions.values())
+        swaps = 0
+        swap_seconds = []
+        lock_waits = []
+        last_swap = self.start
+        for execution in executions:
+            states = [x[1] for x in execution.history]
+            if execution.status == 'SUCCEEDED' and 'Release Lock after Success' in states:
+                output = json.loads(execution.output)
+                swapped = output.get('ondemand_instance_ids') or [output['ondemand_instance_id']]
+                swaps += len(swapped)
+                last_swap = max(last_swap, execution.stop)
+                swap_seconds.extend([execution.stop - self.aws.instances[x]['launched_at'] for x in swapped])
+            # time from requesting a lock until holding it, summed over the execution's attempts
+            (waited, requested_at) = (None, None)
+            for (when, name) in execution.history:
+                if name == 'Acquire AutoScaling Group Lock' and requested_at is None:
+                    requested_at = when
+                elif name == 'Attach Spot Instance' and requested_at is not None:
+                    waited = (waited or 0) + when - requested_at
+                    requested_at = None
+            if waited is not None:
+                lock_waits.append(waited)
+        api_calls = sum(self.aws.calls.values())
+        hours = (last_swap - self.start) / 3600.0
+        per_swap = float(swaps) if swaps else float('nan')
+        return {
+            'launches': sum([1 for x in self.aws.instances.values() if not x['SpotInstanceRequestId']]),
+            'executions': len(executions),
+            'execution_outcomes': dict(collections.Counter(
+                ['{0}: {1}'.format(x.status, x.history[-1][1] if x.history else '') for x in executions])),
+            'swaps': swaps,
+            'swaps_per_hour': swaps / hours if hours else float('nan'),
+            'swap_seconds': percentiles(swap_seconds),
+            'lock_wait_seconds': percentiles(lock_waits),
+            'api_calls': api_calls,
+            'api_calls_per_swap': api_calls / per_swap,
+            'api_calls_by_operation': dict([('{0}.{1}'.format(*k), v) for (k, v) in self.aws.calls.items()]),
+            'lambda_invocations': sum(self.invocations.values()),
+            'lambda_invocations_per_swap': sum(self.invocations.values()) / per_swap,
+            'lambda_invocations_by_action': dict(self.invocations),
+            'lambda_errors': dict(self.errors),
+            'state_transitions_per_swap': self.machine.transitions / per_swap,
+            'virtual_hours': (self.clock.now - self.start) / 3600.0,
+            'wall_seconds': wall_seconds
+        }
@@ -1,21 +1,36 @@
-import boto3
 import logging
 import re
 
 from botocore.exceptions import ClientError
 
+import aws_clients
 import stepfn_strings as strs
+import util
 
 logger = logging.getLogger()
 logging.getLogger('boto3').setLevel(logging.WARNING)
 logging.getLogger('botocore').setLevel(logging.WARNING)
 
-autoscaling = boto3.client('autoscaling')
+autoscaling = aws_clients.client('autoscaling')
 
+# autoscaling group descriptions are shared by every action of a warm container for a few seconds, so that a
+# burst of launch notifications or health polls for one group results in a single DescribeAutoScalingGroups call
+asg_cache_ttl = 10
+asg_cache = util.ExpiringCache(asg_cache_ttl)
+
+# launch configurations are immutable, but may be deleted and re-created under the same name
+launch_config_cache_ttl = 3600
+launch_config_cache = util.ExpiringCache(launch_config_cache_ttl)
+
+# AttachInstances accepts at most 20 instances per call
+max_attach_instances = 20
+terminate_concurrency = 4
+# AutoScaling describes at most 50 instances per call
+max_describe_instances = 50
 
 asg_copy_keys = [
     'AutoScalingGroupName',
-    # 'LaunchConfigurationName',
+    'LaunchConfigurationName',
     'HealthCheckGracePeriod',
     'MinSize',
     'MaxSize',
@@ -24,55 +39,120 @@ asg_copy_keys = [
 ]
 
 
-def describe_asg(asg_name):
+def invalidate_asg_cache(asg_name=None):
     '''
-    Calls autoscaling.describe_auto_scaling_groups()
-    Returns a dict containing autoscaling group description; Empty dict for group not found
+    Discards the cached description of asg_name; discards all cached descriptions if asg_name is None
     '''
-    logger.debug('Querying for autoscaling group {}'.format(asg_name))
-    retval = {}
+    asg_cache.invalidate(asg_name)
+
+
+def describe_group(asg_name, max_age=None):
+    '''
+    Calls autoscaling.describe_auto_scaling_groups() unless a description of asg_name younger than max_age seconds
+    (defaults to asg_cache_ttl) is cached
+    Returns the full autoscaling group description, including Instances; Empty dict for group not found
+    '''
+    group = asg_cache.get(asg_name, max_age)
+    if group is not None:
+        logger.debug('Using cached description of autoscaling group %s', asg_name)
+        return group
+    logger.debug('Querying for autoscaling group %s', asg_name)
     resp = autoscaling.describe_auto_scaling_groups(AutoScalingGroupNames=[asg_name])
     if len(resp['AutoScalingGroups']):
-        logger.debug('Autoscaling group {} found'.format(asg_name))
+        return asg_cache.set(asg_name, resp['AutoScalingGroups'][0])
+    return asg_cache.set(asg_name, {})
+
+
+def describe_asg(asg_name, max_age=None):
+    '''
+    Calls autoscaling.describe_auto_scaling_groups() (see describe_group)
+    Returns a dict containing autoscaling group description; Empty dict for group not found
+    '''
+    retval = {}
+    group = describe_group(asg_name, max_age)
+    if group:
+        logger.debug('Autoscaling group %s found', asg_name)
         for k in asg_copy_keys:
-            retval[k] = resp['AutoScalingGroups'][0][k]
+            if k in group:
+                retval[k] = group[k]
         return retval
-    logger.debug('Autoscaling group {} not found'.format(asg_name))
+    logger.debug('Autoscaling group %s not found', asg_name)
     return retval
 
 
-def get_launch_config(asg_name):
+def describe_launch_config(lc_name):
     '''
-    Fetches the launch configuration of the specified autoscaling group
-    Returns a dict containing the launch configuration; Empty dict for group or luanch-config not found
+    Calls autoscaling.describe_launch_configurations() unless lc_name is cached
+    Returns a dict containing the launch configuration; Empty dict for launch-config not found
     '''
-    logger.debug('Querying for launch config for autoscaling group {}'.format(asg_name))
-    resp = autoscaling.describe_auto_scaling_groups(AutoScalingGroupNames=[asg_name])
-    if len(resp.get('AutoScalingGroups', [])) == 0:
-        return {}
-    lc_name = resp['AutoScalingGroups'][0]['LaunchConfigurationName']
-    logger.debug('Querying for launchh config {}'.format(lc_name))
+    launch_config = launch_config_cache.get(lc_name)
+    if launch_config is not None:
+        logger.debug('Using cached launch config %s', lc_name)
+        return launch_config
+    logger.debug('Querying for launch config %s', lc_name)
     resp = autoscaling.describe_launch_configurations(LaunchConfigurationNames=[lc_name])
     if len(resp['LaunchConfigurations']):
-        logger.debug('Launch config {} found'.format(lc_name))
-        return resp['LaunchConfigurations'][0]
-    logger.debug('Launch config {} not found'.format(lc_name))
+        logger.debug('Launch config %s found', lc_name)
+        return launch_config_cache.set(lc_name, resp['LaunchConfigurations'][0])
+    logger.debug('Launch config %s not found', lc_name)
     return {}
 
 
+def get_launch_config(asg_name, lc_name=None):
+    '''
+    Fetches the launch configuration of the specified autoscaling group
+    lc_name: Name of the group's launch configuration, if known; saves a describe of the group unless it no longer
+             exists, e.g. because a stack update replaced the group's launch configuration
+    Returns a dict containing the launch configuration; Empty dict for group or luanch-config not found
+    '''
+    if lc_name:
+        launch_config = describe_launch_config(lc_name)
+        if launch_config:
+            return launch_config
+        logger.info('Launch config {0} no longer exists; using the current launch config of {1}'.format(lc_name, asg_name))
+        launch_config_cache.invalidate(lc_name)
+        invalidate_asg_cache(asg_name)
+    logger.debug('Querying for launch config for autoscaling group %s', asg_name)
+    group = describe_group(asg_name)
+    if not group.get('LaunchConfigurationName') or group['LaunchConfigurationName'] == lc_name:
+        return {}
+    return describe_launch_config(group['LaunchConfigurationName'])
+
+
 def get_instance_status(instance_id):
     '''
     Fetches the autoscaling health status of instance_id
     Returns a string
     '''
-    logger.debug('Fetching autoscaling health status for {}'.format(instance_id))
+    logger.debug('Fetching autoscaling health status for %s', instance_id)
     resp = autoscaling.describe_auto_scaling_instances(InstanceIds=[instance_id])
     # instance is terminated or detatched if empty
     if not len(resp['AutoScalingInstances']):
         logger.info('{0} terminated or not managed by autoscaling'.format(instance_id))
         return strs.asg_instance_terminated
-    instance_detail = resp['AutoScalingInstances'][0]
-    logger.debug('{0} details: {1}'.format(instance_id, instance_detail))
+    return instance_status(instance_id, resp['AutoScalingInstances'][0])
+
+
+def group_instance_status(group, instance_id):
+    '''
+    Evaluates the autoscaling health status of instance_id using group, as returned by describe_group()
+    Returns a string; no API calls are made
+    '''
+    instance_detail = [x for x in group.get('Instances', []) if x['InstanceId'] == instance_id]
+    # instance is terminated or detatched if absent
+    if not instance_detail:
+        logger.info('{0} terminated or not managed by {1}'.format(instance_id, group.get('AutoScalingGroupName')))
+        return strs.asg_instance_terminated
+    return instance_status(instance_id, instance_detail[0])
+
+
+def instance_status(instance_id, instance_detail):
+    '''
+    Evaluates instance_detail, instance_id as described by the autoscaling api
+    Returns a string
+    '''
+    # HealthStatus is HEALTHY in instance descriptions, but Healthy in group descriptions
+    logger.debug('%s details: %s', instance_id, instance_detail)
     if re.match(r'^terminat', instance_detail.get('LifecycleState', 'unknown').lower()):
         logger.info('{0} is being terminated by autoscaling'.format(instance_id))
         # instance is being terminated
@@ -89,7 +169,7 @@ def get_instance_status(instance_id):
         logger.info('{0} is marked as standby in autoscaling'.format(instance_id))
         return strs.asg_instance_protected
     if instance_detail.get('LifecycleState') == 'InService' \
-            and instance_detail.get('HealthStatus') == 'HEALTHY':
+            and instance_detail.get('HealthStatus', '').upper() == 'HEALTHY':
         logger.info('{0} is healthy and in-service in autoscaling'.format(instance_id))
         # Healthy instance!
         return strs.asg_instance_healthy
@@ -99,30 +179,71 @@ def get_instance_status(instance_id):
     return strs.asg_instance_pending
 
 
+def instance_groups(instance_ids):
+    '''
+    Calls autoscaling.describe_auto_scaling_instances() for up to max_describe_instances at a time
+    Returns a dict mapping each of instance_ids that belongs to an autoscaling group to the group's name
+    '''
+    retval = {}
+    for idx in range(0, len(instance_ids), max_describe_instances):
+        chunk = instance_ids[idx:idx + max_describe_instances]
+        logger.debug('Querying autoscaling groups of %s', ', '.join(chunk))
+        resp = autoscaling.describe_auto_scaling_instances(InstanceIds=chunk)
+        retval.update({x['InstanceId']: x['AutoScalingGroupName'] for x in resp.get('AutoScalingInstances', [])})
+    return retval
+
+
+def set_desired_capacity(asg_name, desired_capacity):
+    logger.info('Setting desired capacity of AutoScaling group {0} to {1}'.format(asg_name, desired_capacity))
+    invalidate_asg_cache(asg_name)
+    autoscaling.set_desired_capacity(AutoScalingGroupName=asg_name, DesiredCapacity=desired_capacity,
+                                     HonorCooldown=False)
+
+
 def terminate_instance(instance_id, decrement_cap):
     '''
     Terminates instance_id via the autoscaling api
-    No return value
+    Returns a string describing the status of the termination
     '''
     logger.info('Terminating autoscaling instance {0}; decrement capacity: {1}'.format(instance_id, decrement_cap))
+    # the instance's group is unknown here
+    invalidate_asg_cache()
     try:
         autoscaling.terminate_instance_in_auto_scaling_group(
             InstanceId=instance_id, ShouldDecrementDesiredCapacity=decrement_cap)
     except ClientError as c:
         if re.match(r'.*not found.*', c.response['Error']['Message']):
             logger.info('Autoscaling instance {} not found ... ignoring'.format(instance_id))
+            return strs.asg_instance_terminated
         else:
             raise
+    return strs.success
 
 
-def attach_instance(asg_name, instance_id):
+def terminate_instances(instance_ids, decrement_cap, concurrency=None):
     '''
-    Attaches instance_id to the specified autoscaling group
+    Terminates instance_ids via the autoscaling api, concurrency (defaults to terminate_concurrency) at a time
+    Returns a dict mapping each instance id to a string describing the status of its termination
+
+    Every termination is attempted before the first exception raised, if any, is re-raised
+    '''
+    results = util.concurrent_map(lambda x: terminate_instance(x, decrement_cap), instance_ids,
+                                  concurrency or terminate_concurrency)
+    for res in results:
+        if isinstance(res, Exception):
+            raise res
+    return dict(zip(instance_ids, results))
+
+
+def attach_instances(asg_name, instance_ids):
+    '''
+    Attaches instance_ids to the specified autoscaling group with a single API call
     Returns a string describing the status of the attachment
     '''
-    logger.info('Attaching {0} to AutoScaling group {1}'.format(instance_id, asg_name))
+    logger.info('Attaching {0} to AutoScaling group {1}'.format(', '.join(instance_ids), asg_name))
+    invalidate_asg_cache(asg_name)
     try:
-        autoscaling.attach_instances(InstanceIds=[instance_id], AutoScalingGroupName=asg_name)
+        autoscaling.attach_instances(InstanceIds=instance_ids, AutoScalingGroupName=asg_name)
     except ClientError as c:
         if re.match(r'.*please update the AutoScalingGroup sizes appropriately', c.response['Error']['Message']):
             logger.error(c.response['Error']['Message'])
@@ -137,21 +258,46 @@ def attach_instance(asg_name, instance_id):
             logger.error(c.response['Error']['Message'])
             return strs.asg_instance_invalid
         raise
-    logger.debug('Successfully attached {0} to {1}'.format(instance_id, asg_name))
+    logger.debug('Successfully attached %s to %s', ', '.join(instance_ids), asg_name)
     return strs.success
 
 
-def not_enough_protected_instances(asg_name, min_protected):
+def attach_instance_batch(asg_name, instance_ids):
+    '''
+    Attaches instance_ids to the specified autoscaling group, up to max_attach_instances per API call
+    Returns a dict mapping each instance id to a string describing the status of its attachment
+    '''
+    results = {}
+    for idx in range(0, len(instance_ids), max_attach_instances):
+        chunk = instance_ids[idx:idx + max_attach_instances]
+        status = attach_instances(asg_name, chunk)
+        if len(chunk) > 1 and status in [strs.asg_instance_missing, strs.asg_instance_invalid]:
+            # the call fails as a whole; attach one at a time to find the instance at fault
+            logger.info('Attaching {} individually'.format(', '.join(chunk)))
+            results.update({x: attach_instances(asg_name, [x]) for x in chunk})
+        else:
+            results.update({x: status for x in chunk})
+    return results
+
+
+def attach_instance(asg_name, instance_id):
+    '''
+    Attaches instance_id to the specified autoscaling group
+    Returns a string describing the status of the attachment
     '''
-    Calls autoscaling.describe_auto_scaling_groups()
+    return attach_instances(asg_name, [instance_id])
+
+
+def not_enough_protected_instances(asg_name, min_protected, max_age=None):
+    '''
+    Calls autoscaling.describe_auto_scaling_groups() (see describe_group)
     Returns True if the number of instances with ProtectedFromScaleIn=True is less than min_protected
     '''
-    logger.debug('Querying for autoscaling group {}'.format(asg_name))
-    resp = autoscaling.describe_auto_scaling_groups(AutoScalingGroupNames=[asg_name])
-    if len(resp['AutoScalingGroups']) == 0:
-        logger.debug('Autoscaling group {} not found'.format(asg_name))
+    group = describe_group(asg_name, max_age)
+    if not group:
+        logger.debug('Autoscaling group %s not found', asg_name)
         return False
-    asg_instances = resp['AutoScalingGroups'][0].get('Instances')
+    asg_instances = group.get('Instances')
     if not asg_instances:
         logger.debug('No instances found')
         return False
@@ -166,4 +312,5 @@ def not_enough_protected_instances(asg_name, min_protected):
 
 
 def protect_instance(asg_name, instance_id):
+    invalidate_asg_cache(asg_name)
     autoscaling.set_instance_protection(InstanceIds=[instance_id], AutoScalingGroupName=asg_name, ProtectedFromScaleIn=True)
@@ -0,0 +1,130 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger()
+
+# boto3 clients shared by every helper module of a (warm) Lambda container; keyed by service name
+clients = {}
+clients_lock = threading.Lock()
+
+# API calls made since reset_usage(); keyed by '<service>.<operation>'
+usage = {}
+usage_lock = threading.Lock()
+
+# client methods that don't call the API
+unaccounted_methods = ['can_paginate', 'generate_presigned_url', 'get_paginator', 'get_waiter']
+
+
+def get_client(service):
+    '''
+    Returns the shared boto3 client for service, creating it (and importing boto3) on first use
+    '''
+    if service not in clients:
+        with clients_lock:
+            if service not in clients:
+                import boto3
+                logging.getLogger('boto3').setLevel(logging.WARNING)
+                logging.getLogger('botocore').setLevel(logging.WARNING)
+                logger.debug('Creating %s client', service)
+                clients[service] = boto3.client(service)
+    return clients[service]
+
+
+def reset_usage():
+    '''
+    Forgets the API calls accounted so far, e.g. at the start of an invocation
+    '''
+    with usage_lock:
+        # cleared in place; the dict may be shared
+        usage.clear()
+
+
+def get_usage():
+    '''
+    Returns a copy of the API calls accounted since reset_usage(): a dict mapping '<service>.<operation>' to a dict
+    of its calls, retries, errors and the milliseconds spent in them
+    '''
+    with usage_lock:
+        return dict([(k, dict(v)) for (k, v) in usage.items()])
+
+
+def retry_attempts(resp):
+    '''
+    Returns the number of times botocore retried the call that returned (or raised, for a ClientError) resp
+    '''
+    if not isinstance(resp, dict):
+        return 0
+    attempts = resp.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+    return attempts if isinstance(attempts, int) else 0
+
+
+def record_call(operation, millis, retries=0, error=False):
+    '''
+    Accounts an API call of operation ('<service>.<operation>') that took millis, including retries
+    '''
+    with usage_lock:
+        stats = usage.setdefault(operation, {'calls': 0, 'retries': 0, 'errors': 0, 'ms': 0.0})
+        stats['calls'] += 1
+        stats['retries'] += retries
+        stats['errors'] += 1 if error else 0
+        stats['ms'] += millis
+
+
+def accounted(operation, method):
+    '''
+    Returns a function that calls method, accounting the call as operation
+    '''
+    def call(*args, **kwargs):
+        t0 = time.time()
+        try:
+            resp = method(*args, **kwargs)
+        except Exception as e:
+            record_call(operation, (time.time() - t0) * 1000, retry_attempts(getattr(e, 'response', None)), True)
+            raise
+        record_call(operation, (time.time() - t0) * 1000, retry_attempts(resp))
+        return resp
+    return call
+
+
+def over_budget(calls, budget, event=None):
+    '''
+    calls: dict mapping '<service>.<operation>' to the number of calls an invocation made
+    budget: dict mapping '<service>.<operation>' to the calls allowed per invocation, or to a function of the
+            invocation's event returning them; operations not in budget are allowed no calls
+    Returns a dict mapping each operation called more often than allowed to a tuple of its calls & allowance
+    '''
+    retval = {}
+    for (operation, count) in calls.items():
+        allowed = budget.get(operation, 0)
+        if callable(allowed):
+            allowed = allowed(event or {})
+        if count > allowed:
+            retval[operation] = (count, allowed)
+    return retval
+
+
+class LazyClient(object):
+    '''
+    Stands in for a boto3 client until one of its methods is used, so an action only pays for the clients it uses;
+    calls of its methods are accounted (see get_usage)
+    '''
+
+    def __init__(self, service):
+        self.service = service
+
+    def __getattr__(self, name):
+        attr = getattr(get_client(self.service), name)
+        if name.startswith('_') or name in unaccounted_methods or not callable(attr):
+            return attr
+        return accounted('{0}.{1}'.format(self.service, name), attr)
+
+    def __repr__(self):
+        return 'LazyClient({})'.format(self.service)
+
+
+def client(service):
+    '''
+    Returns a proxy to the shared boto3 client for service; nothing is created until it's used
+    '''
+    return LazyClient(service)
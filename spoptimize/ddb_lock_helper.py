@@ -1,55 +1,45 @@
-import boto3
 import json
 import logging
+from random import random
+from time import sleep
 
 from botocore.exceptions import ClientError
 
+import aws_clients
 import util
+from logging_helper import LazyJson
 
 logger = logging.getLogger()
 logging.getLogger('boto3').setLevel(logging.WARNING)
 logging.getLogger('botocore').setLevel(logging.WARNING)
 
-ddb = boto3.client('dynamodb')
-sfn = boto3.client('stepfunctions')
+ddb = aws_clients.client('dynamodb')
+sfn = aws_clients.client('stepfunctions')
 
-
-def put_item(table_name, group_name, my_execution_arn, ttl, prev_execution_arn=None):
-    '''
-    Writes a lock to the dynamodb table
-    Returns put_item response if successful; None if put_item condition check fails
-    '''
-    item = {
-        'group_name': {'S': group_name},
-        'execution_arn': {'S': my_execution_arn},
-        'ttl': {'N': str(ttl)}
-    }
-    logger.debug('Putting DDB item into {0}: {1}'.format(table_name, json.dumps(item, default=util.json_dumps_converter)))
-    try:
-        if prev_execution_arn:
-            logger.debug('Expecting previous value {}'.format(prev_execution_arn))
-            return ddb.put_item(TableName=table_name, Item=item, ConditionExpression='execution_arn = :p_val',
-                                ExpressionAttributeValues={':p_val': {'S': prev_execution_arn}})
-        else:
-            return ddb.put_item(TableName=table_name, Item=item, ConditionExpression='attribute_not_exists(execution_arn)')
-    except ClientError as c:
-        if c.response['Error']['Code'] == 'ConditionalCheckFailedException':
-            logger.debug(c.response['Error']['Message'])
-            return None
-        raise
+# DynamoDB writes at most 25 and reads at most 100 items per batch call
+max_batch_write_items = 25
+max_batch_get_items = 100
+# unprocessed items of a batch call are resent with exponential backoff (and full jitter), up to max_batch_attempts
+# calls in all; throttling by the table's provisioned capacity is what leaves items unprocessed
+max_batch_attempts = 5
+batch_backoff_seconds = 0.05
 
 
 def get_item(table_name, group_name):
     '''
     Fetches a lock record from the dynamodb table
-    Returns the step function execution arn of the locked record
+    Returns a dict of the lock's holder: its execution_arn & lease_expires; None if the lock isn't held
     '''
-    logger.debug('Fetching {0} from DDB table {1}'.format(group_name, table_name))
+    logger.debug('Fetching %s from DDB table %s', group_name, table_name)
     resp = ddb.get_item(TableName=table_name, Key={'group_name': {'S': group_name}}, ConsistentRead=True)
     item = resp.get('Item', {})
     if item and 'execution_arn' in item:
         logger.debug('Item Found')
-        return item['execution_arn']['S']
+        return {
+            'execution_arn': item['execution_arn']['S'],
+            # locks written before leases were introduced have no lease_expires
+            'lease_expires': int(item['lease_expires']['N']) if 'lease_expires' in item else None
+        }
     logger.debug('Item Not Found')
     return None
 
@@ -60,18 +50,51 @@ def delete_item(table_name, group_name, my_execution_arn):
     Returns delete_item response
     '''
     key = {'group_name': {'S': group_name}}
-    logger.debug('Deleting DDB item from table {0} [{1}]: {2}'.format(
-        json.dumps(key, default=util.json_dumps_converter), my_execution_arn, table_name))
+    logger.debug('Deleting DDB item from table %s [%s]: %s', LazyJson(key), my_execution_arn, table_name)
     return ddb.delete_item(TableName=table_name, Key=key, ConditionExpression='execution_arn = :p_val',
                            ExpressionAttributeValues={':p_val': {'S': my_execution_arn}})
 
 
+def put_lease(table_name, group_name, my_execution_arn, now, lease_expires, ttl, prev_execution_arn=None):
+    '''
+    Acquires (or renews) the lock of group_name for my_execution_arn until lease_expires with a single conditional
+    write: the lock must be free, already held by my_execution_arn or its holder's lease must have expired. If
+    prev_execution_arn is specified, the lock must be held by it instead
+    Returns a tuple: (True, None) if successful; (False, dict of the lock's current holder) otherwise
+    '''
+    item = {
+        'group_name': {'S': group_name},
+        'execution_arn': {'S': my_execution_arn},
+        'lease_expires': {'N': str(lease_expires)},
+        'ttl': {'N': str(ttl)}
+    }
+    logger.debug('Putting DDB item into %s: %s', table_name, LazyJson(item))
+    if prev_execution_arn:
+        logger.debug('Expecting previous value %s', prev_execution_arn)
+        condition = 'execution_arn = :p_val'
+        values = {':p_val': {'S': prev_execution_arn}}
+    else:
+        condition = 'attribute_not_exists(execution_arn) OR execution_arn = :me OR lease_expires < :now'
+        values = {':me': {'S': my_execution_arn}, ':now': {'N': str(now)}}
+    try:
+        ddb.put_item(TableName=table_name, Item=item, ConditionExpression=condition, ExpressionAttributeValues=values)
+    except ClientError as c:
+        if c.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            logger.debug(c.response['Error']['Message'])
+            # the botocore of the Lambda runtime can't return the item that failed the condition along with the error
+            holder = get_item(table_name, group_name)
+            # a lock released since the write failed is reported as a lease that just expired
+            return (False, holder or {'execution_arn': None, 'lease_expires': now})
+        raise
+    return (True, None)
+
+
 def is_execution_running(execution_arn):
     '''
     Fetches status of step function execution_arn
     Returns True if running; False otherwise
     '''
-    logger.debug('Fetching state machine execution status of {}'.format(execution_arn))
+    logger.debug('Fetching state machine execution status of %s', execution_arn)
     try:
         resp = sfn.describe_execution(executionArn=execution_arn)
     except ClientError as c:
@@ -80,3 +103,323 @@ def is_execution_running(execution_arn):
             return False
         raise
     return resp.get('status') == 'RUNNING'
+
+
+def record_key(kind, name):
+    '''
+    Returns the table key of a record that isn't a lock; locks are keyed by the group name alone
+    '''
+    return '{0}#{1}'.format(kind, name)
+
+
+def get_launch_spec(table_name, spec_key):
+    '''
+    Fetches a persisted EC2 launch specification from the dynamodb table
+    Returns a dict; None if not found
+    '''
+    key = {'group_name': {'S': record_key('launch-spec', spec_key)}}
+    logger.debug('Fetching launch specification %s from DDB table %s', spec_key, table_name)
+    resp = ddb.get_item(TableName=table_name, Key=key)
+    item = resp.get('Item', {})
+    if item and 'launch_spec' in item:
+        logger.debug('Item Found')
+        return json.loads(item['launch_spec']['S'])
+    logger.debug('Item Not Found')
+    return None
+
+
+def put_launch_spec(table_name, spec_key, launch_spec, ttl):
+    '''
+    Persists an EC2 launch specification to the dynamodb table
+    Returns put_item response
+    '''
+    item = {
+        'group_name': {'S': record_key('launch-spec', spec_key)},
+        'launch_spec': {'S': util.to_json(launch_spec)},
+        'ttl': {'N': str(ttl)}
+    }
+    logger.debug('Putting launch specification %s into DDB table %s', spec_key, table_name)
+    return ddb.put_item(TableName=table_name, Item=item)
+
+
+def delete_launch_spec(table_name, spec_key):
+    '''
+    Deletes a persisted EC2 launch specification from the dynamodb table
+    Returns delete_item response
+    '''
+    logger.debug('Deleting launch specification %s from DDB table %s', spec_key, table_name)
+    return ddb.delete_item(TableName=table_name, Key={'group_name': {'S': record_key('launch-spec', spec_key)}})
+
+
+def open_batch(table_name, batch_name, leader_id, now, closes_at, max_members, ttl):
+    '''
+    Opens the replacement batch batch_name, led by leader_id, unless an open batch exists
+    Returns put_item response if successful; None if put_item condition check fails
+    '''
+    item = {
+        'group_name': {'S': record_key('batch', batch_name)},
+        'leader': {'S': leader_id},
+        'member_count': {'N': '1'},
+        'closes_at': {'N': str(closes_at)},
+        'ttl': {'N': str(ttl)}
+    }
+    logger.debug('Opening replacement batch %s led by %s in DDB table %s', batch_name, leader_id, table_name)
+    try:
+        return ddb.put_item(TableName=table_name, Item=item,
+                            ConditionExpression='attribute_not_exists(leader) OR closes_at <= :now OR member_count >= :max',
+                            ExpressionAttributeValues={':now': {'N': str(now)}, ':max': {'N': str(max_members)}})
+    except ClientError as c:
+        if c.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            logger.debug(c.response['Error']['Message'])
+            return None
+        raise
+
+
+def join_batch(table_name, batch_name, instance_id, now, max_members, ttl):
+    '''
+    Adds instance_id to the open replacement batch batch_name
+    Returns the instance id of the batch's leader; None if there's no open batch with room for another member
+    '''
+    logger.debug('Joining replacement batch %s in DDB table %s', batch_name, table_name)
+    try:
+        resp = ddb.update_item(TableName=table_name, Key={'group_name': {'S': record_key('batch', batch_name)}},
+                               UpdateExpression='ADD member_count :one',
+                               ConditionExpression='attribute_exists(leader) AND closes_at > :now AND member_count < :max',
+                               ExpressionAttributeValues={':one': {'N': '1'}, ':now': {'N': str(now)},
+                                                          ':max': {'N': str(max_members)}},
+                               ReturnValues='ALL_NEW')
+    except ClientError as c:
+        if c.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            logger.debug(c.response['Error']['Message'])
+            return None
+        raise
+    leader_id = resp['Attributes']['leader']['S']
+    # members are kept under the leader, so the batch survives the next batch being opened
+    ddb.update_item(TableName=table_name, Key={'group_name': {'S': record_key('batch-members', leader_id)}},
+                    UpdateExpression='ADD members :m SET #t = :ttl',
+                    ExpressionAttributeNames={'#t': 'ttl'},
+                    ExpressionAttributeValues={':m': {'SS': [instance_id]}, ':ttl': {'N': str(ttl)}})
+    return leader_id
+
+
+def get_batch_members(table_name, leader_id):
+    '''
+    Fetches the instance ids that joined the replacement batch led by leader_id
+    Returns a list, which does not include leader_id
+    '''
+    logger.debug('Fetching members of replacement batch led by %s from DDB table %s', leader_id, table_name)
+    resp = ddb.get_item(TableName=table_name, Key={'group_name': {'S': record_key('batch-members', leader_id)}},
+                        ConsistentRead=True)
+    return sorted(resp.get('Item', {}).get('members', {}).get('SS', []))
+
+
+def put_spot_waiter(table_name, spot_request, task_token, ttl):
+    '''
+    Records the task token of an execution waiting for spot_request to be fulfilled,
+    under each of the request's spot instance request ids
+    No return value
+    '''
+    spot_request_ids = spot_request.get('SpotInstanceRequestIds') or [spot_request['SpotInstanceRequestId']]
+    for spot_request_id in spot_request_ids:
+        logger.debug('Putting waiter for spot request %s into DDB table %s', spot_request_id, table_name)
+        ddb.put_item(TableName=table_name, Item={
+            'group_name': {'S': record_key('spot-waiter', spot_request_id)},
+            'task_token': {'S': task_token},
+            'spot_request': {'S': json.dumps(spot_request)},
+            'ttl': {'N': str(ttl)}
+        })
+
+
+def get_spot_waiter(table_name, spot_request_id):
+    '''
+    Fetches the waiter recorded for spot_request_id
+    Returns a tuple of the task token and the spot request; None if not found
+    '''
+    logger.debug('Fetching waiter for spot request %s from DDB table %s', spot_request_id, table_name)
+    resp = ddb.get_item(TableName=table_name, Key={'group_name': {'S': record_key('spot-waiter', spot_request_id)}},
+                        ConsistentRead=True)
+    item = resp.get('Item', {})
+    if 'task_token' not in item:
+        logger.debug('Item Not Found')
+        return None
+    return (item['task_token']['S'], json.loads(item['spot_request']['S']))
+
+
+def delete_spot_waiter(table_name, spot_request):
+    '''
+    Deletes the waiter recorded for each of spot_request's spot instance request ids
+    No return value
+    '''
+    spot_request_ids = spot_request.get('SpotInstanceRequestIds') or [spot_request['SpotInstanceRequestId']]
+    for spot_request_id in spot_request_ids:
+        logger.debug('Deleting waiter for spot request %s from DDB table %s', spot_request_id, table_name)
+        ddb.delete_item(TableName=table_name, Key={'group_name': {'S': record_key('spot-waiter', spot_request_id)}})
+
+
+def enqueue_lock_waiter(table_name, group_name, my_execution_arn, task_token, lease_seconds, ttl):
+    '''
+    Appends an execution waiting for a lock of group_name to the group's wait queue
+    Returns update_item response
+    '''
+    waiter = {'M': {
+        'execution_arn': {'S': my_execution_arn},
+        'task_token': {'S': task_token},
+        'lease_seconds': {'N': str(lease_seconds)}
+    }}
+    logger.debug('Queueing %s for a lock of %s in DDB table %s', my_execution_arn, group_name, table_name)
+    return ddb.update_item(TableName=table_name, Key={'group_name': {'S': record_key('lock-queue', group_name)}},
+                           UpdateExpression='SET waiters = list_append(if_not_exists(waiters, :empty), :w), #t = :ttl',
+                           ExpressionAttributeNames={'#t': 'ttl'},
+                           ExpressionAttributeValues={':empty': {'L': []}, ':w': {'L': [waiter]},
+                                                      ':ttl': {'N': str(ttl)}})
+
+
+def first_lock_waiter(table_name, group_name):
+    '''
+    Fetches the first execution of the wait queue of group_name, leaving it queued
+    Returns a dict of the waiter's execution_arn, task_token & lease_seconds; None if the queue is empty
+    '''
+    logger.debug('Fetching first waiter for a lock of %s from DDB table %s', group_name, table_name)
+    resp = ddb.get_item(TableName=table_name, Key={'group_name': {'S': record_key('lock-queue', group_name)}},
+                        ConsistentRead=True)
+    waiters = resp.get('Item', {}).get('waiters', {}).get('L', [])
+    if not waiters:
+        return None
+    waiter = waiters[0]['M']
+    return {
+        'execution_arn': waiter['execution_arn']['S'],
+        'task_token': waiter['task_token']['S'],
+        'lease_seconds': int(waiter['lease_seconds']['N'])
+    }
+
+
+def remove_first_lock_waiter(table_name, group_name, execution_arn):
+    '''
+    Removes execution_arn from the wait queue of group_name, provided it's still the first waiter
+    Returns True if removed; False otherwise (e.g. it removed itself after acquiring a lock)
+    '''
+    logger.debug('Removing first waiter %s for a lock of %s from DDB table %s', execution_arn, group_name, table_name)
+    try:
+        ddb.update_item(TableName=table_name, Key={'group_name': {'S': record_key('lock-queue', group_name)}},
+                        UpdateExpression='REMOVE waiters[0]', ConditionExpression='waiters[0].execution_arn = :w',
+                        ExpressionAttributeValues={':w': {'S': execution_arn}})
+    except ClientError as c:
+        if c.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            logger.debug(c.response['Error']['Message'])
+            return False
+        raise
+    return True
+
+
+def remove_lock_waiter(table_name, group_name, my_execution_arn):
+    '''
+    Removes my_execution_arn from the wait queue of group_name
+    Returns True if removed; False if it's not queued (e.g. a releasing execution just dequeued it)
+    '''
+    key = {'group_name': {'S': record_key('lock-queue', group_name)}}
+    logger.debug('Removing %s from the lock queue of %s in DDB table %s', my_execution_arn, group_name, table_name)
+    resp = ddb.get_item(TableName=table_name, Key=key, ConsistentRead=True)
+    waiters = [x['M']['execution_arn']['S'] for x in resp.get('Item', {}).get('waiters', {}).get('L', [])]
+    if my_execution_arn not in waiters:
+        return False
+    idx = waiters.index(my_execution_arn)
+    try:
+        ddb.update_item(TableName=table_name, Key=key, UpdateExpression='REMOVE waiters[{}]'.format(idx),
+                        ConditionExpression='waiters[{}].execution_arn = :me'.format(idx),
+                        ExpressionAttributeValues={':me': {'S': my_execution_arn}})
+    except ClientError as c:
+        if c.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            # the queue moved; try again
+            logger.debug(c.response['Error']['Message'])
+            return remove_lock_waiter(table_name, group_name, my_execution_arn)
+        raise
+    return True
+
+
+def get_timings(table_name, timings_name):
+    '''
+    Fetches the observed timings recorded for timings_name
+    Returns a dict mapping each metric to a list of samples (in seconds)
+    '''
+    logger.debug('Fetching timings %s from DDB table %s', timings_name, table_name)
+    resp = ddb.get_item(TableName=table_name, Key={'group_name': {'S': record_key('timings', timings_name)}})
+    item = resp.get('Item', {})
+    return {k: [int(x['N']) for x in v['L']] for k, v in item.items() if 'L' in v}
+
+
+def put_timings(table_name, timings_name, timings, ttl):
+    '''
+    Writes the observed timings of timings_name; timings maps each metric to a list of samples (in seconds)
+    Returns put_item response
+    '''
+    item = {k: {'L': [{'N': str(x)} for x in v]} for k, v in timings.items()}
+    item['group_name'] = {'S': record_key('timings', timings_name)}
+    item['ttl'] = {'N': str(ttl)}
+    logger.debug('Putting timings %s into DDB table %s', timings_name, table_name)
+    return ddb.put_item(TableName=table_name, Item=item)
+
+
+def batch_call(operation, request_items, unprocessed_key):
+    '''
+    Calls operation (batch_write_item or batch_get_item) for request_items, resending the items left in the
+    response's unprocessed_key with exponential backoff, for max_batch_attempts calls in all
+    Returns a list of the responses; raises an exception naming the items still unprocessed after the last attempt
+    '''
+    responses = []
+    for attempt in range(max_batch_attempts):
+        if attempt:
+            sleep(random() * batch_backoff_seconds * 2 ** attempt)
+        resp = getattr(ddb, operation)(RequestItems=request_items)
+        responses.append(resp)
+        request_items = resp.get(unprocessed_key)
+        if not request_items:
+            return responses
+    raise Exception('Unprocessed after {0} {1} calls: {2}'.format(
+        max_batch_attempts, operation, util.to_json(request_items)))
+
+
+def batch_write(table_name, requests):
+    '''
+    Writes requests (PutRequest/DeleteRequest dicts) up to max_batch_write_items per call, resending unprocessed ones
+    No return value
+    '''
+    for idx in range(0, len(requests), max_batch_write_items):
+        batch_call('batch_write_item', {table_name: requests[idx:idx + max_batch_write_items]}, 'UnprocessedItems')
+
+
+def register_instances(table_name, instance_ids, group_name, ttl):
+    '''
+    Records instance_ids as spot instances attached to group_name by spoptimize
+    No return value
+    '''
+    logger.debug('Registering %s of %s in DDB table %s', ', '.join(instance_ids), group_name, table_name)
+    batch_write(table_name, [{'PutRequest': {'Item': {
+        'group_name': {'S': record_key('instance', x)},
+        'autoscaling_group': {'S': group_name},
+        'ttl': {'N': str(ttl)}
+    }}} for x in instance_ids])
+
+
+def deregister_instances(table_name, instance_ids):
+    '''
+    Removes instance_ids from the registry of spot instances attached by spoptimize
+    No return value
+    '''
+    logger.debug('Deregistering %s from DDB table %s', ', '.join(instance_ids), table_name)
+    batch_write(table_name, [{'DeleteRequest': {'Key': {'group_name': {'S': record_key('instance', x)}}}}
+                             for x in instance_ids])
+
+
+def get_registered_instances(table_name, instance_ids):
+    '''
+    Looks instance_ids up in the registry of spot instances attached by spoptimize, up to max_batch_get_items per call
+    Returns a dict mapping each registered instance id to its autoscaling group's name
+    '''
+    retval = {}
+    for idx in range(0, len(instance_ids), max_batch_get_items):
+        request_items = {table_name: {'Keys': [{'group_name': {'S': record_key('instance', x)}}
+                                               for x in instance_ids[idx:idx + max_batch_get_items]]}}
+        for resp in batch_call('batch_get_item', request_items, 'UnprocessedKeys'):
+            for item in resp.get('Responses', {}).get(table_name, []):
+                retval[item['group_name']['S'].split('#', 1)[1]] = item['autoscaling_group']['S']
+    return retval
@@ -1,4 +1,3 @@
-import boto3
 import copy
 import os
 
@@ -6,6 +5,8 @@ from logging_helper import logging
 
 from botocore.exceptions import ClientError
 
+import aws_clients
+
 logger = logging.getLogger()
 logging.getLogger('boto3').setLevel(logging.WARNING)
 logging.getLogger('botocore').setLevel(logging.WARNING)
@@ -14,7 +15,10 @@ logging.getLogger('botocore').setLevel(logging.WARNING)
 here = os.path.dirname(os.path.realpath(__file__))
 mocks_dir = os.path.join(here, 'resources', 'mock_data')
 
-ec2 = boto3.client('ec2')
+ec2 = aws_clients.client('ec2')
+
+# EC2 accepts up to 200 values per filter
+max_filter_values = 200
 
 
 def terminate_instance(instance_id):
@@ -32,6 +36,24 @@ def terminate_instance(instance_id):
             raise
 
 
+def terminate_instances(instance_ids):
+    '''
+    Terminates instance_ids via the EC2 API with a single call, if possible
+    No return value
+    '''
+    logger.info('Terminating EC2 Instances {}'.format(instance_ids))
+    try:
+        ec2.terminate_instances(InstanceIds=instance_ids)
+    except ClientError as c:
+        if c.response['Error']['Code'] == 'InvalidInstanceID.NotFound':
+            # the whole call fails if any instance is unknown
+            logger.info('{} not all found'.format(instance_ids))
+            for instance_id in instance_ids:
+                terminate_instance(instance_id)
+        else:
+            raise
+
+
 def tag_instance(instance_id, orig_instance_id, resource_tags=[]):
     '''
     Tags instance_id using tags of orig_instance_id and resource_tags
@@ -56,7 +78,7 @@ def is_instance_running(instance_id):
     Checks the state of instance_id
     Returns True if the instance is running; False if not
     '''
-    logger.debug('Fetching EC2 instance state of {}'.format(instance_id))
+    logger.debug('Fetching EC2 instance state of %s', instance_id)
     try:
         resp = ec2.describe_instances(InstanceIds=[instance_id])
     except ClientError as c:
@@ -71,12 +93,42 @@ def is_instance_running(instance_id):
     return resp['Reservations'][0]['Instances'][0]['State']['Name'] == 'running'
 
 
+def running_instances(instance_ids):
+    '''
+    Checks the state of instance_ids with a single API call
+    Returns the list of instance_ids that are running
+    '''
+    logger.debug('Fetching EC2 instance state of %s', instance_ids)
+    # filtering by instance-id doesn't fail if an instance is unknown
+    resp = ec2.describe_instances(Filters=[{'Name': 'instance-id', 'Values': instance_ids}])
+    instance_states = {x['InstanceId']: x['State']['Name'] for r in resp['Reservations'] for x in r['Instances']}
+    logger.info('EC2 Instance states: {}'.format(instance_states))
+    return [x for x in instance_ids if instance_states.get(x) == 'running']
+
+
+def spot_request_id(instance_id):
+    '''
+    Looks up the spot instance request that launched instance_id
+    Returns the spot instance request id; None if instance_id is not a spot instance
+    '''
+    logger.debug('Fetching spot instance request of %s', instance_id)
+    try:
+        resp = ec2.describe_instances(InstanceIds=[instance_id])
+    except ClientError as c:
+        if c.response['Error']['Code'] == 'InvalidInstanceID.NotFound':
+            logger.warning('{} not found'.format(instance_id))
+            return None
+        else:
+            raise
+    return resp['Reservations'][0]['Instances'][0].get('SpotInstanceRequestId')
+
+
 def is_spoptimize_instance(instance_id):
     '''
     Uses instance_id's tags to see if it was launched by spoptimize
     Returns True/False
     '''
-    logger.debug('Determining if {} was launched by Spoptimize'.format(instance_id))
+    logger.debug('Determining if %s was launched by Spoptimize', instance_id)
     try:
         resp = ec2.describe_instances(InstanceIds=[instance_id])
     except ClientError as c:
@@ -88,6 +140,27 @@ def is_spoptimize_instance(instance_id):
     spoptimize_tags = [x for x in resp['Reservations'][0]['Instances'][0].get('Tags', [])
                        if x['Key'].split(':')[0] == 'spoptimize']
     if spoptimize_tags:
-        logger.debug('{0} has spoptimize tags: {1}'.format(instance_id, spoptimize_tags))
+        logger.debug('%s has spoptimize tags: %s', instance_id, spoptimize_tags)
         return True
     return False
+
+
+def spoptimize_instances(instance_ids):
+    '''
+    Uses the tags of instance_ids to see which were launched by spoptimize, with one describe_tags call (per page)
+    for up to max_filter_values instances
+    Returns a set of instance ids
+    '''
+    retval = set()
+    for idx in range(0, len(instance_ids), max_filter_values):
+        chunk = instance_ids[idx:idx + max_filter_values]
+        logger.debug('Determining which of %s were launched by Spoptimize', ', '.join(chunk))
+        kwargs = {'Filters': [{'Name': 'resource-type', 'Values': ['instance']},
+                              {'Name': 'resource-id', 'Values': chunk}]}
+        while True:
+            resp = ec2.describe_tags(**kwargs)
+            retval.update([x['ResourceId'] for x in resp.get('Tags', []) if x['Key'].split(':')[0] == 'spoptimize'])
+            if not resp.get('NextToken'):
+                break
+            kwargs['NextToken'] = resp['NextToken']
+    return retval
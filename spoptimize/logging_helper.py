@@ -1,8 +1,14 @@
+import json
 import logging
 
+import util
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# fields added to every structured log record of the current invocation, e.g. action, group & instance ids
+log_context = {}
+
 
 def setup_stream_handler():  # pragma: no cover
     ch = logging.StreamHandler()
@@ -10,3 +16,86 @@ def setup_stream_handler():  # pragma: no cover
     formatter = logging.Formatter('%(asctime)s: [%(filename)s:%(lineno)d %(funcName)s()] %(levelname)s - %(message)s')
     ch.setFormatter(formatter)
     logger.addHandler(ch)
+
+
+def setup_json_handlers():
+    '''
+    Formats the records of the root logger's handlers (e.g. the one installed by the Lambda runtime) as JSON,
+    adding a stream handler if there are none
+    '''
+    if not logger.handlers:
+        logger.addHandler(logging.StreamHandler())
+    for handler in logger.handlers:
+        if not isinstance(handler.formatter, JsonFormatter):
+            handler.setFormatter(JsonFormatter())
+
+
+def set_log_context(**fields):
+    '''
+    Replaces the fields added to every structured log record; fields that are None are left out
+    '''
+    log_context.clear()
+    log_context.update(dict([(k, v) for (k, v) in fields.items() if v is not None]))
+
+
+def json_default(o):
+    # log records must not fail to serialize: what util.to_json can't serialize is logged as its string
+    try:
+        return util.json_dumps_converter(o)
+    except TypeError:
+        return str(o)
+
+
+class LazyJson(object):
+    '''
+    Serializes obj as JSON when the log record it's an argument of is formatted, i.e. only if the record is emitted:
+    logger.debug('Item: %s', LazyJson(item))
+    '''
+
+    def __init__(self, obj, **kwargs):
+        self.obj = obj
+        self.kwargs = kwargs
+
+    def __str__(self):
+        return json.dumps(self.obj, default=json_default, **self.kwargs)
+
+
+class StructuredMessage(object):
+    '''
+    A log message with fields: text formatters render it as "message: {fields as JSON}", while JsonFormatter adds
+    the fields to the record's
+    '''
+
+    def __init__(self, message, **fields):
+        self.message = message
+        self.fields = fields
+
+    def __str__(self):
+        return '{0}: {1}'.format(self.message, json.dumps(self.fields, default=json_default, sort_keys=True))
+
+
+class JsonFormatter(logging.Formatter):
+    '''
+    Formats a log record as a single line JSON object of its level, message & source, the fields of the log context
+    (see set_log_context) and, for a StructuredMessage, the message's fields
+    '''
+
+    def format(self, record):
+        fields = dict(log_context)
+        if isinstance(record.msg, StructuredMessage):
+            fields.update(record.msg.fields)
+            message = record.msg.message
+        else:
+            message = record.getMessage()
+        fields.update({
+            'timestamp': self.formatTime(record),
+            'level': record.levelname,
+            'message': message,
+            'location': '{0}:{1}'.format(record.filename, record.lineno)
+        })
+        # set by the Lambda runtime's log filter
+        if getattr(record, 'aws_request_id', None):
+            fields['aws_request_id'] = record.aws_request_id
+        if record.exc_info:
+            fields['exception'] = self.formatException(record.exc_info)
+        return json.dumps(fields, default=json_default, sort_keys=True)
@@ -0,0 +1,77 @@
+import logging
+
+from botocore.exceptions import ClientError
+
+import aws_clients
+import util
+
+logger = logging.getLogger()
+logging.getLogger('boto3').setLevel(logging.WARNING)
+logging.getLogger('botocore').setLevel(logging.WARNING)
+
+sfn = aws_clients.client('stepfunctions')
+
+# maximum number of concurrent StartExecution calls per invocation
+start_concurrency = 8
+
+
+def start_execution(state_machine_arn, init_state):
+    '''
+    Starts an execution of state_machine_arn named after the state's ondemand_instance_id
+    Returns the start_execution response; a dict with SpoptimizeError if the execution could not be started
+    '''
+    execution_name = init_state['ondemand_instance_id']
+    logger.debug('Starting execution of %s with name %s', state_machine_arn, execution_name)
+    # NOTE: execution ARN is used for locks. if name changes, update lock acquisition & release
+    try:
+        return sfn.start_execution(
+            stateMachineArn=state_machine_arn,
+            name=execution_name,
+            input=util.to_json(init_state)
+        )
+    except ClientError as c:
+        if c.response['Error']['Code'] == 'ExecutionAlreadyExists':
+            logger.info('Execution {} already exists ... ignoring'.format(execution_name))
+            return {'ondemand_instance_id': execution_name, 'SpoptimizeError': 'ExecutionAlreadyExists'}
+        logger.error('Unable to start execution {0}: {1}'.format(execution_name, c.response['Error']['Message']))
+        return {'ondemand_instance_id': execution_name, 'SpoptimizeError': c.response['Error']['Code']}
+    except Exception as e:
+        logger.error('Unable to start execution {0}: {1}'.format(execution_name, e))
+        return {'ondemand_instance_id': execution_name, 'SpoptimizeError': str(e)}
+
+
+def start_executions(state_machine_arn, init_states, max_workers=None):
+    '''
+    Starts an execution of state_machine_arn for each of init_states using a bounded pool of workers
+    Returns a list of start_execution responses in the same order as init_states
+
+    A failure to start one execution does not prevent the others from starting
+    '''
+    logger.info('Starting {0} execution(s) of {1}'.format(len(init_states), state_machine_arn))
+    return util.concurrent_map(lambda x: start_execution(state_machine_arn, x), init_states,
+                               max_workers or start_concurrency)
+
+
+def failed_executions(start_resps):
+    '''
+    Returns the start_execution responses of executions that failed to start and may succeed if retried
+    '''
+    return [x for x in start_resps
+            if x.get('SpoptimizeError') and x['SpoptimizeError'] != 'ExecutionAlreadyExists']
+
+
+def send_task_success(task_token, output):
+    '''
+    Resumes the execution waiting on task_token with output as the task's result
+    Returns True if successful; False if the task is no longer waiting
+    '''
+    logger.debug('Sending task success: %s', output)
+    try:
+        sfn.send_task_success(taskToken=task_token, output=util.to_json(output))
+    except ClientError as c:
+        if c.response['Error']['Code'] in ['TaskTimedOut', 'TaskDoesNotExist', 'InvalidToken']:
+            # the task timed out and fell back to polling, or another event already resumed it
+            logger.info('Task is no longer waiting: {}'.format(c.response['Error']['Message']))
+            return False
+        raise
+    return True
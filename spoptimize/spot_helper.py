@@ -1,12 +1,13 @@
-import boto3
-import json
+import copy
 import logging
 import os
 
 from botocore.exceptions import ClientError
 
+import aws_clients
 import stepfn_strings as strs
 import util
+from logging_helper import LazyJson
 
 logger = logging.getLogger()
 logging.getLogger('boto3').setLevel(logging.WARNING)
@@ -16,8 +17,46 @@ logging.getLogger('botocore').setLevel(logging.WARNING)
 here = os.path.dirname(os.path.realpath(__file__))
 mocks_dir = os.path.join(here, 'resources', 'mock_data')
 
-ec2 = boto3.client('ec2')
-iam = boto3.client('iam')
+ec2 = aws_clients.client('ec2')
+iam = aws_clients.client('iam')
+
+# instance-profile ARNs & security-group ids rarely change, so they're resolved once per warm container
+resolution_cache_ttl = 900
+instance_profile_cache = util.ExpiringCache(resolution_cache_ttl)
+security_group_cache = util.ExpiringCache(resolution_cache_ttl)
+# launch specifications depend on the above, so they don't outlive them
+launch_spec_cache = util.ExpiringCache(resolution_cache_ttl)
+
+
+def invalidate_caches():
+    '''
+    Discards all cached instance-profile ARNs, security-group ids and launch specifications
+    '''
+    instance_profile_cache.invalidate()
+    security_group_cache.invalidate()
+    launch_spec_cache.invalidate()
+
+
+def launch_spec_key(lc_name, avail_zone, subnet_id):
+    '''
+    Returns the key under which the launch specification for lc_name in avail_zone/subnet_id is cached
+    '''
+    return '{0}/{1}/{2}'.format(lc_name, avail_zone, subnet_id or '')
+
+
+def cached_launch_specification(lc_name, avail_zone, subnet_id):
+    '''
+    Returns a copy of the cached launch specification for lc_name in avail_zone/subnet_id; None if not cached
+    '''
+    launch_spec = launch_spec_cache.get(launch_spec_key(lc_name, avail_zone, subnet_id))
+    if launch_spec is None:
+        return None
+    logger.debug('Using cached launch specification for %s in %s/%s', lc_name, avail_zone, subnet_id)
+    return copy.deepcopy(launch_spec)
+
+
+def cache_launch_specification(lc_name, avail_zone, subnet_id, launch_spec):
+    launch_spec_cache.set(launch_spec_key(lc_name, avail_zone, subnet_id), copy.deepcopy(launch_spec))
 
 
 def get_instance_profile_arn(instance_profile):
@@ -26,8 +65,37 @@ def get_instance_profile_arn(instance_profile):
     '''
     if instance_profile[:12] == 'arn:aws:iam:':
         return instance_profile
+    arn = instance_profile_cache.get(instance_profile)
+    if arn:
+        return arn
     logger.info('Fetching arn for instance-profile {}'.format(instance_profile))
-    return iam.get_instance_profile(InstanceProfileName=instance_profile)['InstanceProfile']['Arn']
+    return instance_profile_cache.set(
+        instance_profile, iam.get_instance_profile(InstanceProfileName=instance_profile)['InstanceProfile']['Arn'])
+
+
+def security_group_ids(secgrps):
+    '''
+    Returns the security group ids of secgrps, in order
+    Group names that aren't cached are resolved with a single describe_security_groups call
+    Raises an exception if multiple group ids are detected for a name
+
+    Used for EC2-Classic or Default-VPC Launch Configs
+    '''
+    group_ids = {}
+    for secgrp in secgrps:
+        group_ids[secgrp] = secgrp if secgrp[:3] == 'sg-' else security_group_cache.get(secgrp)
+    unresolved = sorted([k for k, v in group_ids.items() if not v])
+    if unresolved:
+        logger.info('Fetching ids of security groups {}'.format(unresolved))
+        resp = ec2.describe_security_groups(GroupNames=unresolved)
+        if len(resp['SecurityGroups']) > len(unresolved):
+            raise Exception('More than one security group detected for {}'.format(', '.join(unresolved)))
+        for grp in resp['SecurityGroups']:
+            group_ids[grp['GroupName']] = security_group_cache.set(grp['GroupName'], grp['GroupId'])
+        missing = [k for k, v in group_ids.items() if not v]
+        if missing:
+            raise Exception('Unable to find security group(s) {}'.format(', '.join(sorted(missing))))
+    return [group_ids[x] for x in secgrps]
 
 
 def security_group_id(secgrp):
@@ -37,21 +105,23 @@ def security_group_id(secgrp):
 
     Used for EC2-Classic or Default-VPC Launch Configs
     '''
-    if secgrp[:3] == 'sg-':
-        return secgrp
-    resp = ec2.describe_security_groups(GroupNames=[secgrp])
-    if len(resp['SecurityGroups']) > 1:
-        raise Exception('More than one security group detected for {}'.format(secgrp))
-    return resp['SecurityGroups'][0]['GroupId']
+    return security_group_ids([secgrp])[0]
 
 
 def gen_launch_specification(launch_config, avail_zone, subnet_id):
     '''
     Uses an autoscaling launch configuration to generate an EC2 launch specification
     Returns a dict
+
+    Launch configurations are immutable, so the result is cached by launch configuration name, zone and subnet
     '''
+    lc_name = launch_config.get('LaunchConfigurationName')
+    if lc_name:
+        launch_spec = cached_launch_specification(lc_name, avail_zone, subnet_id)
+        if launch_spec is not None:
+            return launch_spec
     logger.debug('Converting asg launch config to ec2 launch spec')
-    # logger.debug('Launch Config: {}'.format(json.dumps(launch_config, indent=2, default=util.json_dumps_converter)))
+    logger.debug('Launch Config: %s', LazyJson(launch_config, indent=2))
     spot_launch_specification = {
         'Placement': {
             'AvailabilityZone': avail_zone,
@@ -71,32 +141,65 @@ def gen_launch_specification(launch_config, avail_zone, subnet_id):
             'Arn': get_instance_profile_arn(launch_config['IamInstanceProfile'])
         }
     if launch_config.get('SecurityGroups'):
-        spot_launch_specification['SecurityGroupIds'] = [security_group_id(x) for x in launch_config['SecurityGroups']]
+        spot_launch_specification['SecurityGroupIds'] = security_group_ids(launch_config['SecurityGroups'])
     if launch_config.get('InstanceMonitoring'):
         spot_launch_specification['Monitoring'] = {
             'Enabled': launch_config['InstanceMonitoring'].get('Enabled', False)
         }
-    # logger.debug('Launch Specification: {}'.format(json.dumps(spot_launch_specification, indent=2, default=util.json_dumps_converter)))
+    logger.debug('Launch Specification: %s', LazyJson(spot_launch_specification, indent=2))
+    if lc_name:
+        cache_launch_specification(lc_name, avail_zone, subnet_id, spot_launch_specification)
     return spot_launch_specification
 
 
-def request_spot_instance(launch_config, avail_zone, subnet_id, client_token):
+def request_spot_instances(launch_spec, avail_zone, subnet_id, client_token, instance_count):
     '''
-    Requests a spot instance
-    Returns a dict containing the spot instance request response
+    Requests instance_count spot instances using launch_spec
+    Returns a dict containing the spot instance request ids, in the order returned by EC2
     '''
-    logger.info('Requesting spot instance in {0}/{1}'.format(avail_zone, subnet_id))
-    launch_spec = gen_launch_specification(launch_config, avail_zone, subnet_id)
+    logger.info('Requesting {0} spot instance(s) in {1}/{2}'.format(instance_count, avail_zone, subnet_id))
     try:
-        resp = ec2.request_spot_instances(InstanceCount=1, LaunchSpecification=launch_spec,
+        resp = ec2.request_spot_instances(InstanceCount=instance_count, LaunchSpecification=launch_spec,
                                           Type='one-time', ClientToken=client_token)
     except ClientError as c:
         if c.response['Error']['Code'] == 'MaxSpotInstanceCountExceeded':
             logger.warning(c.response['Error']['Message'])
             return {'SpoptimizeError': 'MaxSpotInstanceCountExceeded'}
+        # a stale instance-profile or security-group may be the cause, so resolve them again on retry
+        invalidate_caches()
         raise
-    logger.debug('Spot request response: {}'.format(json.dumps(resp, indent=2, default=util.json_dumps_converter)))
-    return {'SpotInstanceRequestId': resp['SpotInstanceRequests'][0]['SpotInstanceRequestId']}
+    logger.debug('Spot request response: %s', LazyJson(resp, indent=2))
+    return {'SpotInstanceRequestIds': [x['SpotInstanceRequestId'] for x in resp['SpotInstanceRequests']]}
+
+
+def request_spot_instance(launch_config, avail_zone, subnet_id, client_token, launch_spec=None):
+    '''
+    Requests a spot instance
+    launch_spec: EC2 launch specification, if already known; otherwise it's generated from launch_config
+    Returns a dict containing the spot instance request response
+    '''
+    if not launch_spec:
+        launch_spec = gen_launch_specification(launch_config, avail_zone, subnet_id)
+    resp = request_spot_instances(launch_spec, avail_zone, subnet_id, client_token, 1)
+    if 'SpotInstanceRequestIds' not in resp:
+        return resp
+    return {'SpotInstanceRequestId': resp['SpotInstanceRequestIds'][0]}
+
+
+def spot_request_status(spot_request):
+    '''
+    Evaluates a spot instance request returned by ec2.describe_spot_instance_requests()
+    Returns instance-id of spot instance if running; 'Pending' or 'Failure' otherwise
+    '''
+    spot_request_id = spot_request['SpotInstanceRequestId']
+    if spot_request.get('State', '') == 'active' and spot_request.get('InstanceId'):
+        logger.info('Spot instance request {0} is active: {1}'.format(spot_request_id, spot_request['InstanceId']))
+        return spot_request['InstanceId']
+    if spot_request.get('State', 'unknown') in ['closed', 'cancelled', 'failed']:
+        logger.info('Spot instance request {0} is {1}'.format(spot_request_id, spot_request['State']))
+        return strs.spot_request_failure
+    logger.info('Spot instance request {0} is pending with state {1}'.format(spot_request_id, spot_request['State']))
+    return strs.spot_request_pending
 
 
 def get_spot_request_status(spot_request_id):
@@ -104,7 +207,7 @@ def get_spot_request_status(spot_request_id):
     Fetches the spot instance request status of spot_request_id
     Returns instance-id of spot instance if running; 'Pending' or 'Failure' otherwise
     '''
-    logger.debug('Checking status of spot request {}'.format(spot_request_id))
+    logger.debug('Checking status of spot request %s', spot_request_id)
     try:
         resp = ec2.describe_spot_instance_requests(SpotInstanceRequestIds=[spot_request_id])
     except ClientError as c:
@@ -114,11 +217,24 @@ def get_spot_request_status(spot_request_id):
         raise
     # logger.debug('Spot request status response: {}'.format(resp))
     spot_request = resp['SpotInstanceRequests'][0]
-    if spot_request.get('State', '') == 'active' and spot_request.get('InstanceId'):
-        logger.info('Spot instance request {0} is active: {1}'.format(spot_request_id, spot_request['InstanceId']))
-        return spot_request['InstanceId']
-    if spot_request.get('State', 'unknown') in ['closed', 'cancelled', 'failed']:
-        logger.info('Spot instance request {0} is {1}'.format(spot_request_id, spot_request['State']))
-        return strs.spot_request_failure
-    logger.info('Spot instance request {0} is pending with state {1}'.format(spot_request_id, spot_request['State']))
-    return strs.spot_request_pending
+    spot_request.setdefault('SpotInstanceRequestId', spot_request_id)
+    return spot_request_status(spot_request)
+
+
+def get_spot_request_statuses(spot_request_ids):
+    '''
+    Fetches the spot instance request status of each of spot_request_ids with a single API call
+    Returns a list of statuses (see spot_request_status) in the order of spot_request_ids
+    '''
+    logger.debug('Checking status of spot requests %s', spot_request_ids)
+    try:
+        resp = ec2.describe_spot_instance_requests(SpotInstanceRequestIds=spot_request_ids)
+    except ClientError as c:
+        if c.response['Error']['Code'] == 'InvalidSpotInstanceRequestID.NotFound':
+            # the whole call fails if any request is unknown
+            logger.info('Spot instance requests {} do not all exist'.format(spot_request_ids))
+            return [get_spot_request_status(x) for x in spot_request_ids]
+        raise
+    spot_requests = {x['SpotInstanceRequestId']: x for x in resp['SpotInstanceRequests']}
+    return [spot_request_status(spot_requests[x]) if x in spot_requests else strs.spot_request_failure
+            for x in spot_request_ids]
@@ -1,24 +1,202 @@
-import json
 import logging
 
 import asg_helper
+import ddb_lock_helper
 import ec2_helper
 import util
 
 logger = logging.getLogger()
 
 
-def process_warning_event(event):
+# a wave of interruption warnings must be acted on within their two minutes
+warning_terminate_concurrency = 16
+# instances in other lifecycle states (e.g. Terminating, after their warning was processed) aren't backfilled
+backfill_lifecycle_states = ['Pending', 'Pending:Wait', 'Pending:Proceed', 'InService']
+
+
+def warning_instance_id(event):
+    '''
+    Returns the id of the instance an EC2 Spot Instance Interruption Warning is about; raises on malformed events
+    '''
     event_source = event.get('source')
     event_detail_type = event.get('detail-type')
     if event_source != 'aws.ec2' or event_detail_type != 'EC2 Spot Instance Interruption Warning':
-        raise Exception('Malformed event: {}'.format(json.dumps(event, indent=2, default=util.json_dumps_converter)))
+        raise Exception('Malformed event: {}'.format(util.to_json(event, indent=2)))
     if event['detail']['instance-action'] != 'terminate':
-        raise Exception('Invalid or unknown event: {}'.format(json.dumps(event, indent=2, default=util.json_dumps_converter)))
-    instance_id = event['detail']['instance-id']
+        raise Exception('Invalid or unknown event: {}'.format(util.to_json(event, indent=2)))
+    return event['detail']['instance-id']
+
+
+def registered_instance_groups(instance_ids, table_name=None):
+    '''
+    Looks instance_ids up in the registry of spot instances attached by spoptimize; failures are logged
+    Returns a dict mapping each registered instance id to its autoscaling group's name
+
+    Registered instances may have since been terminated (e.g. by scale-in), which terminating them via the
+    autoscaling API and backfill_capacity's group description account for
+    '''
+    if not table_name:
+        return {}
+    try:
+        return ddb_lock_helper.get_registered_instances(table_name, instance_ids)
+    except Exception as e:
+        # tags are the fallback when the registry can't be read
+        logger.error('Unable to look up {0} in DDB table {1}: {2}'.format(', '.join(instance_ids), table_name, e))
+        return {}
+
+
+def deregister_instances(instance_ids, table_name=None):
+    '''
+    Removes instance_ids from the registry of spot instances attached by spoptimize; failures are logged
+    '''
+    if not table_name:
+        return
+    try:
+        ddb_lock_helper.deregister_instances(table_name, instance_ids)
+    except Exception as e:
+        # registered items expire regardless
+        logger.warning('Unable to deregister {0}: {1}'.format(', '.join(instance_ids), e))
+
+
+def spoptimize_instance_groups(instance_ids, table_name=None):
+    '''
+    Looks instance_ids up in the registry of spot instances attached by spoptimize (if table_name is specified),
+    then looks up the tags of the instances that aren't registered
+    Returns a dict mapping each of instance_ids launched by spoptimize to its autoscaling group's name (None if
+    only known from its tags)
+    '''
+    retval = registered_instance_groups(instance_ids, table_name)
+    unregistered_ids = [x for x in instance_ids if x not in retval]
+    if unregistered_ids:
+        tagged_ids = ec2_helper.spoptimize_instances(unregistered_ids)
+        retval.update({x: None for x in unregistered_ids if x in tagged_ids})
+    return retval
+
+
+def backfill_capacity(instance_ids, instance_groups=None):
+    '''
+    Raises the desired capacity of the autoscaling groups of instance_ids that are tagged with
+    spoptimize:interruption_backfill, so that replacements launch while the interrupted instances terminate
+    Instances that are no longer in service (e.g. they're terminating after a warning that was already processed)
+    aren't backfilled again
+    instance_groups: dict mapping instance ids to their groups' names, if known
+    Returns a dict mapping each backfilled instance id, whose termination is to decrement the desired capacity, to
+    its group's name
+    '''
+    instance_groups = dict([(k, v) for (k, v) in (instance_groups or {}).items() if v])
+    unknown_ids = [x for x in instance_ids if x not in instance_groups]
+    if unknown_ids:
+        instance_groups.update(asg_helper.instance_groups(unknown_ids))
+    groups = {}
+    for instance_id in instance_ids:
+        if instance_id in instance_groups:
+            groups.setdefault(instance_groups[instance_id], []).append(instance_id)
+    backfilled = {}
+    for asg_name in sorted(groups):
+        try:
+            group = asg_helper.describe_group(asg_name, max_age=0)
+            tags = {x['Key']: x['Value'] for x in group.get('Tags', [])}
+            if tags.get('spoptimize:interruption_backfill', 'false').lower() in ['0', 'no', 'false']:
+                continue
+            in_service_ids = set([x['InstanceId'] for x in group.get('Instances', [])
+                                  if x['LifecycleState'] in backfill_lifecycle_states])
+            backfill_ids = [x for x in groups[asg_name] if x in in_service_ids]
+            count = min(len(backfill_ids), group['MaxSize'] - group['DesiredCapacity'])
+            if count <= 0:
+                logger.info('AutoScaling group {} has no capacity to backfill'.format(asg_name))
+                continue
+            asg_helper.set_desired_capacity(asg_name, group['DesiredCapacity'] + count)
+        except Exception as e:
+            # the interrupted instances are terminated regardless
+            logger.error('Unable to backfill capacity of AutoScaling group {0}: {1}'.format(asg_name, e))
+            continue
+        backfilled.update([(x, asg_name) for x in backfill_ids[:count]])
+    if backfilled:
+        logger.info('Backfilled capacity for {}'.format(', '.join(sorted(backfilled))))
+    return backfilled
+
+
+def release_backfilled_capacity(backfilled):
+    '''
+    Lowers the desired capacity raised for backfilled instances whose termination failed, so that processing their
+    warnings again doesn't raise it twice
+    backfilled: dict mapping instance ids to their groups' names
+    Failures are logged
+    '''
+    groups = {}
+    for (instance_id, asg_name) in backfilled.items():
+        groups.setdefault(asg_name, []).append(instance_id)
+    for asg_name in sorted(groups):
+        try:
+            group = asg_helper.describe_group(asg_name, max_age=0)
+            asg_helper.set_desired_capacity(asg_name, max(group['MinSize'],
+                                                          group['DesiredCapacity'] - len(groups[asg_name])))
+        except Exception as e:
+            logger.error('Unable to release backfilled capacity of AutoScaling group {0}: {1}'.format(asg_name, e))
+
+
+def process_warning_event(event, table_name=None):
+    '''
+    table_name: DynamoDB table of the registry of spot instances attached by spoptimize
+    '''
+    instance_id = warning_instance_id(event)
     logger.info('EC2 Spot Interruption Warning received for {}'.format(instance_id))
-    if ec2_helper.is_spoptimize_instance(instance_id):
+    instance_groups = registered_instance_groups([instance_id], table_name)
+    if instance_id in instance_groups or ec2_helper.is_spoptimize_instance(instance_id):
         logger.info('{} was launched by spoptimize ... terminating via autoscaling API'.format(instance_id))
-        asg_helper.terminate_instance(instance_id, decrement_cap=False)
+        backfilled = backfill_capacity([instance_id], instance_groups)
+        try:
+            asg_helper.terminate_instance(instance_id, decrement_cap=bool(backfilled))
+        except Exception:
+            release_backfilled_capacity(backfilled)
+            raise
+        deregister_instances([instance_id], table_name)
     else:
         logger.info('{} was not launched by spoptimize ... ignoring'.format(instance_id))
+
+
+def process_warning_events(events, table_name=None):
+    '''
+    Processes a batch of EC2 Spot Instance Interruption Warnings: instances are de-duplicated, looked up in the
+    registry (falling back to their tags) together and those launched by spoptimize terminated concurrently via
+    the autoscaling API
+    Malformed events are logged and skipped
+    table_name: DynamoDB table of the registry of spot instances attached by spoptimize
+    Returns a dict mapping each terminated instance id to a string describing the status of its termination
+    '''
+    instance_ids = []
+    for event in events:
+        try:
+            instance_id = warning_instance_id(event)
+        except Exception as e:
+            logger.error(str(e))
+            continue
+        if instance_id not in instance_ids:
+            instance_ids.append(instance_id)
+    if not instance_ids:
+        return {}
+    logger.info('EC2 Spot Interruption Warnings received for {}'.format(', '.join(instance_ids)))
+    spoptimize_ids = spoptimize_instance_groups(instance_ids, table_name)
+    ignored_ids = [x for x in instance_ids if x not in spoptimize_ids]
+    if ignored_ids:
+        logger.info('{} were not launched by spoptimize ... ignoring'.format(', '.join(ignored_ids)))
+    term_ids = [x for x in instance_ids if x in spoptimize_ids]
+    if not term_ids:
+        return {}
+    logger.info('{} were launched by spoptimize ... terminating via autoscaling API'.format(', '.join(term_ids)))
+    backfilled = backfill_capacity(term_ids, spoptimize_ids)
+    # backfilled & other instances are terminated in one pass: a failed termination doesn't keep the rest from
+    # being terminated & deregistered
+    results = util.concurrent_map(lambda x: asg_helper.terminate_instance(x, decrement_cap=x in backfilled),
+                                  term_ids, warning_terminate_concurrency)
+    retval = dict([(x, res) for (x, res) in zip(term_ids, results) if not isinstance(res, Exception)])
+    failures = [(x, res) for (x, res) in zip(term_ids, results) if isinstance(res, Exception)]
+    if retval:
+        deregister_instances([x for x in term_ids if x in retval], table_name)
+    if not failures:
+        return retval
+    for (instance_id, e) in failures:
+        logger.error('Unable to terminate {0}: {1}'.format(instance_id, e))
+    release_backfilled_capacity(dict([(x, backfilled[x]) for (x, _) in failures if x in backfilled]))
+    # the batch is redelivered, retrying the failed terminations
+    raise failures[0][1]
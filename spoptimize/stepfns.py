@@ -8,16 +8,45 @@ from random import random
 import asg_helper
 import ddb_lock_helper
 import ec2_helper
+import sfn_helper
 import spot_helper
 import stepfn_strings as strs
-# import util
+import util
+from logging_helper import LazyJson
 
 logger = logging.getLogger()
 
+# AutoScaling attaches at most 20 instances per call
+max_batch_size = 20
+
+# group locks are leases: a holder that stops renewing (e.g. its execution was aborted) loses the lock once its
+# lease expires, without waiting executions having to look the holder's execution up
+lock_lease_seconds = 300
+
+# attached spot instances are registered for this long; older instances are recognized by their tags. The registry
+# isn't authoritative: instances terminated by scale-in or by hand stay registered until they expire, so whatever
+# is looked up in it is re-validated against the autoscaling API before being acted on
+instance_registry_days = 90
+
+# observed timings: number of samples kept per metric, and needed before waits are derived from them
+timing_samples = 50
+min_timing_samples = 5
+# the percentile of observed timings a wait is derived from, and the fraction of it that is waited,
+# so waits keep shrinking until the first check after a wait occasionally finds the instance not ready
+timing_percentile = 50
+timing_wait_factor = 0.8
+# waits of groups slower than the defaults are lengthened to at most this many seconds
+max_adaptive_wait = 900
+# the wait each metric's observations are used to derive
+timing_waits = {
+    'ondemand_healthy': 'init_sleep_interval',
+    'spot_fulfillment': 'spot_req_sleep_interval',
+    'spot_healthy': 'spot_attach_sleep_interval'
+}
+
 
 def get_spoptimize_tags(asg_tags):
-    # logger.debug('Processing auto-scaling group tags for configuration override: {}'.format(
-    #    json.dumps(asg_tags, indent=2, default=util.json_dumps_converter)))
+    logger.debug('Processing auto-scaling group tags for configuration override: %s', LazyJson(asg_tags, indent=2))
     spoptimize_tags = {
         x['Key'].split(':')[1]: x['Value']
         for x in asg_tags
@@ -27,14 +56,58 @@ def get_spoptimize_tags(asg_tags):
     return spoptimize_tags
 
 
-def init_machine_state(sns_message):
+def timings_name(asg_dict):
+    '''
+    Returns the name observed timings of the ASG's instances are recorded under
+    '''
+    # the launch configuration stands in for the instance type, which it determines
+    return '{0}/{1}'.format(asg_dict['AutoScalingGroupName'], asg_dict.get('LaunchConfigurationName', ''))
+
+
+def record_timing(table_name, asg_dict, metric, seconds):
+    '''
+    Records an observed timing of metric for the ASG's instances
+    Failures are logged and otherwise ignored
+    '''
+    logger.info('Observed {0} of {1}s in {2}'.format(metric, seconds, asg_dict['AutoScalingGroupName']))
+    try:
+        name = timings_name(asg_dict)
+        timings = ddb_lock_helper.get_timings(table_name, name)
+        timings[metric] = (timings.get(metric, []) + [int(seconds)])[-timing_samples:]
+        ttl = int((timedelta(days=30) + datetime.now() - datetime.utcfromtimestamp(0)).total_seconds())
+        ddb_lock_helper.put_timings(table_name, name, timings, ttl)
+    except Exception as e:
+        logger.warning('Unable to record {0} timing: {1}'.format(metric, e))
+
+
+def adaptive_waits(table_name, asg_dict):
+    '''
+    Derives wait intervals from the observed timings of the ASG's instances
+    Returns a dict of wait intervals, containing only those with enough observations
+    '''
+    try:
+        timings = ddb_lock_helper.get_timings(table_name, timings_name(asg_dict))
+    except Exception as e:
+        logger.warning('Unable to fetch timings: {}'.format(e))
+        return {}
+    waits = {}
+    for (metric, wait) in timing_waits.items():
+        samples = timings.get(metric, [])
+        if len(samples) >= min_timing_samples:
+            waits[wait] = int(util.percentile(samples, timing_percentile) * timing_wait_factor)
+    logger.debug('Waits derived from observed timings: %s', waits)
+    return waits
+
+
+def init_machine_state(sns_message, timings_table=None):
     '''
     sns_message: Dict of Launch Notification embedded in SNS message
+    timings_table: DynamoDB table of observed timings to derive wait intervals from
     Returns initial machine state for Spoptimize step functions
 
     Raises exception if an improper message is passed
     '''
-    # logger.debug('Launch notification received {}'.format(json.dumps(sns_message, indent=2, default=util.json_dumps_converter)))
+    logger.debug('Launch notification received %s', LazyJson(sns_message, indent=2))
     if type(sns_message) != dict:
         return ({}, 'Invalid SNS message')
     if sns_message.get('Event') != 'autoscaling:EC2_INSTANCE_LAUNCH':
@@ -64,13 +137,30 @@ def init_machine_state(sns_message):
         return ({}, 'AutoScaling Group does not exist')
     spoptimize_tags = get_spoptimize_tags(asg.get('Tags', []))
     min_protected_instances = spoptimize_tags.get('min_protected_instances', 0)
-    init_sleep_interval = spoptimize_tags.get(
-        'init_sleep_interval',
-        (asg['HealthCheckGracePeriod'] * asg['DesiredCapacity']) + (60 * random()) + 30
-    )
-    spot_req_sleep_interval = spoptimize_tags.get('spot_req_sleep_interval', 30)
-    spot_attach_sleep_interval = spoptimize_tags.get('spot_attach_sleep_interval', asg['HealthCheckGracePeriod'] + 30)
+    default_waits = {
+        'init_sleep_interval': (asg['HealthCheckGracePeriod'] * asg['DesiredCapacity']) + (60 * random()) + 30,
+        'spot_req_sleep_interval': 30,
+        'spot_attach_sleep_interval': asg['HealthCheckGracePeriod'] + 30
+    }
+    if timings_table:
+        # observed timings replace the default waits, lengthening them up to max_adaptive_wait;
+        # tags take precedence over both
+        for (wait, seconds) in adaptive_waits(timings_table, asg).items():
+            if seconds < default_waits[wait]:
+                default_waits[wait] = max(seconds, 1)
+            else:
+                default_waits[wait] = max(default_waits[wait], min(seconds, max_adaptive_wait))
+    init_sleep_interval = spoptimize_tags.get('init_sleep_interval', default_waits['init_sleep_interval'])
+    spot_req_sleep_interval = spoptimize_tags.get('spot_req_sleep_interval', default_waits['spot_req_sleep_interval'])
+    spot_attach_sleep_interval = spoptimize_tags.get('spot_attach_sleep_interval', default_waits['spot_attach_sleep_interval'])
     spot_failure_sleep_interval = spoptimize_tags.get('spot_failure_sleep_interval', 3600)
+    spot_fulfillment_events = str(spoptimize_tags.get('spot_fulfillment_events', 'false')).lower() not in ['0', 'no', 'false']
+    batch_window = int(spoptimize_tags.get('replacement_batch_window', 0))
+    max_concurrent_swaps = max(1, int(spoptimize_tags.get('max_concurrent_swaps', 1)))
+    if batch_window:
+        # the batch's members must have joined before the leader looks them up
+        init_sleep_interval = max(int(init_sleep_interval), batch_window + 30)
+        logger.info('Replacement batch window {}s'.format(batch_window))
     logger.info('Initial wait interval {}s'.format(init_sleep_interval))
     logger.info('Spot request wait interval {}s'.format(spot_req_sleep_interval))
     logger.info('Spot attachment wait interval {}s'.format(spot_attach_sleep_interval))
@@ -81,6 +171,7 @@ def init_machine_state(sns_message):
     return ({
         'iteration_count': 0,
         'ondemand_instance_id': instance_id,
+        'launched_at': util.epoch_seconds(sns_message['StartTime']) if sns_message.get('StartTime') else None,
         'launch_subnet_id': subnet_details.get('Subnet ID', ''),
         'launch_az': subnet_details['Availability Zone'],
         'autoscaling_group': asg,
@@ -88,30 +179,192 @@ def init_machine_state(sns_message):
         'init_sleep_interval': int(init_sleep_interval),
         'spot_req_sleep_interval': int(spot_req_sleep_interval),
         'spot_attach_sleep_interval': int(spot_attach_sleep_interval),
-        'spot_failure_sleep_interval': int(spot_failure_sleep_interval)
+        'spot_failure_sleep_interval': int(spot_failure_sleep_interval),
+        'batch_window': batch_window,
+        'spot_fulfillment_events': spot_fulfillment_events,
+        'max_concurrent_swaps': max_concurrent_swaps
     }, msg)
 
 
+def init_machine_states(sns_messages, timings_table=None):
+    '''
+    sns_messages: List of Launch Notifications embedded in SNS messages
+    timings_table: DynamoDB table of observed timings to derive wait intervals from
+    Returns a list of initial machine states, de-duplicated by ondemand_instance_id
+
+    Every message is validated before any state is returned; invalid messages are logged and skipped
+    '''
+    init_states = []
+    seen_instance_ids = set()
+    for sns_message in sns_messages:
+        (init_state, msg) = init_machine_state(sns_message, timings_table)
+        if not init_state.get('autoscaling_group'):
+            logger.error('Aborting executing: {}'.format(msg))
+            continue
+        if init_state['ondemand_instance_id'] in seen_instance_ids:
+            logger.info('Ignoring duplicate launch notification for {}'.format(init_state['ondemand_instance_id']))
+            continue
+        seen_instance_ids.add(init_state['ondemand_instance_id'])
+        init_states.append(init_state)
+    return init_states
+
+
+def batch_name(init_state):
+    '''
+    Returns the name of the replacement batch an execution's ondemand instance belongs in
+    '''
+    return '{0}/{1}/{2}'.format(init_state['autoscaling_group']['AutoScalingGroupName'],
+                                init_state['launch_az'], init_state.get('launch_subnet_id', ''))
+
+
+def join_replacement_batch(table_name, init_state):
+    '''
+    Adds the ondemand instance of init_state to an open replacement batch, or opens one led by it
+    Returns True if an execution should be started for init_state; False if another execution will replace it
+    '''
+    if not init_state.get('batch_window'):
+        return True
+    instance_id = init_state['ondemand_instance_id']
+    name = batch_name(init_state)
+    now = int((datetime.now() - datetime.utcfromtimestamp(0)).total_seconds())
+    ttl = now + int(timedelta(days=1).total_seconds())
+    for _ in range(2):
+        leader_id = ddb_lock_helper.join_batch(table_name, name, instance_id, now, max_batch_size, ttl)
+        if leader_id == instance_id:
+            return True
+        if leader_id:
+            logger.info('{0} joined replacement batch {1} led by {2}'.format(instance_id, name, leader_id))
+            return False
+        if ddb_lock_helper.open_batch(table_name, name, instance_id, now, now + init_state['batch_window'],
+                                      max_batch_size, ttl):
+            logger.info('{0} opened replacement batch {1}'.format(instance_id, name))
+            return True
+    # lost the race to open a batch twice; replace the instance on its own
+    logger.warning('Unable to join replacement batch {0}; replacing {1} alone'.format(name, instance_id))
+    return True
+
+
+def load_replacement_batch(table_name, leader_id):
+    '''
+    Returns the ondemand instance ids replaced by the execution of leader_id, starting with leader_id
+    '''
+    members = [x for x in ddb_lock_helper.get_batch_members(table_name, leader_id) if x != leader_id]
+    logger.info('Replacement batch led by {0} has members: {1}'.format(leader_id, members))
+    return [leader_id] + members[:max_batch_size - 1]
+
+
 def asg_instance_state(asg_dict, instance_id):
     '''
     Evaluates ondemand instance_id's health according to autoscaling group
     '''
     asg_name = asg_dict.get('AutoScalingGroupName')
-    logger.debug('Fetching instance status for {0} in {1}'.format(instance_id, asg_name))
-    if not asg_helper.describe_asg(asg_name):
+    logger.debug('Fetching instance status for %s in %s', instance_id, asg_name)
+    # the group's description includes its instances, so one call answers both questions
+    group = asg_helper.describe_group(asg_name)
+    if not group:
         logger.warning('AutoScaling group {} not longer exists'.format(asg_name))
         return strs.asg_disappeared
-    return asg_helper.get_instance_status(instance_id)
+    return asg_helper.group_instance_status(group, instance_id)
+
+
+def asg_instances_state(asg_dict, instance_ids, require_all=False):
+    '''
+    Evaluates the health of instance_ids according to autoscaling group
+    Returns 'Pending' if any instance is pending; 'Healthy' if any (or with require_all, every) instance is healthy;
+    otherwise the status of the first unhealthy instance
+    '''
+    asg_name = asg_dict.get('AutoScalingGroupName')
+    logger.debug('Fetching instance status for %s in %s', instance_ids, asg_name)
+    group = asg_helper.describe_group(asg_name)
+    if not group:
+        logger.warning('AutoScaling group {} not longer exists'.format(asg_name))
+        return strs.asg_disappeared
+    statuses = [asg_helper.group_instance_status(group, x) for x in instance_ids]
+    if strs.asg_instance_pending in statuses:
+        return strs.asg_instance_pending
+    unhealthy = [x for x in statuses if x != strs.asg_instance_healthy]
+    if not unhealthy or (strs.asg_instance_healthy in statuses and not require_all):
+        return strs.asg_instance_healthy
+    return unhealthy[0]
+
+
+def get_launch_specification(asg_dict, az, subnet_id, spec_table=None):
+    '''
+    Returns the EC2 launch specification for a spot instance in az/subnet_id for the ASG
+
+    Uses the launch specification cached by this container, then the one persisted in spec_table (if specified),
+    before translating the launch config
+    '''
+    asg_name = asg_dict.get('AutoScalingGroupName')
+    # LaunchConfigurationName is absent from the state of executions started by earlier releases
+    lc_name = asg_dict.get('LaunchConfigurationName')
+    if lc_name:
+        launch_spec = spot_helper.cached_launch_specification(lc_name, az, subnet_id)
+        if launch_spec:
+            return launch_spec
+        if spec_table:
+            launch_spec = ddb_lock_helper.get_launch_spec(spec_table, spot_helper.launch_spec_key(lc_name, az, subnet_id))
+            if launch_spec:
+                logger.debug('Using persisted launch specification for %s in %s/%s', lc_name, az, subnet_id)
+                spot_helper.cache_launch_specification(lc_name, az, subnet_id, launch_spec)
+                return launch_spec
+    launch_config = asg_helper.get_launch_config(asg_name, lc_name)
+    launch_spec = spot_helper.gen_launch_specification(launch_config, az, subnet_id)
+    if spec_table and launch_config.get('LaunchConfigurationName'):
+        ttl = int((timedelta(days=1) + datetime.now() - datetime.utcfromtimestamp(0)).total_seconds())
+        ddb_lock_helper.put_launch_spec(
+            spec_table, spot_helper.launch_spec_key(launch_config['LaunchConfigurationName'], az, subnet_id), launch_spec, ttl)
+    return launch_spec
+
+
+def discard_launch_specification(asg_dict, az, subnet_id, spec_table):
+    '''
+    Deletes the launch specification persisted in spec_table for az/subnet_id, if any
+    '''
+    if spec_table and asg_dict.get('LaunchConfigurationName'):
+        # don't let a stale launch specification outlive the in-memory caches
+        ddb_lock_helper.delete_launch_spec(
+            spec_table, spot_helper.launch_spec_key(asg_dict['LaunchConfigurationName'], az, subnet_id))
 
 
-def request_spot_instance(asg_dict, az, subnet_id, client_token):
+def request_spot_instance(asg_dict, az, subnet_id, client_token, spec_table=None):
     '''
     Fetches LaunchConfig of ASG and requests a Spot instance
     '''
     asg_name = asg_dict.get('AutoScalingGroupName')
     logger.info('Preparing to launch spot instance in {0}/{1} for {2}'.format(az, subnet_id, asg_name))
-    launch_config = asg_helper.get_launch_config(asg_name)
-    return spot_helper.request_spot_instance(launch_config, az, subnet_id, client_token)
+    launch_spec = get_launch_specification(asg_dict, az, subnet_id, spec_table)
+    try:
+        return spot_helper.request_spot_instance(None, az, subnet_id, client_token, launch_spec=launch_spec)
+    except Exception:
+        discard_launch_specification(asg_dict, az, subnet_id, spec_table)
+        raise
+
+
+def request_spot_instances(asg_dict, az, subnet_id, ondemand_instance_ids, client_token, spec_table=None):
+    '''
+    Requests a Spot instance for each healthy instance of ondemand_instance_ids
+    Returns a dict containing the spot instance request ids and the ondemand instance ids they replace
+    '''
+    asg_name = asg_dict.get('AutoScalingGroupName')
+    group = asg_helper.describe_group(asg_name)
+    healthy_ids = [x for x in ondemand_instance_ids
+                   if group and asg_helper.group_instance_status(group, x) == strs.asg_instance_healthy]
+    if not healthy_ids:
+        logger.info('None of {0} are healthy in {1}'.format(ondemand_instance_ids, asg_name))
+        return {'SpoptimizeError': 'NoHealthyOnDemandInstances'}
+    logger.info('Preparing to launch {0} spot instances in {1}/{2} for {3}'.format(len(healthy_ids), az, subnet_id, asg_name))
+    launch_spec = get_launch_specification(asg_dict, az, subnet_id, spec_table)
+    # the token must change with the count, or a retry with fewer healthy instances is rejected
+    client_token = '{0}-{1}'.format(client_token, len(healthy_ids))
+    try:
+        resp = spot_helper.request_spot_instances(launch_spec, az, subnet_id, client_token, len(healthy_ids))
+    except Exception:
+        discard_launch_specification(asg_dict, az, subnet_id, spec_table)
+        raise
+    if 'SpotInstanceRequestIds' in resp:
+        resp['OnDemandInstanceIds'] = healthy_ids
+    return resp
 
 
 def get_spot_request_status(spot_request_id):
@@ -127,6 +380,91 @@ def get_spot_request_status(spot_request_id):
     return spot_request_result
 
 
+def get_spot_requests_status(spot_request_ids):
+    '''
+    Fetches status of spot requests
+    Returns 'Pending' if any request is pending, 'Failure' if every request failed;
+    otherwise the list of running spot instance ids
+    '''
+    results = spot_helper.get_spot_request_statuses(spot_request_ids)
+    if strs.spot_request_pending in results:
+        return strs.spot_request_pending
+    instance_ids = [x for x in results if re.match(r'^i-', x)]
+    if not instance_ids:
+        return strs.spot_request_failure
+    if len(ec2_helper.running_instances(instance_ids)) < len(instance_ids):
+        return strs.spot_request_pending
+    return instance_ids
+
+
+def spot_request_result(spot_request):
+    '''
+    Evaluates the response of a spot instance request: a string as returned by get_spot_request_status,
+    or a list as returned by get_spot_requests_status for multi-instance requests
+    '''
+    if spot_request.get('SpoptimizeError') == 'NoHealthyOnDemandInstances':
+        # a batch whose instances are all gone has nothing left to replace, so its execution ends
+        logger.info('No healthy ondemand instances were left to request spot instances for')
+        return strs.asg_instance_terminated
+    if spot_request.get('SpoptimizeError'):
+        logger.info('Spot request error: {}'.format(spot_request['SpoptimizeError']))
+        return strs.spot_request_failure
+    if 'SpotInstanceRequestIds' in spot_request:
+        return get_spot_requests_status(spot_request['SpotInstanceRequestIds'])
+    return get_spot_request_status(spot_request['SpotInstanceRequestId'])
+
+
+def resume_spot_waiter(table_name, task_token, spot_request):
+    '''
+    Resumes the execution waiting on task_token if spot_request is no longer pending
+    Returns the spot request's result if the execution was resumed; None otherwise
+    '''
+    result = spot_request_result(spot_request)
+    if result == strs.spot_request_pending:
+        return None
+    ddb_lock_helper.delete_spot_waiter(table_name, spot_request)
+    sfn_helper.send_task_success(task_token, result)
+    return result
+
+
+def await_spot_request(table_name, spot_request, task_token):
+    '''
+    Records task_token so the waiting execution is resumed by the spot request's fulfillment events
+    Returns the spot request's result if the execution was resumed right away; None otherwise
+    '''
+    if spot_request.get('SpoptimizeError'):
+        # no spot request was made, so there's no waiter to record (or delete)
+        result = spot_request_result(spot_request)
+        sfn_helper.send_task_success(task_token, result)
+        return result
+    ttl = int((timedelta(days=1) + datetime.now() - datetime.utcfromtimestamp(0)).total_seconds())
+    ddb_lock_helper.put_spot_waiter(table_name, spot_request, task_token, ttl)
+    # the instance may be running before the waiter was recorded
+    return resume_spot_waiter(table_name, task_token, spot_request)
+
+
+def process_spot_event(table_name, event):
+    '''
+    event: EC2 Spot Instance Request Fulfillment or EC2 Instance State-change Notification event
+    Resumes the execution waiting on the event's spot request, if any
+    Returns the spot request's result if an execution was resumed; None otherwise
+    '''
+    detail = event.get('detail', {})
+    spot_request_id = detail.get('spot-instance-request-id')
+    if not spot_request_id and detail.get('instance-id') and detail.get('state') == 'running':
+        spot_request_id = ec2_helper.spot_request_id(detail['instance-id'])
+    if not spot_request_id:
+        logger.debug('Event does not concern a spot request')
+        return None
+    waiter = ddb_lock_helper.get_spot_waiter(table_name, spot_request_id)
+    if not waiter:
+        logger.debug('No execution is waiting on spot request %s', spot_request_id)
+        return None
+    (task_token, spot_request) = waiter
+    logger.info('Processing {0} event for spot request {1}'.format(event.get('detail-type'), spot_request_id))
+    return resume_spot_waiter(table_name, task_token, spot_request)
+
+
 def attach_spot_instance(asg_dict, spot_instance_id, ondemand_instance_id):
     '''
     Attaches spot_instance_id to AutoScaling Group
@@ -134,7 +472,8 @@ def attach_spot_instance(asg_dict, spot_instance_id, ondemand_instance_id):
     asg_name = asg_dict.get('AutoScalingGroupName')
     logger.info('Checking AutoScaling group {0} in preparation to attach {1} and term {2}'.format(
         asg_name, spot_instance_id, ondemand_instance_id))
-    asg = asg_helper.describe_asg(asg_name)
+    # capacity is evaluated while holding the group's lock, so don't trust a cached description
+    asg = asg_helper.describe_group(asg_name, max_age=0)
     if not asg:
         logger.info('AutoScaling group {0} no longer exists; Terminating {1}'.format(asg_name, spot_instance_id))
         return strs.asg_disappeared
@@ -143,7 +482,7 @@ def attach_spot_instance(asg_dict, spot_instance_id, ondemand_instance_id):
     if not ec2_helper.tag_instance(spot_instance_id, ondemand_instance_id, resource_tags):
         logger.warning('Spot instance {} does not appear to exist'.format(spot_instance_id))
         return strs.spot_instance_disappeared
-    if asg_helper.get_instance_status(ondemand_instance_id) != 'Healthy':
+    if asg_helper.group_instance_status(asg, ondemand_instance_id) != 'Healthy':
         logger.info('OnDemand instance {} is protected or unhealthy'.format(ondemand_instance_id))
         return strs.od_instance_disappeared
     if asg['DesiredCapacity'] == asg['MaxSize']:
@@ -154,52 +493,264 @@ def attach_spot_instance(asg_dict, spot_instance_id, ondemand_instance_id):
     logger.info('AutoScaling group {0} has available capacity - attaching {1}, then terminating {2}'.format(
         asg_name, spot_instance_id, ondemand_instance_id))
     retval = asg_helper.attach_instance(asg_dict['AutoScalingGroupName'], spot_instance_id)
+    if retval != strs.success:
+        # e.g. a concurrent swap used up the capacity; keep the on-demand instance
+        logger.warning('Unable to attach {0}; not terminating {1}'.format(spot_instance_id, ondemand_instance_id))
+        return retval
     asg_helper.terminate_instance(ondemand_instance_id, decrement_cap=True)
     return retval
 
 
+def attach_spot_instances(asg_dict, spot_instance_ids, ondemand_instance_ids):
+    '''
+    Attaches spot_instance_ids to AutoScaling Group, replacing ondemand_instance_ids pairwise
+    Returns the list of attached spot instance ids; a string describing the failure if none were attached
+    '''
+    asg_name = asg_dict.get('AutoScalingGroupName')
+    logger.info('Checking AutoScaling group {0} in preparation to attach {1} and term {2}'.format(
+        asg_name, spot_instance_ids, ondemand_instance_ids))
+    # capacity is evaluated while holding the group's lock, so don't trust a cached description
+    asg = asg_helper.describe_group(asg_name, max_age=0)
+    if not asg:
+        logger.info('AutoScaling group {0} no longer exists; Terminating {1}'.format(asg_name, spot_instance_ids))
+        return strs.asg_disappeared
+    resource_tags = [{'Key': x['Key'], 'Value': x['Value']} for x in asg['Tags']
+                     if x.get('PropagateAtLaunch', False) and x.get('Key', '').split(':')[0] != 'aws']
+    pairs = []
+    unpaired_ids = []
+    failure = strs.spot_instance_disappeared
+    for (spot_instance_id, ondemand_instance_id) in zip(spot_instance_ids, ondemand_instance_ids):
+        if not ec2_helper.tag_instance(spot_instance_id, ondemand_instance_id, resource_tags):
+            logger.warning('Spot instance {} does not appear to exist'.format(spot_instance_id))
+            continue
+        if asg_helper.group_instance_status(asg, ondemand_instance_id) != 'Healthy':
+            logger.info('OnDemand instance {} is protected or unhealthy'.format(ondemand_instance_id))
+            unpaired_ids.append(spot_instance_id)
+            failure = strs.od_instance_disappeared
+            continue
+        pairs.append((spot_instance_id, ondemand_instance_id))
+    if not pairs:
+        # the execution's failure handling terminates every spot instance
+        return failure
+    headroom = max(asg['MaxSize'] - asg['DesiredCapacity'], 0)
+    # make room for the spot instances that don't fit by terminating their ondemand counterparts first
+    pre_term_pairs = pairs[:max(len(pairs) - headroom, 0)]
+    if pre_term_pairs:
+        logger.info("AutoScaling group {0} lacks capacity for {1} more instances - terminating {2} first".format(
+            asg_name, len(pairs), [x[1] for x in pre_term_pairs]))
+        asg_helper.terminate_instances([x[1] for x in pre_term_pairs], decrement_cap=True)
+    attach_results = asg_helper.attach_instance_batch(asg_name, [x[0] for x in pairs])
+    attached_pairs = [x for x in pairs if attach_results.get(x[0]) == strs.success]
+    if not attached_pairs:
+        return attach_results[pairs[0][0]]
+    unpaired_ids.extend([x[0] for x in pairs if x not in attached_pairs])
+    if unpaired_ids:
+        logger.info('Terminating spot instances that did not replace an ondemand instance: {}'.format(unpaired_ids))
+        ec2_helper.terminate_instances(unpaired_ids)
+    post_term_ids = [x[1] for x in attached_pairs if x not in pre_term_pairs]
+    if post_term_ids:
+        logger.info('Attached {0} to AutoScaling group {1} - terminating {2}'.format(
+            [x[0] for x in attached_pairs], asg_name, post_term_ids))
+        asg_helper.terminate_instances(post_term_ids, decrement_cap=True)
+    return [x[0] for x in attached_pairs]
+
+
+def register_spot_instances(table_name, asg_name, instance_ids):
+    '''
+    Records the spot instances attached to asg_name, so that interruption warnings needn't look up their tags
+    Failures are logged and otherwise ignored; unregistered instances are recognized by their tags
+    '''
+    try:
+        ttl = int((timedelta(days=instance_registry_days) + datetime.now() - datetime.utcfromtimestamp(0)).total_seconds())
+        ddb_lock_helper.register_instances(table_name, instance_ids, asg_name, ttl)
+    except Exception as e:
+        logger.warning('Unable to register {0}: {1}'.format(', '.join(instance_ids), e))
+
+
+def deregister_spot_instances(table_name, instance_ids):
+    '''
+    Removes terminated spot instances from the registry of attached spot instances
+    Failures are logged and otherwise ignored; registered instances expire regardless
+    '''
+    try:
+        ddb_lock_helper.deregister_instances(table_name, instance_ids)
+    except Exception as e:
+        logger.warning('Unable to deregister {0}: {1}'.format(', '.join(instance_ids), e))
+
+
 def terminate_ec2_instance(instance_id):
+    if isinstance(instance_id, list):
+        return ec2_helper.terminate_instances(instance_id)
     if instance_id:
         return ec2_helper.terminate_instance(instance_id)
 
 
-def acquire_lock(table_name, group_name, my_execution_arn):
+def acquire_lock(table_name, group_name, my_execution_arn, lease_seconds=None):
+    '''
+    Acquires the lock of group_name for lease_seconds (defaults to lock_lease_seconds); holders extend their lease
+    via renew_lock. A lock whose lease has expired is stale and is taken over by the same conditional write
+    Returns True if acquired; False otherwise
+    '''
     logger.info('Acquiring lock for {}'.format(group_name))
-    logger.debug('My execution ARN is {}'.format(my_execution_arn))
-    ttl = int((timedelta(days=7) + datetime.now() - datetime.utcfromtimestamp(0)).total_seconds())
-    if ddb_lock_helper.put_item(table_name, group_name, my_execution_arn, ttl):
-        logger.info('Lock for {} Acquired'.format(group_name))
-        return True
-    current_owner = ddb_lock_helper.get_item(table_name, group_name)
-    if current_owner == my_execution_arn:
-        logger.info('Lock for {} Already Acquired'.format(group_name))
+    logger.debug('My execution ARN is %s', my_execution_arn)
+    now = int((datetime.now() - datetime.utcfromtimestamp(0)).total_seconds())
+    lease_expires = now + (lease_seconds or lock_lease_seconds)
+    ttl = lease_expires + int(timedelta(days=1).total_seconds())
+    (acquired, holder) = ddb_lock_helper.put_lease(table_name, group_name, my_execution_arn, now, lease_expires, ttl)
+    if acquired:
+        logger.info('Lock for {0} Acquired until {1}'.format(group_name, lease_expires))
         return True
-    if ddb_lock_helper.is_execution_running(current_owner):
-        logger.info('Lock for {0} belongs to {1}'.format(group_name, current_owner))
+    if holder['lease_expires'] is not None:
+        logger.info('Lock for {0} belongs to {1} until {2}'.format(
+            group_name, holder['execution_arn'], holder['lease_expires']))
         return False
-    logger.info('Found stale lock for {0}  belonging to {1}'.format(group_name, current_owner))
-    if ddb_lock_helper.put_item(table_name, group_name, my_execution_arn, ttl, current_owner):
+    # locks written before leases were introduced are stale once their execution is no longer running
+    if ddb_lock_helper.is_execution_running(holder['execution_arn']):
+        logger.info('Lock for {0} belongs to {1}'.format(group_name, holder['execution_arn']))
+        return False
+    logger.info('Found stale lock for {0}  belonging to {1}'.format(group_name, holder['execution_arn']))
+    if ddb_lock_helper.put_lease(table_name, group_name, my_execution_arn, now, lease_expires, ttl,
+                                 holder['execution_arn'])[0]:
         logger.info('Lock for {} Acquired'.format(group_name))
         return True
     logger.warning('Unable to acquire lock for {}'.format(group_name))
     return False
 
 
-def release_lock(table_name, group_name, my_execution_arn):
-    logger.info('Releasing lock for {}'.format(group_name))
-    logger.debug('My execution ARN is {}'.format(my_execution_arn))
-    ddb_lock_helper.delete_item(table_name, group_name, my_execution_arn)
+def renew_lock(table_name, group_name, my_execution_arn, lease_seconds=None):
+    '''
+    Extends my_execution_arn's lease on the lock of group_name by lease_seconds (defaults to lock_lease_seconds)
+    Returns True if renewed; False if the lock was taken over by another execution
+    '''
+    logger.debug('Renewing lock for %s', group_name)
+    now = int((datetime.now() - datetime.utcfromtimestamp(0)).total_seconds())
+    lease_expires = now + (lease_seconds or lock_lease_seconds)
+    ttl = lease_expires + int(timedelta(days=1).total_seconds())
+    (renewed, holder) = ddb_lock_helper.put_lease(table_name, group_name, my_execution_arn, now, lease_expires, ttl,
+                                                  my_execution_arn)
+    if not renewed:
+        logger.warning('Lock for {0} was taken over by {1}'.format(group_name, holder['execution_arn']))
+    return renewed
 
 
-def protected_instance(group_name, instance_id, min_protected, lock_table_name, my_execution_arn):
+def swap_slot_name(group_name, slot):
+    '''
+    Returns the lock name of slot of group_name's swap semaphore; slot 0 is the group's lock
+    '''
+    if not slot:
+        return group_name
+    return ddb_lock_helper.record_key('swap-slot', '{0}/{1}'.format(group_name, slot))
+
+
+def acquire_swap_slot(table_name, group_name, my_execution_arn, max_swaps=1, lease_seconds=None):
+    '''
+    Acquires one of up to max_swaps locks of group_name, so that up to max_swaps instances of the group are swapped
+    concurrently. Only as many slots as the group has capacity for (MaxSize - DesiredCapacity) are used, so that
+    concurrent swaps attach before terminating and a group without spare capacity is swapped one at a time
+    Returns the name of the acquired lock; None if all slots are taken
+    '''
+    slots = 1
+    if max_swaps > 1:
+        group = asg_helper.describe_group(group_name, max_age=0)
+        if group:
+            slots = max(1, min(max_swaps, group['MaxSize'] - group['DesiredCapacity']))
+        logger.info('Using {0} of {1} swap slots of {2}'.format(slots, max_swaps, group_name))
+    for slot in range(slots):
+        lock_name = swap_slot_name(group_name, slot)
+        if acquire_lock(table_name, lock_name, my_execution_arn, lease_seconds):
+            return lock_name
+    return None
+
+
+def swap_slot_usable(group_name, lock_name):
+    '''
+    Returns True if lock_name is the group's lock, or a swap slot within the group's spare capacity
+    (MaxSize - DesiredCapacity); acquire_swap_slot only uses those
+    '''
+    if lock_name == group_name:
+        return True
+    group = asg_helper.describe_group(group_name, max_age=0)
+    if not group:
+        return False
+    return int(lock_name.rsplit('/', 1)[1]) < group['MaxSize'] - group['DesiredCapacity']
+
+
+def release_lock(table_name, group_name, my_execution_arn, lock_name=None):
+    '''
+    Releases lock_name (defaults to group_name's lock), handing it over to the first execution waiting for a lock
+    of group_name, if any. A swap slot the group no longer has spare capacity for isn't handed over; the waiter
+    keeps waiting for another lock of the group
+    '''
+    lock_name = lock_name or group_name
+    logger.info('Releasing lock {}'.format(lock_name))
+    logger.debug('My execution ARN is %s', my_execution_arn)
+    holder_arn = my_execution_arn
+    waiter = ddb_lock_helper.first_lock_waiter(table_name, group_name)
+    if waiter and not swap_slot_usable(group_name, lock_name):
+        logger.info('{0} lacks the spare capacity for {1}; not handing it over'.format(group_name, lock_name))
+        waiter = None
+    while waiter:
+        now = int((datetime.now() - datetime.utcfromtimestamp(0)).total_seconds())
+        lease_expires = now + waiter['lease_seconds']
+        ttl = lease_expires + int(timedelta(days=1).total_seconds())
+        if not ddb_lock_helper.put_lease(table_name, lock_name, waiter['execution_arn'], now, lease_expires, ttl,
+                                         holder_arn)[0]:
+            # the waiter is still queued, for whichever execution holds a lock of the group to hand it one
+            logger.warning('Lock {0} is no longer held by {1}; unable to hand it over to {2}'.format(
+                lock_name, holder_arn, waiter['execution_arn']))
+            return
+        holder_arn = waiter['execution_arn']
+        # the waiter is dequeued only once it holds the lock
+        if ddb_lock_helper.remove_first_lock_waiter(table_name, group_name, holder_arn) and \
+                sfn_helper.send_task_success(waiter['task_token'], lock_name):
+            logger.info('Lock {0} handed over to {1}'.format(lock_name, holder_arn))
+            return
+        logger.info('{} is no longer waiting'.format(holder_arn))
+        waiter = ddb_lock_helper.first_lock_waiter(table_name, group_name)
+    ddb_lock_helper.delete_item(table_name, lock_name, holder_arn)
+
+
+def await_lock(table_name, group_name, my_execution_arn, task_token, max_swaps=1, lease_seconds=None):
+    '''
+    Queues task_token for a lock of group_name; release_lock hands the lock over and resumes the waiting execution
+    in order
+    Returns the name of the acquired lock if the execution was resumed right away; None otherwise
+    '''
+    lease_seconds = lease_seconds or lock_lease_seconds
+    ttl = int((timedelta(days=1) + datetime.now() - datetime.utcfromtimestamp(0)).total_seconds())
+    ddb_lock_helper.enqueue_lock_waiter(table_name, group_name, my_execution_arn, task_token, lease_seconds, ttl)
+    # the lock may have been released before the waiter was queued
+    lock_name = acquire_swap_slot(table_name, group_name, my_execution_arn, max_swaps, lease_seconds)
+    if not lock_name:
+        return None
+    if not ddb_lock_helper.remove_lock_waiter(table_name, group_name, my_execution_arn):
+        # already dequeued by a releasing execution, which handed its lock over
+        logger.info('{0} is being handed a lock of {1}; releasing {2}'.format(my_execution_arn, group_name, lock_name))
+        release_lock(table_name, group_name, my_execution_arn, lock_name)
+        return None
+    sfn_helper.send_task_success(task_token, lock_name)
+    return lock_name
+
+
+def protected_instances(group_name, instance_ids, min_protected, lock_table_name, my_execution_arn):
     if not min_protected:
         logger.info('No protected instances required for auto-scaling group {}'.format(group_name))
         return None
     logger.info('{0} protected instances required fro auto-scaling group {1}'.format(min_protected, group_name))
+    # Optimistic read of the (shared, possibly cached) group description: the lock is only needed to add protection
+    if not asg_helper.not_enough_protected_instances(group_name, min_protected):
+        logger.debug('Auto-scaling group %s already has enough protected instances', group_name)
+        return None
     if not acquire_lock(lock_table_name, group_name, my_execution_arn):
         return strs.unable_to_acquire_lock
-    if asg_helper.not_enough_protected_instances(group_name, min_protected):
+    for instance_id in instance_ids:
+        if not asg_helper.not_enough_protected_instances(group_name, min_protected, max_age=0):
+            break
         logger.info('Marking {0} as protected from scale-in in group {1}'.format(instance_id, group_name))
         asg_helper.protect_instance(group_name, instance_id)
     release_lock(lock_table_name, group_name, my_execution_arn)
     return None
+
+
+def protected_instance(group_name, instance_id, min_protected, lock_table_name, my_execution_arn):
+    return protected_instances(group_name, [instance_id], min_protected, lock_table_name, my_execution_arn)
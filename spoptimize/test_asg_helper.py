@@ -1,10 +1,11 @@
 import copy
 import json
 import os
+import time
 import unittest
 
 from botocore.exceptions import ClientError
-from mock import Mock
+from mock import Mock, call
 
 import asg_helper
 import stepfn_strings as strs
@@ -27,6 +28,7 @@ class TestDescribeAsg(unittest.TestCase):
     def setUp(self):
         self.asg_name = mock_attrs['describe_auto_scaling_groups.return_value']['AutoScalingGroups'][0]['AutoScalingGroupName']
         self.mock_attrs = copy.deepcopy(mock_attrs)
+        asg_helper.invalidate_asg_cache()
 
     def test_valid_asg(self):
         logger.debug('TestDescribeAsg.test_valid_asg')
@@ -44,12 +46,74 @@ class TestDescribeAsg(unittest.TestCase):
         self.assertDictEqual(asg_dict, {})
 
 
+class TestAsgCache(unittest.TestCase):
+
+    def setUp(self):
+        self.asg_name = mock_attrs['describe_auto_scaling_groups.return_value']['AutoScalingGroups'][0]['AutoScalingGroupName']
+        self.mock_attrs = copy.deepcopy(mock_attrs)
+        asg_helper.invalidate_asg_cache()
+
+    def test_cached_description(self):
+        logger.debug('TestAsgCache.test_cached_description')
+        asg_helper.autoscaling = Mock(**self.mock_attrs)
+        asg_dict = asg_helper.describe_asg(self.asg_name)
+        self.assertDictEqual(asg_helper.describe_asg(self.asg_name), asg_dict)
+        self.assertFalse(asg_helper.not_enough_protected_instances(self.asg_name, 0))
+        asg_helper.get_launch_config(self.asg_name)
+        asg_helper.autoscaling.describe_auto_scaling_groups.assert_called_once_with(AutoScalingGroupNames=[self.asg_name])
+
+    def test_cached_unknown_asg(self):
+        logger.debug('TestAsgCache.test_cached_unknown_asg')
+        self.mock_attrs['describe_auto_scaling_groups.return_value'] = {'AutoScalingGroups': []}
+        asg_helper.autoscaling = Mock(**self.mock_attrs)
+        self.assertDictEqual(asg_helper.describe_asg(self.asg_name), {})
+        self.assertDictEqual(asg_helper.describe_asg(self.asg_name), {})
+        asg_helper.autoscaling.describe_auto_scaling_groups.assert_called_once()
+
+    def test_max_age(self):
+        logger.debug('TestAsgCache.test_max_age')
+        asg_helper.autoscaling = Mock(**self.mock_attrs)
+        asg_helper.describe_asg(self.asg_name)
+        asg_helper.describe_asg(self.asg_name, max_age=0)
+        self.assertEqual(asg_helper.autoscaling.describe_auto_scaling_groups.call_count, 2)
+
+    def test_expired(self):
+        logger.debug('TestAsgCache.test_expired')
+        now = [1000.0]
+        asg_helper.asg_cache.clock = lambda: now[0]
+        try:
+            asg_helper.autoscaling = Mock(**self.mock_attrs)
+            asg_helper.describe_asg(self.asg_name)
+            now[0] += asg_helper.asg_cache_ttl - 1
+            asg_helper.describe_asg(self.asg_name)
+            asg_helper.autoscaling.describe_auto_scaling_groups.assert_called_once()
+            now[0] += 1
+            asg_helper.describe_asg(self.asg_name)
+            self.assertEqual(asg_helper.autoscaling.describe_auto_scaling_groups.call_count, 2)
+        finally:
+            asg_helper.asg_cache.clock = time.time
+
+    def test_invalidated_by_changes(self):
+        logger.debug('TestAsgCache.test_invalidated_by_changes')
+        asg_helper.autoscaling = Mock(**self.mock_attrs)
+        asg_helper.describe_asg(self.asg_name)
+        asg_helper.attach_instance(self.asg_name, 'i-abcd123')
+        asg_helper.describe_asg(self.asg_name)
+        asg_helper.protect_instance(self.asg_name, 'i-abcd123')
+        asg_helper.describe_asg(self.asg_name)
+        asg_helper.terminate_instance('i-abcd123', True)
+        asg_helper.describe_asg(self.asg_name)
+        self.assertEqual(asg_helper.autoscaling.describe_auto_scaling_groups.call_count, 4)
+
+
 class TestGetLaunchConfig(unittest.TestCase):
 
     def setUp(self):
         self.asg_name = mock_attrs['describe_auto_scaling_groups.return_value']['AutoScalingGroups'][0]['AutoScalingGroupName']
         self.lc_name = mock_attrs['describe_launch_configurations.return_value']['LaunchConfigurations'][0]['LaunchConfigurationName']
         self.mock_attrs = copy.deepcopy(mock_attrs)
+        asg_helper.invalidate_asg_cache()
+        asg_helper.launch_config_cache.invalidate()
 
     def test_valid_lc(self):
         logger.debug('TestGetLaunchConfig.test_valid_lc')
@@ -72,12 +136,62 @@ class TestGetLaunchConfig(unittest.TestCase):
         lc_dict = asg_helper.get_launch_config(self.asg_name)
         self.assertDictEqual(lc_dict, {})
 
+    def test_launch_template_asg(self):
+        logger.debug('TestGetLaunchConfig.test_launch_template_asg')
+        del(self.mock_attrs['describe_auto_scaling_groups.return_value']['AutoScalingGroups'][0]['LaunchConfigurationName'])
+        asg_helper.autoscaling = Mock(**self.mock_attrs)
+        lc_dict = asg_helper.get_launch_config(self.asg_name)
+        asg_helper.autoscaling.describe_launch_configurations.assert_not_called()
+        self.assertDictEqual(lc_dict, {})
+
+    def test_known_lc_name(self):
+        logger.debug('TestGetLaunchConfig.test_known_lc_name')
+        asg_helper.autoscaling = Mock(**self.mock_attrs)
+        expected_dict = mock_attrs['describe_launch_configurations.return_value']['LaunchConfigurations'][0]
+        lc_dict = asg_helper.get_launch_config(self.asg_name, self.lc_name)
+        asg_helper.autoscaling.describe_auto_scaling_groups.assert_not_called()
+        asg_helper.autoscaling.describe_launch_configurations.assert_called_once_with(LaunchConfigurationNames=[self.lc_name])
+        self.assertDictEqual(lc_dict, expected_dict)
+
+    def test_cached_lc(self):
+        logger.debug('TestGetLaunchConfig.test_cached_lc')
+        asg_helper.autoscaling = Mock(**self.mock_attrs)
+        expected_dict = mock_attrs['describe_launch_configurations.return_value']['LaunchConfigurations'][0]
+        asg_helper.get_launch_config(self.asg_name, self.lc_name)
+        lc_dict = asg_helper.get_launch_config(self.asg_name, self.lc_name)
+        asg_helper.autoscaling.describe_launch_configurations.assert_called_once()
+        self.assertDictEqual(lc_dict, expected_dict)
+
+    def test_unknown_lc_not_cached(self):
+        logger.debug('TestGetLaunchConfig.test_unknown_lc_not_cached')
+        self.mock_attrs['describe_launch_configurations.return_value'] = {'LaunchConfigurations': []}
+        asg_helper.autoscaling = Mock(**self.mock_attrs)
+        asg_helper.get_launch_config(self.asg_name, self.lc_name)
+        asg_helper.get_launch_config(self.asg_name, self.lc_name)
+        self.assertEqual(asg_helper.autoscaling.describe_launch_configurations.call_count, 2)
+
+    def test_deleted_lc_name(self):
+        logger.debug('TestGetLaunchConfig.test_deleted_lc_name')
+        expected_dict = mock_attrs['describe_launch_configurations.return_value']['LaunchConfigurations'][0]
+        # e.g. a stack update replaced the group's launch configuration since the execution recorded its name
+        self.mock_attrs['describe_launch_configurations.side_effect'] = lambda LaunchConfigurationNames: \
+            {'LaunchConfigurations': [expected_dict] if LaunchConfigurationNames == [self.lc_name] else []}
+        asg_helper.autoscaling = Mock(**self.mock_attrs)
+        asg_helper.describe_group(self.asg_name)
+        lc_dict = asg_helper.get_launch_config(self.asg_name, 'deleted-lc')
+        self.assertDictEqual(lc_dict, expected_dict)
+        self.assertListEqual(asg_helper.autoscaling.describe_launch_configurations.call_args_list, [
+            call(LaunchConfigurationNames=['deleted-lc']), call(LaunchConfigurationNames=[self.lc_name])])
+        # the group's cached description may predate the stack update
+        self.assertEqual(asg_helper.autoscaling.describe_auto_scaling_groups.call_count, 2)
+
 
 class TestGetInstanceStatus(unittest.TestCase):
 
     def setUp(self):
         self.instance_id = mock_attrs['describe_auto_scaling_instances.return_value']['AutoScalingInstances'][0]['InstanceId']
         self.mock_attrs = copy.deepcopy(mock_attrs)
+        asg_helper.invalidate_asg_cache()
         self.mock_resp = self.mock_attrs['describe_auto_scaling_instances.return_value']['AutoScalingInstances'][0]
 
     def test_healthy_inservice(self):
@@ -144,15 +258,48 @@ class TestGetInstanceStatus(unittest.TestCase):
         self.assertEqual(res, strs.asg_instance_terminated)
 
 
+class TestGroupInstanceStatus(unittest.TestCase):
+
+    def setUp(self):
+        self.group = copy.deepcopy(mock_attrs['describe_auto_scaling_groups.return_value']['AutoScalingGroups'][0])
+        self.instance_id = self.group['Instances'][0]['InstanceId']
+        asg_helper.autoscaling = Mock()
+
+    def test_healthy_inservice(self):
+        logger.debug('TestGroupInstanceStatus.test_healthy_inservice')
+        self.assertEqual(asg_helper.group_instance_status(self.group, self.instance_id), strs.asg_instance_healthy)
+        asg_helper.autoscaling.describe_auto_scaling_instances.assert_not_called()
+
+    def test_protected_from_scalein(self):
+        logger.debug('TestGroupInstanceStatus.test_protected_from_scalein')
+        self.group['Instances'][0]['ProtectedFromScaleIn'] = True
+        self.assertEqual(asg_helper.group_instance_status(self.group, self.instance_id), strs.asg_instance_protected)
+
+    def test_unhealthy_inservice(self):
+        logger.debug('TestGroupInstanceStatus.test_unhealthy_inservice')
+        self.group['Instances'][0]['HealthStatus'] = 'Unhealthy'
+        self.assertEqual(asg_helper.group_instance_status(self.group, self.instance_id), strs.asg_instance_pending)
+
+    def test_terminating(self):
+        logger.debug('TestGroupInstanceStatus.test_terminating')
+        self.group['Instances'][0]['LifecycleState'] = 'Terminating:Wait'
+        self.assertEqual(asg_helper.group_instance_status(self.group, self.instance_id), strs.asg_instance_terminated)
+
+    def test_unknown_instance(self):
+        logger.debug('TestGroupInstanceStatus.test_unknown_instance')
+        self.assertEqual(asg_helper.group_instance_status(self.group, 'i-abcd123'), strs.asg_instance_terminated)
+
+
 class TestTerminateInstance(unittest.TestCase):
 
     def setUp(self):
         self.mock_attrs = copy.deepcopy(mock_attrs)
+        asg_helper.invalidate_asg_cache()
 
     def test_term_instance(self):
         logger.debug('TestTerminateInstance.test_term_instance')
         asg_helper.autoscaling = Mock(**self.mock_attrs)
-        asg_helper.terminate_instance('i-abcd123', True)
+        self.assertEqual(asg_helper.terminate_instance('i-abcd123', True), strs.success)
         asg_helper.autoscaling.terminate_instance_in_auto_scaling_group.assert_called()
 
     def test_term_instance_not_found(self):
@@ -165,7 +312,7 @@ class TestTerminateInstance(unittest.TestCase):
             }
         }, 'TerminateInstanceInAutoScalingGroup')
         asg_helper.autoscaling = Mock(**self.mock_attrs)
-        asg_helper.terminate_instance('i-abcd123', True)
+        self.assertEqual(asg_helper.terminate_instance('i-abcd123', True), strs.asg_instance_terminated)
         asg_helper.autoscaling.terminate_instance_in_auto_scaling_group.assert_called()
 
     def test_term_instance_raise_clienterror(self):
@@ -193,6 +340,7 @@ class TestAttachInstance(unittest.TestCase):
 
     def setUp(self):
         self.mock_attrs = copy.deepcopy(mock_attrs)
+        asg_helper.invalidate_asg_cache()
 
     def test_attach_instance(self):
         logger.debug('TestAttachInstance.test_attach_instance')
@@ -276,12 +424,101 @@ class TestAttachInstance(unittest.TestCase):
             asg_helper.attach_instance('group-name', 'i-abcd123XXX')
 
 
+class TestInstanceGroups(unittest.TestCase):
+
+    def test_instance_groups(self):
+        logger.debug('TestInstanceGroups.test_instance_groups')
+        asg_helper.autoscaling = Mock(**{'describe_auto_scaling_instances.side_effect': lambda **kwargs: {
+            'AutoScalingInstances': [{'InstanceId': x, 'AutoScalingGroupName': 'asg-group'}
+                                     for x in kwargs['InstanceIds'] if x != 'i-3']
+        }})
+        res = asg_helper.instance_groups(['i-{}'.format(x) for x in range(60)])
+        self.assertEqual(asg_helper.autoscaling.describe_auto_scaling_instances.call_count, 2)
+        self.assertEqual(len(res), 59)
+        self.assertNotIn('i-3', res)
+        self.assertEqual(res['i-59'], 'asg-group')
+
+
+class TestTerminateInstances(unittest.TestCase):
+
+    def setUp(self):
+        asg_helper.invalidate_asg_cache()
+
+    def test_term_instances(self):
+        logger.debug('TestTerminateInstances.test_term_instances')
+
+        def terminate(InstanceId, ShouldDecrementDesiredCapacity):
+            if InstanceId == 'i-2':
+                raise ClientError({'Error': {'Code': 'ValidationError', 'Message': 'Instance Id not found'}},
+                                  'TerminateInstanceInAutoScalingGroup')
+            return {}
+
+        asg_helper.autoscaling = Mock(**{'terminate_instance_in_auto_scaling_group.side_effect': terminate})
+        res = asg_helper.terminate_instances(['i-1', 'i-2', 'i-3'], True)
+        self.assertEqual(asg_helper.autoscaling.terminate_instance_in_auto_scaling_group.call_count, 3)
+        self.assertDictEqual(res, {'i-1': strs.success, 'i-2': strs.asg_instance_terminated, 'i-3': strs.success})
+
+    def test_term_instances_raise_exception(self):
+        logger.debug('TestTerminateInstances.test_term_instances_raise_exception')
+        asg_helper.autoscaling = Mock(**{'terminate_instance_in_auto_scaling_group.side_effect': Exception('Testing')})
+        with self.assertRaises(Exception):
+            asg_helper.terminate_instances(['i-1', 'i-2'], True)
+        self.assertEqual(asg_helper.autoscaling.terminate_instance_in_auto_scaling_group.call_count, 2)
+
+
+class TestAttachInstances(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_attrs = copy.deepcopy(mock_attrs)
+        asg_helper.invalidate_asg_cache()
+
+    def test_attach_instances(self):
+        logger.debug('TestAttachInstances.test_attach_instances')
+        asg_helper.autoscaling = Mock(**self.mock_attrs)
+        self.assertEqual(asg_helper.attach_instances('group-name', ['i-abcd123', 'i-abcd456']), strs.success)
+        asg_helper.autoscaling.attach_instances.assert_called_once_with(
+            InstanceIds=['i-abcd123', 'i-abcd456'], AutoScalingGroupName='group-name')
+
+    def test_attach_instance_batch_chunks(self):
+        logger.debug('TestAttachInstances.test_attach_instance_batch_chunks')
+        asg_helper.autoscaling = Mock(**self.mock_attrs)
+        instance_ids = ['i-{}'.format(x) for x in range(45)]
+        res = asg_helper.attach_instance_batch('group-name', instance_ids)
+        self.assertListEqual([len(x[1]['InstanceIds']) for x in asg_helper.autoscaling.attach_instances.call_args_list],
+                             [20, 20, 5])
+        self.assertDictEqual(res, {x: strs.success for x in instance_ids})
+
+    def test_attach_instance_batch_maps_failures(self):
+        logger.debug('TestAttachInstances.test_attach_instance_batch_maps_failures')
+
+        def attach_instances(InstanceIds, AutoScalingGroupName):
+            if 'i-2' in InstanceIds:
+                raise ClientError({'Error': {'Code': 'ValidationError', 'Message': 'Instance i-2 is not in correct state'}},
+                                  'AttachInstances')
+            return {}
+
+        asg_helper.autoscaling = Mock(**{'attach_instances.side_effect': attach_instances})
+        res = asg_helper.attach_instance_batch('group-name', ['i-1', 'i-2', 'i-3'])
+        self.assertEqual(asg_helper.autoscaling.attach_instances.call_count, 4)
+        self.assertDictEqual(res, {'i-1': strs.success, 'i-2': strs.asg_instance_missing, 'i-3': strs.success})
+
+    def test_attach_instance_batch_group_failure(self):
+        logger.debug('TestAttachInstances.test_attach_instance_batch_group_failure')
+        asg_helper.autoscaling = Mock(**{'attach_instances.side_effect': ClientError({'Error': {
+            'Code': 'ValidationError', 'Message': 'AutoScalingGroup name not found - AutoScalingGroup group-name not found'
+        }}, 'AttachInstances')})
+        res = asg_helper.attach_instance_batch('group-name', ['i-1', 'i-2'])
+        asg_helper.autoscaling.attach_instances.assert_called_once()
+        self.assertDictEqual(res, {'i-1': strs.asg_disappeared, 'i-2': strs.asg_disappeared})
+
+
 class TestNotEnoughProtectedInstances(unittest.TestCase):
 
     def setUp(self):
         self.asg_name = mock_attrs['describe_auto_scaling_groups.return_value']['AutoScalingGroups'][0]['AutoScalingGroupName']
         self.min_protected = 1
         self.mock_attrs = copy.deepcopy(mock_attrs)
+        asg_helper.invalidate_asg_cache()
 
     def test_instance_needs_protection(self):
         logger.debug('TestNotEnoughProtectedInstances.test_instance_needs_protection')
@@ -339,6 +576,7 @@ class TestProtectInstance(unittest.TestCase):
         self.asg_name = mock_attrs['describe_auto_scaling_groups.return_value']['AutoScalingGroups'][0]['AutoScalingGroupName']
         self.instance_id = 'i-abcd123'
         self.mock_attrs = copy.deepcopy(mock_attrs)
+        asg_helper.invalidate_asg_cache()
 
     def test_set_instance_protection_is_called(self):
         logger.debug('ProtectInstance.test_set_instance_protection_')
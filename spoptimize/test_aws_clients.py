@@ -0,0 +1,106 @@
+import unittest
+from botocore.exceptions import ClientError
+from mock import Mock, patch
+
+import aws_clients
+from logging_helper import logging, setup_stream_handler
+
+logger = logging.getLogger()
+logger.addHandler(logging.NullHandler())
+
+
+class TestLazyClient(unittest.TestCase):
+
+    def setUp(self):
+        aws_clients.clients = {}
+
+    def tearDown(self):
+        aws_clients.clients = {}
+
+    def test_nothing_created_until_used(self):
+        logger.debug('TestLazyClient.test_nothing_created_until_used')
+        with patch('boto3.client') as boto3_client:
+            aws_clients.client('ec2')
+            self.assertEqual(boto3_client.call_count, 0)
+            self.assertDictEqual(aws_clients.clients, {})
+
+    def test_client_is_shared(self):
+        logger.debug('TestLazyClient.test_client_is_shared')
+        ec2 = Mock(**{'describe_instances.return_value': {'Reservations': []}})
+        with patch('boto3.client', return_value=ec2) as boto3_client:
+            client1 = aws_clients.client('ec2')
+            client2 = aws_clients.client('ec2')
+            self.assertDictEqual(client1.describe_instances(), {'Reservations': []})
+            client2.describe_instances()
+            boto3_client.assert_called_once_with('ec2')
+        self.assertEqual(ec2.describe_instances.call_count, 2)
+        self.assertIs(aws_clients.get_client('ec2'), ec2)
+
+
+class TestUsage(unittest.TestCase):
+
+    def setUp(self):
+        aws_clients.clients = {}
+        aws_clients.reset_usage()
+
+    def tearDown(self):
+        aws_clients.clients = {}
+        aws_clients.reset_usage()
+
+    def test_calls_accounted(self):
+        logger.debug('TestUsage.test_calls_accounted')
+        aws_clients.clients['ec2'] = Mock(**{
+            'describe_instances.return_value': {'Reservations': [], 'ResponseMetadata': {'RetryAttempts': 2}}
+        })
+        ec2 = aws_clients.client('ec2')
+        ec2.describe_instances()
+        ec2.describe_instances(InstanceIds=['i-abc'])
+        usage = aws_clients.get_usage()
+        self.assertListEqual(list(usage.keys()), ['ec2.describe_instances'])
+        self.assertEqual(usage['ec2.describe_instances']['calls'], 2)
+        self.assertEqual(usage['ec2.describe_instances']['retries'], 4)
+        self.assertEqual(usage['ec2.describe_instances']['errors'], 0)
+        self.assertGreaterEqual(usage['ec2.describe_instances']['ms'], 0)
+        aws_clients.reset_usage()
+        self.assertDictEqual(aws_clients.get_usage(), {})
+
+    def test_errors_accounted(self):
+        logger.debug('TestUsage.test_errors_accounted')
+        aws_clients.clients['autoscaling'] = Mock(**{'attach_instances.side_effect': ClientError({
+            'Error': {'Code': 'ValidationError', 'Message': 'AutoScalingGroup name not found'},
+            'ResponseMetadata': {'RetryAttempts': 1}
+        }, 'AttachInstances')})
+        with self.assertRaises(ClientError):
+            aws_clients.client('autoscaling').attach_instances(InstanceIds=['i-abc'], AutoScalingGroupName='asg')
+        usage = aws_clients.get_usage()['autoscaling.attach_instances']
+        self.assertEqual(usage['calls'], 1)
+        self.assertEqual(usage['retries'], 1)
+        self.assertEqual(usage['errors'], 1)
+
+    def test_non_api_methods_not_accounted(self):
+        logger.debug('TestUsage.test_non_api_methods_not_accounted')
+        aws_clients.clients['dynamodb'] = Mock()
+        ddb = aws_clients.client('dynamodb')
+        ddb.get_paginator('scan')
+        ddb.can_paginate('scan')
+        self.assertDictEqual(aws_clients.get_usage(), {})
+
+    def test_over_budget(self):
+        logger.debug('TestUsage.test_over_budget')
+        budget = {
+            'ec2.create_tags': lambda event: len(event['instance_ids']),
+            'autoscaling.attach_instances': 1
+        }
+        calls = {'ec2.create_tags': 2, 'autoscaling.attach_instances': 1}
+        self.assertDictEqual(aws_clients.over_budget(calls, budget, {'instance_ids': ['i-abc', 'i-def']}), {})
+        self.assertDictEqual(aws_clients.over_budget(calls, budget, {'instance_ids': ['i-abc']}),
+                             {'ec2.create_tags': (2, 1)})
+        # operations not in the budget are allowed no calls
+        self.assertDictEqual(aws_clients.over_budget({'ec2.terminate_instances': 1}, budget, {'instance_ids': []}),
+                             {'ec2.terminate_instances': (1, 0)})
+
+
+if __name__ == '__main__':
+    logger.setLevel(logging.DEBUG)
+    setup_stream_handler()
+    unittest.main()
@@ -1,6 +1,7 @@
+import json
 import unittest
 from botocore.exceptions import ClientError
-from mock import Mock
+from mock import Mock, call
 
 import ddb_lock_helper
 from logging_helper import logging, setup_stream_handler
@@ -9,93 +10,90 @@ logger = logging.getLogger()
 logger.addHandler(logging.NullHandler())
 
 
-class TestPutItem(unittest.TestCase):
+class TestPutLease(unittest.TestCase):
 
     def setUp(self):
         self.table_name = 'ddbtable'
         self.group_name = 'asg-group'
         self.exec_arn = 'my:execution:arn'
-        self.ttl = 1234
-        ddb_lock_helper.ddb = Mock()
-        ddb_lock_helper.sfn = Mock()
-
-    def test_put_item_none_existing(self):
-        logger.debug('TestPutItem.test_put_item_none_existing')
-        ddb_lock_helper.ddb = Mock(**{
-            'put_item.return_value': {}
-        })
-        expected_item = {
+        self.expected_item = {
             'group_name': {'S': self.group_name},
             'execution_arn': {'S': self.exec_arn},
-            'ttl': {'N': str(self.ttl)}
+            'lease_expires': {'N': '1300'},
+            'ttl': {'N': '90000'}
         }
-        res = ddb_lock_helper.put_item(self.table_name, self.group_name, self.exec_arn, self.ttl)
-        ddb_lock_helper.ddb.put_item.assert_called_once_with(TableName=self.table_name, Item=expected_item,
-                                                             ConditionExpression='attribute_not_exists(execution_arn)')
-
-        self.assertDictEqual(res, {})
-
-    def test_put_item_none_existing_cond_fail(self):
-        logger.debug('TestPutItem.test_put_item_none_existing_cond_fail')
-        ddb_lock_helper.ddb = Mock(**{'put_item.side_effect': ClientError({
+        self.cond_fail = ClientError({
             'Error': {
                 'Code': 'ConditionalCheckFailedException',
                 'Message': 'The conditional request failed'
             }
-        }, 'PutItem')})
-        res = ddb_lock_helper.put_item(self.table_name, self.group_name, self.exec_arn, self.ttl)
-        # should not raise an exception
-        self.assertIsNone(res)
+        }, 'PutItem')
+        ddb_lock_helper.ddb = Mock()
+        ddb_lock_helper.sfn = Mock()
+
+    def test_put_lease(self):
+        logger.debug('TestPutLease.test_put_lease')
+        res = ddb_lock_helper.put_lease(self.table_name, self.group_name, self.exec_arn, 1000, 1300, 90000)
+        ddb_lock_helper.ddb.put_item.assert_called_once_with(
+            TableName=self.table_name, Item=self.expected_item,
+            ConditionExpression='attribute_not_exists(execution_arn) OR execution_arn = :me OR lease_expires < :now',
+            ExpressionAttributeValues={':me': {'S': self.exec_arn}, ':now': {'N': '1000'}})
+        self.assertTupleEqual(res, (True, None))
+
+    def test_put_lease_expected_holder(self):
+        logger.debug('TestPutLease.test_put_lease_expected_holder')
+        ddb_lock_helper.put_lease(self.table_name, self.group_name, self.exec_arn, 1000, 1300, 90000, 'other:arn')
+        ddb_lock_helper.ddb.put_item.assert_called_once_with(
+            TableName=self.table_name, Item=self.expected_item, ConditionExpression='execution_arn = :p_val',
+            ExpressionAttributeValues={':p_val': {'S': 'other:arn'}})
 
-    def test_put_item_existing_record_expected(self):
-        logger.debug('TestPutItem.test_put_item_existing_record')
+    def test_put_lease_held(self):
+        logger.debug('TestPutLease.test_put_lease_held')
         ddb_lock_helper.ddb = Mock(**{
-            'put_item.return_value': {}
+            'put_item.side_effect': self.cond_fail,
+            'get_item.return_value': {'Item': {
+                'group_name': {'S': self.group_name},
+                'execution_arn': {'S': 'other:arn'},
+                'lease_expires': {'N': '1100'},
+                'ttl': {'N': '90000'}
+            }}
         })
-        expected_item = {
-            'group_name': {'S': self.group_name},
-            'execution_arn': {'S': self.exec_arn},
-            'ttl': {'N': str(self.ttl)}
-        }
-        prev_exec_arn = 'prev:execution:arn'
-        res = ddb_lock_helper.put_item(self.table_name, self.group_name, self.exec_arn, self.ttl, prev_exec_arn)
-        ddb_lock_helper.ddb.put_item.assert_called_once_with(TableName=self.table_name, Item=expected_item,
-                                                             ConditionExpression='execution_arn = :p_val',
-                                                             ExpressionAttributeValues={':p_val': {'S': prev_exec_arn}})
-        self.assertDictEqual(res, {})
+        res = ddb_lock_helper.put_lease(self.table_name, self.group_name, self.exec_arn, 1000, 1300, 90000)
+        # the holder is read consistently once the write fails
+        ddb_lock_helper.ddb.get_item.assert_called_once_with(TableName=self.table_name,
+                                                             Key={'group_name': {'S': self.group_name}},
+                                                             ConsistentRead=True)
+        self.assertTupleEqual(res, (False, {'execution_arn': 'other:arn', 'lease_expires': 1100}))
 
-    def test_put_item_existing_record_unexpected(self):
-        logger.debug('TestPutItem.test_put_item_existing_record_unexpected')
-        ddb_lock_helper.ddb = Mock(**{'put_item.side_effect': ClientError({
-            'Error': {
-                'Code': 'ConditionalCheckFailedException',
-                'Message': 'The conditional request failed'
-            }
-        }, 'PutItem')})
-        prev_exec_arn = 'prev:execution:arn'
-        res = ddb_lock_helper.put_item(self.table_name, self.group_name, self.exec_arn, self.ttl, prev_exec_arn)
-        # should not raise an exception
-        self.assertIsNone(res)
+    def test_put_lease_held_without_lease(self):
+        logger.debug('TestPutLease.test_put_lease_held_without_lease')
+        ddb_lock_helper.ddb = Mock(**{
+            'put_item.side_effect': self.cond_fail,
+            'get_item.return_value': {'Item': {
+                'group_name': {'S': self.group_name},
+                'execution_arn': {'S': 'other:arn'},
+                'ttl': {'N': '90000'}
+            }}
+        })
+        res = ddb_lock_helper.put_lease(self.table_name, self.group_name, self.exec_arn, 1000, 1300, 90000)
+        self.assertTupleEqual(res, (False, {'execution_arn': 'other:arn', 'lease_expires': None}))
+
+    def test_put_lease_released_meanwhile(self):
+        logger.debug('TestPutLease.test_put_lease_released_meanwhile')
+        ddb_lock_helper.ddb = Mock(**{'put_item.side_effect': self.cond_fail, 'get_item.return_value': {}})
+        res = ddb_lock_helper.put_lease(self.table_name, self.group_name, self.exec_arn, 1000, 1300, 90000)
+        self.assertTupleEqual(res, (False, {'execution_arn': None, 'lease_expires': 1000}))
 
-    def test_put_item_clienterror_exception(self):
-        logger.debug('TestPutItem.test_put_item_clienterror_exception')
+    def test_put_lease_other_clienterror(self):
+        logger.debug('TestPutLease.test_put_lease_other_clienterror')
         ddb_lock_helper.ddb = Mock(**{'put_item.side_effect': ClientError({
             'Error': {
-                'Code': 'UnknownError',
-                'Message': 'Some other error',
-                'Type': 'Unknown'
+                'Code': 'ProvisionedThroughputExceededException',
+                'Message': 'Rate exceeded'
             }
         }, 'PutItem')})
-        prev_exec_arn = 'prev:execution:arn'
         with self.assertRaises(ClientError):
-            ddb_lock_helper.put_item(self.table_name, self.group_name, self.exec_arn, self.ttl, prev_exec_arn)
-
-    def test_put_item_other_exception(self):
-        logger.debug('TestPutItem.test_put_item_other_exception')
-        ddb_lock_helper.ddb = Mock(**{'put_item.side_effect': Exception('test')})
-        prev_exec_arn = 'prev:execution:arn'
-        with self.assertRaises(Exception):
-            ddb_lock_helper.put_item(self.table_name, self.group_name, self.exec_arn, self.ttl, prev_exec_arn)
+            ddb_lock_helper.put_lease(self.table_name, self.group_name, self.exec_arn, 1000, 1300, 90000)
 
 
 class TestGetItem(unittest.TestCase):
@@ -113,6 +111,7 @@ class TestGetItem(unittest.TestCase):
                 'Item': {
                     'execution_arn': {'S': 'my:execution:arn'},
                     'group_name': {'S': self.group_name},
+                    'lease_expires': {'N': '1518534300'},
                     'ttl': {'N': '1518620700'}
                 }
             }
@@ -121,7 +120,7 @@ class TestGetItem(unittest.TestCase):
         ddb_lock_helper.ddb.get_item.assert_called_once_with(TableName=self.table_name,
                                                              Key={'group_name': {'S': self.group_name}},
                                                              ConsistentRead=True)
-        self.assertEqual(res, 'my:execution:arn')
+        self.assertDictEqual(res, {'execution_arn': 'my:execution:arn', 'lease_expires': 1518534300})
 
     def test_get_item_not_found(self):
         logger.debug('TestPutItem.test_get_item_not_found')
@@ -150,6 +149,300 @@ class TestDeleteItem(unittest.TestCase):
                                                                 ExpressionAttributeValues={':p_val': {'S': self.exec_arn}})
 
 
+class TestLaunchSpec(unittest.TestCase):
+
+    def setUp(self):
+        self.table_name = 'ddbtable'
+        self.spec_key = 'test-launch-config/us-east-1d/subnet-11111111'
+        self.launch_spec = {'InstanceType': 't2.micro', 'SecurityGroupIds': ['sg-cccccccc']}
+        ddb_lock_helper.ddb = Mock()
+        ddb_lock_helper.sfn = Mock()
+
+    def test_put_launch_spec(self):
+        logger.debug('TestLaunchSpec.test_put_launch_spec')
+        ddb_lock_helper.put_launch_spec(self.table_name, self.spec_key, self.launch_spec, 1234)
+        ddb_lock_helper.ddb.put_item.assert_called_once_with(TableName=self.table_name, Item={
+            'group_name': {'S': 'launch-spec#{}'.format(self.spec_key)},
+            'launch_spec': {'S': json.dumps(self.launch_spec)},
+            'ttl': {'N': '1234'}
+        })
+
+    def test_get_launch_spec_found(self):
+        logger.debug('TestLaunchSpec.test_get_launch_spec_found')
+        ddb_lock_helper.ddb = Mock(**{
+            'get_item.return_value': {'Item': {
+                'group_name': {'S': 'launch-spec#{}'.format(self.spec_key)},
+                'launch_spec': {'S': json.dumps(self.launch_spec)}
+            }}
+        })
+        res = ddb_lock_helper.get_launch_spec(self.table_name, self.spec_key)
+        ddb_lock_helper.ddb.get_item.assert_called_once_with(
+            TableName=self.table_name, Key={'group_name': {'S': 'launch-spec#{}'.format(self.spec_key)}})
+        self.assertDictEqual(res, self.launch_spec)
+
+    def test_get_launch_spec_not_found(self):
+        logger.debug('TestLaunchSpec.test_get_launch_spec_not_found')
+        ddb_lock_helper.ddb = Mock(**{'get_item.return_value': {}})
+        self.assertIsNone(ddb_lock_helper.get_launch_spec(self.table_name, self.spec_key))
+
+    def test_delete_launch_spec(self):
+        logger.debug('TestLaunchSpec.test_delete_launch_spec')
+        ddb_lock_helper.delete_launch_spec(self.table_name, self.spec_key)
+        ddb_lock_helper.ddb.delete_item.assert_called_once_with(
+            TableName=self.table_name, Key={'group_name': {'S': 'launch-spec#{}'.format(self.spec_key)}})
+
+
+class TestReplacementBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.table_name = 'ddbtable'
+        self.batch_name = 'asg-group/us-east-1d/subnet-11111111'
+        ddb_lock_helper.ddb = Mock()
+        ddb_lock_helper.sfn = Mock()
+        self.cond_fail = ClientError({
+            'Error': {
+                'Code': 'ConditionalCheckFailedException',
+                'Message': 'The conditional request failed'
+            }
+        }, 'UpdateItem')
+
+    def test_open_batch(self):
+        logger.debug('TestReplacementBatch.test_open_batch')
+        ddb_lock_helper.ddb = Mock(**{'put_item.return_value': {}})
+        res = ddb_lock_helper.open_batch(self.table_name, self.batch_name, 'i-leader', 100, 160, 20, 1234)
+        self.assertDictEqual(res, {})
+        self.assertDictEqual(ddb_lock_helper.ddb.put_item.call_args[1]['Item'], {
+            'group_name': {'S': 'batch#{}'.format(self.batch_name)},
+            'leader': {'S': 'i-leader'},
+            'member_count': {'N': '1'},
+            'closes_at': {'N': '160'},
+            'ttl': {'N': '1234'}
+        })
+
+    def test_open_batch_cond_fail(self):
+        logger.debug('TestReplacementBatch.test_open_batch_cond_fail')
+        ddb_lock_helper.ddb = Mock(**{'put_item.side_effect': self.cond_fail})
+        self.assertIsNone(ddb_lock_helper.open_batch(self.table_name, self.batch_name, 'i-leader', 100, 160, 20, 1234))
+
+    def test_join_batch(self):
+        logger.debug('TestReplacementBatch.test_join_batch')
+        ddb_lock_helper.ddb = Mock(**{'update_item.return_value': {'Attributes': {'leader': {'S': 'i-leader'}}}})
+        res = ddb_lock_helper.join_batch(self.table_name, self.batch_name, 'i-member', 100, 20, 1234)
+        self.assertEqual(res, 'i-leader')
+        self.assertEqual(ddb_lock_helper.ddb.update_item.call_count, 2)
+        members_update = ddb_lock_helper.ddb.update_item.call_args[1]
+        self.assertDictEqual(members_update['Key'], {'group_name': {'S': 'batch-members#i-leader'}})
+        self.assertDictEqual(members_update['ExpressionAttributeValues'][':m'], {'SS': ['i-member']})
+
+    def test_join_batch_cond_fail(self):
+        logger.debug('TestReplacementBatch.test_join_batch_cond_fail')
+        ddb_lock_helper.ddb = Mock(**{'update_item.side_effect': self.cond_fail})
+        self.assertIsNone(ddb_lock_helper.join_batch(self.table_name, self.batch_name, 'i-member', 100, 20, 1234))
+        ddb_lock_helper.ddb.update_item.assert_called_once()
+
+    def test_get_batch_members(self):
+        logger.debug('TestReplacementBatch.test_get_batch_members')
+        ddb_lock_helper.ddb = Mock(**{'get_item.return_value': {'Item': {'members': {'SS': ['i-2', 'i-1']}}}})
+        self.assertListEqual(ddb_lock_helper.get_batch_members(self.table_name, 'i-leader'), ['i-1', 'i-2'])
+        ddb_lock_helper.ddb.get_item.assert_called_once_with(
+            TableName=self.table_name, Key={'group_name': {'S': 'batch-members#i-leader'}}, ConsistentRead=True)
+        ddb_lock_helper.ddb.get_item.return_value = {}
+        self.assertListEqual(ddb_lock_helper.get_batch_members(self.table_name, 'i-leader'), [])
+
+
+class TestSpotWaiter(unittest.TestCase):
+
+    def setUp(self):
+        self.table_name = 'ddbtable'
+        self.spot_request = {'SpotInstanceRequestIds': ['sir-1', 'sir-2'], 'OnDemandInstanceIds': ['i-1', 'i-2']}
+        ddb_lock_helper.ddb = Mock()
+        ddb_lock_helper.sfn = Mock()
+
+    def test_put_spot_waiter(self):
+        logger.debug('TestSpotWaiter.test_put_spot_waiter')
+        ddb_lock_helper.put_spot_waiter(self.table_name, self.spot_request, 'task-token', 1234)
+        self.assertListEqual([x[1]['Item']['group_name']['S'] for x in ddb_lock_helper.ddb.put_item.call_args_list],
+                             ['spot-waiter#sir-1', 'spot-waiter#sir-2'])
+        self.assertEqual(ddb_lock_helper.ddb.put_item.call_args[1]['Item']['task_token'], {'S': 'task-token'})
+
+    def test_get_spot_waiter(self):
+        logger.debug('TestSpotWaiter.test_get_spot_waiter')
+        ddb_lock_helper.ddb = Mock(**{'get_item.return_value': {'Item': {
+            'task_token': {'S': 'task-token'},
+            'spot_request': {'S': json.dumps(self.spot_request)}
+        }}})
+        res = ddb_lock_helper.get_spot_waiter(self.table_name, 'sir-2')
+        ddb_lock_helper.ddb.get_item.assert_called_once_with(
+            TableName=self.table_name, Key={'group_name': {'S': 'spot-waiter#sir-2'}}, ConsistentRead=True)
+        self.assertEqual(res, ('task-token', self.spot_request))
+
+    def test_get_spot_waiter_not_found(self):
+        logger.debug('TestSpotWaiter.test_get_spot_waiter_not_found')
+        ddb_lock_helper.ddb = Mock(**{'get_item.return_value': {}})
+        self.assertIsNone(ddb_lock_helper.get_spot_waiter(self.table_name, 'sir-1'))
+
+    def test_delete_spot_waiter(self):
+        logger.debug('TestSpotWaiter.test_delete_spot_waiter')
+        ddb_lock_helper.delete_spot_waiter(self.table_name, {'SpotInstanceRequestId': 'sir-1'})
+        ddb_lock_helper.ddb.delete_item.assert_called_once_with(
+            TableName=self.table_name, Key={'group_name': {'S': 'spot-waiter#sir-1'}})
+
+
+class TestLockQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.table_name = 'ddbtable'
+        self.key = {'group_name': {'S': 'lock-queue#asg-group'}}
+        self.waiters = {'L': [
+            {'M': {'execution_arn': {'S': 'first:arn'}, 'task_token': {'S': 'token1'}, 'lease_seconds': {'N': '300'}}},
+            {'M': {'execution_arn': {'S': 'my:arn'}, 'task_token': {'S': 'token2'}, 'lease_seconds': {'N': '600'}}}
+        ]}
+        ddb_lock_helper.ddb = Mock()
+        ddb_lock_helper.sfn = Mock()
+
+    def test_enqueue_lock_waiter(self):
+        logger.debug('TestLockQueue.test_enqueue_lock_waiter')
+        ddb_lock_helper.enqueue_lock_waiter(self.table_name, 'asg-group', 'my:arn', 'token2', 600, 1234)
+        ddb_lock_helper.ddb.update_item.assert_called_once_with(
+            TableName=self.table_name, Key=self.key,
+            UpdateExpression='SET waiters = list_append(if_not_exists(waiters, :empty), :w), #t = :ttl',
+            ExpressionAttributeNames={'#t': 'ttl'},
+            ExpressionAttributeValues={':empty': {'L': []}, ':w': {'L': [self.waiters['L'][1]]},
+                                       ':ttl': {'N': '1234'}})
+
+    def test_first_lock_waiter(self):
+        logger.debug('TestLockQueue.test_first_lock_waiter')
+        ddb_lock_helper.ddb = Mock(**{'get_item.return_value': {'Item': {'waiters': self.waiters}}})
+        res = ddb_lock_helper.first_lock_waiter(self.table_name, 'asg-group')
+        ddb_lock_helper.ddb.get_item.assert_called_once_with(TableName=self.table_name, Key=self.key,
+                                                             ConsistentRead=True)
+        ddb_lock_helper.ddb.update_item.assert_not_called()
+        self.assertDictEqual(res, {'execution_arn': 'first:arn', 'task_token': 'token1', 'lease_seconds': 300})
+
+    def test_first_lock_waiter_empty(self):
+        logger.debug('TestLockQueue.test_first_lock_waiter_empty')
+        ddb_lock_helper.ddb = Mock(**{'get_item.return_value': {'Item': {'waiters': {'L': []}}}})
+        self.assertIsNone(ddb_lock_helper.first_lock_waiter(self.table_name, 'asg-group'))
+
+    def test_remove_first_lock_waiter(self):
+        logger.debug('TestLockQueue.test_remove_first_lock_waiter')
+        self.assertTrue(ddb_lock_helper.remove_first_lock_waiter(self.table_name, 'asg-group', 'first:arn'))
+        ddb_lock_helper.ddb.update_item.assert_called_once_with(
+            TableName=self.table_name, Key=self.key, UpdateExpression='REMOVE waiters[0]',
+            ConditionExpression='waiters[0].execution_arn = :w', ExpressionAttributeValues={':w': {'S': 'first:arn'}})
+
+    def test_remove_first_lock_waiter_moved(self):
+        logger.debug('TestLockQueue.test_remove_first_lock_waiter_moved')
+        ddb_lock_helper.ddb = Mock(**{'update_item.side_effect': ClientError({
+            'Error': {
+                'Code': 'ConditionalCheckFailedException',
+                'Message': 'The conditional request failed'
+            }
+        }, 'UpdateItem')})
+        self.assertFalse(ddb_lock_helper.remove_first_lock_waiter(self.table_name, 'asg-group', 'first:arn'))
+
+    def test_remove_lock_waiter(self):
+        logger.debug('TestLockQueue.test_remove_lock_waiter')
+        ddb_lock_helper.ddb = Mock(**{'get_item.return_value': {'Item': {'waiters': self.waiters}}})
+        self.assertTrue(ddb_lock_helper.remove_lock_waiter(self.table_name, 'asg-group', 'my:arn'))
+        ddb_lock_helper.ddb.update_item.assert_called_once_with(
+            TableName=self.table_name, Key=self.key, UpdateExpression='REMOVE waiters[1]',
+            ConditionExpression='waiters[1].execution_arn = :me', ExpressionAttributeValues={':me': {'S': 'my:arn'}})
+
+    def test_remove_lock_waiter_not_queued(self):
+        logger.debug('TestLockQueue.test_remove_lock_waiter_not_queued')
+        ddb_lock_helper.ddb = Mock(**{'get_item.return_value': {}})
+        self.assertFalse(ddb_lock_helper.remove_lock_waiter(self.table_name, 'asg-group', 'my:arn'))
+        ddb_lock_helper.ddb.update_item.assert_not_called()
+
+
+class TestTimings(unittest.TestCase):
+
+    def setUp(self):
+        self.table_name = 'ddbtable'
+        ddb_lock_helper.ddb = Mock()
+        ddb_lock_helper.sfn = Mock()
+
+    def test_put_timings(self):
+        logger.debug('TestTimings.test_put_timings')
+        ddb_lock_helper.put_timings(self.table_name, 'asg-group/lc-name', {'spot_healthy': [10, 20]}, 1234)
+        ddb_lock_helper.ddb.put_item.assert_called_once_with(TableName=self.table_name, Item={
+            'group_name': {'S': 'timings#asg-group/lc-name'},
+            'spot_healthy': {'L': [{'N': '10'}, {'N': '20'}]},
+            'ttl': {'N': '1234'}
+        })
+
+    def test_get_timings(self):
+        logger.debug('TestTimings.test_get_timings')
+        ddb_lock_helper.ddb = Mock(**{'get_item.return_value': {'Item': {
+            'group_name': {'S': 'timings#asg-group/lc-name'},
+            'spot_healthy': {'L': [{'N': '10'}, {'N': '20'}]},
+            'ttl': {'N': '1234'}
+        }}})
+        self.assertDictEqual(ddb_lock_helper.get_timings(self.table_name, 'asg-group/lc-name'), {'spot_healthy': [10, 20]})
+        ddb_lock_helper.ddb.get_item.return_value = {}
+        self.assertDictEqual(ddb_lock_helper.get_timings(self.table_name, 'asg-group/lc-name'), {})
+
+
+class TestInstanceRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.table_name = 'ddbtable'
+        ddb_lock_helper.ddb = Mock(**{'batch_write_item.return_value': {'UnprocessedItems': {}}})
+        ddb_lock_helper.sfn = Mock()
+        ddb_lock_helper.sleep = Mock()
+
+    def test_register_instances(self):
+        logger.debug('TestInstanceRegistry.test_register_instances')
+        instance_ids = ['i-{}'.format(x) for x in range(30)]
+        ddb_lock_helper.register_instances(self.table_name, instance_ids, 'asg-group', 1234)
+        self.assertEqual(ddb_lock_helper.ddb.batch_write_item.call_count, 2)
+        requests = ddb_lock_helper.ddb.batch_write_item.call_args_list[0][1]['RequestItems'][self.table_name]
+        self.assertEqual(len(requests), ddb_lock_helper.max_batch_write_items)
+        self.assertDictEqual(requests[0], {'PutRequest': {'Item': {
+            'group_name': {'S': 'instance#i-0'},
+            'autoscaling_group': {'S': 'asg-group'},
+            'ttl': {'N': '1234'}
+        }}})
+
+    def test_unprocessed_items_resent(self):
+        logger.debug('TestInstanceRegistry.test_unprocessed_items_resent')
+        unprocessed = {self.table_name: [{'DeleteRequest': {'Key': {'group_name': {'S': 'instance#i-2'}}}}]}
+        ddb_lock_helper.ddb.batch_write_item.side_effect = [{'UnprocessedItems': unprocessed},
+                                                            {'UnprocessedItems': {}}]
+        ddb_lock_helper.deregister_instances(self.table_name, ['i-1', 'i-2'])
+        self.assertEqual(ddb_lock_helper.ddb.batch_write_item.call_args_list[1], call(RequestItems=unprocessed))
+        self.assertEqual(ddb_lock_helper.sleep.call_count, 1)
+
+    def test_unprocessed_items_backoff_exhausted(self):
+        logger.debug('TestInstanceRegistry.test_unprocessed_items_backoff_exhausted')
+        unprocessed = {self.table_name: [{'DeleteRequest': {'Key': {'group_name': {'S': 'instance#i-2'}}}}]}
+        ddb_lock_helper.ddb.batch_write_item.return_value = {'UnprocessedItems': unprocessed}
+        with self.assertRaises(Exception) as ctx:
+            ddb_lock_helper.deregister_instances(self.table_name, ['i-1', 'i-2'])
+        self.assertIn('instance#i-2', str(ctx.exception))
+        self.assertEqual(ddb_lock_helper.ddb.batch_write_item.call_count, ddb_lock_helper.max_batch_attempts)
+        # delays are capped by a backoff that doubles every attempt
+        delays = [x[0][0] for x in ddb_lock_helper.sleep.call_args_list]
+        self.assertEqual(len(delays), ddb_lock_helper.max_batch_attempts - 1)
+        for (attempt, delay) in enumerate(delays, 1):
+            self.assertLessEqual(delay, ddb_lock_helper.batch_backoff_seconds * 2 ** attempt)
+
+    def test_get_registered_instances(self):
+        logger.debug('TestInstanceRegistry.test_get_registered_instances')
+        unprocessed = {self.table_name: {'Keys': [{'group_name': {'S': 'instance#i-3'}}]}}
+        ddb_lock_helper.ddb.batch_get_item.side_effect = [
+            {'Responses': {self.table_name: [
+                {'group_name': {'S': 'instance#i-1'}, 'autoscaling_group': {'S': 'asg-group'}}]},
+             'UnprocessedKeys': unprocessed},
+            {'Responses': {self.table_name: [
+                {'group_name': {'S': 'instance#i-3'}, 'autoscaling_group': {'S': 'other-group'}}]}}
+        ]
+        res = ddb_lock_helper.get_registered_instances(self.table_name, ['i-1', 'i-2', 'i-3'])
+        self.assertDictEqual(res, {'i-1': 'asg-group', 'i-3': 'other-group'})
+        self.assertEqual(ddb_lock_helper.ddb.batch_get_item.call_args_list[1], call(RequestItems=unprocessed))
+
+
 class TestIsExecutionRunning(unittest.TestCase):
 
     def setUp(self):
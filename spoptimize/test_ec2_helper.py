@@ -60,6 +60,29 @@ class TestTerminateInstance(unittest.TestCase):
             ec2_helper.terminate_instance('i-abcd123')
 
 
+class TestTerminateInstances(unittest.TestCase):
+
+    def setUp(self):
+        ec2_helper.ec2 = Mock()
+
+    def test_terminate_instances(self):
+        logger.debug('TestTerminateInstances.test_terminate_instances')
+        ec2_helper.terminate_instances(['i-abcd123', 'i-abcd456'])
+        ec2_helper.ec2.terminate_instances.assert_called_once_with(InstanceIds=['i-abcd123', 'i-abcd456'])
+
+    def test_unknown_instance(self):
+        logger.debug('TestTerminateInstances.test_unknown_instance')
+        not_found = ClientError({
+            'Error': {
+                'Code': 'InvalidInstanceID.NotFound',
+                'Message': 'The instance ID does not exist'
+            }
+        }, 'TerminateInstances')
+        ec2_helper.ec2 = Mock(**{'terminate_instances.side_effect': [not_found, {}, not_found]})
+        ec2_helper.terminate_instances(['i-abcd123', 'i-abcd456'])
+        self.assertEqual(ec2_helper.ec2.terminate_instances.call_count, 3)
+
+
 class TestTagInstance(unittest.TestCase):
 
     def setUp(self):
@@ -164,6 +187,65 @@ class TestIsInstanceRunning(unittest.TestCase):
             ec2_helper.is_instance_running('i-abcd123')
 
 
+class TestRunningInstances(unittest.TestCase):
+
+    def test_running_instances(self):
+        logger.debug('TestRunningInstances.test_running_instances')
+        ec2_helper.ec2 = Mock(**{'describe_instances.return_value': {'Reservations': [
+            {'Instances': [{'InstanceId': 'i-1', 'State': {'Name': 'running'}},
+                           {'InstanceId': 'i-2', 'State': {'Name': 'pending'}}]},
+            {'Instances': [{'InstanceId': 'i-3', 'State': {'Name': 'running'}}]}
+        ]}})
+        res = ec2_helper.running_instances(['i-3', 'i-2', 'i-1', 'i-4'])
+        ec2_helper.ec2.describe_instances.assert_called_once_with(
+            Filters=[{'Name': 'instance-id', 'Values': ['i-3', 'i-2', 'i-1', 'i-4']}])
+        self.assertListEqual(res, ['i-3', 'i-1'])
+
+
+class TestSpotRequestId(unittest.TestCase):
+
+    def test_spot_instance(self):
+        logger.debug('TestSpotRequestId.test_spot_instance')
+        ec2_helper.ec2 = Mock(**{'describe_instances.return_value': {'Reservations': [
+            {'Instances': [{'InstanceId': 'i-1', 'InstanceLifecycle': 'spot', 'SpotInstanceRequestId': 'sir-1'}]}
+        ]}})
+        self.assertEqual(ec2_helper.spot_request_id('i-1'), 'sir-1')
+
+    def test_ondemand_instance(self):
+        logger.debug('TestSpotRequestId.test_ondemand_instance')
+        ec2_helper.ec2 = Mock(**{'describe_instances.return_value': {'Reservations': [
+            {'Instances': [{'InstanceId': 'i-1'}]}
+        ]}})
+        self.assertIsNone(ec2_helper.spot_request_id('i-1'))
+
+
+class TestSpoptimizeInstances(unittest.TestCase):
+
+    def test_spoptimize_instances(self):
+        logger.debug('TestSpoptimizeInstances.test_spoptimize_instances')
+        ec2_helper.ec2 = Mock(**{'describe_tags.side_effect': [{
+            'Tags': [
+                {'ResourceId': 'i-1', 'Key': 'spoptimize:ondemand_instance_id', 'Value': 'i-a'},
+                {'ResourceId': 'i-2', 'Key': 'Name', 'Value': 'web'}
+            ],
+            'NextToken': 'token'
+        }, {
+            'Tags': [{'ResourceId': 'i-3', 'Key': 'spoptimize:ondemand_instance_id', 'Value': 'i-c'}]
+        }]})
+        res = ec2_helper.spoptimize_instances(['i-1', 'i-2', 'i-3'])
+        self.assertEqual(res, set(['i-1', 'i-3']))
+        self.assertEqual(ec2_helper.ec2.describe_tags.call_count, 2)
+        self.assertEqual(ec2_helper.ec2.describe_tags.call_args[1]['NextToken'], 'token')
+
+    def test_chunked(self):
+        logger.debug('TestSpoptimizeInstances.test_chunked')
+        ec2_helper.ec2 = Mock(**{'describe_tags.return_value': {'Tags': []}})
+        res = ec2_helper.spoptimize_instances(['i-{}'.format(x) for x in range(250)])
+        self.assertEqual(res, set())
+        self.assertListEqual([len(x[1]['Filters'][1]['Values']) for x in ec2_helper.ec2.describe_tags.call_args_list],
+                             [200, 50])
+
+
 class TestIsSpoptimizeInstance(unittest.TestCase):
 
     def setUp(self):
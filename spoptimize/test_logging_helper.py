@@ -0,0 +1,84 @@
+import datetime
+import json
+import sys
+import unittest
+from mock import patch
+
+import logging_helper
+from logging_helper import logging, setup_stream_handler
+
+logger = logging.getLogger()
+logger.addHandler(logging.NullHandler())
+
+
+def log_record(msg, *args, **kwargs):
+    return logging.LogRecord('root', kwargs.get('level', logging.INFO), '/var/task/spoptimize/stepfns.py', 42, msg,
+                             args, kwargs.get('exc_info'))
+
+
+class TestLazyJson(unittest.TestCase):
+
+    def test_serialized_when_formatted(self):
+        logger.debug('TestLazyJson.test_serialized_when_formatted')
+        lazy = logging_helper.LazyJson({'ts': datetime.datetime(2018, 3, 6, 9, 36, 2)}, sort_keys=True)
+        self.assertEqual(log_record('Item: %s', lazy).getMessage(), 'Item: {"ts": "2018-03-06T09:36:02"}')
+
+    def test_not_serialized_unless_enabled(self):
+        logger.debug('TestLazyJson.test_not_serialized_unless_enabled')
+        test_logger = logging.getLogger('spoptimize.test_logging_helper')
+        test_logger.addHandler(logging.NullHandler())
+        test_logger.setLevel(logging.INFO)
+        with patch('json.dumps') as dumps:
+            test_logger.debug('Item: %s', logging_helper.LazyJson({'a': 'b'}))
+            self.assertEqual(dumps.call_count, 0)
+
+
+class TestJsonFormatter(unittest.TestCase):
+
+    def setUp(self):
+        logging_helper.set_log_context()
+
+    def tearDown(self):
+        logging_helper.set_log_context()
+
+    def test_context_fields(self):
+        logger.debug('TestJsonFormatter.test_context_fields')
+        logging_helper.set_log_context(action='attach-spot', group='asg', instance_ids=['i-abc'], execution=None)
+        record = log_record('Attaching %s', 'i-def')
+        record.aws_request_id = 'request-id'
+        res = json.loads(logging_helper.JsonFormatter().format(record))
+        self.assertEqual(res['message'], 'Attaching i-def')
+        self.assertEqual(res['level'], 'INFO')
+        self.assertEqual(res['location'], 'stepfns.py:42')
+        self.assertEqual(res['action'], 'attach-spot')
+        self.assertEqual(res['group'], 'asg')
+        self.assertListEqual(res['instance_ids'], ['i-abc'])
+        self.assertEqual(res['aws_request_id'], 'request-id')
+        self.assertNotIn('execution', res)
+
+    def test_structured_message(self):
+        logger.debug('TestJsonFormatter.test_structured_message')
+        logging_helper.set_log_context(action='check-spot')
+        msg = logging_helper.StructuredMessage('AWS API usage of check-spot', api_usage={'calls': 2})
+        res = json.loads(logging_helper.JsonFormatter().format(log_record(msg)))
+        self.assertEqual(res['message'], 'AWS API usage of check-spot')
+        self.assertDictEqual(res['api_usage'], {'calls': 2})
+        self.assertEqual(res['action'], 'check-spot')
+        # text formatters render the fields after the message
+        self.assertEqual(log_record(msg).getMessage(), 'AWS API usage of check-spot: {"api_usage": {"calls": 2}}')
+
+    def test_exception(self):
+        logger.debug('TestJsonFormatter.test_exception')
+        try:
+            raise ValueError('Unknown type')
+        except ValueError:
+            record = log_record('Unable to decode', level=logging.ERROR, exc_info=sys.exc_info())
+        res = json.loads(logging_helper.JsonFormatter().format(record))
+        self.assertEqual(res['level'], 'ERROR')
+        self.assertIn('ValueError: Unknown type', res['exception'])
+
+
+if __name__ == '__main__':
+    logger.setLevel(logging.DEBUG)
+    setup_stream_handler()
+    unittest.main()
@@ -0,0 +1,118 @@
+import json
+import unittest
+from botocore.exceptions import ClientError
+from mock import Mock
+
+import sfn_helper
+from logging_helper import logging, setup_stream_handler
+
+logger = logging.getLogger()
+logger.addHandler(logging.NullHandler())
+
+state_machine_arn = 'arn:aws:states:us-east-1:123456789012:stateMachine:spoptimize-spot-requestor'
+
+
+class TestStartExecution(unittest.TestCase):
+
+    def setUp(self):
+        self.init_state = {'ondemand_instance_id': 'i-abcd123', 'iteration_count': 0}
+        sfn_helper.sfn = Mock()
+
+    def test_start_execution(self):
+        logger.debug('TestStartExecution.test_start_execution')
+        sfn_helper.sfn = Mock(**{'start_execution.return_value': {'executionArn': 'my:execution:arn'}})
+        res = sfn_helper.start_execution(state_machine_arn, self.init_state)
+        sfn_helper.sfn.start_execution.assert_called_once_with(
+            stateMachineArn=state_machine_arn, name='i-abcd123', input=json.dumps(self.init_state))
+        self.assertDictEqual(res, {'executionArn': 'my:execution:arn'})
+
+    def test_execution_already_exists(self):
+        logger.debug('TestStartExecution.test_execution_already_exists')
+        sfn_helper.sfn = Mock(**{'start_execution.side_effect': ClientError({
+            'Error': {
+                'Code': 'ExecutionAlreadyExists',
+                'Message': 'Execution Already Exists'
+            }
+        }, 'StartExecution')})
+        res = sfn_helper.start_execution(state_machine_arn, self.init_state)
+        self.assertDictEqual(res, {'ondemand_instance_id': 'i-abcd123', 'SpoptimizeError': 'ExecutionAlreadyExists'})
+        self.assertListEqual(sfn_helper.failed_executions([res]), [])
+
+    def test_throttled(self):
+        logger.debug('TestStartExecution.test_throttled')
+        sfn_helper.sfn = Mock(**{'start_execution.side_effect': ClientError({
+            'Error': {
+                'Code': 'ThrottlingException',
+                'Message': 'Rate exceeded'
+            }
+        }, 'StartExecution')})
+        res = sfn_helper.start_execution(state_machine_arn, self.init_state)
+        self.assertDictEqual(res, {'ondemand_instance_id': 'i-abcd123', 'SpoptimizeError': 'ThrottlingException'})
+        self.assertListEqual(sfn_helper.failed_executions([res]), [res])
+
+
+class TestStartExecutions(unittest.TestCase):
+
+    def setUp(self):
+        self.init_states = [{'ondemand_instance_id': 'i-{}'.format(x)} for x in range(20)]
+        sfn_helper.sfn = Mock()
+
+    def test_start_executions(self):
+        logger.debug('TestStartExecutions.test_start_executions')
+        sfn_helper.sfn = Mock(**{'start_execution.side_effect': lambda **kwargs: {'executionArn': kwargs['name']}})
+        res = sfn_helper.start_executions(state_machine_arn, self.init_states, 4)
+        self.assertEqual(sfn_helper.sfn.start_execution.call_count, 20)
+        self.assertListEqual(res, [{'executionArn': x['ondemand_instance_id']} for x in self.init_states])
+
+    def test_failure_is_isolated(self):
+        logger.debug('TestStartExecutions.test_failure_is_isolated')
+
+        def start_execution(**kwargs):
+            if kwargs['name'] == 'i-3':
+                raise Exception('Testing')
+            return {'executionArn': kwargs['name']}
+
+        sfn_helper.sfn = Mock(**{'start_execution.side_effect': start_execution})
+        res = sfn_helper.start_executions(state_machine_arn, self.init_states, 4)
+        self.assertEqual(sfn_helper.sfn.start_execution.call_count, 20)
+        self.assertDictEqual(res[3], {'ondemand_instance_id': 'i-3', 'SpoptimizeError': 'Testing'})
+        self.assertEqual(len([x for x in res if 'executionArn' in x]), 19)
+        self.assertListEqual(sfn_helper.failed_executions(res), [res[3]])
+
+
+class TestSendTaskSuccess(unittest.TestCase):
+
+    def setUp(self):
+        sfn_helper.sfn = Mock()
+
+    def test_send_task_success(self):
+        logger.debug('TestSendTaskSuccess.test_send_task_success')
+        self.assertTrue(sfn_helper.send_task_success('task-token', ['i-abcd123']))
+        sfn_helper.sfn.send_task_success.assert_called_once_with(taskToken='task-token', output='["i-abcd123"]')
+
+    def test_task_timed_out(self):
+        logger.debug('TestSendTaskSuccess.test_task_timed_out')
+        sfn_helper.sfn = Mock(**{'send_task_success.side_effect': ClientError({
+            'Error': {
+                'Code': 'TaskTimedOut',
+                'Message': 'Task Timed Out'
+            }
+        }, 'SendTaskSuccess')})
+        self.assertFalse(sfn_helper.send_task_success('task-token', 'i-abcd123'))
+
+    def test_other_clienterror_raises(self):
+        logger.debug('TestSendTaskSuccess.test_other_clienterror_raises')
+        sfn_helper.sfn = Mock(**{'send_task_success.side_effect': ClientError({
+            'Error': {
+                'Code': 'ThrottlingException',
+                'Message': 'Rate exceeded'
+            }
+        }, 'SendTaskSuccess')})
+        with self.assertRaises(ClientError):
+            sfn_helper.send_task_success('task-token', 'i-abcd123')
+
+
+if __name__ == '__main__':
+    logger.setLevel(logging.DEBUG)
+    setup_stream_handler()
+    unittest.main()
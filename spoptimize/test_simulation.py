@@ -0,0 +1,120 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+from logging_helper import logging, setup_stream_handler
+
+logger = logging.getLogger()
+logger.addHandler(logging.NullHandler())
+
+scripts_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'scripts')
+sys.path.insert(0, scripts_dir)
+
+import fake_aws  # noqa: E402
+import sfn_interpreter  # noqa: E402
+
+
+def run_script(script, *args):
+    env = dict(os.environ)
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    out = subprocess.check_output([sys.executable, os.path.join(scripts_dir, script), '--json'] + list(args), env=env)
+    return json.loads(out.decode('utf-8'))
+
+
+def simulate(*args):
+    '''
+    Runs simulate-throughput.py in a fresh interpreter (it patches the handler's modules) and returns its results
+    '''
+    return run_script('simulate-throughput.py', *args)
+
+
+class TestSimulation(unittest.TestCase):
+
+    def test_swaps(self):
+        logger.debug('TestSimulation.test_swaps')
+        res = simulate('--groups', '2', '--launches', '12', '--tag', 'max_concurrent_swaps=2', '--headroom', '2')
+        self.assertEqual(res['launches'], 12)
+        self.assertEqual(res['swaps'], 12)
+        self.assertDictEqual(res['execution_outcomes'], {'SUCCEEDED: Release Lock after Success': 12})
+        self.assertEqual(res['lock_wait_seconds']['count'], 12)
+        self.assertEqual(res['api_calls_by_operation']['autoscaling.attach_instances'], 12)
+        self.assertEqual(res['api_calls_by_operation']['ec2.request_spot_instances'], 12)
+        self.assertGreater(res['swaps_per_hour'], 0)
+        # the spot fulfillment function isn't deployed by default
+        self.assertNotIn('spot-fulfillment', res['lambda_invocations_by_action'])
+
+    def test_replacement_batches(self):
+        logger.debug('TestSimulation.test_replacement_batches')
+        res = simulate('--groups', '1', '--launches', '8', '--burst', '4', '--tag', 'replacement_batch_window=60',
+                       '--tag', 'spot_fulfillment_events=true', '--env', 'SPOPTIMIZE_SPOT_FULFILLMENT_EVENTS=true')
+        self.assertEqual(res['swaps'], 8)
+        self.assertLess(res['executions'], 8)
+        # executions are resumed by fulfillment events rather than polling
+        self.assertEqual(res['lambda_invocations_by_action'].get('check-spot', 0), 0)
+
+
+class TestActionBenchmarks(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.res = run_script('benchmark-actions.py', '--runs', '1')
+
+    def test_api_calls_within_baselines(self):
+        logger.debug('TestActionBenchmarks.test_api_calls_within_baselines')
+        self.assertListEqual(self.res['missing'], [])
+        # wall times & memory depend on the machine; API calls & invocations don't
+        self.assertListEqual([x for x in self.res['regressions'] if x[1] in ['api_calls', 'invocations']], [])
+
+    def test_api_calls_within_budgets(self):
+        logger.debug('TestActionBenchmarks.test_api_calls_within_budgets')
+        # every invocation is checked against its action's budget
+        self.assertListEqual(self.res['over_budget'], [])
+
+
+class TestStateMachineDefinition(unittest.TestCase):
+
+    def test_increment_failure_count(self):
+        logger.debug('TestStateMachineDefinition.test_increment_failure_count')
+        definition = sfn_interpreter.load_definition()
+        state = definition['States']['Increment Failure Count']
+        res = sfn_interpreter.evaluate_parameters(state['Parameters'], {'iteration_count': 2, 'a': 'b'}, {})
+        self.assertDictEqual(sfn_interpreter.get_path(res, state['OutputPath']), {'iteration_count': 3, 'a': 'b'})
+
+    def test_maximum_iteration_count(self):
+        logger.debug('TestStateMachineDefinition.test_maximum_iteration_count')
+        definition = sfn_interpreter.load_definition(MaximumIterationCount=5)
+        choice = definition['States']['Check Iteration Count?']['Choices'][0]
+        self.assertEqual(choice['NumericLessThanEquals'], 5)
+
+    def test_batch_terminated_before_spot_request(self):
+        logger.debug('TestStateMachineDefinition.test_batch_terminated_before_spot_request')
+        results = {
+            'ondemand-instance-healthy': 'Healthy',
+            'request-spot': {'SpoptimizeError': 'NoHealthyOnDemandInstances'},
+            'check-spot': 'Terminated'
+        }
+        clock = fake_aws.VirtualClock()
+        machine = sfn_interpreter.StateMachine('arn:aws:states:us-east-1:123456789012:stateMachine:spoptimize',
+                                               sfn_interpreter.load_definition(), clock,
+                                               lambda function_name, payload: results[payload['spoptimize_action']])
+        machine.start_execution('i-abcd123', json.dumps({
+            'init_sleep_interval': 60, 'spot_req_sleep_interval': 30, 'spot_failure_sleep_interval': 3600,
+            'iteration_count': 0, 'batch_window': 0, 'spot_fulfillment_events': False,
+            'ondemand_instance_ids': ['i-abcd123', 'i-abcd456']
+        }))
+        clock.run()
+        execution = list(machine.executions.values())[0]
+        states = [x[1] for x in execution.history]
+        # the execution ends rather than counting a failure and sleeping before re-testing the instances
+        self.assertEqual(execution.status, 'SUCCEEDED')
+        self.assertEqual(states[-1], 'Instance Protected/Detached/Terminated or ASG Disappeared')
+        self.assertNotIn('Increment Failure Count', states)
+        self.assertEqual(states.count('Check Spot Request'), 1)
+
+
+if __name__ == '__main__':
+    logger.setLevel(logging.DEBUG)
+    setup_stream_handler()
+    unittest.main()
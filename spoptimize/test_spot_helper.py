@@ -69,6 +69,7 @@ class TestGetInstanceProfileArn(unittest.TestCase):
     def setUp(self):
         self.instance_profile_arn = 'arn:aws:iam::123456789012:instance-profile/base-ec2'
         self.iam_mock_attrs = copy.deepcopy(iam_mock_attrs)
+        spot_helper.invalidate_caches()
         spot_helper.ec2 = Mock()
         spot_helper.iam = Mock()
 
@@ -87,6 +88,16 @@ class TestGetInstanceProfileArn(unittest.TestCase):
         spot_helper.iam.get_instance_profile.called_onced_with(InstanceProfileName=instance_profile_name)
         self.assertEqual(res, expected_arn)
 
+    def test_cached_arn(self):
+        logger.debug('TestGetInstanceProfileArn.test_cached_arn')
+        instance_profile_name = self.iam_mock_attrs['get_instance_profile.return_value']['InstanceProfile']['InstanceProfileName']
+        expected_arn = self.iam_mock_attrs['get_instance_profile.return_value']['InstanceProfile']['Arn']
+        spot_helper.iam = Mock(**self.iam_mock_attrs)
+        spot_helper.get_instance_profile_arn(instance_profile_name)
+        res = spot_helper.get_instance_profile_arn(instance_profile_name)
+        spot_helper.iam.get_instance_profile.assert_called_once_with(InstanceProfileName=instance_profile_name)
+        self.assertEqual(res, expected_arn)
+
     def test_pass_name_raise_client_error(self):
         logger.debug('TestGetInstanceProfileArn.test_pass_name_return_arn')
         self.iam_mock_attrs['get_instance_profile.side_effect'] = ClientError({
@@ -104,6 +115,7 @@ class TestGetInstanceProfileArn(unittest.TestCase):
 class TestSecurityGroupId(unittest.TestCase):
 
     def setUp(self):
+        spot_helper.invalidate_caches()
         spot_helper.ec2 = Mock()
         self.mock_attrs = copy.deepcopy(mock_attrs)
         self.group_name = self.mock_attrs['describe_security_groups.return_value']['SecurityGroups'][0]['GroupName']
@@ -144,6 +156,34 @@ class TestSecurityGroupId(unittest.TestCase):
         with self.assertRaises(Exception):
             spot_helper.security_group_id(self.group_name)
 
+    def test_cached_security_group(self):
+        logger.debug('TestSecurityGroupId.test_cached_security_group')
+        spot_helper.ec2 = Mock(**self.mock_attrs)
+        spot_helper.security_group_id(self.group_name)
+        res = spot_helper.security_group_id(self.group_name)
+        spot_helper.ec2.describe_security_groups.assert_called_once_with(GroupNames=[self.group_name])
+        self.assertEqual(res, self.group_id)
+        spot_helper.invalidate_caches()
+        spot_helper.security_group_id(self.group_name)
+        self.assertEqual(spot_helper.ec2.describe_security_groups.call_count, 2)
+
+    def test_batched_security_groups(self):
+        logger.debug('TestSecurityGroupId.test_batched_security_groups')
+        second_group = copy.deepcopy(self.mock_attrs['describe_security_groups.return_value']['SecurityGroups'][0])
+        second_group['GroupName'] = 'test'
+        second_group['GroupId'] = 'sg-xxxxxxxx'
+        self.mock_attrs['describe_security_groups.return_value']['SecurityGroups'].append(second_group)
+        spot_helper.ec2 = Mock(**self.mock_attrs)
+        res = spot_helper.security_group_ids(['test', 'sg-yyyyyyyy', self.group_name])
+        spot_helper.ec2.describe_security_groups.assert_called_once_with(GroupNames=sorted(['test', self.group_name]))
+        self.assertListEqual(res, ['sg-xxxxxxxx', 'sg-yyyyyyyy', self.group_id])
+
+    def test_missing_security_group(self):
+        logger.debug('TestSecurityGroupId.test_missing_security_group')
+        spot_helper.ec2 = Mock(**self.mock_attrs)
+        with self.assertRaises(Exception):
+            spot_helper.security_group_ids([self.group_name, 'unknown'])
+
 
 class TestGenLaunchSpecification(unittest.TestCase):
 
@@ -154,6 +194,7 @@ class TestGenLaunchSpecification(unittest.TestCase):
         self.az = 'us-east-1d'
         self.expected_launch_spec = copy.deepcopy(expected_launch_spec)
         self.iam_mock_attrs = copy.deepcopy(iam_mock_attrs)
+        spot_helper.invalidate_caches()
         spot_helper.ec2 = Mock()
         spot_helper.iam = Mock()
 
@@ -221,6 +262,28 @@ class TestGenLaunchSpecification(unittest.TestCase):
         # logger.debug('Expected launch spec: {}'.format(json.dumps(self.expected_launch_spec, indent=2, default=util.json_dumps_converter)))
         self.assertDictEqual(launch_spec, self.expected_launch_spec)
 
+    def test_cached_launch_specification(self):
+        logger.debug('TestSpotHelper.test_cached_launch_specification')
+        instance_profile_name = self.iam_mock_attrs['get_instance_profile.return_value']['InstanceProfile']['InstanceProfileName']
+        spot_helper.iam = Mock(**self.iam_mock_attrs)
+        self.launch_config['IamInstanceProfile'] = instance_profile_name
+        launch_spec = spot_helper.gen_launch_specification(self.launch_config, self.az, self.subnet_id)
+        # caller's changes don't leak into the cache
+        launch_spec['Placement']['AvailabilityZone'] = 'changed'
+        spot_helper.gen_launch_specification(self.launch_config, self.az, self.subnet_id)
+        launch_spec = spot_helper.gen_launch_specification(self.launch_config, self.az, self.subnet_id)
+        spot_helper.iam.get_instance_profile.assert_called_once()
+        self.assertEqual(launch_spec['Placement']['AvailabilityZone'], self.az)
+        other_spec = spot_helper.gen_launch_specification(self.launch_config, 'us-east-1c', 'subnet-22222222')
+        self.assertEqual(other_spec['SubnetId'], 'subnet-22222222')
+        self.assertIsNone(spot_helper.cached_launch_specification(self.launch_config['LaunchConfigurationName'], self.az, None))
+
+    def test_unnamed_launch_config_not_cached(self):
+        logger.debug('TestSpotHelper.test_unnamed_launch_config_not_cached')
+        del(self.launch_config['LaunchConfigurationName'])
+        spot_helper.gen_launch_specification(self.launch_config, self.az, self.subnet_id)
+        self.assertIsNone(spot_helper.cached_launch_specification(None, self.az, self.subnet_id))
+
 
 class TestRequestSpotInstance(unittest.TestCase):
 
@@ -231,6 +294,7 @@ class TestRequestSpotInstance(unittest.TestCase):
         self.subnet_id = 'subnet-11111111'
         self.client_token = 'testing1234'
         self.mock_attrs = copy.deepcopy(mock_attrs)
+        spot_helper.invalidate_caches()
         spot_helper.ec2 = Mock()
         spot_helper.iam = Mock()
 
@@ -248,6 +312,16 @@ class TestRequestSpotInstance(unittest.TestCase):
         )
         self.assertDictEqual(spot_req_dict, expected_dict)
 
+    def test_request_spot_instance_with_launch_spec(self):
+        logger.debug('TestRequestSpotInstance.test_request_spot_instance_with_launch_spec')
+        spot_helper.ec2 = Mock(**self.mock_attrs)
+        spot_helper.request_spot_instance(None, self.az, self.subnet_id, self.client_token, launch_spec=self.expected_launch_spec)
+        spot_helper.ec2.request_spot_instances.assert_called_once_with(
+            InstanceCount=1,
+            LaunchSpecification=self.expected_launch_spec,
+            Type='one-time', ClientToken=self.client_token
+        )
+
     def test_max_spot_instance_count(self):
         logger.debug('TestRequestSpotInstance.test_max_spot_instance_count')
         self.mock_attrs['request_spot_instances.side_effect'] = ClientError({
@@ -270,8 +344,10 @@ class TestRequestSpotInstance(unittest.TestCase):
             }
         }, 'RequestSpotInstances')
         spot_helper.ec2 = Mock(**self.mock_attrs)
+        spot_helper.security_group_cache.set('cached-group', 'sg-zzzzzzzz')
         with self.assertRaises(ClientError):
             spot_helper.request_spot_instance(self.launch_config, self.az, self.subnet_id, self.client_token)
+        self.assertIsNone(spot_helper.security_group_cache.get('cached-group'))
 
     def test_other_exception_raises(self):
         logger.debug('TestRequestSpotInstance.test_other_exception_raises')
@@ -281,6 +357,42 @@ class TestRequestSpotInstance(unittest.TestCase):
             spot_helper.request_spot_instance(self.launch_config, self.az, self.subnet_id, self.client_token)
 
 
+class TestRequestSpotInstances(unittest.TestCase):
+
+    def setUp(self):
+        self.launch_spec = copy.deepcopy(expected_launch_spec)
+        spot_helper.invalidate_caches()
+        spot_helper.ec2 = Mock(**{'request_spot_instances.return_value': {'SpotInstanceRequests': [
+            {'SpotInstanceRequestId': 'sir-1'}, {'SpotInstanceRequestId': 'sir-2'}
+        ]}})
+        spot_helper.iam = Mock()
+
+    def test_request_spot_instances(self):
+        logger.debug('TestRequestSpotInstances.test_request_spot_instances')
+        res = spot_helper.request_spot_instances(self.launch_spec, 'us-east-1d', 'subnet-11111111', 'testing1234', 2)
+        spot_helper.ec2.request_spot_instances.assert_called_once_with(
+            InstanceCount=2, LaunchSpecification=self.launch_spec, Type='one-time', ClientToken='testing1234')
+        self.assertDictEqual(res, {'SpotInstanceRequestIds': ['sir-1', 'sir-2']})
+
+
+class TestGetSpotRequestStatuses(unittest.TestCase):
+
+    def setUp(self):
+        spot_helper.ec2 = Mock(**{'describe_spot_instance_requests.return_value': {'SpotInstanceRequests': [
+            {'SpotInstanceRequestId': 'sir-2', 'State': 'open'},
+            {'SpotInstanceRequestId': 'sir-1', 'State': 'active', 'InstanceId': 'i-1'},
+            {'SpotInstanceRequestId': 'sir-3', 'State': 'cancelled'}
+        ]}})
+        spot_helper.iam = Mock()
+
+    def test_get_spot_request_statuses(self):
+        logger.debug('TestGetSpotRequestStatuses.test_get_spot_request_statuses')
+        res = spot_helper.get_spot_request_statuses(['sir-1', 'sir-2', 'sir-3', 'sir-4'])
+        spot_helper.ec2.describe_spot_instance_requests.assert_called_once_with(
+            SpotInstanceRequestIds=['sir-1', 'sir-2', 'sir-3', 'sir-4'])
+        self.assertListEqual(res, ['i-1', strs.spot_request_pending, strs.spot_request_failure, strs.spot_request_failure])
+
+
 class TestGetSpotRequestStatus(unittest.TestCase):
 
     def setUp(self):
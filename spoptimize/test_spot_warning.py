@@ -1,6 +1,6 @@
 import copy
 import unittest
-from mock import Mock
+from mock import Mock, call
 
 import spot_warning
 from logging_helper import logging, setup_stream_handler
@@ -24,11 +24,15 @@ sample_warning_event = {
 }
 
 
+def group_instances(*instance_ids):
+    return [{'InstanceId': x, 'LifecycleState': 'InService'} for x in instance_ids]
+
+
 class TestProcessSpotWarningEvent(unittest.TestCase):
 
     def setUp(self):
         self.event = copy.deepcopy(sample_warning_event)
-        spot_warning.asg_helper = Mock()
+        spot_warning.asg_helper = Mock(**{'instance_groups.return_value': {}})
         spot_warning.ec2_helper = Mock()
 
     def test_malformed_event(self):
@@ -56,6 +60,174 @@ class TestProcessSpotWarningEvent(unittest.TestCase):
         spot_warning.ec2_helper.is_spoptimize_instance.assert_called_once_with(self.event['detail']['instance-id'])
         spot_warning.asg_helper.terminate_instance.assert_called_once_with(self.event['detail']['instance-id'], decrement_cap=False)
 
+    def test_terminate_backfilled_instance(self):
+        logger.debug('TestProcessSpotWarningEvent.test_terminate_backfilled_instance')
+        spot_warning.ec2_helper = Mock(**{'is_spoptimize_instance.return_value': True})
+        spot_warning.asg_helper = Mock(**{
+            'instance_groups.return_value': {self.event['detail']['instance-id']: 'asg-group'},
+            'describe_group.return_value': {'MinSize': 1, 'MaxSize': 4, 'DesiredCapacity': 2, 'Tags': [
+                {'Key': 'spoptimize:interruption_backfill', 'Value': 'true'}],
+                'Instances': group_instances(self.event['detail']['instance-id'])}
+        })
+        spot_warning.process_warning_event(self.event)
+        spot_warning.asg_helper.set_desired_capacity.assert_called_once_with('asg-group', 3)
+        spot_warning.asg_helper.terminate_instance.assert_called_once_with(self.event['detail']['instance-id'], decrement_cap=True)
+
+    def test_backfilled_instance_termination_failure(self):
+        logger.debug('TestProcessSpotWarningEvent.test_backfilled_instance_termination_failure')
+        spot_warning.ec2_helper = Mock(**{'is_spoptimize_instance.return_value': True})
+        spot_warning.asg_helper = Mock(**{
+            'instance_groups.return_value': {self.event['detail']['instance-id']: 'asg-group'},
+            'describe_group.side_effect': [
+                {'MinSize': 1, 'MaxSize': 4, 'DesiredCapacity': 2, 'Tags': [
+                    {'Key': 'spoptimize:interruption_backfill', 'Value': 'true'}],
+                 'Instances': group_instances(self.event['detail']['instance-id'])},
+                {'MinSize': 1, 'MaxSize': 4, 'DesiredCapacity': 3}
+            ],
+            'terminate_instance.side_effect': Exception('Testing')
+        })
+        with self.assertRaises(Exception):
+            spot_warning.process_warning_event(self.event)
+        # the raised capacity is given back, so that a retry backfills the instance once
+        self.assertEqual(spot_warning.asg_helper.set_desired_capacity.call_args_list,
+                         [call('asg-group', 3), call('asg-group', 2)])
+
+    def test_registered_instance(self):
+        logger.debug('TestProcessSpotWarningEvent.test_registered_instance')
+        instance_id = self.event['detail']['instance-id']
+        spot_warning.ddb_lock_helper = Mock(**{'get_registered_instances.return_value': {instance_id: 'asg-group'}})
+        spot_warning.asg_helper.describe_group.return_value = {'MaxSize': 2, 'DesiredCapacity': 2, 'Tags': []}
+        spot_warning.process_warning_event(self.event, 'lock-table')
+        spot_warning.ec2_helper.is_spoptimize_instance.assert_not_called()
+        spot_warning.asg_helper.instance_groups.assert_not_called()
+        spot_warning.asg_helper.terminate_instance.assert_called_once_with(instance_id, decrement_cap=False)
+        spot_warning.ddb_lock_helper.deregister_instances.assert_called_once_with('lock-table', [instance_id])
+
+    def test_registry_failure(self):
+        logger.debug('TestProcessSpotWarningEvent.test_registry_failure')
+        spot_warning.ddb_lock_helper = Mock(**{'get_registered_instances.side_effect': Exception('Testing')})
+        spot_warning.ec2_helper = Mock(**{'is_spoptimize_instance.return_value': True})
+        spot_warning.process_warning_event(self.event, 'lock-table')
+        spot_warning.asg_helper.terminate_instance.assert_called_once_with(self.event['detail']['instance-id'], decrement_cap=False)
+
+
+class TestProcessSpotWarningEvents(unittest.TestCase):
+
+    def setUp(self):
+        self.events = []
+        for instance_id in ['i-1', 'i-2', 'i-1', 'i-3']:
+            event = copy.deepcopy(sample_warning_event)
+            event['detail']['instance-id'] = instance_id
+            self.events.append(event)
+        spot_warning.asg_helper = Mock(**{
+            'instance_groups.return_value': {},
+            'terminate_instance.return_value': 'Success'
+        })
+        spot_warning.ec2_helper = Mock(**{'spoptimize_instances.return_value': set(['i-1', 'i-3'])})
+
+    def test_terminate_spoptimize_instances(self):
+        logger.debug('TestProcessSpotWarningEvents.test_terminate_spoptimize_instances')
+        res = spot_warning.process_warning_events(self.events)
+        spot_warning.ec2_helper.spoptimize_instances.assert_called_once_with(['i-1', 'i-2', 'i-3'])
+        spot_warning.asg_helper.terminate_instance.assert_has_calls(
+            [call('i-1', decrement_cap=False), call('i-3', decrement_cap=False)], any_order=True)
+        self.assertDictEqual(res, {'i-1': 'Success', 'i-3': 'Success'})
+
+    def test_registered_instances(self):
+        logger.debug('TestProcessSpotWarningEvents.test_registered_instances')
+        spot_warning.ddb_lock_helper = Mock(**{'get_registered_instances.return_value': {'i-1': 'asg-group'}})
+        spot_warning.asg_helper.describe_group.return_value = {'MaxSize': 2, 'DesiredCapacity': 2, 'Tags': []}
+        spot_warning.process_warning_events(self.events, 'lock-table')
+        spot_warning.ddb_lock_helper.get_registered_instances.assert_called_once_with('lock-table', ['i-1', 'i-2', 'i-3'])
+        # only unregistered instances fall back to tag & autoscaling lookups
+        spot_warning.ec2_helper.spoptimize_instances.assert_called_once_with(['i-2', 'i-3'])
+        spot_warning.asg_helper.instance_groups.assert_called_once_with(['i-3'])
+        self.assertEqual(spot_warning.asg_helper.terminate_instance.call_count, 2)
+        spot_warning.ddb_lock_helper.deregister_instances.assert_called_once_with('lock-table', ['i-1', 'i-3'])
+
+    def test_backfilled_instances(self):
+        logger.debug('TestProcessSpotWarningEvents.test_backfilled_instances')
+        spot_warning.asg_helper.instance_groups.return_value = {'i-1': 'asg-group', 'i-3': 'asg-group'}
+        spot_warning.asg_helper.describe_group.return_value = {'MaxSize': 4, 'DesiredCapacity': 3, 'Tags': [
+            {'Key': 'spoptimize:interruption_backfill', 'Value': 'true'}], 'Instances': group_instances('i-1', 'i-3')}
+        res = spot_warning.process_warning_events(self.events)
+        # only one instance fits within MaxSize
+        spot_warning.asg_helper.set_desired_capacity.assert_called_once_with('asg-group', 4)
+        spot_warning.asg_helper.terminate_instance.assert_has_calls(
+            [call('i-1', decrement_cap=True), call('i-3', decrement_cap=False)], any_order=True)
+        self.assertDictEqual(res, {'i-1': 'Success', 'i-3': 'Success'})
+
+    def test_terminating_instances_not_backfilled(self):
+        logger.debug('TestProcessSpotWarningEvents.test_terminating_instances_not_backfilled')
+        spot_warning.asg_helper.instance_groups.return_value = {'i-1': 'asg-group', 'i-3': 'asg-group'}
+        # i-1's warning was processed before
+        spot_warning.asg_helper.describe_group.return_value = {'MaxSize': 4, 'DesiredCapacity': 2, 'Tags': [
+            {'Key': 'spoptimize:interruption_backfill', 'Value': 'true'}], 'Instances': [
+            {'InstanceId': 'i-1', 'LifecycleState': 'Terminating'},
+            {'InstanceId': 'i-3', 'LifecycleState': 'InService'}
+        ]}
+        spot_warning.process_warning_events(self.events)
+        spot_warning.asg_helper.set_desired_capacity.assert_called_once_with('asg-group', 3)
+        spot_warning.asg_helper.terminate_instance.assert_has_calls(
+            [call('i-1', decrement_cap=False), call('i-3', decrement_cap=True)], any_order=True)
+
+    def test_termination_failure(self):
+        logger.debug('TestProcessSpotWarningEvents.test_termination_failure')
+        spot_warning.ddb_lock_helper = Mock(**{'get_registered_instances.return_value': {}})
+        spot_warning.asg_helper.instance_groups.return_value = {'i-1': 'asg-group', 'i-3': 'asg-group'}
+        spot_warning.asg_helper.describe_group.side_effect = [
+            {'MinSize': 1, 'MaxSize': 5, 'DesiredCapacity': 3, 'Tags': [
+                {'Key': 'spoptimize:interruption_backfill', 'Value': 'true'}],
+             'Instances': group_instances('i-1', 'i-3')},
+            {'MinSize': 1, 'MaxSize': 5, 'DesiredCapacity': 5}
+        ]
+
+        def terminate_instance(instance_id, decrement_cap):
+            if instance_id == 'i-1':
+                raise Exception('Testing')
+            return 'Success'
+        spot_warning.asg_helper.terminate_instance.side_effect = terminate_instance
+        with self.assertRaises(Exception):
+            spot_warning.process_warning_events(self.events, 'lock-table')
+        # every termination is attempted, and the terminated instance deregistered
+        self.assertEqual(spot_warning.asg_helper.terminate_instance.call_count, 2)
+        spot_warning.ddb_lock_helper.deregister_instances.assert_called_once_with('lock-table', ['i-3'])
+        # the capacity raised for i-1 is given back, so that the redelivered warning backfills it once
+        self.assertEqual(spot_warning.asg_helper.set_desired_capacity.call_args_list,
+                         [call('asg-group', 5), call('asg-group', 4)])
+
+    def test_backfill_failure(self):
+        logger.debug('TestProcessSpotWarningEvents.test_backfill_failure')
+        spot_warning.asg_helper.instance_groups.return_value = {'i-1': 'asg-group'}
+        spot_warning.asg_helper.describe_group.side_effect = Exception('Testing')
+        spot_warning.process_warning_events(self.events)
+        spot_warning.asg_helper.set_desired_capacity.assert_not_called()
+        spot_warning.asg_helper.terminate_instance.assert_has_calls(
+            [call('i-1', decrement_cap=False), call('i-3', decrement_cap=False)], any_order=True)
+
+    def test_backfill_not_enabled(self):
+        logger.debug('TestProcessSpotWarningEvents.test_backfill_not_enabled')
+        spot_warning.asg_helper.instance_groups.return_value = {'i-1': 'asg-group'}
+        spot_warning.asg_helper.describe_group.return_value = {'MaxSize': 4, 'DesiredCapacity': 3, 'Tags': []}
+        spot_warning.process_warning_events(self.events)
+        spot_warning.asg_helper.set_desired_capacity.assert_not_called()
+
+    def test_malformed_event_skipped(self):
+        logger.debug('TestProcessSpotWarningEvents.test_malformed_event_skipped')
+        spot_warning.process_warning_events([{}] + self.events[:1])
+        spot_warning.ec2_helper.spoptimize_instances.assert_called_once_with(['i-1'])
+
+    def test_no_spoptimize_instances(self):
+        logger.debug('TestProcessSpotWarningEvents.test_no_spoptimize_instances')
+        spot_warning.ec2_helper.spoptimize_instances.return_value = set()
+        self.assertDictEqual(spot_warning.process_warning_events(self.events), {})
+        spot_warning.asg_helper.terminate_instance.assert_not_called()
+
+    def test_no_events(self):
+        logger.debug('TestProcessSpotWarningEvents.test_no_events')
+        self.assertDictEqual(spot_warning.process_warning_events([]), {})
+        spot_warning.ec2_helper.spoptimize_instances.assert_not_called()
+
 
 if __name__ == '__main__':
     logger.setLevel(logging.DEBUG)
@@ -6,8 +6,9 @@ import random
 import unittest
 
 # from botocore.exceptions import ClientError
-from mock import Mock
+from mock import Mock, call
 
+import ddb_lock_helper
 import stepfns
 import stepfn_strings as strs
 from asg_helper import asg_copy_keys
@@ -34,6 +35,8 @@ randseed = (datetime.datetime.now() - datetime.datetime.utcfromtimestamp(0)).tot
 state_machine_init = {
     'iteration_count': 0,
     'ondemand_instance_id': launch_notification['EC2InstanceId'],
+    # 2018-02-03T20:11:57.103Z
+    'launched_at': 1517688717,
     'launch_subnet_id': launch_notification['Details']['Subnet ID'],
     'launch_az': launch_notification['Details']['Availability Zone'],
     'autoscaling_group': {},
@@ -41,7 +44,10 @@ state_machine_init = {
     'init_sleep_interval': 0,
     'spot_req_sleep_interval': 30,
     'spot_attach_sleep_interval': 0,
-    'spot_failure_sleep_interval': 3600
+    'spot_failure_sleep_interval': 3600,
+    'batch_window': 0,
+    'spot_fulfillment_events': False,
+    'max_concurrent_swaps': 1
 }
 
 
@@ -171,6 +177,192 @@ class TestInitMachineState(unittest.TestCase):
         self.assertEqual(state_machine_dict['min_protected_instances'], min_protected)
         self.assertIsNone(msg)
 
+    def test_asg_with_batch_window(self):
+        logger.debug('TestInitMachineState.test_asg_with_batch_window')
+        self.asg_dict['Tags'].append({'Key': 'spoptimize:init_sleep_interval', 'Value': '10'})
+        self.asg_dict['Tags'].append({'Key': 'spoptimize:replacement_batch_window', 'Value': '120'})
+        stepfns.asg_helper = Mock(**{
+            'describe_asg.return_value': self.asg_dict
+        })
+        (state_machine_dict, msg) = stepfns.init_machine_state(launch_notification)
+        self.assertEqual(state_machine_dict['batch_window'], 120)
+        # the leader waits for the batch window to close
+        self.assertEqual(state_machine_dict['init_sleep_interval'], 150)
+        self.assertIsNone(msg)
+
+    def test_asg_with_spot_fulfillment_events(self):
+        logger.debug('TestInitMachineState.test_asg_with_spot_fulfillment_events')
+        self.asg_dict['Tags'].append({'Key': 'spoptimize:spot_fulfillment_events', 'Value': 'true'})
+        stepfns.asg_helper = Mock(**{
+            'describe_asg.return_value': self.asg_dict
+        })
+        (state_machine_dict, msg) = stepfns.init_machine_state(launch_notification)
+        self.assertTrue(state_machine_dict['spot_fulfillment_events'])
+        self.assertIsNone(msg)
+
+    def test_asg_with_adaptive_waits(self):
+        logger.debug('TestInitMachineState.test_asg_with_adaptive_waits')
+        stepfns.asg_helper = Mock(**{
+            'describe_asg.return_value': self.asg_dict
+        })
+        stepfns.ddb_lock_helper = Mock(**{'get_timings.return_value': {
+            'ondemand_healthy': [100, 200, 300, 400, 500],
+            'spot_fulfillment': [20] * 5,
+            'spot_healthy': [50, 60]
+        }})
+        (state_machine_dict, msg) = stepfns.init_machine_state(launch_notification, 'ddbtable')
+        stepfns.ddb_lock_helper.get_timings.assert_called_once_with(
+            'ddbtable', '{0}/{1}'.format(self.asg_dict['AutoScalingGroupName'], self.asg_dict['LaunchConfigurationName']))
+        # 80% of the median
+        self.assertEqual(state_machine_dict['init_sleep_interval'], 240)
+        self.assertEqual(state_machine_dict['spot_req_sleep_interval'], 16)
+        # too few samples
+        self.assertEqual(state_machine_dict['spot_attach_sleep_interval'], self.asg_dict['HealthCheckGracePeriod'] + 30)
+        self.assertIsNone(msg)
+
+    def test_asg_with_slow_adaptive_waits(self):
+        logger.debug('TestInitMachineState.test_asg_with_slow_adaptive_waits')
+        stepfns.asg_helper = Mock(**{
+            'describe_asg.return_value': self.asg_dict
+        })
+        stepfns.ddb_lock_helper = Mock(**{'get_timings.return_value': {
+            'spot_fulfillment': [100] * 5,
+            'spot_healthy': [3600] * 5
+        }})
+        (state_machine_dict, msg) = stepfns.init_machine_state(launch_notification, 'ddbtable')
+        # slow groups wait longer than the defaults, rather than polling in vain
+        self.assertEqual(state_machine_dict['spot_req_sleep_interval'], 80)
+        # up to max_adaptive_wait
+        self.assertEqual(state_machine_dict['spot_attach_sleep_interval'], stepfns.max_adaptive_wait)
+        self.assertIsNone(msg)
+
+    def test_tags_override_adaptive_waits(self):
+        logger.debug('TestInitMachineState.test_tags_override_adaptive_waits')
+        self.asg_dict['Tags'].append({'Key': 'spoptimize:init_sleep_interval', 'Value': '1000'})
+        stepfns.asg_helper = Mock(**{
+            'describe_asg.return_value': self.asg_dict
+        })
+        stepfns.ddb_lock_helper = Mock(**{'get_timings.return_value': {'ondemand_healthy': [100] * 5}})
+        (state_machine_dict, msg) = stepfns.init_machine_state(launch_notification, 'ddbtable')
+        self.assertEqual(state_machine_dict['init_sleep_interval'], 1000)
+
+
+class TestInitMachineStates(unittest.TestCase):
+
+    def setUp(self):
+        mock_response = copy.deepcopy(mock_attrs['autoscaling']['describe_auto_scaling_groups.return_value']['AutoScalingGroups'][0])
+        self.asg_dict = {k: mock_response[k] for k in mock_response if k in asg_copy_keys}
+        stepfns.asg_helper = Mock(**{
+            'describe_asg.return_value': self.asg_dict
+        })
+        stepfns.ec2_helper = Mock()
+        stepfns.spot_helper = Mock()
+        stepfns.ddb_lock_helper = Mock()
+
+    def test_dedupe_and_skip_invalid(self):
+        logger.debug('TestInitMachineStates.test_dedupe_and_skip_invalid')
+        other_notification = copy.deepcopy(launch_notification)
+        other_notification['EC2InstanceId'] = 'i-9999999'
+        res = stepfns.init_machine_states([launch_notification, {'hello': 'world'}, launch_notification, other_notification])
+        self.assertListEqual([x['ondemand_instance_id'] for x in res],
+                             [launch_notification['EC2InstanceId'], 'i-9999999'])
+
+    def test_no_messages(self):
+        logger.debug('TestInitMachineStates.test_no_messages')
+        self.assertListEqual(stepfns.init_machine_states([]), [])
+        stepfns.asg_helper.describe_asg.assert_not_called()
+
+
+class TestJoinReplacementBatch(unittest.TestCase):
+
+    def setUp(self):
+        mock_response = copy.deepcopy(mock_attrs['autoscaling']['describe_auto_scaling_groups.return_value']['AutoScalingGroups'][0])
+        self.init_state = copy.deepcopy(state_machine_init)
+        self.init_state['autoscaling_group'] = {k: mock_response[k] for k in mock_response if k in asg_copy_keys}
+        self.init_state['batch_window'] = 60
+        self.instance_id = self.init_state['ondemand_instance_id']
+        self.batch_name = '{0}/{1}/{2}'.format(self.init_state['autoscaling_group']['AutoScalingGroupName'],
+                                               self.init_state['launch_az'], self.init_state['launch_subnet_id'])
+        stepfns.asg_helper = Mock()
+        stepfns.ec2_helper = Mock()
+        stepfns.spot_helper = Mock()
+        stepfns.ddb_lock_helper = Mock()
+
+    def test_no_batch_window(self):
+        logger.debug('TestJoinReplacementBatch.test_no_batch_window')
+        self.init_state['batch_window'] = 0
+        self.assertTrue(stepfns.join_replacement_batch('ddbtable', self.init_state))
+        stepfns.ddb_lock_helper.join_batch.assert_not_called()
+        stepfns.ddb_lock_helper.open_batch.assert_not_called()
+
+    def test_join_open_batch(self):
+        logger.debug('TestJoinReplacementBatch.test_join_open_batch')
+        stepfns.ddb_lock_helper = Mock(**{'join_batch.return_value': 'i-leader'})
+        self.assertFalse(stepfns.join_replacement_batch('ddbtable', self.init_state))
+        self.assertEqual(stepfns.ddb_lock_helper.join_batch.call_args[0][:3], ('ddbtable', self.batch_name, self.instance_id))
+        stepfns.ddb_lock_helper.open_batch.assert_not_called()
+
+    def test_open_batch(self):
+        logger.debug('TestJoinReplacementBatch.test_open_batch')
+        stepfns.ddb_lock_helper = Mock(**{'join_batch.return_value': None, 'open_batch.return_value': {'dummy': 'response'}})
+        self.assertTrue(stepfns.join_replacement_batch('ddbtable', self.init_state))
+        (table_name, name, leader_id, now, closes_at) = stepfns.ddb_lock_helper.open_batch.call_args[0][:5]
+        self.assertEqual((table_name, name, leader_id), ('ddbtable', self.batch_name, self.instance_id))
+        self.assertEqual(closes_at - now, 60)
+
+    def test_lost_race(self):
+        logger.debug('TestJoinReplacementBatch.test_lost_race')
+        stepfns.ddb_lock_helper = Mock(**{'join_batch.return_value': None, 'open_batch.return_value': None})
+        self.assertTrue(stepfns.join_replacement_batch('ddbtable', self.init_state))
+        self.assertEqual(stepfns.ddb_lock_helper.join_batch.call_count, 2)
+        self.assertEqual(stepfns.ddb_lock_helper.open_batch.call_count, 2)
+
+
+class TestLoadReplacementBatch(unittest.TestCase):
+
+    def setUp(self):
+        stepfns.ddb_lock_helper = Mock(**{'get_batch_members.return_value': ['i-0002', 'i-0003']})
+
+    def test_load(self):
+        logger.debug('TestLoadReplacementBatch.test_load')
+        res = stepfns.load_replacement_batch('ddbtable', 'i-0001')
+        stepfns.ddb_lock_helper.get_batch_members.assert_called_once_with('ddbtable', 'i-0001')
+        self.assertListEqual(res, ['i-0001', 'i-0002', 'i-0003'])
+
+    def test_capped(self):
+        logger.debug('TestLoadReplacementBatch.test_capped')
+        stepfns.ddb_lock_helper.get_batch_members.return_value = ['i-{:04d}'.format(x) for x in range(2, 40)]
+        res = stepfns.load_replacement_batch('ddbtable', 'i-0001')
+        self.assertEqual(len(res), stepfns.max_batch_size)
+        self.assertEqual(res[0], 'i-0001')
+
+
+class TestRecordTiming(unittest.TestCase):
+
+    def setUp(self):
+        self.asg_dict = {'AutoScalingGroupName': 'asg-group', 'LaunchConfigurationName': 'lc-name'}
+        stepfns.ddb_lock_helper = Mock(**{'get_timings.return_value': {'spot_healthy': [10, 20]}})
+
+    def test_record_timing(self):
+        logger.debug('TestRecordTiming.test_record_timing')
+        stepfns.record_timing('ddbtable', self.asg_dict, 'spot_fulfillment', 42)
+        self.assertEqual(stepfns.ddb_lock_helper.put_timings.call_args[0][:3], (
+            'ddbtable', 'asg-group/lc-name', {'spot_healthy': [10, 20], 'spot_fulfillment': [42]}))
+
+    def test_samples_are_capped(self):
+        logger.debug('TestRecordTiming.test_samples_are_capped')
+        stepfns.ddb_lock_helper.get_timings.return_value = {'spot_healthy': list(range(stepfns.timing_samples))}
+        stepfns.record_timing('ddbtable', self.asg_dict, 'spot_healthy', 999)
+        samples = stepfns.ddb_lock_helper.put_timings.call_args[0][2]['spot_healthy']
+        self.assertEqual(len(samples), stepfns.timing_samples)
+        self.assertEqual(samples[-1], 999)
+        self.assertEqual(samples[0], 1)
+
+    def test_failure_is_ignored(self):
+        logger.debug('TestRecordTiming.test_failure_is_ignored')
+        stepfns.ddb_lock_helper.put_timings.side_effect = Exception('Testing')
+        stepfns.record_timing('ddbtable', self.asg_dict, 'spot_healthy', 30)
+
 
 class TestAsgInstanceStatus(unittest.TestCase):
 
@@ -185,48 +377,168 @@ class TestAsgInstanceStatus(unittest.TestCase):
     def test_valid_asg(self):
         logger.debug('TestAsgInstanceStatus.test_valid_asg')
         stepfns.asg_helper = Mock(**{
-            'describe_asg.return_value': self.asg_dict,
-            'get_instance_status.return_value': 'Healthy'
+            'describe_group.return_value': self.asg_dict,
+            'group_instance_status.return_value': 'Healthy'
         })
         res = stepfns.asg_instance_state(self.asg_dict, 'i-abcd123')
-        stepfns.asg_helper.describe_asg.assert_called()
-        stepfns.asg_helper.get_instance_status.assert_called()
+        stepfns.asg_helper.describe_group.assert_called()
+        stepfns.asg_helper.group_instance_status.assert_called()
         self.assertEqual(res, strs.asg_instance_healthy)
 
     def test_unknown_asg(self):
         logger.debug('TestAsgInstanceStatus.test_unknown_asg')
         stepfns.asg_helper = Mock(**{
-            'describe_asg.return_value': {},
-            'get_instance_status.return_value': 'Terminated'
+            'describe_group.return_value': {},
+            'group_instance_status.return_value': 'Terminated'
         })
         res = stepfns.asg_instance_state(self.asg_dict, 'i-abcd123')
-        stepfns.asg_helper.describe_asg.assert_called()
-        stepfns.asg_helper.get_instance_status.assert_not_called()
+        stepfns.asg_helper.describe_group.assert_called()
+        stepfns.asg_helper.group_instance_status.assert_not_called()
         self.assertEqual(res, strs.asg_disappeared)
 
 
+class TestAsgInstancesStatus(unittest.TestCase):
+
+    def setUp(self):
+        mock_response = copy.deepcopy(mock_attrs['autoscaling']['describe_auto_scaling_groups.return_value']['AutoScalingGroups'][0])
+        self.asg_dict = {k: mock_response[k] for k in mock_response if k in asg_copy_keys}
+        self.statuses = {'i-0001': 'Healthy', 'i-0002': 'Terminated', 'i-0003': 'Pending'}
+        stepfns.asg_helper = Mock(**{
+            'describe_group.return_value': self.asg_dict,
+            'group_instance_status.side_effect': lambda x, y: self.statuses[y]
+        })
+
+    def test_any_healthy(self):
+        logger.debug('TestAsgInstancesStatus.test_any_healthy')
+        self.assertEqual(stepfns.asg_instances_state(self.asg_dict, ['i-0001', 'i-0002']), strs.asg_instance_healthy)
+        self.assertEqual(stepfns.asg_instances_state(self.asg_dict, ['i-0002']), strs.asg_instance_terminated)
+
+    def test_require_all(self):
+        logger.debug('TestAsgInstancesStatus.test_require_all')
+        self.assertEqual(stepfns.asg_instances_state(self.asg_dict, ['i-0001', 'i-0002'], require_all=True),
+                         strs.asg_instance_terminated)
+        self.assertEqual(stepfns.asg_instances_state(self.asg_dict, ['i-0001'], require_all=True),
+                         strs.asg_instance_healthy)
+
+    def test_pending(self):
+        logger.debug('TestAsgInstancesStatus.test_pending')
+        self.assertEqual(stepfns.asg_instances_state(self.asg_dict, ['i-0001', 'i-0002', 'i-0003']),
+                         strs.asg_instance_pending)
+
+    def test_unknown_asg(self):
+        logger.debug('TestAsgInstancesStatus.test_unknown_asg')
+        stepfns.asg_helper.describe_group.return_value = {}
+        self.assertEqual(stepfns.asg_instances_state(self.asg_dict, ['i-0001']), strs.asg_disappeared)
+        stepfns.asg_helper.group_instance_status.assert_not_called()
+
+
 class TestRequestSpotInstance(unittest.TestCase):
 
     def setUp(self):
         mock_response = copy.deepcopy(mock_attrs['autoscaling']['describe_auto_scaling_groups.return_value']['AutoScalingGroups'][0])
         self.asg_dict = {k: mock_response[k] for k in mock_response if k in asg_copy_keys}
-        stepfns.asg_helper = Mock()
+        self.az = launch_notification['Details']['Availability Zone']
+        self.subnet_id = launch_notification['Details']['Subnet ID']
+        self.launch_spec = {'InstanceType': 't2.micro', 'Placement': {'AvailabilityZone': self.az}}
+        stepfns.asg_helper = Mock(**{
+            'get_launch_config.return_value': {'LaunchConfigurationName': self.asg_dict['LaunchConfigurationName']}
+        })
         stepfns.ec2_helper = Mock()
-        stepfns.spot_helper = Mock()
-        stepfns.ddb_lock_helper = Mock()
+        stepfns.spot_helper = Mock(**{
+            'cached_launch_specification.return_value': None,
+            'gen_launch_specification.return_value': self.launch_spec,
+            'launch_spec_key.return_value': 'spec-key',
+            'request_spot_instance.return_value': {'SpotInstanceRequestId': 'sir-xyz123'}
+        })
+        stepfns.ddb_lock_helper = Mock(**{
+            'get_launch_spec.return_value': None
+        })
 
     def test_request_spot(self):
         logger.debug('TestRequestSpotInstance.test_request_spot')
+        res = stepfns.request_spot_instance(self.asg_dict, self.az, self.subnet_id, 'test-activity')
+        stepfns.asg_helper.get_launch_config.assert_called_once_with(self.asg_dict['AutoScalingGroupName'],
+                                                                     self.asg_dict['LaunchConfigurationName'])
+        stepfns.spot_helper.request_spot_instance.assert_called_once_with(None, self.az, self.subnet_id, 'test-activity',
+                                                                          launch_spec=self.launch_spec)
+        stepfns.ddb_lock_helper.get_launch_spec.assert_not_called()
+        stepfns.ddb_lock_helper.put_launch_spec.assert_not_called()
+        self.assertDictEqual(res, {'SpotInstanceRequestId': 'sir-xyz123'})
+
+    def test_cached_launch_spec(self):
+        logger.debug('TestRequestSpotInstance.test_cached_launch_spec')
+        stepfns.spot_helper.cached_launch_specification.return_value = self.launch_spec
+        res = stepfns.request_spot_instance(self.asg_dict, self.az, self.subnet_id, 'test-activity', 'ddbtable')
+        stepfns.asg_helper.get_launch_config.assert_not_called()
+        stepfns.ddb_lock_helper.get_launch_spec.assert_not_called()
+        stepfns.spot_helper.request_spot_instance.assert_called_once_with(None, self.az, self.subnet_id, 'test-activity',
+                                                                          launch_spec=self.launch_spec)
+        self.assertDictEqual(res, {'SpotInstanceRequestId': 'sir-xyz123'})
+
+    def test_persisted_launch_spec(self):
+        logger.debug('TestRequestSpotInstance.test_persisted_launch_spec')
+        stepfns.ddb_lock_helper.get_launch_spec.return_value = self.launch_spec
+        stepfns.request_spot_instance(self.asg_dict, self.az, self.subnet_id, 'test-activity', 'ddbtable')
+        stepfns.ddb_lock_helper.get_launch_spec.assert_called_once_with('ddbtable', 'spec-key')
+        stepfns.spot_helper.cache_launch_specification.assert_called_once_with(
+            self.asg_dict['LaunchConfigurationName'], self.az, self.subnet_id, self.launch_spec)
+        stepfns.asg_helper.get_launch_config.assert_not_called()
+        stepfns.ddb_lock_helper.put_launch_spec.assert_not_called()
+
+    def test_persist_launch_spec(self):
+        logger.debug('TestRequestSpotInstance.test_persist_launch_spec')
+        stepfns.request_spot_instance(self.asg_dict, self.az, self.subnet_id, 'test-activity', 'ddbtable')
+        stepfns.asg_helper.get_launch_config.assert_called_once()
+        stepfns.ddb_lock_helper.put_launch_spec.assert_called_once()
+        self.assertEqual(stepfns.ddb_lock_helper.put_launch_spec.call_args[0][:3], ('ddbtable', 'spec-key', self.launch_spec))
+
+    def test_failed_request_forgets_launch_spec(self):
+        logger.debug('TestRequestSpotInstance.test_failed_request_forgets_launch_spec')
+        stepfns.spot_helper.request_spot_instance.side_effect = Exception('Testing')
+        with self.assertRaises(Exception):
+            stepfns.request_spot_instance(self.asg_dict, self.az, self.subnet_id, 'test-activity', 'ddbtable')
+        stepfns.ddb_lock_helper.delete_launch_spec.assert_called_once_with('ddbtable', 'spec-key')
+
+
+class TestRequestSpotInstances(unittest.TestCase):
+
+    def setUp(self):
+        mock_response = copy.deepcopy(mock_attrs['autoscaling']['describe_auto_scaling_groups.return_value']['AutoScalingGroups'][0])
+        self.asg_dict = {k: mock_response[k] for k in mock_response if k in asg_copy_keys}
+        self.az = launch_notification['Details']['Availability Zone']
+        self.subnet_id = launch_notification['Details']['Subnet ID']
+        self.launch_spec = {'InstanceType': 't2.micro', 'Placement': {'AvailabilityZone': self.az}}
+        self.statuses = {'i-0001': 'Healthy', 'i-0002': 'Protected', 'i-0003': 'Healthy'}
+        stepfns.asg_helper = Mock(**{
+            'group_instance_status.side_effect': lambda x, y: self.statuses[y]
+        })
+        stepfns.ec2_helper = Mock()
         stepfns.spot_helper = Mock(**{
-            'request_spot_instance.return_value': {'SpotInstanceRequestId': 'sir-xyz123'}
+            'cached_launch_specification.return_value': self.launch_spec,
+            'launch_spec_key.return_value': 'spec-key',
+            'request_spot_instances.return_value': {'SpotInstanceRequestIds': ['sir-1', 'sir-3']}
         })
-        res = stepfns.request_spot_instance(self.asg_dict,
-                                            launch_notification['Details']['Availability Zone'],
-                                            launch_notification['Details']['Subnet ID'],
-                                            'test-activity')
-        stepfns.asg_helper.get_launch_config.assert_called()
-        stepfns.spot_helper.request_spot_instance.assert_called()
-        self.assertDictEqual(res, {'SpotInstanceRequestId': 'sir-xyz123'})
+        stepfns.ddb_lock_helper = Mock()
+
+    def test_request_spot_instances(self):
+        logger.debug('TestRequestSpotInstances.test_request_spot_instances')
+        res = stepfns.request_spot_instances(self.asg_dict, self.az, self.subnet_id, ['i-0001', 'i-0002', 'i-0003'],
+                                             'i-0001-0')
+        stepfns.spot_helper.request_spot_instances.assert_called_once_with(
+            self.launch_spec, self.az, self.subnet_id, 'i-0001-0-2', 2)
+        self.assertDictEqual(res, {'SpotInstanceRequestIds': ['sir-1', 'sir-3'], 'OnDemandInstanceIds': ['i-0001', 'i-0003']})
+
+    def test_no_healthy_instances(self):
+        logger.debug('TestRequestSpotInstances.test_no_healthy_instances')
+        res = stepfns.request_spot_instances(self.asg_dict, self.az, self.subnet_id, ['i-0002'], 'i-0001-0')
+        stepfns.spot_helper.request_spot_instances.assert_not_called()
+        self.assertTrue(res.get('SpoptimizeError'))
+
+    def test_spot_request_error(self):
+        logger.debug('TestRequestSpotInstances.test_spot_request_error')
+        stepfns.spot_helper.request_spot_instances.return_value = {'SpoptimizeError': 'MaxSpotInstanceCountExceeded'}
+        res = stepfns.request_spot_instances(self.asg_dict, self.az, self.subnet_id, ['i-0001'], 'i-0001-0')
+        self.assertDictEqual(res, {'SpoptimizeError': 'MaxSpotInstanceCountExceeded'})
 
 
 class TestGetSpotRequestStatus(unittest.TestCase):
@@ -273,6 +585,151 @@ class TestGetSpotRequestStatus(unittest.TestCase):
         self.assertEqual(res, strs.spot_request_pending)
 
 
+class TestGetSpotRequestsStatus(unittest.TestCase):
+
+    def setUp(self):
+        stepfns.asg_helper = Mock()
+        stepfns.ec2_helper = Mock(**{'running_instances.side_effect': lambda x: x})
+        stepfns.spot_helper = Mock()
+        stepfns.ddb_lock_helper = Mock()
+
+    def test_partially_fulfilled(self):
+        logger.debug('TestGetSpotRequestsStatus.test_partially_fulfilled')
+        stepfns.spot_helper = Mock(**{'get_spot_request_statuses.return_value': ['i-0001', 'Failure', 'i-0003']})
+        res = stepfns.get_spot_requests_status(['sir-1', 'sir-2', 'sir-3'])
+        stepfns.ec2_helper.running_instances.assert_called_once_with(['i-0001', 'i-0003'])
+        self.assertListEqual(res, ['i-0001', 'i-0003'])
+
+    def test_pending(self):
+        logger.debug('TestGetSpotRequestsStatus.test_pending')
+        stepfns.spot_helper = Mock(**{'get_spot_request_statuses.return_value': ['i-0001', 'Pending']})
+        self.assertEqual(stepfns.get_spot_requests_status(['sir-1', 'sir-2']), strs.spot_request_pending)
+        stepfns.ec2_helper.running_instances.side_effect = lambda x: x[1:]
+        stepfns.spot_helper.get_spot_request_statuses.return_value = ['i-0001', 'i-0002']
+        self.assertEqual(stepfns.get_spot_requests_status(['sir-1', 'sir-2']), strs.spot_request_pending)
+
+    def test_all_failed(self):
+        logger.debug('TestGetSpotRequestsStatus.test_all_failed')
+        stepfns.spot_helper = Mock(**{'get_spot_request_statuses.return_value': ['Failure', 'Failure']})
+        self.assertEqual(stepfns.get_spot_requests_status(['sir-1', 'sir-2']), strs.spot_request_failure)
+        stepfns.ec2_helper.running_instances.assert_not_called()
+
+
+class TestSpotRequestResult(unittest.TestCase):
+
+    def setUp(self):
+        stepfns.asg_helper = Mock()
+        stepfns.ec2_helper = Mock(**{'is_instance_running.return_value': True, 'running_instances.side_effect': lambda x: x})
+        stepfns.spot_helper = Mock(**{
+            'get_spot_request_status.return_value': 'i-abcd123',
+            'get_spot_request_statuses.return_value': ['i-abcd123', 'i-abcd456']
+        })
+        stepfns.ddb_lock_helper = Mock()
+
+    def test_single(self):
+        logger.debug('TestSpotRequestResult.test_single')
+        self.assertEqual(stepfns.spot_request_result({'SpotInstanceRequestId': 'sir-1'}), 'i-abcd123')
+        stepfns.spot_helper.get_spot_request_status.assert_called_once_with('sir-1')
+
+    def test_multiple(self):
+        logger.debug('TestSpotRequestResult.test_multiple')
+        self.assertListEqual(stepfns.spot_request_result({'SpotInstanceRequestIds': ['sir-1', 'sir-2']}),
+                             ['i-abcd123', 'i-abcd456'])
+
+    def test_error(self):
+        logger.debug('TestSpotRequestResult.test_error')
+        self.assertEqual(stepfns.spot_request_result({'SpoptimizeError': 'MaxSpotInstanceCountExceeded'}),
+                         strs.spot_request_failure)
+        stepfns.spot_helper.get_spot_request_status.assert_not_called()
+
+    def test_no_healthy_instances(self):
+        logger.debug('TestSpotRequestResult.test_no_healthy_instances')
+        self.assertEqual(stepfns.spot_request_result({'SpoptimizeError': 'NoHealthyOnDemandInstances'}),
+                         strs.asg_instance_terminated)
+        stepfns.spot_helper.get_spot_request_status.assert_not_called()
+
+
+class TestAwaitSpotRequest(unittest.TestCase):
+
+    def setUp(self):
+        self.spot_request = {'SpotInstanceRequestId': 'sir-1'}
+        stepfns.asg_helper = Mock()
+        stepfns.ec2_helper = Mock(**{'is_instance_running.return_value': True})
+        stepfns.spot_helper = Mock(**{'get_spot_request_status.return_value': 'Pending'})
+        stepfns.ddb_lock_helper = Mock(**{'get_spot_waiter.return_value': ('task-token', self.spot_request)})
+        stepfns.sfn_helper = Mock()
+
+    def test_await_pending(self):
+        logger.debug('TestAwaitSpotRequest.test_await_pending')
+        self.assertIsNone(stepfns.await_spot_request('ddbtable', self.spot_request, 'task-token'))
+        self.assertEqual(stepfns.ddb_lock_helper.put_spot_waiter.call_args[0][:3], ('ddbtable', self.spot_request, 'task-token'))
+        stepfns.sfn_helper.send_task_success.assert_not_called()
+        stepfns.ddb_lock_helper.delete_spot_waiter.assert_not_called()
+
+    def test_await_already_fulfilled(self):
+        logger.debug('TestAwaitSpotRequest.test_await_already_fulfilled')
+        stepfns.spot_helper.get_spot_request_status.return_value = 'i-abcd123'
+        self.assertEqual(stepfns.await_spot_request('ddbtable', self.spot_request, 'task-token'), 'i-abcd123')
+        stepfns.sfn_helper.send_task_success.assert_called_once_with('task-token', 'i-abcd123')
+        stepfns.ddb_lock_helper.delete_spot_waiter.assert_called_once_with('ddbtable', self.spot_request)
+
+    def test_await_error(self):
+        logger.debug('TestAwaitSpotRequest.test_await_error')
+        # the real helper, so a lookup of the missing spot request id would raise
+        stepfns.ddb_lock_helper = ddb_lock_helper
+        ddb_lock_helper.ddb = Mock()
+        res = stepfns.await_spot_request('ddbtable', {'SpoptimizeError': 'MaxSpotInstanceCountExceeded'}, 'task-token')
+        self.assertEqual(res, strs.spot_request_failure)
+        ddb_lock_helper.ddb.put_item.assert_not_called()
+        ddb_lock_helper.ddb.delete_item.assert_not_called()
+        stepfns.sfn_helper.send_task_success.assert_called_once_with('task-token', strs.spot_request_failure)
+
+    def test_fulfillment_event(self):
+        logger.debug('TestAwaitSpotRequest.test_fulfillment_event')
+        stepfns.spot_helper.get_spot_request_status.return_value = 'i-abcd123'
+        event = {'detail-type': 'EC2 Spot Instance Request Fulfillment',
+                 'detail': {'spot-instance-request-id': 'sir-1', 'instance-id': 'i-abcd123'}}
+        self.assertEqual(stepfns.process_spot_event('ddbtable', event), 'i-abcd123')
+        stepfns.ddb_lock_helper.get_spot_waiter.assert_called_once_with('ddbtable', 'sir-1')
+        stepfns.ec2_helper.spot_request_id.assert_not_called()
+        stepfns.sfn_helper.send_task_success.assert_called_once_with('task-token', 'i-abcd123')
+
+    def test_fulfillment_event_instance_pending(self):
+        logger.debug('TestAwaitSpotRequest.test_fulfillment_event_instance_pending')
+        stepfns.spot_helper.get_spot_request_status.return_value = 'i-abcd123'
+        stepfns.ec2_helper.is_instance_running.return_value = False
+        event = {'detail-type': 'EC2 Spot Instance Request Fulfillment',
+                 'detail': {'spot-instance-request-id': 'sir-1', 'instance-id': 'i-abcd123'}}
+        self.assertIsNone(stepfns.process_spot_event('ddbtable', event))
+        stepfns.sfn_helper.send_task_success.assert_not_called()
+
+    def test_state_change_event(self):
+        logger.debug('TestAwaitSpotRequest.test_state_change_event')
+        stepfns.spot_helper.get_spot_request_status.return_value = 'i-abcd123'
+        stepfns.ec2_helper.spot_request_id.return_value = 'sir-1'
+        event = {'detail-type': 'EC2 Instance State-change Notification',
+                 'detail': {'instance-id': 'i-abcd123', 'state': 'running'}}
+        self.assertEqual(stepfns.process_spot_event('ddbtable', event), 'i-abcd123')
+        stepfns.ec2_helper.spot_request_id.assert_called_once_with('i-abcd123')
+        stepfns.sfn_helper.send_task_success.assert_called_once_with('task-token', 'i-abcd123')
+
+    def test_unrelated_event(self):
+        logger.debug('TestAwaitSpotRequest.test_unrelated_event')
+        stepfns.ec2_helper.spot_request_id.return_value = None
+        event = {'detail-type': 'EC2 Instance State-change Notification',
+                 'detail': {'instance-id': 'i-abcd123', 'state': 'running'}}
+        self.assertIsNone(stepfns.process_spot_event('ddbtable', event))
+        stepfns.ddb_lock_helper.get_spot_waiter.assert_not_called()
+
+    def test_no_waiter(self):
+        logger.debug('TestAwaitSpotRequest.test_no_waiter')
+        stepfns.ddb_lock_helper.get_spot_waiter.return_value = None
+        event = {'detail-type': 'EC2 Spot Instance Request Fulfillment',
+                 'detail': {'spot-instance-request-id': 'sir-1', 'instance-id': 'i-abcd123'}}
+        self.assertIsNone(stepfns.process_spot_event('ddbtable', event))
+        stepfns.spot_helper.get_spot_request_status.assert_not_called()
+
+
 class TestAttachSpotInstance(unittest.TestCase):
 
     def setUp(self):
@@ -288,18 +745,18 @@ class TestAttachSpotInstance(unittest.TestCase):
         expected_res = strs.success
         self.asg_dict['DesiredCapacity'] = self.asg_dict['MaxSize']
         stepfns.asg_helper = Mock(**{
-            'describe_asg.return_value': self.asg_dict,
-            'get_instance_status.return_value': 'Healthy',
+            'describe_group.return_value': self.asg_dict,
+            'group_instance_status.return_value': 'Healthy',
             'attach_instance.return_value': 'Success'
         })
         stepfns.ec2_helper = Mock(**{
             'tag_instance.return_value': True
         })
         res = stepfns.attach_spot_instance(self.asg_dict, 'i-9999999', 'i-abcd123')
-        stepfns.asg_helper.describe_asg.assert_called()
+        stepfns.asg_helper.describe_group.assert_called()
         stepfns.ec2_helper.terminate_instance.assert_not_called()
         stepfns.ec2_helper.tag_instance.assert_called()
-        stepfns.asg_helper.get_instance_status.assert_called()
+        stepfns.asg_helper.group_instance_status.assert_called()
         stepfns.asg_helper.attach_instance.assert_called_once_with(
             self.asg_dict['AutoScalingGroupName'], 'i-9999999')
         stepfns.asg_helper.terminate_instance.assert_called_once_with('i-abcd123', decrement_cap=True)
@@ -311,33 +768,49 @@ class TestAttachSpotInstance(unittest.TestCase):
         expected_tags = [{'Key': x['Key'], 'Value': x['Value']} for x in self.asg_dict['Tags']
                          if x.get('PropagateAtLaunch', False) and x.get('Key', '').split(':')[0] != 'aws']
         stepfns.asg_helper = Mock(**{
-            'describe_asg.return_value': self.asg_dict,
-            'get_instance_status.return_value': 'Healthy',
+            'describe_group.return_value': self.asg_dict,
+            'group_instance_status.return_value': 'Healthy',
             'attach_instance.return_value': 'Success'
         })
         stepfns.ec2_helper = Mock(**{
             'tag_instance.return_value': True
         })
         res = stepfns.attach_spot_instance(self.asg_dict, 'i-9999999', 'i-abcd123')
-        stepfns.asg_helper.describe_asg.assert_called()
+        stepfns.asg_helper.describe_group.assert_called()
         stepfns.ec2_helper.terminate_instance.assert_not_called()
         stepfns.ec2_helper.tag_instance.assert_called_once_with('i-9999999', 'i-abcd123', expected_tags)
-        stepfns.asg_helper.get_instance_status.assert_called_once_with('i-abcd123')
+        stepfns.asg_helper.group_instance_status.assert_called_once_with(self.asg_dict, 'i-abcd123')
         stepfns.asg_helper.attach_instance.assert_called_once_with(
             self.asg_dict['AutoScalingGroupName'], 'i-9999999')
         stepfns.asg_helper.terminate_instance.assert_called_once_with('i-abcd123', decrement_cap=True)
         self.assertEqual(res, expected_res)
 
+    def test_attach_failure(self):
+        logger.debug('TestAttachSpotInstance.test_attach_failure')
+        stepfns.asg_helper = Mock(**{
+            'describe_group.return_value': self.asg_dict,
+            'group_instance_status.return_value': 'Healthy',
+            'attach_instance.return_value': strs.asg_not_sized_correctly
+        })
+        stepfns.ec2_helper = Mock(**{
+            'tag_instance.return_value': True
+        })
+        res = stepfns.attach_spot_instance(self.asg_dict, 'i-9999999', 'i-abcd123')
+        stepfns.asg_helper.attach_instance.assert_called_once_with(
+            self.asg_dict['AutoScalingGroupName'], 'i-9999999')
+        stepfns.asg_helper.terminate_instance.assert_not_called()
+        self.assertEqual(res, strs.asg_not_sized_correctly)
+
     def test_no_asg(self):
         logger.debug('TestAttachSpotInstance.test_no_asg')
         expected_res = strs.asg_disappeared
         stepfns.asg_helper = Mock(**{
-            'describe_asg.return_value': {}
+            'describe_group.return_value': {}
         })
         res = stepfns.attach_spot_instance(self.asg_dict, 'i-9999999', 'i-abcd123')
-        stepfns.asg_helper.describe_asg.assert_called()
+        stepfns.asg_helper.describe_group.assert_called()
         stepfns.ec2_helper.tag_instance.assert_not_called()
-        stepfns.asg_helper.get_instance_status.assert_not_called()
+        stepfns.asg_helper.group_instance_status.assert_not_called()
         stepfns.asg_helper.attach_instance.assert_not_called()
         stepfns.asg_helper.terminate_instance.assert_not_called()
         self.assertEqual(res, expected_res)
@@ -346,16 +819,16 @@ class TestAttachSpotInstance(unittest.TestCase):
         logger.debug('TestAttachSpotInstance.test_spot_disappeared')
         expected_res = strs.spot_instance_disappeared
         stepfns.asg_helper = Mock(**{
-            'describe_asg.return_value': self.asg_dict,
-            'get_instance_status.return_value': 'Healthy'
+            'describe_group.return_value': self.asg_dict,
+            'group_instance_status.return_value': 'Healthy'
         })
         stepfns.ec2_helper = Mock(**{
             'tag_instance.return_value': False
         })
         res = stepfns.attach_spot_instance(self.asg_dict, 'i-9999999', 'i-abcd123')
-        stepfns.asg_helper.describe_asg.assert_called()
+        stepfns.asg_helper.describe_group.assert_called()
         stepfns.ec2_helper.tag_instance.assert_called()
-        stepfns.asg_helper.get_instance_status.assert_not_called()
+        stepfns.asg_helper.group_instance_status.assert_not_called()
         stepfns.asg_helper.attach_instance.assert_not_called()
         stepfns.asg_helper.terminate_instance.assert_not_called()
         self.assertEqual(res, expected_res)
@@ -364,20 +837,99 @@ class TestAttachSpotInstance(unittest.TestCase):
         logger.debug('TestAttachSpotInstance.test_od_disappeared_or_protected')
         expected_res = strs.od_instance_disappeared
         stepfns.asg_helper = Mock(**{
-            'describe_asg.return_value': self.asg_dict,
-            'get_instance_status.return_value': 'Protected'
+            'describe_group.return_value': self.asg_dict,
+            'group_instance_status.return_value': 'Protected'
         })
         stepfns.ec2_helper = Mock(**{
             'tag_instance.return_value': True
         })
         res = stepfns.attach_spot_instance(self.asg_dict, 'i-9999999', 'i-abcd123')
-        stepfns.asg_helper.describe_asg.assert_called()
+        stepfns.asg_helper.describe_group.assert_called()
         stepfns.ec2_helper.tag_instance.assert_called()
-        stepfns.asg_helper.get_instance_status.assert_called()
+        stepfns.asg_helper.group_instance_status.assert_called()
         stepfns.asg_helper.terminate_instance.assert_not_called()
         self.assertEqual(res, expected_res)
 
 
+class TestAttachSpotInstances(unittest.TestCase):
+
+    def setUp(self):
+        mock_response = copy.deepcopy(mock_attrs['autoscaling']['describe_auto_scaling_groups.return_value']['AutoScalingGroups'][0])
+        self.asg_dict = {k: mock_response[k] for k in mock_response if k in asg_copy_keys}
+        self.asg_dict['DesiredCapacity'] = 2
+        self.asg_dict['MaxSize'] = 4
+        self.statuses = {'i-od1': 'Healthy', 'i-od2': 'Healthy', 'i-od3': 'Healthy'}
+        self.attach_statuses = {}
+        stepfns.asg_helper = Mock(**{
+            'describe_group.return_value': self.asg_dict,
+            'group_instance_status.side_effect': lambda x, y: self.statuses[y],
+            'attach_instance_batch.side_effect': lambda x, y: {z: self.attach_statuses.get(z, 'Success') for z in y}
+        })
+        stepfns.ec2_helper = Mock(**{
+            'tag_instance.return_value': True
+        })
+        stepfns.spot_helper = Mock()
+        stepfns.ddb_lock_helper = Mock()
+
+    def test_capacity_available(self):
+        logger.debug('TestAttachSpotInstances.test_capacity_available')
+        res = stepfns.attach_spot_instances(self.asg_dict, ['i-spot1', 'i-spot2'], ['i-od1', 'i-od2'])
+        stepfns.asg_helper.attach_instance_batch.assert_called_once_with(self.asg_dict['AutoScalingGroupName'],
+                                                                         ['i-spot1', 'i-spot2'])
+        stepfns.asg_helper.terminate_instances.assert_called_once_with(['i-od1', 'i-od2'], decrement_cap=True)
+        stepfns.ec2_helper.terminate_instances.assert_not_called()
+        self.assertListEqual(res, ['i-spot1', 'i-spot2'])
+
+    def test_no_capacity(self):
+        logger.debug('TestAttachSpotInstances.test_no_capacity')
+        self.asg_dict['DesiredCapacity'] = self.asg_dict['MaxSize']
+        res = stepfns.attach_spot_instances(self.asg_dict, ['i-spot1', 'i-spot2', 'i-spot3'], ['i-od1', 'i-od2', 'i-od3'])
+        stepfns.asg_helper.terminate_instances.assert_called_once_with(['i-od1', 'i-od2', 'i-od3'], decrement_cap=True)
+        stepfns.asg_helper.attach_instance_batch.assert_called_once()
+        self.assertListEqual(res, ['i-spot1', 'i-spot2', 'i-spot3'])
+
+    def test_partial_capacity(self):
+        logger.debug('TestAttachSpotInstances.test_partial_capacity')
+        res = stepfns.attach_spot_instances(self.asg_dict, ['i-spot1', 'i-spot2', 'i-spot3'], ['i-od1', 'i-od2', 'i-od3'])
+        # only the instance that doesn't fit is terminated before attaching
+        self.assertListEqual(stepfns.asg_helper.terminate_instances.call_args_list[0][0][0], ['i-od1'])
+        self.assertListEqual(stepfns.asg_helper.terminate_instances.call_args_list[1][0][0], ['i-od2', 'i-od3'])
+        self.assertListEqual(res, ['i-spot1', 'i-spot2', 'i-spot3'])
+
+    def test_partial(self):
+        logger.debug('TestAttachSpotInstances.test_partial')
+        self.statuses['i-od2'] = 'Protected'
+        stepfns.ec2_helper.tag_instance.side_effect = lambda x, y, z: x != 'i-spot3'
+        res = stepfns.attach_spot_instances(self.asg_dict, ['i-spot1', 'i-spot2', 'i-spot3'], ['i-od1', 'i-od2', 'i-od3'])
+        stepfns.ec2_helper.terminate_instances.assert_called_once_with(['i-spot2'])
+        stepfns.asg_helper.attach_instance_batch.assert_called_once_with(self.asg_dict['AutoScalingGroupName'], ['i-spot1'])
+        stepfns.asg_helper.terminate_instances.assert_called_once_with(['i-od1'], decrement_cap=True)
+        self.assertListEqual(res, ['i-spot1'])
+
+    def test_partial_attach_failure(self):
+        logger.debug('TestAttachSpotInstances.test_partial_attach_failure')
+        self.attach_statuses['i-spot2'] = strs.asg_instance_missing
+        res = stepfns.attach_spot_instances(self.asg_dict, ['i-spot1', 'i-spot2'], ['i-od1', 'i-od2'])
+        stepfns.ec2_helper.terminate_instances.assert_called_once_with(['i-spot2'])
+        stepfns.asg_helper.terminate_instances.assert_called_once_with(['i-od1'], decrement_cap=True)
+        self.assertListEqual(res, ['i-spot1'])
+
+    def test_od_disappeared(self):
+        logger.debug('TestAttachSpotInstances.test_od_disappeared')
+        self.statuses['i-od1'] = 'Terminated'
+        res = stepfns.attach_spot_instances(self.asg_dict, ['i-spot1'], ['i-od1'])
+        stepfns.asg_helper.attach_instance_batch.assert_not_called()
+        stepfns.asg_helper.terminate_instances.assert_not_called()
+        self.assertEqual(res, strs.od_instance_disappeared)
+
+    def test_attach_failure(self):
+        logger.debug('TestAttachSpotInstances.test_attach_failure')
+        self.attach_statuses['i-spot1'] = strs.asg_not_sized_correctly
+        res = stepfns.attach_spot_instances(self.asg_dict, ['i-spot1'], ['i-od1'])
+        stepfns.asg_helper.terminate_instances.assert_not_called()
+        self.assertEqual(res, strs.asg_not_sized_correctly)
+
+
 class TestTerminateEc2Instance(unittest.TestCase):
 
     def setUp(self):
@@ -402,6 +954,12 @@ class TestTerminateEc2Instance(unittest.TestCase):
         stepfns.terminate_ec2_instance(None)
         stepfns.ec2_helper.terminate_instance.assert_not_called()
 
+    def test_terminate_list(self):
+        logger.debug('TestTerminateEc2Instance.test_terminate_list')
+        stepfns.terminate_ec2_instance(['i-9999999', 'i-8888888'])
+        stepfns.ec2_helper.terminate_instances.assert_called_once_with(['i-9999999', 'i-8888888'])
+        stepfns.ec2_helper.terminate_instance.assert_not_called()
+
 
 class TestAcquireLock(unittest.TestCase):
 
@@ -414,84 +972,317 @@ class TestAcquireLock(unittest.TestCase):
         stepfns.spot_helper = Mock()
         stepfns.ddb_lock_helper = Mock()
 
-    def test_lock_acquired_no_existing(self):
-        logger.debug('TestAcquireLock.test_lock_acquired_no_existing')
+    def test_lock_acquired(self):
+        logger.debug('TestAcquireLock.test_lock_acquired')
         stepfns.ddb_lock_helper = Mock(**{
-            'put_item.return_value': True
+            'put_lease.return_value': (True, None)
         })
         res = stepfns.acquire_lock(self.table_name, self.group_name, self.exec_arn)
-        stepfns.ddb_lock_helper.put_item.assert_called_once()
+        stepfns.ddb_lock_helper.put_lease.assert_called_once()
+        (table_name, group_name, exec_arn, now, lease_expires, ttl) = stepfns.ddb_lock_helper.put_lease.call_args[0]
+        self.assertEqual(lease_expires - now, stepfns.lock_lease_seconds)
+        self.assertGreater(ttl, lease_expires)
         stepfns.ddb_lock_helper.get_item.assert_not_called()
         stepfns.ddb_lock_helper.is_execution_running.assert_not_called()
         self.assertTrue(res)
 
-    def test_lock_already_acquired(self):
-        logger.debug('TestAcquireLock.test_lock_already_acquired')
+    def test_lock_acquired_lease_seconds(self):
+        logger.debug('TestAcquireLock.test_lock_acquired_lease_seconds')
         stepfns.ddb_lock_helper = Mock(**{
-            'put_item.return_value': False,
-            'get_item.return_value': self.exec_arn
+            'put_lease.return_value': (True, None)
+        })
+        self.assertTrue(stepfns.acquire_lock(self.table_name, self.group_name, self.exec_arn, 900))
+        (table_name, group_name, exec_arn, now, lease_expires, ttl) = stepfns.ddb_lock_helper.put_lease.call_args[0]
+        self.assertEqual(lease_expires - now, 900)
+
+    def test_lock_not_acquired_existing_lease(self):
+        logger.debug('TestAcquireLock.test_lock_not_acquired_existing_lease')
+        stepfns.ddb_lock_helper = Mock(**{
+            'put_lease.return_value': (False, {'execution_arn': 'other:execution:arn', 'lease_expires': 1234})
         })
         res = stepfns.acquire_lock(self.table_name, self.group_name, self.exec_arn)
-        stepfns.ddb_lock_helper.put_item.assert_called_once()
-        stepfns.ddb_lock_helper.get_item.assert_called_once()
+        stepfns.ddb_lock_helper.put_lease.assert_called_once()
         stepfns.ddb_lock_helper.is_execution_running.assert_not_called()
-        self.assertTrue(res)
+        self.assertFalse(res)
 
-    def test_lock_not_acquired_existing_owner(self):
-        logger.debug('TestAcquireLock.test_lock_not_acquired_existing_owner')
+    def test_lock_not_acquired_legacy_owner(self):
+        logger.debug('TestAcquireLock.test_lock_not_acquired_legacy_owner')
         stepfns.ddb_lock_helper = Mock(**{
-            'put_item.return_value': False,
-            'get_item.return_value': 'other:execution:arn',
+            'put_lease.return_value': (False, {'execution_arn': 'other:execution:arn', 'lease_expires': None}),
             'is_execution_running.return_value': True
         })
         res = stepfns.acquire_lock(self.table_name, self.group_name, self.exec_arn)
-        stepfns.ddb_lock_helper.put_item.assert_called_once()
-        stepfns.ddb_lock_helper.get_item.assert_called_once()
-        stepfns.ddb_lock_helper.is_execution_running.assert_called_once()
+        stepfns.ddb_lock_helper.put_lease.assert_called_once()
+        stepfns.ddb_lock_helper.is_execution_running.assert_called_once_with('other:execution:arn')
         self.assertFalse(res)
 
-    def test_lock_acquired_old_owner(self):
-        logger.debug('TestAcquireLock.test_lock_acquired_old_owner')
+    def test_lock_acquired_old_legacy_owner(self):
+        logger.debug('TestAcquireLock.test_lock_acquired_old_legacy_owner')
         stepfns.ddb_lock_helper = Mock(**{
-            'put_item.side_effect': [False, True],
-            'get_item.return_value': 'other:execution:arn',
+            'put_lease.side_effect': [(False, {'execution_arn': 'other:execution:arn', 'lease_expires': None}),
+                                      (True, None)],
             'is_execution_running.return_value': False
         })
         res = stepfns.acquire_lock(self.table_name, self.group_name, self.exec_arn)
-        stepfns.ddb_lock_helper.put_item.assert_called()
-        stepfns.ddb_lock_helper.get_item.assert_called_once()
+        self.assertEqual(stepfns.ddb_lock_helper.put_lease.call_count, 2)
+        self.assertEqual(stepfns.ddb_lock_helper.put_lease.call_args[0][6], 'other:execution:arn')
         stepfns.ddb_lock_helper.is_execution_running.assert_called_once()
         self.assertTrue(res)
 
-    def test_lock_not_acquired_old_owner(self):
-        logger.debug('TestAcquireLock.test_lock_not_acquired_old_owner')
+    def test_lock_not_acquired_old_legacy_owner(self):
+        logger.debug('TestAcquireLock.test_lock_not_acquired_old_legacy_owner')
         stepfns.ddb_lock_helper = Mock(**{
-            'put_item.return_value': False,
-            'get_item.return_value': 'other:execution:arn',
+            'put_lease.return_value': (False, {'execution_arn': 'other:execution:arn', 'lease_expires': None}),
             'is_execution_running.return_value': False
         })
         res = stepfns.acquire_lock(self.table_name, self.group_name, self.exec_arn)
-        stepfns.ddb_lock_helper.put_item.assert_called()
-        stepfns.ddb_lock_helper.get_item.assert_called_once()
+        self.assertEqual(stepfns.ddb_lock_helper.put_lease.call_count, 2)
         stepfns.ddb_lock_helper.is_execution_running.assert_called_once()
         self.assertFalse(res)
 
 
+class TestAcquireSwapSlot(unittest.TestCase):
+
+    def setUp(self):
+        self.table_name = 'ddbtable'
+        self.group_name = 'group-name'
+        self.exec_arn = 'my:execution:arn'
+        stepfns.asg_helper = Mock(**{
+            'describe_group.return_value': {'MaxSize': 10, 'DesiredCapacity': 6}
+        })
+        stepfns.ddb_lock_helper = Mock(**{
+            'record_key.side_effect': lambda kind, name: '{0}#{1}'.format(kind, name),
+            'put_lease.return_value': (True, None)
+        })
+
+    def test_single_slot(self):
+        logger.debug('TestAcquireSwapSlot.test_single_slot')
+        res = stepfns.acquire_swap_slot(self.table_name, self.group_name, self.exec_arn)
+        stepfns.asg_helper.describe_group.assert_not_called()
+        self.assertEqual(stepfns.ddb_lock_helper.put_lease.call_args[0][1], self.group_name)
+        self.assertEqual(res, self.group_name)
+
+    def test_next_free_slot(self):
+        logger.debug('TestAcquireSwapSlot.test_next_free_slot')
+        held = (False, {'execution_arn': 'other:execution:arn', 'lease_expires': 1234})
+        stepfns.ddb_lock_helper.put_lease.side_effect = [held, held, (True, None)]
+        res = stepfns.acquire_swap_slot(self.table_name, self.group_name, self.exec_arn, 3)
+        stepfns.asg_helper.describe_group.assert_called_once_with(self.group_name, max_age=0)
+        self.assertListEqual([x[0][1] for x in stepfns.ddb_lock_helper.put_lease.call_args_list],
+                             [self.group_name, 'swap-slot#group-name/1', 'swap-slot#group-name/2'])
+        self.assertEqual(res, 'swap-slot#group-name/2')
+
+    def test_slots_limited_by_capacity(self):
+        logger.debug('TestAcquireSwapSlot.test_slots_limited_by_capacity')
+        stepfns.asg_helper.describe_group.return_value = {'MaxSize': 10, 'DesiredCapacity': 9}
+        stepfns.ddb_lock_helper.put_lease.return_value = (False, {'execution_arn': 'other:execution:arn',
+                                                                  'lease_expires': 1234})
+        res = stepfns.acquire_swap_slot(self.table_name, self.group_name, self.exec_arn, 4)
+        self.assertEqual(stepfns.ddb_lock_helper.put_lease.call_count, 1)
+        self.assertIsNone(res)
+
+    def test_no_spare_capacity(self):
+        logger.debug('TestAcquireSwapSlot.test_no_spare_capacity')
+        stepfns.asg_helper.describe_group.return_value = {'MaxSize': 10, 'DesiredCapacity': 10}
+        res = stepfns.acquire_swap_slot(self.table_name, self.group_name, self.exec_arn, 4)
+        self.assertEqual(res, self.group_name)
+
+
+class TestRenewLock(unittest.TestCase):
+
+    def setUp(self):
+        self.table_name = 'ddbtable'
+        self.group_name = 'group-name'
+        self.exec_arn = 'my:execution:arn'
+        stepfns.ddb_lock_helper = Mock(**{
+            'put_lease.return_value': (True, None)
+        })
+
+    def test_lock_renewed(self):
+        logger.debug('TestRenewLock.test_lock_renewed')
+        self.assertTrue(stepfns.renew_lock(self.table_name, self.group_name, self.exec_arn))
+        (table_name, group_name, exec_arn, now, lease_expires, ttl, prev_arn) = \
+            stepfns.ddb_lock_helper.put_lease.call_args[0]
+        self.assertEqual(lease_expires - now, stepfns.lock_lease_seconds)
+        self.assertEqual(prev_arn, self.exec_arn)
+
+    def test_lock_taken_over(self):
+        logger.debug('TestRenewLock.test_lock_taken_over')
+        stepfns.ddb_lock_helper.put_lease.return_value = (False, {'execution_arn': 'other:execution:arn',
+                                                                  'lease_expires': 1234})
+        self.assertFalse(stepfns.renew_lock(self.table_name, self.group_name, self.exec_arn))
+
+
+class TestRegisterSpotInstances(unittest.TestCase):
+
+    def setUp(self):
+        stepfns.ddb_lock_helper = Mock()
+
+    def test_registered(self):
+        logger.debug('TestRegisterSpotInstances.test_registered')
+        stepfns.register_spot_instances('ddbtable', 'asg-group', ['i-1'])
+        (table_name, instance_ids, asg_name, ttl) = stepfns.ddb_lock_helper.register_instances.call_args[0]
+        self.assertEqual((table_name, instance_ids, asg_name), ('ddbtable', ['i-1'], 'asg-group'))
+        self.assertGreater(ttl, 1514764800)
+
+    def test_failure_ignored(self):
+        logger.debug('TestRegisterSpotInstances.test_failure_ignored')
+        stepfns.ddb_lock_helper.register_instances.side_effect = Exception('Testing')
+        stepfns.register_spot_instances('ddbtable', 'asg-group', ['i-1'])
+
+
+class TestDeregisterSpotInstances(unittest.TestCase):
+
+    def setUp(self):
+        stepfns.ddb_lock_helper = Mock()
+
+    def test_deregistered(self):
+        logger.debug('TestDeregisterSpotInstances.test_deregistered')
+        stepfns.deregister_spot_instances('ddbtable', ['i-1', 'i-2'])
+        stepfns.ddb_lock_helper.deregister_instances.assert_called_once_with('ddbtable', ['i-1', 'i-2'])
+
+    def test_failure_ignored(self):
+        logger.debug('TestDeregisterSpotInstances.test_failure_ignored')
+        stepfns.ddb_lock_helper.deregister_instances.side_effect = Exception('Testing')
+        stepfns.deregister_spot_instances('ddbtable', ['i-1'])
+
+
 class TestReleaseLock(unittest.TestCase):
 
     def setUp(self):
         self.table_name = 'ddbtable'
         self.group_name = 'group-name'
         self.exec_arn = 'my:execution:arn'
-        stepfns.asg_helper = Mock()
+        stepfns.asg_helper = Mock(**{'describe_group.return_value': {'MaxSize': 4, 'DesiredCapacity': 2}})
         stepfns.ec2_helper = Mock()
         stepfns.spot_helper = Mock()
-        stepfns.ddb_lock_helper = Mock()
+        stepfns.ddb_lock_helper = Mock(**{
+            'first_lock_waiter.return_value': None,
+            'remove_first_lock_waiter.return_value': True,
+            'put_lease.return_value': (True, None)
+        })
+        stepfns.sfn_helper = Mock(**{'send_task_success.return_value': True})
+        self.waiter = {'execution_arn': 'other:execution:arn', 'task_token': 'task-token', 'lease_seconds': 600}
 
     def test_delete_item_is_called(self):
         logger.debug('TestReleaseLock.test_delete_item_is_called')
         stepfns.release_lock(self.table_name, self.group_name, self.exec_arn)
+        stepfns.ddb_lock_helper.first_lock_waiter.assert_called_once_with(self.table_name, self.group_name)
+        stepfns.ddb_lock_helper.delete_item.assert_called_once_with(self.table_name, self.group_name, self.exec_arn)
+        stepfns.asg_helper.describe_group.assert_not_called()
+
+    def test_swap_slot_released(self):
+        logger.debug('TestReleaseLock.test_swap_slot_released')
+        stepfns.release_lock(self.table_name, self.group_name, self.exec_arn, 'swap-slot#group-name/1')
+        stepfns.ddb_lock_helper.first_lock_waiter.assert_called_once_with(self.table_name, self.group_name)
+        stepfns.ddb_lock_helper.delete_item.assert_called_once_with(self.table_name, 'swap-slot#group-name/1',
+                                                                    self.exec_arn)
+
+    def test_handed_over_to_waiter(self):
+        logger.debug('TestReleaseLock.test_handed_over_to_waiter')
+        stepfns.ddb_lock_helper.first_lock_waiter.return_value = self.waiter
+        stepfns.release_lock(self.table_name, self.group_name, self.exec_arn)
+        (table_name, lock_name, exec_arn, now, lease_expires, ttl, prev_arn) = \
+            stepfns.ddb_lock_helper.put_lease.call_args[0]
+        self.assertEqual((lock_name, exec_arn, prev_arn), (self.group_name, 'other:execution:arn', self.exec_arn))
+        self.assertEqual(lease_expires - now, 600)
+        stepfns.ddb_lock_helper.remove_first_lock_waiter.assert_called_once_with(self.table_name, self.group_name,
+                                                                                 'other:execution:arn')
+        stepfns.sfn_helper.send_task_success.assert_called_once_with('task-token', self.group_name)
+        stepfns.ddb_lock_helper.delete_item.assert_not_called()
+
+    def test_swap_slot_handed_over_within_capacity(self):
+        logger.debug('TestReleaseLock.test_swap_slot_handed_over_within_capacity')
+        stepfns.ddb_lock_helper.first_lock_waiter.return_value = self.waiter
+        stepfns.release_lock(self.table_name, self.group_name, self.exec_arn, 'swap-slot#group-name/1')
+        stepfns.asg_helper.describe_group.assert_called_once_with(self.group_name, max_age=0)
+        stepfns.sfn_helper.send_task_success.assert_called_once_with('task-token', 'swap-slot#group-name/1')
+        stepfns.ddb_lock_helper.delete_item.assert_not_called()
+
+    def test_swap_slot_without_capacity(self):
+        logger.debug('TestReleaseLock.test_swap_slot_without_capacity')
+        stepfns.asg_helper.describe_group.return_value = {'MaxSize': 4, 'DesiredCapacity': 3}
+        stepfns.ddb_lock_helper.first_lock_waiter.return_value = self.waiter
+        stepfns.release_lock(self.table_name, self.group_name, self.exec_arn, 'swap-slot#group-name/1')
+        # the waiter stays queued for the group's lock
+        stepfns.ddb_lock_helper.put_lease.assert_not_called()
+        stepfns.ddb_lock_helper.remove_first_lock_waiter.assert_not_called()
+        stepfns.sfn_helper.send_task_success.assert_not_called()
+        stepfns.ddb_lock_helper.delete_item.assert_called_once_with(self.table_name, 'swap-slot#group-name/1',
+                                                                    self.exec_arn)
+
+    def test_waiter_gone(self):
+        logger.debug('TestReleaseLock.test_waiter_gone')
+        stepfns.ddb_lock_helper.first_lock_waiter.side_effect = [self.waiter, None]
+        stepfns.sfn_helper.send_task_success.return_value = False
+        stepfns.release_lock(self.table_name, self.group_name, self.exec_arn)
+        self.assertEqual(stepfns.ddb_lock_helper.first_lock_waiter.call_count, 2)
+        # the lock was handed over to the waiter, so it's deleted on its behalf
+        stepfns.ddb_lock_helper.delete_item.assert_called_once_with(self.table_name, self.group_name,
+                                                                    'other:execution:arn')
+
+    def test_waiter_acquired_lock_itself(self):
+        logger.debug('TestReleaseLock.test_waiter_acquired_lock_itself')
+        stepfns.ddb_lock_helper.first_lock_waiter.side_effect = [self.waiter, None]
+        stepfns.ddb_lock_helper.remove_first_lock_waiter.return_value = False
+        stepfns.release_lock(self.table_name, self.group_name, self.exec_arn)
+        stepfns.sfn_helper.send_task_success.assert_not_called()
+        stepfns.ddb_lock_helper.delete_item.assert_called_once_with(self.table_name, self.group_name,
+                                                                    'other:execution:arn')
+
+    def test_lock_lost(self):
+        logger.debug('TestReleaseLock.test_lock_lost')
+        stepfns.ddb_lock_helper.first_lock_waiter.return_value = self.waiter
+        stepfns.ddb_lock_helper.put_lease.return_value = (False, {'execution_arn': 'third:execution:arn',
+                                                                  'lease_expires': 1234})
+        stepfns.release_lock(self.table_name, self.group_name, self.exec_arn)
+        # the waiter stays queued
+        stepfns.ddb_lock_helper.remove_first_lock_waiter.assert_not_called()
+        stepfns.sfn_helper.send_task_success.assert_not_called()
+        stepfns.ddb_lock_helper.delete_item.assert_not_called()
+
+
+class TestAwaitLock(unittest.TestCase):
+
+    def setUp(self):
+        self.table_name = 'ddbtable'
+        self.group_name = 'group-name'
+        self.exec_arn = 'my:execution:arn'
+        stepfns.asg_helper = Mock()
+        stepfns.ddb_lock_helper = Mock(**{
+            'put_lease.return_value': (False, {'execution_arn': 'other:execution:arn', 'lease_expires': 1234}),
+            'first_lock_waiter.return_value': None,
+            'remove_lock_waiter.return_value': True
+        })
+        stepfns.sfn_helper = Mock(**{'send_task_success.return_value': True})
+
+    def test_waiter_queued(self):
+        logger.debug('TestAwaitLock.test_waiter_queued')
+        res = stepfns.await_lock(self.table_name, self.group_name, self.exec_arn, 'task-token', 1, 600)
+        self.assertEqual(stepfns.ddb_lock_helper.enqueue_lock_waiter.call_args[0][:5],
+                         (self.table_name, self.group_name, self.exec_arn, 'task-token', 600))
+        stepfns.ddb_lock_helper.remove_lock_waiter.assert_not_called()
+        stepfns.sfn_helper.send_task_success.assert_not_called()
+        self.assertIsNone(res)
+
+    def test_released_while_queueing(self):
+        logger.debug('TestAwaitLock.test_released_while_queueing')
+        stepfns.ddb_lock_helper.put_lease.return_value = (True, None)
+        res = stepfns.await_lock(self.table_name, self.group_name, self.exec_arn, 'task-token', 1, 600)
+        stepfns.ddb_lock_helper.remove_lock_waiter.assert_called_once_with(self.table_name, self.group_name,
+                                                                           self.exec_arn)
+        stepfns.sfn_helper.send_task_success.assert_called_once_with('task-token', self.group_name)
+        self.assertEqual(res, self.group_name)
+
+    def test_handed_over_while_queueing(self):
+        logger.debug('TestAwaitLock.test_handed_over_while_queueing')
+        stepfns.ddb_lock_helper.put_lease.return_value = (True, None)
+        stepfns.ddb_lock_helper.remove_lock_waiter.return_value = False
+        res = stepfns.await_lock(self.table_name, self.group_name, self.exec_arn, 'task-token', 1, 600)
+        # the lock acquired while queueing is released; the handed over lock resumes the execution
         stepfns.ddb_lock_helper.delete_item.assert_called_once_with(self.table_name, self.group_name, self.exec_arn)
+        stepfns.sfn_helper.send_task_success.assert_not_called()
+        self.assertIsNone(res)
 
 
 class TestProtectedInstance(unittest.TestCase):
@@ -509,7 +1300,7 @@ class TestProtectedInstance(unittest.TestCase):
     def test_no_protected_instances(self):
         logger.debug('TestProtectedInstance.test_no_protected_instances')
         res = stepfns.protected_instance(self.group_name, self.instance_id, 0, self.table_name, self.exec_arn)
-        stepfns.ddb_lock_helper.put_item.assert_not_called()
+        stepfns.ddb_lock_helper.put_lease.assert_not_called()
         stepfns.asg_helper.not_enough_protected_instances.assert_not_called()
         stepfns.asg_helper.protect_instance.assert_not_called()
         stepfns.ddb_lock_helper.delete_item.assert_not_called()
@@ -521,11 +1312,13 @@ class TestProtectedInstance(unittest.TestCase):
             'not_enough_protected_instances.return_value': True
         })
         stepfns.ddb_lock_helper = Mock(**{
-            'put_item.return_value': True
+            'put_lease.return_value': (True, None),
+            'first_lock_waiter.return_value': None
         })
         res = stepfns.protected_instance(self.group_name, self.instance_id, 1, self.table_name, self.exec_arn)
-        stepfns.ddb_lock_helper.put_item.assert_called_once()
-        stepfns.asg_helper.not_enough_protected_instances.assert_called_once_with(self.group_name, 1)
+        stepfns.ddb_lock_helper.put_lease.assert_called_once()
+        self.assertEqual(stepfns.asg_helper.not_enough_protected_instances.call_args_list,
+                         [call(self.group_name, 1), call(self.group_name, 1, max_age=0)])
         stepfns.asg_helper.protect_instance.assert_called_once_with(self.group_name, self.instance_id)
         stepfns.ddb_lock_helper.delete_item.assert_called_once()
         self.assertIsNone(res)
@@ -536,25 +1329,41 @@ class TestProtectedInstance(unittest.TestCase):
             'not_enough_protected_instances.return_value': False
         })
         stepfns.ddb_lock_helper = Mock(**{
-            'put_item.return_value': True
+            'put_lease.return_value': (True, None),
+            'first_lock_waiter.return_value': None
         })
         res = stepfns.protected_instance(self.group_name, self.instance_id, 1, self.table_name, self.exec_arn)
-        stepfns.ddb_lock_helper.put_item.assert_called_once()
+        stepfns.ddb_lock_helper.put_lease.assert_not_called()
         stepfns.asg_helper.not_enough_protected_instances.assert_called_once_with(self.group_name, 1)
         stepfns.asg_helper.protect_instance.assert_not_called()
+        stepfns.ddb_lock_helper.delete_item.assert_not_called()
+        self.assertIsNone(res)
+
+    def test_protected_while_acquiring_lock(self):
+        logger.debug('TestProtectedInstance.test_protected_while_acquiring_lock')
+        stepfns.asg_helper = Mock(**{
+            'not_enough_protected_instances.side_effect': [True, False]
+        })
+        stepfns.ddb_lock_helper = Mock(**{
+            'put_lease.return_value': (True, None),
+            'first_lock_waiter.return_value': None
+        })
+        res = stepfns.protected_instance(self.group_name, self.instance_id, 1, self.table_name, self.exec_arn)
+        stepfns.ddb_lock_helper.put_lease.assert_called_once()
+        self.assertEqual(stepfns.asg_helper.not_enough_protected_instances.call_args_list,
+                         [call(self.group_name, 1), call(self.group_name, 1, max_age=0)])
+        stepfns.asg_helper.protect_instance.assert_not_called()
         stepfns.ddb_lock_helper.delete_item.assert_called_once()
         self.assertIsNone(res)
 
     def test_could_not_acquire_lock(self):
         logger.debug('TestProtectedInstance.test_could_not_acquire_lock')
         stepfns.ddb_lock_helper = Mock(**{
-            'put_item.return_value': None,
-            'get_item.return_value': 'other:execution:arn',
-            'get_item.is_execution_running': True
+            'put_lease.return_value': (False, {'execution_arn': 'other:execution:arn', 'lease_expires': 1234})
         })
         res = stepfns.protected_instance(self.group_name, self.instance_id, 1, self.table_name, self.exec_arn)
-        stepfns.ddb_lock_helper.put_item.assert_called_once()
-        stepfns.asg_helper.not_enough_protected_instances.assert_not_called()
+        stepfns.ddb_lock_helper.put_lease.assert_called_once()
+        stepfns.asg_helper.not_enough_protected_instances.assert_called_once_with(self.group_name, 1)
         stepfns.asg_helper.protect_instance.assert_not_called()
         stepfns.ddb_lock_helper.delete_item.assert_not_called()
         self.assertEqual(res, strs.unable_to_acquire_lock)
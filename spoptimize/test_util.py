@@ -1,3 +1,4 @@
+import collections
 import copy
 import datetime
 import json
@@ -57,6 +58,94 @@ class WalkDictForDatetime(unittest.TestCase):
         util.walk_dict_for_datetime(self.my_dict)
         self.assertDictEqual(self.my_dict, self.expected_res)
 
+    def test_walk_nothing_to_convert(self):
+        logger.debug('WalkDictForDatetime.test_walk_nothing_to_convert')
+        util.walk_dict_for_datetime(self.expected_res)
+        self.assertDictEqual(self.expected_res, sample_walked_dict)
+
+
+class JsonSafe(unittest.TestCase):
+
+    def setUp(self):
+        self.maxDiff = None
+
+    def test_convert(self):
+        logger.debug('JsonSafe.test_convert')
+        my_dict = copy.deepcopy(sample_dict)
+        res = util.json_safe(my_dict)
+        self.assertDictEqual(res, sample_walked_dict)
+        # the input is left as it was
+        self.assertDictEqual(my_dict, sample_dict)
+
+    def test_unchanged_values_shared(self):
+        logger.debug('JsonSafe.test_unchanged_values_shared')
+        res = util.json_safe(sample_dict)
+        self.assertIsNot(res['level1b'], sample_dict['level1b'])
+        self.assertIs(res['level1b'][1], sample_dict['level1b'][1])
+        self.assertIs(util.json_safe(sample_walked_dict), sample_walked_dict)
+
+    def test_other_types(self):
+        logger.debug('JsonSafe.test_other_types')
+        res = util.json_safe(collections.OrderedDict([
+            ('date', datetime.date(2018, 3, 6)),
+            ('tuple', ('a', datetime.datetime(2018, 3, 6, 9, 36, 2))),
+            ('set', set(['b'])),
+            ('scalars', [1, 2.5, None, True, u'c'])
+        ]))
+        self.assertDictEqual(res, {
+            'date': '2018-03-06',
+            'tuple': ['a', '2018-03-06T09:36:02'],
+            'set': ['b'],
+            'scalars': [1, 2.5, None, True, u'c']
+        })
+        self.assertEqual(util.json_safe(datetime.datetime(2018, 3, 6, 9, 36, 2)), '2018-03-06T09:36:02')
+
+    def test_to_json(self):
+        logger.debug('JsonSafe.test_to_json')
+        res = util.to_json(sample_dict, sort_keys=True)
+        self.assertEqual(res, json.dumps(util.json_safe(sample_dict), sort_keys=True))
+
+
+class EpochSeconds(unittest.TestCase):
+
+    def test_epoch_seconds(self):
+        logger.debug('EpochSeconds.test_epoch_seconds')
+        self.assertEqual(util.epoch_seconds('2018-02-03T20:11:57.103Z'), 1517688717)
+        self.assertEqual(util.epoch_seconds('1970-01-01T00:01:00Z'), 60)
+
+
+class Percentile(unittest.TestCase):
+
+    def test_percentile(self):
+        logger.debug('Percentile.test_percentile')
+        self.assertEqual(util.percentile([5, 1, 4, 2, 3], 50), 3)
+        self.assertEqual(util.percentile([5, 1, 4, 2, 3], 90), 5)
+        self.assertEqual(util.percentile([5, 1, 4, 2, 3], 0), 1)
+        self.assertIsNone(util.percentile([], 50))
+
+
+class ConcurrentMap(unittest.TestCase):
+
+    def test_results_in_order(self):
+        logger.debug('ConcurrentMap.test_results_in_order')
+        self.assertListEqual(util.concurrent_map(lambda x: x * 2, range(50), 8), [x * 2 for x in range(50)])
+
+    def test_exception_is_returned(self):
+        logger.debug('ConcurrentMap.test_exception_is_returned')
+
+        def func(x):
+            if x == 2:
+                raise ValueError('Testing')
+            return x
+
+        res = util.concurrent_map(func, range(5), 3)
+        self.assertIsInstance(res[2], ValueError)
+        self.assertListEqual([res[x] for x in [0, 1, 3, 4]], [0, 1, 3, 4])
+
+    def test_no_items(self):
+        logger.debug('ConcurrentMap.test_no_items')
+        self.assertListEqual(util.concurrent_map(lambda x: x, [], 8), [])
+
 
 if __name__ == '__main__':
     logger.setLevel(logging.DEBUG)
@@ -1,25 +1,175 @@
 import datetime
+import json
+import math
+import threading
+import time
+
+
+# values json.dumps serializes as they are
+json_scalar_types = frozenset([type(None), bool, int, float, type(u''), type(''), type(2 ** 64)])
 
 
 def json_dumps_converter(o):
-    if isinstance(o, datetime.datetime):
+    '''
+    Serializes what json.dumps can't (pass as its default): datetimes & dates as isoformat, sets as lists
+    '''
+    if isinstance(o, (datetime.date, datetime.time)):
         return o.isoformat()
+    if isinstance(o, (set, frozenset)):
+        return list(o)
     raise TypeError("Unknown type")  # pragma: no cover
 
 
+def to_json(obj, **kwargs):
+    '''
+    Returns obj (e.g. a boto3 response) serialized as JSON; kwargs are passed to json.dumps
+    '''
+    return json.dumps(obj, default=json_dumps_converter, **kwargs)
+
+
+def json_safe(node):
+    '''
+    Returns node as json.dumps serializes it without a default: datetimes & dates as isoformat, tuples & sets as
+    lists. Converts in a single pass without modifying node; only the containers on the path to a converted value
+    are copied, anything else is shared with node
+    '''
+    cls = type(node)
+    if cls in json_scalar_types:
+        return node
+    if cls is dict or isinstance(node, dict):
+        converted = None
+        for (key, item) in node.items():
+            if type(item) in json_scalar_types:
+                continue
+            safe = json_safe(item)
+            if safe is not item:
+                if converted is None:
+                    converted = dict(node)
+                converted[key] = safe
+        return node if converted is None else converted
+    if cls is list or isinstance(node, list):
+        converted = None
+        for (idx, item) in enumerate(node):
+            if type(item) in json_scalar_types:
+                continue
+            safe = json_safe(item)
+            if safe is not item:
+                if converted is None:
+                    converted = list(node)
+                converted[idx] = safe
+        return node if converted is None else converted
+    if isinstance(node, (tuple, set, frozenset)):
+        return [json_safe(x) for x in node]
+    if isinstance(node, (datetime.date, datetime.time)):
+        return node.isoformat()
+    return node
+
+
 def walk_dict_for_datetime(node):
     '''
-    Converts any instance of datetime.datetime to isoformat in a collection
-    '''
-    if type(node) == dict:
-        for key, item in node.items():
-            if type(item) in [dict, list]:
-                walk_dict_for_datetime(item)
-            elif type(item) == datetime.datetime:
-                node[key] = item.isoformat()
-    if type(node) == list:
-        for idx, item in enumerate(node):
-            if type(item) in [dict, list]:
-                walk_dict_for_datetime(item)
-            elif type(item) == datetime.datetime:
-                node[idx] = item.isoformat()
+    Converts any instance of datetime.datetime to isoformat in a collection, in place (see json_safe)
+    '''
+    safe = json_safe(node)
+    if safe is node:
+        return
+    if isinstance(node, dict):
+        node.clear()
+        node.update(safe)
+    elif isinstance(node, list):
+        node[:] = safe
+
+
+def epoch_seconds(timestamp):
+    '''
+    Converts an ISO 8601 UTC timestamp, such as 2018-02-03T20:11:57.103Z, to seconds since the epoch
+    Returns an int; fractions of a second are dropped
+    '''
+    parsed = datetime.datetime.strptime(timestamp[:19], '%Y-%m-%dT%H:%M:%S')
+    return int((parsed - datetime.datetime.utcfromtimestamp(0)).total_seconds())
+
+
+def percentile(samples, pct):
+    '''
+    Returns the pct-th percentile of samples using the nearest-rank method; None if there are no samples
+    '''
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = int(math.ceil(pct / 100.0 * len(ordered)))
+    return ordered[max(rank, 1) - 1]
+
+
+def concurrent_map(func, items, max_workers):
+    '''
+    Calls func for each of items using at most max_workers threads
+    Returns a list of results in the same order as items
+
+    An exception raised by func is returned in place of its result, so one failing item does not affect the others
+    '''
+    items = list(items)
+    results = [None] * len(items)
+    pending = iter(enumerate(items))
+    pending_lock = threading.Lock()
+
+    def worker():
+        while True:
+            with pending_lock:
+                try:
+                    (idx, item) = next(pending)
+                except StopIteration:
+                    return
+            try:
+                results[idx] = func(item)
+            except Exception as e:
+                results[idx] = e
+
+    num_workers = min(max_workers, len(items))
+    if num_workers <= 1:
+        worker()
+        return results
+    threads = [threading.Thread(target=worker) for _ in range(num_workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+class ExpiringCache(object):
+    '''
+    Thread-safe cache whose entries expire ttl seconds after being set
+
+    Entries are held at module scope by callers, so they survive across invocations of a warm Lambda container
+    '''
+
+    def __init__(self, ttl, clock=time.time):
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, max_age=None):
+        '''
+        Returns the cached value of key; None if missing or older than max_age (defaults to ttl) seconds
+        '''
+        max_age = self.ttl if max_age is None else max_age
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or self.clock() - entry[0] >= max_age:
+            return None
+        return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (self.clock(), value)
+        return value
+
+    def invalidate(self, key=None):
+        '''
+        Removes key from the cache; removes every entry if key is None
+        '''
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)